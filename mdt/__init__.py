@@ -33,9 +33,14 @@ from mdt.utils import estimate_noise_std, get_cl_devices, load_input_data,\
     load_samples, load_sample, load_nifti, write_slice_roi, apply_mask_to_file, extract_volumes, \
     get_slice_in_dimension, per_model_logging_context, \
     get_temporary_results_dir, get_example_data, SimpleInitializationData, InitializationData, load_volume_maps,\
-    covariance_to_correlation, check_user_components, unzip_nifti, zip_nifti
-from mdt.lib.sorting import sort_orientations, create_4d_sort_matrix, sort_volumes_per_voxel
-from mdt.simulations import create_signal_estimates, simulate_signals, add_rician_noise
+    covariance_to_correlation, check_user_components, unzip_nifti, zip_nifti, load_covariances
+from mdt.lib.sorting import sort_orientations, sort_orientations_in_directory, create_4d_sort_matrix, \
+    sort_volumes_per_voxel
+from mdt.lib.masking import create_median_otsu_brain_masks
+from mdt.lib.noise_std_estimation import estimate_noise_std_in_slabs
+from mdt.lib.uncertainty import get_packed_covariances, propagate_variance, propagate_uncertainty
+from mdt.simulations import create_signal_estimates, simulate_signals, add_rician_noise, add_noise
+from mdt.lib.simulation_study import run_simulation_study, write_simulation_study_table
 from mdt.lib.batch_utils import run_function_on_batch_fit_output, batch_apply, \
     batch_profile_factory, get_subject_selection
 from mdt.protocols import load_bvec_bval, load_protocol, auto_load_protocol, write_protocol, write_bvec_bval, \
@@ -53,7 +58,7 @@ __maintainer__ = "Robbert Harms"
 __email__ = "robbert.harms@maastrichtuniversity.nl"
 
 
-def get_optimization_inits(model_name, input_data, output_folder, cl_device_ind=None):
+def get_optimization_inits(model_name, input_data, output_folder, cl_device_ind=None, source_fingerprint=None):
     """Get better optimization starting points for the given model.
 
     Since initialization can make quite a difference in optimization results, this function can generate
@@ -81,12 +86,15 @@ def get_optimization_inits(model_name, input_data, output_folder, cl_device_ind=
             model name in it.
         cl_device_ind (int or list): the index of the CL device to use. The index is from the list from the function
             utils.get_cl_devices(). This can also be a list of device indices.
+        source_fingerprint (str): the fingerprint of the input files. Intermediate fits made on other input files
+            are fitted again.
 
     Returns:
         dict: a dictionary with initialization points for the selected model
     """
     from mdt.lib.model_fitting import get_optimization_inits
-    return get_optimization_inits(model_name, input_data, output_folder, cl_device_ind=cl_device_ind)
+    return get_optimization_inits(model_name, input_data, output_folder, cl_device_ind=cl_device_ind,
+                                  source_fingerprint=source_fingerprint)
 
 
 def fit_model(model, input_data, output_folder,
@@ -211,7 +219,7 @@ def sample_model(model, input_data, output_folder, nmr_samples=None, burnin=None
                  method=None, recalculate=False, cl_device_ind=None, double_precision=False,
                  store_samples=True, sample_items_to_save=None, tmp_results_dir=True,
                  initialization_data=None, post_processing=None, post_sampling_cb=None,
-                 sampler_options=None):
+                 sampler_options=None, continue_from=None):
     """Sample a composite model using Markov Chain Monte Carlo sampling.
 
     Args:
@@ -238,8 +246,12 @@ def sample_model(model, input_data, output_folder, nmr_samples=None, burnin=None
         cl_device_ind (int): the index of the CL device to use. The index is from the list from the function
             utils.get_cl_devices().
         double_precision (boolean): if we would like to do the calculations in double precision
-        store_samples (boolean): determines if we store any of the samples. If set to False we will store none
-            of the samples.
+        store_samples (boolean, sequence or :class:`mdt.lib.processing_strategies.SamplesStorageStrategy`): if set to
+            False, we will store none of the samples. If set to True we will save all samples. If set to a sequence we
+            expect a sequence of integer numbers with sample positions to store. Finally, you can also give a subclass
+            instance of :class:`~mdt.lib.processing_strategies.SamplesStorageStrategy` (for example a
+            :class:`mdt.lib.processing_strategies.SaveThinnedSamples` instance). If not all samples are stored, and the
+            active post-processing permits, only the stored samples are kept in memory during sampling.
         sample_items_to_save (list): list of output names we want to store the samples of. If given, we only
             store the items specified in this list. Valid items are the free parameter names of the model and the
             items 'LogLikelihood' and 'LogPrior'.
@@ -265,6 +277,11 @@ def sample_model(model, input_data, output_folder, nmr_samples=None, burnin=None
                 dictionary with as keys dir-/file-names and as values maps to be stored in the results directory.
         sampler_options (dict): specific options for the MCMC routine. These will be provided to the sampling routine
             as additional keyword arguments to the constructor.
+        continue_from (str): the output folder of a previous call to this function. If given, we continue the
+            chains of that run instead of starting new ones. That is, we load the final state of the sampler
+            (chain positions, proposal standard deviations, acceptance counters and random number generator state),
+            draw ``nmr_samples`` new samples without burn-in and append those to the previous samples. This can be
+            the same folder as ``output_folder``. The previous run must have stored all the samples.
 
     Returns:
         dict: if store_samples is True then we return the samples per parameter as a numpy memmap. If store_samples
@@ -311,6 +328,12 @@ def sample_model(model, input_data, output_folder, nmr_samples=None, burnin=None
         if not os.path.isdir(base_dir):
             os.makedirs(base_dir)
 
+        continue_dir = None
+        if continue_from:
+            continue_dir = os.path.join(continue_from, model.name, 'samples')
+            if recalculate and os.path.abspath(continue_dir) == os.path.abspath(base_dir):
+                raise ValueError('Can not recalculate the samples we want to continue from.')
+
         if recalculate:
             shutil.rmtree(base_dir)
 
@@ -327,14 +350,15 @@ def sample_model(model, input_data, output_folder, nmr_samples=None, burnin=None
                                       sample_items_to_save=sample_items_to_save,
                                       initialization_data=initialization_data,
                                       post_sampling_cb=post_sampling_cb,
-                                      sampler_options=sampler_options)
+                                      sampler_options=sampler_options,
+                                      continue_from=continue_dir)
 
 
 def batch_fit(data_folder, models_to_fit, output_folder=None, batch_profile=None,
               subjects_selection=None, recalculate=False,
               cl_device_ind=None, dry_run=False,
               double_precision=False, tmp_results_dir=True,
-              use_gradient_deviations=False):
+              use_gradient_deviations=False, input_data_cache_dir=None, use_manifest_index=False):
     """Run all the available and applicable models on the data in the given folder.
 
     The idea is that a single folder is enough to fit_model the computations. One can optionally give it the
@@ -361,6 +385,13 @@ def batch_fit(data_folder, models_to_fit, output_folder=None, batch_profile=None
         tmp_results_dir (str, True or None): The temporary dir for the calculations. Set to a string to use
                 that path directly, set to True to use the config value, set to None to disable.
         use_gradient_deviations (boolean): if you want to use the gradient deviations if present
+        input_data_cache_dir (str): if given, the directory to use as a persistent cache of the prepared input data
+            of each subject. Re-fitting subjects then memory maps the cached observations instead of reading the DWIs
+            again. See :func:`mdt.utils.load_input_data`.
+        use_manifest_index (boolean): every completed model fit writes a manifest in its output directory, which is
+            used to skip subjects with current outputs and to refit subjects with stale outputs. If this is set, we
+            additionally collect these manifests in a single index file in the output folder, such that checking
+            all subjects requires reading only one file. See :mod:`mdt.lib.fit_manifest`.
     Returns:
         The list of subjects we will calculate / have calculated.
     """
@@ -397,7 +428,8 @@ def batch_fit(data_folder, models_to_fit, output_folder=None, batch_profile=None
     batch_fit_func = get_batch_fitting_function(
         len(subjects), models_to_fit, output_folder, recalculate=recalculate,
         cl_device_ind=cl_device_ind, double_precision=double_precision,
-        tmp_results_dir=tmp_results_dir, use_gradient_deviations=use_gradient_deviations)
+        tmp_results_dir=tmp_results_dir, use_gradient_deviations=use_gradient_deviations,
+        input_data_cache_dir=input_data_cache_dir, use_manifest_index=use_manifest_index)
 
     return batch_apply(data_folder, batch_fit_func, batch_profile=batch_profile, subjects_selection=subjects_selection)
 
@@ -561,6 +593,11 @@ def get_volume_names(directory):
     Returns:
         :class:`list`: A list with the names of the volumes.
     """
+    from mdt.lib.results_container import load_results_container_maps
+    container_maps = load_results_container_maps(directory)
+    if container_maps is not None:
+        return list(sorted(container_maps.keys()))
+
     from mdt.lib.nifti import yield_nifti_info
     return list(sorted(el[1] for el in yield_nifti_info(directory)))
 
@@ -579,6 +616,21 @@ def write_volume_maps(maps, directory, header=None, overwrite_volumes=True, gzip
     write_all_as_nifti(maps, directory, nifti_header=header, overwrite_volumes=overwrite_volumes, gzip=gzip)
 
 
+def export_results_container(container_path, output_dir=None, map_names=None, gzip=True):
+    """Export the maps stored in a results container to separate nifti files.
+
+    See :mod:`mdt.lib.results_container` for details on the results container.
+
+    Args:
+        container_path (str): the path to the container file, or to the model output directory containing it
+        output_dir (str): the directory to write the nifti files to, defaults to the directory of the container
+        map_names (list of str): if given, we only export these maps
+        gzip (boolean): if we want to write the results gzipped
+    """
+    from mdt.lib.results_container import export_results_container
+    export_results_container(container_path, output_dir=output_dir, map_names=map_names, gzip=gzip)
+
+
 def get_models_list():
     """Get a list of all available models, composite and cascade.
 
@@ -103,6 +103,16 @@ class BatchFit(BasicShellApplication):
                             help='The directory for the temporary results. The default ("True") uses the config file '
                                  'setting. Set to the literal "None" to disable.').completer = FilesCompleter()
 
+        parser.add_argument('--input-data-cache-dir', dest='input_data_cache_dir', type=str,
+                            help='If given, a directory to use as a persistent cache of the prepared input data of '
+                                 'each subject. Subsequent runs load the subjects from this cache.'
+                            ).completer = FilesCompleter()
+
+        parser.add_argument('--manifest-index', dest='use_manifest_index', action='store_true',
+                            help='Keep an index of the fit manifests of all subjects in a single file in the output '
+                                 'folder, this speeds up checking which subjects need to be fitted.')
+        parser.set_defaults(use_manifest_index=False)
+
         return parser
 
     def run(self, args, extra_args):
@@ -131,7 +141,9 @@ class BatchFit(BasicShellApplication):
                       double_precision=args.double_precision,
                       dry_run=args.dry_run,
                       tmp_results_dir=tmp_results_dir,
-                      use_gradient_deviations=args.use_gradient_deviations)
+                      use_gradient_deviations=args.use_gradient_deviations,
+                      input_data_cache_dir=args.input_data_cache_dir,
+                      use_manifest_index=args.use_manifest_index)
 
 
 def get_doc_arg_parser():
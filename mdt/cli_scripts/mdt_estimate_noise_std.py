@@ -2,16 +2,26 @@
 # PYTHON_ARGCOMPLETE_OK
 """Estimate the noise standard deviation of the Gaussian noise in the original complex image domain.
 
-The result is a single floating point number with the noise std. for every voxel. It uses the estimation routines
-from the components folders for the estimation. The estimation is the same as the one used in mdt-model-fit, but
-since the noise std estimation depends on the mask used, it is better to call this function beforehand with a
-complete brain mask. Later, the mdt-model-fit routine can be called on smaller masks with as noise std the value
-from this function.
+The result is either a single floating point number with the noise std. for every voxel, or, with --noise-map, a
+volume with a noise std estimate per slab of the data. The default estimation method is the same as the one used in
+mdt-model-fit, but since the noise std estimation depends on the mask used, it is better to call this function
+beforehand with a complete brain mask. Later, the mdt-model-fit routine can be called on smaller masks with as noise
+std the value or the map from this function.
+
+The available methods are:
+
+    - unweighted_std: the mean over the brain mask of the std over the unweighted volumes (default)
+    - unweighted_mad: the median absolute deviation of the unweighted volumes around their mean, in the brain mask
+    - background: the median of the squared signal outside of the brain mask, for Rician or chi distributed noise
+
+The data is read one slab at a time, such that this also works for large datasets.
 """
 import argparse
 import os
+import numpy as np
 import mdt
 from argcomplete.completers import FilesCompleter
+from mdt.lib.noise_std_estimation import estimate_noise_std_in_slabs
 from mdt.lib.shell_utils import BasicShellApplication
 from mot.lib import cl_environments
 import textwrap
@@ -35,6 +45,9 @@ class NoiseStdEstimation(BasicShellApplication):
 
         examples = textwrap.dedent('''
             mdt-estimate-noise-std data.nii.gz data.prtcl full_mask.nii.gz
+            mdt-estimate-noise-std data.nii.gz data.prtcl full_mask.nii.gz -o noise_std.txt
+            mdt-estimate-noise-std data.nii.gz data.prtcl full_mask.nii.gz --method background --nmr-coils 4
+            mdt-estimate-noise-std data.nii.gz data.prtcl full_mask.nii.gz --noise-map -o noise_std.nii.gz
         ''')
         epilog = self._format_examples(doc_parser, examples)
 
@@ -53,16 +66,49 @@ class NoiseStdEstimation(BasicShellApplication):
                             help='the (brain) mask to use').completer = FilesCompleter(['nii', 'gz', 'hdr', 'img'],
                                                                                directories=False)
 
+        parser.add_argument('--method', choices=['unweighted_std', 'unweighted_mad', 'background'],
+                            default='unweighted_std', help='the estimation method (default unweighted_std)')
+
+        parser.add_argument('--nmr-coils', type=int, default=1,
+                            help='the number of coils for the background method, one for Rician noise (default 1)')
+
+        parser.add_argument('--noise-map', action='store_true',
+                            help='estimate a noise std map with one estimate per slab, instead of a single value')
+
+        parser.add_argument('--slab-thickness', type=int, default=8,
+                            help='the number of slices per slab (default 8)')
+
+        parser.add_argument('-o', '--output-file',
+                            help='the file to write the result to, a .txt file for a single value or a nifti file '
+                                 'for a noise map. Defaults to printing the value, or <dwi_name>_noise_std.nii.gz '
+                                 'for a noise map.').completer = FilesCompleter(['txt', 'nii', 'gz'], directories=False)
+
         return parser
 
     def run(self, args, extra_args):
-        input_data = mdt.load_input_data(os.path.realpath(args.dwi),
-                                         os.path.realpath(args.protocol),
-                                         os.path.realpath(args.mask))
+        kwargs = {}
+        if args.method == 'background':
+            kwargs['nmr_coils'] = args.nmr_coils
 
         with mdt.with_logging_to_debug():
-            noise_std = mdt.estimate_noise_std(input_data)
+            noise_std = estimate_noise_std_in_slabs(os.path.realpath(args.dwi),
+                                                    os.path.realpath(args.protocol),
+                                                    os.path.realpath(args.mask),
+                                                    method=args.method, noise_map=args.noise_map,
+                                                    slab_thickness=args.slab_thickness, **kwargs)
+
+        output_file = args.output_file
+        if args.noise_map and not output_file:
+            output_file = os.path.splitext(os.path.realpath(args.dwi))[0].replace('.nii', '') + '_noise_std.nii.gz'
+
+        if not output_file:
             print(noise_std)
+        elif args.noise_map:
+            mdt.write_nifti(noise_std.astype(np.float32), os.path.realpath(output_file),
+                            mdt.load_nifti(os.path.realpath(args.dwi)).header)
+        else:
+            with open(os.path.realpath(output_file), 'w') as f:
+                f.write(str(noise_std))
 
 
 def get_doc_arg_parser():
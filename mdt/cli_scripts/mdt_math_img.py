@@ -34,19 +34,31 @@ used as expression value).
 If no output file is specified and the output is of dimension 2 or lower we print the output directly
 to the console. If the output is a list or tuple instead of an ndarray we will write every element of that
 sequence as a separate file. This will use the indicated file as basename and append an numerical index to it.
+
+For large inputs, the switch --chunked evaluates the expression slab by slab, either along the z axis (the default)
+or along the volume axis (--chunk-axis volume). In this mode the inputs are not loaded completely, only the slabs
+currently being evaluated are in memory, and the output is written incrementally to the output file. The slab size is
+chosen such that the slabs being evaluated fit in the given memory budget (--memory-limit). This requires that the
+expression evaluates every slab independently, for example element-wise expressions or reductions over the volume axis
+(when chunking along z), and that the expression returns an array with the chunked axis intact.
+Gzipped inputs are decompressed once to a temporary directory, such that reading a slab does not require decompressing
+the file up to that slab. Slabs are evaluated in parallel using multiple threads (--nmr-threads).
 """
 import argparse
 import glob
 import os
+import tempfile
 from collections import Sequence
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
 import mdt
 from argcomplete.completers import FilesCompleter
 import textwrap
 
+from mdt.lib.nifti import IncrementalNiftiWriter, nifti_filepath_resolution
 from mdt.lib.shell_utils import BasicShellApplication
-from mdt.utils import split_image_path
+from mdt.utils import split_image_path, unzip_nifti
 
 __author__ = 'Robbert Harms'
 __date__ = "2015-08-18"
@@ -68,6 +80,7 @@ class MathImg(BasicShellApplication):
             mdt-math-img images*.nii.gz mask.nii 'list(map(lambda f: np.mean(mdt.create_roi(f, i[-1])), i[0:-1]))'
             mdt-math-img FA.nii.gz
             mdt-math-img timeseries.nii '[a[..., ind] for ind in range(a.shape[-1])]' -o split.nii
+            mdt-math-img dwi_*.nii.gz 'np.mean(np.concatenate(i, axis=3), axis=3)' -o mean.nii.gz --chunked
            ''')
         epilog = self._format_examples(doc_parser, examples)
 
@@ -97,6 +110,20 @@ class MathImg(BasicShellApplication):
                             help='Add a singleton dimension to all input 3d maps to make them 4d, this prevents '
                                  'some broadcast issues.')
 
+        parser.add_argument('--chunked', action='store_true',
+                            help='Evaluate the expression slab by slab and write the output incrementally. '
+                                 'This implies --write.')
+        parser.set_defaults(chunked=False)
+
+        parser.add_argument('--chunk-axis', choices=['z', 'volume'], default='z',
+                            help='The axis along which to chunk the inputs in chunked mode, defaults to z.')
+
+        parser.add_argument('--memory-limit', type=float, default=1024,
+                            help='The memory budget in MiB for the slabs in chunked mode, defaults to 1024.')
+
+        parser.add_argument('--nmr-threads', type=int,
+                            help='The number of threads to use in chunked mode, defaults to the number of CPUs.')
+
         parser.add_argument('--verbose', '-v', action='store_true', help="Verbose, prints runtime information")
         parser.set_defaults(verbose=False)
 
@@ -104,17 +131,19 @@ class MathImg(BasicShellApplication):
 
     def run(self, args, extra_args):
         file_names = []
-        images = []
         for file in args.input_files:
             globbed = glob.glob(file)
 
             if globbed:
-                for fname in globbed:
-                    file_names.append(fname)
-                    images.append(mdt.load_nifti(os.path.realpath(fname)).get_data())
+                file_names.extend(globbed)
             else:
                 file_names.append(file)
-                images.append(mdt.load_nifti(os.path.realpath(file)).get_data())
+
+        if args.chunked:
+            self._run_chunked(args, file_names)
+            return
+
+        images = [mdt.load_nifti(os.path.realpath(fname)).get_data() for fname in file_names]
 
         if args.verbose:
             print('')
@@ -122,31 +151,16 @@ class MathImg(BasicShellApplication):
         if args.input_4d:
             images = self._images_3d_to_4d(images)
 
-        context_dict = {'input': images, 'i': images, 'np': np, 'mdt': mdt}
-        alpha_chars = list('abcdefghjklmnopqrstuvwxyz')
-
-        for ind, image in enumerate(images):
-            context_dict.update({alpha_chars[ind]: image})
-
-            if args.verbose:
-                print('Input {ind} ({alpha}):'.format(ind=ind, alpha=alpha_chars[ind]))
+        if args.verbose:
+            for ind, image in enumerate(images):
+                print('Input {ind} ({alpha}):'.format(ind=ind, alpha=_ALPHA_CHARS[ind]))
                 print('    name: {}'.format(split_image_path(file_names[ind])[1]))
                 print('    shape: {}'.format(str(image.shape)))
 
-        if args.verbose:
             print('')
             print("Evaluating: '{expr}'".format(expr=args.expr))
 
-        if args.as_expression:
-            output = eval(args.expr, context_dict)
-        else:
-            expr = textwrap.dedent('''
-            def mdt_image_math():
-                {}
-            output = mdt_image_math()
-            ''').format(args.expr)
-            exec(expr, context_dict)
-            output = context_dict['output']
+        output = self._evaluate(args.expr, images, args.as_expression)
 
         if args.verbose:
             print('')
@@ -186,10 +200,110 @@ class MathImg(BasicShellApplication):
 
                 mdt.write_nifti(output, output_file, mdt.load_nifti(file_names[0]).header)
 
+    def _run_chunked(self, args, file_names):
+        """Evaluate the expression slab by slab, writing the output incrementally."""
+        with tempfile.TemporaryDirectory(prefix='mdt-math-img-') as tmp_dir:
+            nifti_images = [self._load_uncompressed(fname, os.path.join(tmp_dir, str(ind)))
+                            for ind, fname in enumerate(file_names)]
+            self._evaluate_chunked(args, file_names, nifti_images)
+
+    def _load_uncompressed(self, fname, tmp_dir):
+        """Load the given nifti file, decompressing gzipped files once to the given temporary directory.
+
+        Reading a slab from a gzipped file requires decompressing the file from the start up to that slab. By
+        decompressing the file once we can read every slab directly from the uncompressed file.
+        """
+        path = nifti_filepath_resolution(os.path.realpath(fname))
+        if path.endswith('.gz'):
+            os.makedirs(tmp_dir)
+            uncompressed_path = os.path.join(tmp_dir, os.path.basename(path)[:-len('.gz')])
+            unzip_nifti(path, uncompressed_path)
+            path = uncompressed_path
+        return mdt.load_nifti(path)
+
+    def _evaluate_chunked(self, args, file_names, nifti_images):
+        """Evaluate the expression on the slabs of the given images and write the output incrementally."""
+        axis = 2 if args.chunk_axis == 'z' else 3
+
+        axis_lengths = {image.shape[axis] for image in nifti_images if len(image.shape) > axis}
+        if len(axis_lengths) != 1:
+            raise ValueError('All inputs with a {} axis should have the same length on that axis.'.format(
+                args.chunk_axis))
+        axis_length = axis_lengths.pop()
+
+        nmr_threads = args.nmr_threads or os.cpu_count() or 1
+        bytes_per_slice = sum(8 * int(np.prod(image.shape)) // image.shape[axis]
+                              for image in nifti_images if len(image.shape) > axis)
+        slab_size = int(np.clip(args.memory_limit * 1024 ** 2 // (2 * nmr_threads * bytes_per_slice),
+                                1, axis_length))
+        slabs = [(start, min(start + slab_size, axis_length)) for start in range(0, axis_length, slab_size)]
+
+        if args.verbose:
+            print('Evaluating "{}" in {} slabs of {} along the {} axis, using {} threads.'.format(
+                args.expr, len(slabs), slab_size, args.chunk_axis, nmr_threads))
+
+        def read_slab(image, start, end):
+            if len(image.shape) <= axis:
+                return np.asarray(image.dataobj)
+            index = [slice(None)] * len(image.shape)
+            index[axis] = slice(start, end)
+            return np.asarray(image.dataobj[tuple(index)])
+
+        def evaluate_slab(slab):
+            images = [read_slab(image, *slab) for image in nifti_images]
+            if args.input_4d:
+                images = self._images_3d_to_4d(images)
+
+            output = self._evaluate(args.expr, images, args.as_expression)
+            if not isinstance(output, np.ndarray) or output.ndim <= axis or output.shape[axis] != slab[1] - slab[0]:
+                raise ValueError('The expression can not be evaluated in chunks, '
+                                 'it should return an array with the {} axis intact.'.format(args.chunk_axis))
+            return output
+
+        output_file = os.path.realpath(args.output_file or file_names[0])
+
+        with ThreadPoolExecutor(max_workers=nmr_threads) as executor:
+            first_output = evaluate_slab(slabs[0])
+            shape = list(first_output.shape)
+            shape[axis] = axis_length
+
+            def write_slab(writer, slab, output):
+                index = [slice(None)] * output.ndim
+                index[axis] = slice(*slab)
+                writer[tuple(index)] = output
+
+            with IncrementalNiftiWriter(output_file, shape, first_output.dtype, nifti_images[0].header) as writer:
+                write_slab(writer, slabs[0], first_output)
+                del first_output
+
+                for batch_start in range(1, len(slabs), nmr_threads):
+                    batch = slabs[batch_start:batch_start + nmr_threads]
+                    for slab, output in zip(batch, executor.map(evaluate_slab, batch)):
+                        write_slab(writer, slab, output)
+
+    def _evaluate(self, expr, images, as_expression):
+        """Evaluate the expression or statement on the given images."""
+        context_dict = {'input': images, 'i': images, 'np': np, 'mdt': mdt}
+        context_dict.update(zip(_ALPHA_CHARS, images))
+
+        if as_expression:
+            return eval(expr, context_dict)
+
+        expr = textwrap.dedent('''
+        def mdt_image_math():
+            {}
+        output = mdt_image_math()
+        ''').format(expr)
+        exec(expr, context_dict)
+        return context_dict['output']
+
     def _images_3d_to_4d(self, images):
         return list([image[..., np.newaxis] if len(image.shape) == 3 else image for image in images])
 
 
+_ALPHA_CHARS = list('abcdefghjklmnopqrstuvwxyz')
+
+
 def get_doc_arg_parser():
     return MathImg().get_documentation_arg_parser()
 
@@ -3,6 +3,7 @@ import os
 from itertools import filterfalse
 
 from mdt.lib.batch_utils import SimpleBatchProfile, BatchFitProtocolLoader, SimpleSubjectInfo
+from mdt.lib.subject_discovery_cache import get_glob_directories
 from mdt.component_templates.base import ComponentBuilder, ComponentTemplate
 
 __author__ = 'Robbert Harms'
@@ -11,6 +12,16 @@ __maintainer__ = "Robbert Harms"
 __email__ = "robbert.harms@maastrichtuniversity.nl"
 
 
+_template_search_attributes = ('subject_base_folder', 'data_fname', 'mask_fname', 'noise_std_fname',
+                               'gradient_deviations_fname', 'protocol_auto_dir', 'protocol_fname', 'bvec_fname',
+                               'bval_fname', 'protocol_columns')
+"""The attributes of the batch profile templates determining which subjects are found, used by the discovery cache."""
+
+_template_path_attributes = ('data_fname', 'mask_fname', 'noise_std_fname', 'gradient_deviations_fname',
+                             'protocol_auto_dir', 'protocol_fname', 'bvec_fname', 'bval_fname')
+"""The path templates of the batch profile templates, expanded per subject."""
+
+
 class BatchProfileBuilder(ComponentBuilder):
 
     def _create_class(self, template):
@@ -24,42 +35,32 @@ class BatchProfileBuilder(ComponentBuilder):
         """
         class AutoCreatedBatchProfile(SimpleBatchProfile):
             def _get_subjects(self, data_folder):
-                dirs = sorted([os.path.basename(f) for f in glob.glob(os.path.join(data_folder, '*'))])
-
                 subjects = []
-                for subject_id in dirs:
-                    subject_base_folder = os.path.join(
-                        data_folder, template.subject_base_folder.format(subject_id=subject_id))
-
-                    def _prepare_path(template_path):
-                        if template_path is None:
-                            return None
-                        return template_path.format(data_folder=data_folder,
-                                                    subject_id=subject_id,
-                                                    subject_base_folder=subject_base_folder)
-
-                    data_glob = glob.glob(_prepare_path(template.data_fname))
+                for subject_id in self._get_subject_ids(data_folder):
+                    subject_base_folder, paths = self._get_search_paths(data_folder, subject_id)
+
+                    data_glob = glob.glob(paths['data_fname'])
                     if not list(data_glob):
-                        break
+                        continue
 
                     noise_std = self._autoload_noise_std(data_folder, subject_id,
-                                                         file_pattern=_prepare_path(template.noise_std_fname))
+                                                         file_pattern=paths['noise_std_fname'])
 
                     protocol_loader = BatchFitProtocolLoader(
-                        _prepare_path(template.protocol_auto_dir),
-                        protocol_fname=_prepare_path(template.protocol_fname),
-                        bvec_fname=_prepare_path(template.bvec_fname),
-                        bval_fname=_prepare_path(template.bval_fname),
+                        paths['protocol_auto_dir'],
+                        protocol_fname=paths['protocol_fname'],
+                        bvec_fname=paths['bvec_fname'],
+                        bval_fname=paths['bval_fname'],
                         protocol_columns=template.protocol_columns)
 
                     mask_fname = None
-                    if list(glob.glob(_prepare_path(template.mask_fname))):
-                        mask_fname = glob.glob(_prepare_path(template.mask_fname))[0]
+                    if list(glob.glob(paths['mask_fname'])):
+                        mask_fname = glob.glob(paths['mask_fname'])[0]
                         data_glob = list(filterfalse(lambda v: v == mask_fname, data_glob))
 
                     grad_dev = None
-                    if list(glob.glob(_prepare_path(template.gradient_deviations_fname))):
-                        grad_dev = glob.glob(_prepare_path(template.gradient_deviations_fname))[0]
+                    if list(glob.glob(paths['gradient_deviations_fname'])):
+                        grad_dev = glob.glob(paths['gradient_deviations_fname'])[0]
                         data_glob = list(filterfalse(lambda v: v == grad_dev, data_glob))
 
                     subjects.append(SimpleSubjectInfo(
@@ -69,9 +70,46 @@ class BatchProfileBuilder(ComponentBuilder):
 
                 return subjects
 
+            def _get_subject_ids(self, data_folder):
+                return sorted([os.path.basename(f) for f in glob.glob(os.path.join(data_folder, '*'))])
+
+            def _get_search_paths(self, data_folder, subject_id):
+                """Get the subject base folder and the expanded path templates of the given subject."""
+                subject_base_folder = os.path.join(
+                    data_folder, template.subject_base_folder.format(subject_id=subject_id))
+
+                def _prepare_path(template_path):
+                    if template_path is None:
+                        return None
+                    return template_path.format(data_folder=data_folder,
+                                                subject_id=subject_id,
+                                                subject_base_folder=subject_base_folder)
+
+                return subject_base_folder, {name: _prepare_path(getattr(template, name)) for name in
+                                             _template_path_attributes}
+
+            def _get_discovery_cache_directories(self, data_folder, subjects):
+                directories = set(super()._get_discovery_cache_directories(data_folder, subjects))
+                for subject_id in self._get_subject_ids(data_folder):
+                    paths = self._get_search_paths(data_folder, subject_id)[1]
+                    if paths['protocol_auto_dir'] is not None:
+                        paths['protocol_auto_dir'] = os.path.join(paths['protocol_auto_dir'], '*')
+                    for path in paths.values():
+                        if path is not None:
+                            directories.update(get_glob_directories(path))
+                return sorted(directories)
+
             def __str__(self):
                 return template.name
 
+            def _get_discovery_cache_identifier(self):
+                return 'BatchProfileTemplate.' + template.name
+
+            def _get_discovery_cache_configuration(self):
+                return super()._get_discovery_cache_configuration() + [
+                    [(name, getattr(template, name)) for name in _template_search_attributes],
+                    [(name, self._get_source_code(method)) for name, method in sorted(template.bound_methods.items())]]
+
         for name, method in template.bound_methods.items():
             setattr(AutoCreatedBatchProfile, name, method)
 
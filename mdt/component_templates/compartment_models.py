@@ -1,11 +1,12 @@
 from copy import deepcopy, copy
 import numpy as np
 from mdt.component_templates.base import ComponentBuilder, ComponentTemplate
-from mdt.lib.components import get_component, has_component
+from mdt.lib.components import get_component, get_template, has_component
 from mdt.models.compartments import DMRICompartmentModelFunction, WeightCompartment, CacheInfo
 from mdt.utils import spherical_to_cartesian
 from mot.lib.cl_function import CLFunction, SimpleCLFunction, SimpleCLFunctionParameter, SimpleCLCodeObject
-from mdt.model_building.parameters import CurrentObservationParam, DataCacheParameter, NoiseStdInputParameter
+from mdt.model_building.parameters import CurrentObservationParam, DataCacheParameter, NoiseStdInputParameter, \
+    DerivedProtocolParameter
 
 __author__ = 'Robbert Harms'
 __date__ = "2017-02-14"
@@ -27,7 +28,13 @@ class CompartmentBuilder(ComponentBuilder):
         class AutoCreatedDMRICompartmentModel(DMRICompartmentModelFunction):
 
             def __init__(self, nickname=None):
+                precomputed_values = _resolve_precomputed_values(template.precompute)
+
                 parameters = _resolve_parameters(template.parameters, template.name)
+                parameters.extend(DerivedProtocolParameter(*column) for column in template.protocol_columns)
+                if precomputed_values and not any(isinstance(p, DataCacheParameter) for p in parameters):
+                    parameters.append(DataCacheParameter(template.name, 'cache'))
+
                 dependencies = _resolve_dependencies(template.dependencies)
 
                 if template.cl_extra:
@@ -44,7 +51,7 @@ class CompartmentBuilder(ComponentBuilder):
                     template.return_type,
                     template.name,
                     parameters,
-                    template.cl_code,
+                    _add_precomputed_values_loading_code(template.cl_code, precomputed_values),
                     dependencies=dependencies,
                     model_function_priors=_resolve_prior(template.extra_prior, template.name,
                                                          [p.name for p in parameters]),
@@ -53,7 +60,7 @@ class CompartmentBuilder(ComponentBuilder):
                     extra_sampling_maps_funcs= builder._get_extra_sampling_map_funcs(template, parameters),
                     proposal_callbacks=builder._get_proposal_callbacks(template, parameters),
                     nickname=nickname,
-                    cache_info=builder._get_cache_info(template))
+                    cache_info=builder._get_cache_info(template, precomputed_values))
 
         for name, method in template.bound_methods.items():
             setattr(AutoCreatedDMRICompartmentModel, name, method)
@@ -133,12 +140,14 @@ class CompartmentBuilder(ComponentBuilder):
 
         return callbacks
 
-    def _get_cache_info(self, template):
-        if template.cache_info is None:
+    def _get_cache_info(self, template, precomputed_values):
+        if template.cache_info is None and not precomputed_values:
             return None
 
-        fields = []
-        for field in template.cache_info['fields']:
+        cache_info = template.cache_info or {'fields': [], 'cl_code': ''}
+
+        fields = [(ctype, name, nmr_elements) for ctype, name, nmr_elements, _ in precomputed_values]
+        for field in cache_info['fields']:
             if isinstance(field, str):
                 param = SimpleCLFunctionParameter(field)
 
@@ -155,15 +164,24 @@ class CompartmentBuilder(ComponentBuilder):
 
             fields.append((ctype, name, nmr_elements))
 
-        if template.cache_info.get('use_local_reduction', True):
-            cl_code = '''
+        cl_code = ''
+        if precomputed_values:
+            cl_code += '''
                 if(get_local_id(0) == 0){{
                     {}
                 }}
                 barrier(CLK_LOCAL_MEM_FENCE);
-            '''.format(template.cache_info['cl_code'])
+            '''.format(_get_precomputed_values_init_code(precomputed_values))
+
+        if cache_info.get('use_local_reduction', True) and cache_info['cl_code'].strip():
+            cl_code += '''
+                if(get_local_id(0) == 0){{
+                    {}
+                }}
+                barrier(CLK_LOCAL_MEM_FENCE);
+            '''.format(cache_info['cl_code'])
         else:
-            cl_code = template.cache_info['cl_code']
+            cl_code += cache_info['cl_code']
 
         return CacheInfo(fields, cl_code)
 
@@ -296,6 +314,31 @@ class CompartmentTemplate(ComponentTemplate):
             to a variable using the cache. An optional element in the cache info is "use_local_reduction"
             which specifies that for this compartment we use all workitems in the workgroup. If not set, or if False,
             we will execute the cache CL code only for the first work item. The default is True.
+
+        precompute (list): subexpressions of the CL code which only depend on the free parameters of this compartment
+            and not on the observation. These are computed once per evaluation of the model, instead of once per
+            observation, and shared among all observations. Each element should either be a string like
+            ``'float4 direction = SphericalToCartesian(theta, phi)'`` with a declaration and an expression, or a tuple
+            with a declaration and a piece of CL code assigning the value, like
+            ``('double coeffs[7]', 'NODDI_WatsonSHCoeff(kappa, coeffs);')``. The latter is needed for arrays.
+            The expressions can use the free parameters of this compartment, the precomputed values declared before it
+            and the functions in ``dependencies``. In ``cl_code``, the precomputed values are available as local
+            variables with the declared names.
+
+            The values are stored in the data cache of this compartment, as such, using this adds the ``@cache``
+            parameter if not already present. This also means that compartments using this can not be used as a
+            dependency of other compartments, these should call the library functions directly instead.
+
+        protocol_columns (list): protocol derived values, computed once in NumPy when the kernel data is created,
+            instead of in the CL code for every evaluation of the model. Each element should be a tuple with a
+            declaration and a Python function, like ``('double q', lambda G, delta: G * delta)``. The arguments of the
+            function are filled with the protocol values of the same name. The computed values are available in
+            ``cl_code`` under the declared name, as a protocol parameter of this compartment. Since the names are shared
+            between all compartments of a model, the names should be unique, for example by prefixing them with the
+            compartment name. These values are computed from the protocol as given. If the value depends on the
+            gradient amplitude, add the power of the gradient amplitude as third element of the tuple, like
+            ``('double q', lambda G, delta: G * delta, 1)``, such that the gradient deviations scale the values
+            accordingly.
     """
     _component_type = 'compartment_models'
     _builder = CompartmentBuilder()
@@ -313,6 +356,8 @@ class CompartmentTemplate(ComponentTemplate):
     extra_sampling_maps = []
     spherical_parameters = ('theta', 'phi')
     cache_info = None
+    precompute = []
+    protocol_columns = []
 
 
 class WeightCompartmentTemplate(ComponentTemplate):
@@ -353,6 +398,10 @@ def _resolve_dependencies(dependencies):
             if has_component('library_functions', dependency):
                 result.append(get_component('library_functions', dependency)())
             else:
+                if _uses_precomputed_values(dependency):
+                    raise ValueError('The compartment "{}" uses precomputed values and can not be used as a dependency '
+                                     'of other compartments, please depend on the library functions '
+                                     'it uses instead.'.format(dependency))
                 result.append(get_component('compartment_models', dependency)())
         else:
             result.append(dependency)
@@ -360,6 +409,80 @@ def _resolve_dependencies(dependencies):
     return result
 
 
+def _uses_precomputed_values(compartment_name):
+    """Check if the compartment with the given name was created from a template with precomputed values."""
+    try:
+        return bool(getattr(get_template('compartment_models', compartment_name), 'precompute', None))
+    except ValueError:
+        return False
+
+
+def _resolve_precomputed_values(precompute):
+    """Parse the precomputed values of a compartment template.
+
+    Args:
+        precompute (list): the list of precomputed values, see :class:`CompartmentTemplate` for the syntax.
+
+    Returns:
+        List[Tuple[str, str, int, str]]: per precomputed value the ctype, the name, the number of elements and
+            the CL code assigning the value.
+    """
+    values = []
+    for item in precompute:
+        if isinstance(item, str):
+            if '=' not in item:
+                raise ValueError('The precomputed value "{}" should be of the form '
+                                 '"<declaration> = <expression>".'.format(item))
+            declaration, expression = item.split('=', 1)
+            param = SimpleCLFunctionParameter(declaration.strip())
+
+            if param.is_array_type:
+                raise ValueError('The precomputed array "{}" should be given as a tuple with '
+                                 'a declaration and CL code.'.format(param.name))
+            cl_code = '{} = {};'.format(param.name, expression.strip())
+        else:
+            declaration, cl_code = item
+            param = SimpleCLFunctionParameter(declaration)
+
+        nmr_elements = 1
+        if param.is_array_type:
+            nmr_elements = int(np.prod(param.array_sizes))
+
+        values.append((param.ctype, param.name, nmr_elements, cl_code))
+    return values
+
+
+def _get_precomputed_values_init_code(precomputed_values):
+    """Get the CL code computing the precomputed values and storing them in the data cache."""
+    declarations = []
+    assignments = []
+    stores = []
+    for ctype, name, nmr_elements, cl_code in precomputed_values:
+        if nmr_elements > 1:
+            declarations.append('{} {}[{}];'.format(ctype, name, nmr_elements))
+            stores.append('for(uint i = 0; i < {0}; i++){{ cache->{1}[i] = {1}[i]; }}'.format(nmr_elements, name))
+        else:
+            declarations.append('{} {};'.format(ctype, name))
+            stores.append('*cache->{0} = {0};'.format(name))
+        assignments.append(cl_code)
+    return '\n'.join(declarations + assignments + stores)
+
+
+def _add_precomputed_values_loading_code(cl_code, precomputed_values):
+    """Prepend the CL code loading the precomputed values from the data cache into local variables."""
+    if not precomputed_values:
+        return cl_code
+
+    lines = []
+    for ctype, name, nmr_elements, _ in precomputed_values:
+        if nmr_elements > 1:
+            lines.append('{0} {1}[{2}];\nfor(uint i = 0; i < {2}; i++){{ {1}[i] = cache->{1}[i]; }}'.format(
+                ctype, name, nmr_elements))
+        else:
+            lines.append('const {0} {1} = *cache->{1};'.format(ctype, name))
+    return '\n'.join(lines) + '\n' + cl_code
+
+
 def _resolve_prior(prior, compartment_name, compartment_parameters):
     """Create a proper prior out of the given prior information.
 
@@ -8,6 +8,7 @@ from mdt.lib.components import get_component
 from mdt.models.composite import DMRICompositeModel
 from mot.lib.cl_function import CLFunction, SimpleCLFunction
 from mdt.model_building.trees import CompartmentModelTree
+from mdt.utils import PackedCovariances
 import collections
 
 __author__ = 'Robbert Harms'
@@ -355,7 +356,9 @@ def _get_model_extra_optimization_maps_funcs(compartments):
         def get_compartment_specific_results(results):
             maps = {k[len(compartment_name) + 1:]: v for k, v in results.items() if k.startswith(compartment_name)}
 
-            if 'covariances' in results and results['covariances'] is not None:
+            if isinstance(results.get('covariances', None), PackedCovariances):
+                maps['covariances'] = results['covariances'].get_compartment_covariances(compartment_name)
+            elif 'covariances' in results and results['covariances'] is not None:
                 p = re.compile(compartment_name + r'\.\w+_to_' + compartment_name + r'\.\w+')
                 maps['covariances'] = {k.replace(compartment_name + '.', ''): v
                                        for k, v in results['covariances'].items() if p.match(k)}
@@ -1,5 +1,6 @@
 from copy import deepcopy
 from mdt.component_templates.base import ComponentBuilder, ComponentTemplate
+from mdt.configuration import use_lookup_tables
 from mot.lib.cl_function import SimpleCLFunction, SimpleCLCodeObject
 from mdt.model_building.parameters import LibraryParameter
 from mdt.lib.components import get_component
@@ -23,6 +24,7 @@ class LibraryFunctionsBuilder(ComponentBuilder):
             class AutoCreatedLibraryFunction(CLLibrary, SimpleCLFunction):
                 def __init__(self):
                     dependencies = _resolve_dependencies(template.dependencies)
+                    dependencies.extend(_resolve_lookup_tables(template.lookup_tables))
 
                     if template.cl_extra:
                         extra_code = '''
@@ -55,6 +57,9 @@ class LibraryFunctionsBuilder(ComponentBuilder):
                     '''.format(inclusion_guard_name='INCLUDE_GUARD_{}'.format(template.name),
                                cl_code=str)
 
+                    for table_code in _resolve_lookup_tables(template.lookup_tables):
+                        cl_code = table_code.get_cl_code() + cl_code
+
                     super().__init__(cl_code)
 
         for name, method in template.bound_methods.items():
@@ -81,6 +86,9 @@ class LibraryFunctionTemplate(ComponentTemplate):
             resolved as library functions.
         is_function (boolean): set to False to disable the automatic generation of a function signature.
             Use this for macro or typedef only libraries.
+        lookup_tables (list): list of :class:`~mdt.lib.lookup_tables.LookupTable` instances with precomputed
+            function values. For every table, a CL function with the name of the table is made available to the
+            CL code of this library function, see :mod:`mdt.lib.lookup_tables` for details.
     """
     _component_type = 'library_functions'
     _builder = LibraryFunctionsBuilder()
@@ -93,6 +101,7 @@ class LibraryFunctionTemplate(ComponentTemplate):
     cl_extra = None
     dependencies = []
     is_function = True
+    lookup_tables = []
 
 
 def _resolve_dependencies(dependencies):
@@ -117,6 +126,30 @@ def _resolve_dependencies(dependencies):
     return result
 
 
+def _resolve_lookup_tables(lookup_tables):
+    """Get the CL code objects of the given lookup tables.
+
+    If the use of lookup tables is disabled in the configuration, the generated lookup functions always return false,
+    such that the library functions use their exact computations.
+
+    Args:
+        lookup_tables (list of mdt.lib.lookup_tables.LookupTable): the lookup tables to resolve
+
+    Returns:
+        list of SimpleCLCodeObject: the CL code of the lookup tables, with inclusion guards
+    """
+    code_objects = []
+    for table in lookup_tables:
+        code_objects.append(SimpleCLCodeObject('''
+            #ifndef {inclusion_guard_name}
+            #define {inclusion_guard_name}
+            {cl_code}
+            #endif // {inclusion_guard_name}
+        '''.format(inclusion_guard_name='INCLUDE_GUARD_{}'.format(table.name),
+                   cl_code=table.get_cl_code(use_table=use_lookup_tables()))))
+    return code_objects
+
+
 def _resolve_parameters(parameter_list):
     """Convert all the parameters in the given parameter list to actual parameter objects.
 
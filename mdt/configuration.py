@@ -258,6 +258,9 @@ class OutputFormatLoader(ConfigSectionLoader):
             if 'gzip' in options:
                 _config_insert(['output_format', item, 'gzip'], bool(options['gzip']))
 
+            if 'container' in options:
+                _config_insert(['output_format', item, 'container'], bool(options['container']))
+
 
 class LoggingLoader(ConfigSectionLoader):
     """Loader for the top level key logging. """
@@ -347,6 +350,41 @@ class AutomaticCascadeModels(ConfigSectionLoader):
         _config_insert(['auto_generate_cascade_models', 'excluded'], value.get('excluded', []))
 
 
+class NumpyBackendLoader(ConfigSectionLoader):
+    """Load the settings of the NumPy compute backend."""
+
+    def load(self, value):
+        _config_insert(['numpy_backend', 'enabled'], bool(value.get('enabled', False)))
+        _config_insert(['numpy_backend', 'max_nmr_voxels'], int(value.get('max_nmr_voxels', 500)))
+
+
+class LookupTablesLoader(ConfigSectionLoader):
+    """Load the settings of the lookup tables of the library functions."""
+
+    def load(self, value):
+        _config_insert(['lookup_tables', 'enabled'], bool(value.get('enabled', False)))
+
+
+class DKIMeasuresLoader(ConfigSectionLoader):
+    """Load the settings of the computation of the DKI measures."""
+
+    def load(self, value):
+        method = value.get('method', 'closed_form')
+        if method not in ('quadrature', 'closed_form'):
+            raise ValueError('The DKI measures method should be "quadrature" or "closed_form", '
+                             '"{}" given.'.format(method))
+        _config_insert(['dki_measures', 'method'], method)
+        _config_insert(['dki_measures', 'quadrature_order'], int(value.get('quadrature_order', 16)))
+
+
+class SubjectDiscoveryCacheLoader(ConfigSectionLoader):
+    """Load the settings of the cache of the subjects found by the batch profiles."""
+
+    def load(self, value):
+        _config_insert(['subject_discovery_cache', 'enabled'], bool(value.get('enabled', False)))
+        _config_insert(['subject_discovery_cache', 'location'], value.get('location', None))
+
+
 class RuntimeSettingsLoader(ConfigSectionLoader):
 
     def load(self, value):
@@ -400,6 +438,18 @@ def get_section_loader(section):
     if section == 'active_post_processing':
         return ActivePostProcessingLoader()
 
+    if section == 'numpy_backend':
+        return NumpyBackendLoader()
+
+    if section == 'subject_discovery_cache':
+        return SubjectDiscoveryCacheLoader()
+
+    if section == 'lookup_tables':
+        return LookupTablesLoader()
+
+    if section == 'dki_measures':
+        return DKIMeasuresLoader()
+
     raise ValueError('Could not find a suitable configuration loader for the section {}.'.format(section))
 
 
@@ -421,6 +471,26 @@ def gzip_sampling_results():
     return _config['output_format']['sampling']['gzip']
 
 
+def use_results_container_for_optimization():
+    """Check if we should write the volume maps from the optimization to a single results container file.
+
+    Returns:
+        boolean: True if the results of optimization computations should be written to a results container,
+            False if they should be written as separate nifti files.
+    """
+    return _config['output_format']['optimization']['container']
+
+
+def use_results_container_for_sampling():
+    """Check if we should write the volume maps from the sampling to a single results container file.
+
+    Returns:
+        boolean: True if the results of sample computations should be written to a results container,
+            False if they should be written as separate nifti files.
+    """
+    return _config['output_format']['sampling']['container']
+
+
 def get_tmp_results_dir():
     """Get the default tmp results directory.
 
@@ -461,6 +531,54 @@ def get_processing_strategy(processing_type, *args, **kwargs):
     return VoxelRange(*args, **options)
 
 
+def use_numpy_backend(nmr_voxels):
+    """Check if we should try to use the NumPy compute backend for a problem of the given size.
+
+    Even if this returns True, the NumPy backend is only used if the model is supported by the backend.
+
+    Args:
+        nmr_voxels (int): the number of voxels we want to process
+
+    Returns:
+        boolean: True if the NumPy backend is enabled and the number of voxels is within the limit, False otherwise.
+    """
+    return _config['numpy_backend']['enabled'] and nmr_voxels <= _config['numpy_backend']['max_nmr_voxels']
+
+
+def use_lookup_tables():
+    """Check if the library functions should use their precomputed lookup tables.
+
+    Returns:
+        boolean: True if the library functions can interpolate in lookup tables, False if they should always use the
+            exact computations.
+    """
+    return _config['lookup_tables']['enabled']
+
+
+def get_dki_measures_settings():
+    """Get the settings for computing the DKI measures (MK, AK and RK).
+
+    Returns:
+        dict: the keyword arguments for :meth:`mdt.lib.post_processing.DKIMeasures.compute_measures`, that is,
+            the 'method' and the 'quadrature_order'.
+    """
+    return {'method': _config['dki_measures']['method'],
+            'quadrature_order': _config['dki_measures']['quadrature_order']}
+
+
+def get_subject_discovery_cache_dir():
+    """Get the directory of the cache of the subjects found by the batch profiles.
+
+    Returns:
+        str or None: the directory of the subject discovery cache, or None if this cache is disabled.
+    """
+    if not _config['subject_discovery_cache']['enabled']:
+        return None
+    if _config['subject_discovery_cache']['location']:
+        return _config['subject_discovery_cache']['location']
+    return os.path.join(get_config_dir(), 'cache', 'subject_discovery')
+
+
 def get_logging_configuration_dict():
     """Get the configuration dictionary for the logging.dictConfig().
 
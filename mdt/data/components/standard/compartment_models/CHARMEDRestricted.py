@@ -11,7 +11,7 @@ class CHARMEDRestricted(CompartmentTemplate):
     parameters = ('g', 'b', 'G', 'Delta', 'delta', 'TE', 'd', 'theta', 'phi')
     dependencies = ('SphericalToCartesian', 'NeumanCylinderLongApprox')
     cl_code = '''
-        double direction_2 = pown(dot(g, SphericalToCartesian(theta, phi)), 2);
+        double direction_2 = pown(dot(g, direction), 2);
         double signal_par = -b * d * direction_2;
         
         float weights[] = {0.021184720085574, 0.107169623942214, 0.194400551313197,
@@ -29,3 +29,4 @@ class CHARMEDRestricted(CompartmentTemplate):
         
         return sum;
     '''
+    precompute = ['float4 direction = SphericalToCartesian(theta, phi)']
@@ -11,10 +11,11 @@ class CylinderGPD(CompartmentTemplate):
     parameters = ('g', 'b', 'G', 'Delta', 'delta', 'd', 'theta', 'phi', 'R')
     dependencies = ('VanGelderenCylinder', 'SphericalToCartesian')
     cl_code = '''
-        double direction_2 = pown(dot(g, SphericalToCartesian(theta, phi)), 2);
+        double direction_2 = pown(dot(g, direction), 2);
 
         double signal_par = -b * d * direction_2;
         double signal_perp = (1 - direction_2) * VanGelderenCylinder(G, Delta, delta, d, R);
 
         return exp(signal_perp + signal_par);
     '''
+    precompute = ['float4 direction = SphericalToCartesian(theta, phi)']
@@ -16,7 +16,7 @@ class GDRCylinders(CompartmentTemplate):
         uint nmr_radii = 16;
         double radius_spacing = (*cache->upper_radius - *cache->lower_radius) / nmr_radii;
 
-        double direction_2 = pown(dot(g, SphericalToCartesian(theta, phi)), 2);
+        double direction_2 = pown(dot(g, direction), 2);
         double diffusivity_par = -b * d * direction_2;
 
         double radius;
@@ -33,6 +33,7 @@ class GDRCylinders(CompartmentTemplate):
         }
         return signal_sum / weight_sum;
     '''
+    precompute = ['float4 direction = SphericalToCartesian(theta, phi)']
     cache_info = {
         'fields': ['double lower_radius',
                    'double upper_radius',
@@ -86,16 +86,16 @@ def get_parameters():
 class KurtosisTensor(CompartmentTemplate):
 
     parameters = get_parameters()
-    dependencies = ['TensorApparentDiffusion', 'KurtosisMultiplication']
+    dependencies = ['TensorSphericalToCartesian', 'KurtosisMultiplication']
     cl_code = '''
-        double adc = TensorApparentDiffusion(theta, phi, psi, d, dperp0, dperp1, g);
+        double adc = d *      pown(dot(vec[0], g), 2) +
+                     dperp0 * pown(dot(vec[1], g), 2) +
+                     dperp1 * pown(dot(vec[2], g), 2);
 
         if(adc <= 0.0){
             return 1;
         }
 
-        double tensor_md_2 = pown((d + dperp0 + dperp1) / 3.0, 2);
-
         double kurtosis_sum = KurtosisMultiplication(
             W_0000, W_1111, W_2222, W_1000, W_2000, W_1110,
             W_2220, W_2111, W_2221, W_1100, W_2200, W_2211,
@@ -107,6 +107,8 @@ class KurtosisTensor(CompartmentTemplate):
 
         return exp(-b*adc + (b*b)/6.0 * tensor_md_2 * kurtosis_sum);
     '''
+    precompute = [('float4 vec[3]', 'TensorSphericalToCartesian(theta, phi, psi, vec, vec + 1, vec + 2);'),
+                  'double tensor_md_2 = pown((d + dperp0 + dperp1) / 3.0, 2)']
 
     extra_prior = 'return dperp1 < dperp0 && dperp0 < d;'
 
@@ -13,43 +13,60 @@ class NODDI_EC(CompartmentTemplate):
     This is the compartment as described in Gary Zhang's papers, with the exponent model outside the integral.
     """
     parameters = ('g', 'b', 'd', 'dperp0', 'theta', 'phi', 'kappa')
-    dependencies = ('NODDI_WatsonHinderedDiffusionCoeff', 'Zeppelin')
+    dependencies = ('NODDI_WatsonHinderedDiffusionCoeff', 'SphericalToCartesian')
     cl_code = '''
-        NODDI_WatsonHinderedDiffusionCoeff(&d, &dperp0, kappa);
-        return Zeppelin(g, b, d, dperp0, theta, phi);
+        return exp(-b * (((dw[0] - dw[1]) * pown(dot(g, direction), 2)) + dw[1]));
     '''
+    precompute = ['float4 direction = SphericalToCartesian(theta, phi)',
+                  ('mot_float_type dw[2]', '''
+                        dw[0] = d;
+                        dw[1] = dperp0;
+                        NODDI_WatsonHinderedDiffusionCoeff(dw, dw + 1, kappa);
+                   ''')]
 
 
 class NODDI_EC_Integration(CompartmentTemplate):
     """Extra-Cellular NODDI with the compartment inside the integration instead of outside."""
     parameters = ('g', 'b', 'd', 'dperp0', 'theta', 'phi', 'kappa')
-    dependencies = ('NODDI_SphericalHarmonicsIntegral', 'SphericalToCartesian')
+    dependencies = ('NODDI_SphericalHarmonicsIntegralFromSHCoeff', 'NODDI_WatsonSHCoeff', 'SphericalToCartesian')
     cl_code = '''
-        return exp(-b * dperp0) * NODDI_SphericalHarmonicsIntegral(dot(g, SphericalToCartesian(theta, phi)), 
-                                                                   -b * (d - dperp0), kappa);
+        return exp(-b * dperp0) * NODDI_SphericalHarmonicsIntegralFromSHCoeff(
+            dot(g, direction), -b * (d - dperp0), watson_sh_coeff);
     '''
+    precompute = ['float4 direction = SphericalToCartesian(theta, phi)',
+                  ('double watson_sh_coeff[7]', 'NODDI_WatsonSHCoeff(kappa, watson_sh_coeff);')]
 
 
 class NODDI_IC(CompartmentTemplate):
     """Generate the compartment model signal for the NODDI Intra Cellular (Stick with dispersion) compartment."""
     parameters = ('g', 'b', 'd', 'theta', 'phi', 'kappa')
-    dependencies = ('NODDI_SphericalHarmonicsIntegral', 'SphericalToCartesian')
+    dependencies = ('NODDI_SphericalHarmonicsIntegralFromSHCoeff', 'NODDI_WatsonSHCoeff', 'SphericalToCartesian')
     cl_code = '''
-        return NODDI_SphericalHarmonicsIntegral(dot(g, SphericalToCartesian(theta, phi)), -b*d, kappa);
+        return NODDI_SphericalHarmonicsIntegralFromSHCoeff(dot(g, direction), -b*d, watson_sh_coeff);
     '''
+    precompute = ['float4 direction = SphericalToCartesian(theta, phi)',
+                  ('double watson_sh_coeff[7]', 'NODDI_WatsonSHCoeff(kappa, watson_sh_coeff);')]
 
 
 class BinghamNODDI_EN(CompartmentTemplate):
-    """The Extra-Neurite tissue model of Bingham NODDI."""
+    """The Extra-Neurite tissue model of Bingham NODDI.
+
+    The derivatives of the normalization constant are computed using finite differences of the direct saddlepoint
+    approximation, instead of the lookup table interpolation, since finite differences amplify interpolation errors.
+    """
     parameters = ('g', 'b', 'd', 'dperp0', 'theta', 'phi', 'psi', 'k1', 'kw', '@cache')
-    dependencies = ['ConfluentHyperGeometricFirstKind', 'SphericalToCartesian', 'Tensor']
+    dependencies = ['ConfluentHyperGeometricFirstKind', 'TensorSphericalToCartesian']
     cl_code = '''
         double d_mu_1 = dperp0 + (d - dperp0) * *cache->diff_kappa;
         double d_mu_2 = dperp0 + (d - dperp0) * *cache->diff_beta;
         double d_mu_3 = d + 2*dperp0 - d_mu_1 - d_mu_2;
 
-        return Tensor(g, b, d_mu_1, d_mu_2, d_mu_3, theta, phi, psi);
+        double adc = d_mu_1 * pown(dot(vec[0], g), 2) +
+                     d_mu_2 * pown(dot(vec[1], g), 2) +
+                     d_mu_3 * pown(dot(vec[2], g), 2);
+        return exp(-b * adc);
     '''
+    precompute = [('float4 vec[3]', 'TensorSphericalToCartesian(theta, phi, psi, vec, vec + 1, vec + 2);')]
     cache_info = {
         'fields': ['double diff_kappa',
                    'double diff_beta'],
@@ -58,14 +75,14 @@ class BinghamNODDI_EN(CompartmentTemplate):
             double beta = k1 / kw;
 
             double DELTA = 1e-4;
-            double normalization_constant = ConfluentHyperGeometricFirstKind(-kappa, -beta, 0);
+            double normalization_constant = ConfluentHyperGeometricFirstKind_saddlepoint(-kappa, -beta, 0);
 
-            *cache->diff_kappa = (ConfluentHyperGeometricFirstKind(-(kappa+DELTA), -beta, 0) -
-                                  ConfluentHyperGeometricFirstKind(-(kappa-DELTA), -beta, 0))
+            *cache->diff_kappa = (ConfluentHyperGeometricFirstKind_saddlepoint(-(kappa+DELTA), -beta, 0) -
+                                  ConfluentHyperGeometricFirstKind_saddlepoint(-(kappa-DELTA), -beta, 0))
                                   / (2*DELTA) / normalization_constant;
 
-            *cache->diff_beta = (ConfluentHyperGeometricFirstKind(-kappa, -(beta+DELTA), 0) -
-                                 ConfluentHyperGeometricFirstKind(-kappa, -(beta-DELTA), 0))
+            *cache->diff_beta = (ConfluentHyperGeometricFirstKind_saddlepoint(-kappa, -(beta+DELTA), 0) -
+                                 ConfluentHyperGeometricFirstKind_saddlepoint(-kappa, -(beta-DELTA), 0))
                                  / (2*DELTA) / normalization_constant;
         '''
     }
@@ -78,17 +95,14 @@ class BinghamNODDI_IN(CompartmentTemplate):
     cl_code = '''
         double kappa = k1;
         double beta = k1 / kw;
-    
-        float4 v1, v2, v3;
-        TensorSphericalToCartesian(theta, phi, psi, &v1, &v2, &v3);
 
         double Q[6]; // upper triangular
-        Q[0] = pown(dot(g, v3), 2) * (-b * d);
-        Q[1] = dot(g, v3) * dot(g, v2) * (-b * d);
-        Q[2] = dot(g, v3) * dot(g, v1) * (-b * d);
-        Q[3] = pown(dot(g, v2), 2) * (-b * d);
-        Q[4] = dot(g, v2) * dot(g, v1) * (-b * d);
-        Q[5] = pown(dot(g, v1), 2) * (-b * d);
+        Q[0] = pown(dot(g, vec[2]), 2) * (-b * d);
+        Q[1] = dot(g, vec[2]) * dot(g, vec[1]) * (-b * d);
+        Q[2] = dot(g, vec[2]) * dot(g, vec[0]) * (-b * d);
+        Q[3] = pown(dot(g, vec[1]), 2) * (-b * d);
+        Q[4] = dot(g, vec[1]) * dot(g, vec[0]) * (-b * d);
+        Q[5] = pown(dot(g, vec[0]), 2) * (-b * d);
 
         Q[3] += beta;
         Q[5] += kappa;
@@ -98,6 +112,7 @@ class BinghamNODDI_IN(CompartmentTemplate):
 
         return ConfluentHyperGeometricFirstKind(-e[0], -e[1], -e[2]) / *cache->denom;
     '''
+    precompute = [('float4 vec[3]', 'TensorSphericalToCartesian(theta, phi, psi, vec, vec + 1, vec + 2);')]
     cache_info = {
         'fields': ['double denom'],
         'cl_code': '''
@@ -8,35 +8,51 @@ __email__ = 'robbert.harms@maastrichtuniversity.nl'
 __licence__ = 'LGPL v3'
 
 
+GAMMA_H = 267.5987E6
+"""The gyromagnetic ratio of hydrogen in radians s^-1 T^-1, the same as in the ``MRIConstants`` library."""
+
+_ssfp_protocol_columns = [
+    ('double SSFP_b', lambda G, delta, TR: (GAMMA_H * G * delta) ** 2 * TR, 2),
+    ('double SSFP_beta', lambda G, delta: (GAMMA_H * G * delta) ** 2 * delta, 2)
+]
+"""The diffusion weighting terms of the SSFP models, these only depend on the protocol and scale with G squared."""
+
+
 class SSFP_Ball(CompartmentTemplate):
 
-    parameters = ('d', 'delta', 'G', 'TR', 'flip_angle', 'b1', 'T1', 'T2')
-    dependencies = ('SSFP',)
+    parameters = ('d', 'TR', 'flip_angle', 'b1', 'T1', 'T2')
+    protocol_columns = _ssfp_protocol_columns
+    dependencies = ('SSFPFromDiffusionWeighting',)
     cl_code = '''
-        return SSFP(d, delta, G, TR, flip_angle, b1, T1, T2);
+        return SSFPFromDiffusionWeighting(d, SSFP_b, SSFP_beta, TR, flip_angle, b1, T1, T2);
     '''
 
 
 class SSFP_Stick(CompartmentTemplate):
 
-    parameters = ('g', 'd', 'theta', 'phi', 'delta', 'G', 'TR', 'flip_angle', 'b1', 'T1', 'T2')
-    dependencies = ('SSFP',)
+    parameters = ('g', 'd', 'theta', 'phi', 'TR', 'flip_angle', 'b1', 'T1', 'T2')
+    protocol_columns = _ssfp_protocol_columns
+    dependencies = ('SSFPFromDiffusionWeighting', 'SphericalToCartesian')
     cl_code = '''
-        double adc = d * pown(dot(g, (float4)(cos(phi) * sin(theta), sin(phi) * sin(theta), cos(theta), 0.0)), 2);
+        double adc = d * pown(dot(g, direction), 2);
 
-        return SSFP(adc, delta, G, TR, flip_angle, b1, T1, T2);
+        return SSFPFromDiffusionWeighting(adc, SSFP_b, SSFP_beta, TR, flip_angle, b1, T1, T2);
     '''
+    precompute = ['float4 direction = SphericalToCartesian(theta, phi)']
 
 
 class SSFP_Tensor(CompartmentTemplate):
 
-    parameters = ('g', 'd', 'dperp0', 'dperp1', 'theta', 'phi', 'psi', 'delta',
-                  'G', 'TR', 'flip_angle', 'b1', 'T1', 'T2')
-    dependencies = ('SSFP', 'TensorApparentDiffusion')
+    parameters = ('g', 'd', 'dperp0', 'dperp1', 'theta', 'phi', 'psi', 'TR', 'flip_angle', 'b1', 'T1', 'T2')
+    protocol_columns = _ssfp_protocol_columns
+    dependencies = ('SSFPFromDiffusionWeighting', 'TensorSphericalToCartesian')
     cl_code = '''
-        double adc = TensorApparentDiffusion(theta, phi, psi, d, dperp0, dperp1, g);
-        return SSFP(adc, delta, G, TR, flip_angle, b1, T1, T2);
+        double adc = d *      pown(dot(vec[0], g), 2) +
+                     dperp0 * pown(dot(vec[1], g), 2) +
+                     dperp1 * pown(dot(vec[2], g), 2);
+        return SSFPFromDiffusionWeighting(adc, SSFP_b, SSFP_beta, TR, flip_angle, b1, T1, T2);
     '''
+    precompute = [('float4 vec[3]', 'TensorSphericalToCartesian(theta, phi, psi, vec, vec + 1, vec + 2);')]
     extra_prior = 'return dperp1 < dperp0 && dperp0 < d;'
     post_optimization_modifiers = [DTIMeasures.post_optimization_modifier]
     extra_optimization_maps = [DTIMeasures.extra_optimization_maps]
@@ -45,11 +61,12 @@ class SSFP_Tensor(CompartmentTemplate):
 
 class SSFP_Zeppelin(CompartmentTemplate):
 
-    parameters = ('g', 'd', 'dperp0', 'theta', 'phi', 'delta', 'G', 'TR', 'flip_angle', 'b1', 'T1', 'T2')
-    dependencies = ('SSFP',)
+    parameters = ('g', 'd', 'dperp0', 'theta', 'phi', 'TR', 'flip_angle', 'b1', 'T1', 'T2')
+    protocol_columns = _ssfp_protocol_columns
+    dependencies = ('SSFPFromDiffusionWeighting', 'SphericalToCartesian')
     cl_code = '''
-        double adc = dperp0 + ((d - dperp0) * pown(dot(g, (float4)(cos(phi) * sin(theta), 
-                                                                   sin(phi) * sin(theta), cos(theta), 0.0)), 2);
+        double adc = dperp0 + (d - dperp0) * pown(dot(g, direction), 2);
 
-        return SSFP(adc, delta, G, TR, flip_angle, b1, T1, T2);
+        return SSFPFromDiffusionWeighting(adc, SSFP_b, SSFP_beta, TR, flip_angle, b1, T1, T2);
     '''
+    precompute = ['float4 direction = SphericalToCartesian(theta, phi)']
@@ -12,5 +12,6 @@ class Stick(CompartmentTemplate):
     parameters = ('g', 'b', 'd', 'theta', 'phi')
     dependencies = ['SphericalToCartesian']
     cl_code = '''
-        return exp(-b * d * pown(dot(g, SphericalToCartesian(theta, phi)), 2));
+        return exp(-b * d * pown(dot(g, direction), 2));
     '''
+    precompute = ['float4 direction = SphericalToCartesian(theta, phi)']
@@ -10,11 +10,14 @@ __email__ = "robbert.harms@maastrichtuniversity.nl"
 class Tensor(CompartmentTemplate):
 
     parameters = ('g', 'b', 'd', 'dperp0', 'dperp1', 'theta', 'phi', 'psi')
-    dependencies = ['TensorApparentDiffusion']
+    dependencies = ['TensorSphericalToCartesian']
     cl_code = '''
-        double adc = TensorApparentDiffusion(theta, phi, psi, d, dperp0, dperp1, g);
+        double adc = d *      pown(dot(vec[0], g), 2) +
+                     dperp0 * pown(dot(vec[1], g), 2) +
+                     dperp1 * pown(dot(vec[2], g), 2);
         return exp(-b * adc);
     '''
+    precompute = [('float4 vec[3]', 'TensorSphericalToCartesian(theta, phi, psi, vec, vec + 1, vec + 2);')]
     extra_prior = 'return dperp1 < dperp0 && dperp0 < d;'
     post_optimization_modifiers = [DTIMeasures.post_optimization_modifier]
     extra_optimization_maps = [
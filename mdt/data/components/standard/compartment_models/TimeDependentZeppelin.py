@@ -24,11 +24,12 @@ class TimeDependentZeppelin(CompartmentTemplate):
     """
     parameters = ('g', 'b', 'd', 'd_bulk', 'theta', 'phi', 'time_dependent_characteristic_coefficient(A)',
                   'Delta', 'delta')
-    dependencies = ('Zeppelin',)
+    dependencies = ('SphericalToCartesian',)
     cl_code = '''
         double dperp0 = d_bulk + A * (log(Delta/delta) + 3/2.0)/(Delta - delta/3.0);
-        return Zeppelin(g, b, d, dperp0, theta, phi);
+        return exp(-b * (((d - dperp0) * pown(dot(g, direction), 2)) + dperp0));
     '''
+    precompute = ['float4 direction = SphericalToCartesian(theta, phi)']
 
     class time_dependent_characteristic_coefficient(FreeParameterTemplate):
         """The time dependent characteristic as used in the TimeDependentZeppelin model. Values are in m^2."""
@@ -11,5 +11,6 @@ class Zeppelin(CompartmentTemplate):
     parameters = ('g', 'b', 'd', 'dperp0', 'theta', 'phi')
     dependencies = ['SphericalToCartesian']
     cl_code = '''
-        return exp(-b * (((d - dperp0) * pown(dot(g, SphericalToCartesian(theta, phi)), 2)) + dperp0));
+        return exp(-b * (((d - dperp0) * pown(dot(g, direction), 2)) + dperp0));
     '''
+    precompute = ['float4 direction = SphericalToCartesian(theta, phi)']
@@ -2,7 +2,7 @@ import numpy as np
 from mdt import CompartmentTemplate, CompositeModelTemplate, FreeParameterTemplate, ProtocolParameterTemplate, \
     LibraryFunctionTemplate
 from mdt.model_building.parameter_functions.transformations import ScaleTransform
-from mdt.utils import voxelwise_vector_matrix_vector_product, create_covariance_matrix
+from mdt.lib.uncertainty import get_packed_covariances, propagate_variance
 from mot.library_functions import simpsons_rule
 
 
@@ -151,14 +151,11 @@ def produce_reduced_ramani_model(lineshape_method_name):
         Ra = R_obs / (1.0 + ((RM0a * fterm * (Rb - R_obs)) / (Rb - R_obs + RM0a)))
         f = fterm * Ra / (1.0 + fterm * Ra)
 
-        covars = create_covariance_matrix(
+        covars = get_packed_covariances(
             results, ['QMT.RM0a', 'QMT.fterm', 'QMT.Rb'], results.get('covariances', None))
 
-        Ra_gradient = get_ra_gradient(R_obs, RM0a, fterm, Rb)
-        Ra_std = np.nan_to_num(np.sqrt(voxelwise_vector_matrix_vector_product(Ra_gradient, covars, Ra_gradient)))
-
-        f_gradient = get_f_gradient(R_obs, RM0a, fterm, Rb)
-        f_std = np.nan_to_num(np.sqrt(voxelwise_vector_matrix_vector_product(f_gradient, covars, f_gradient)))
+        Ra_std = np.nan_to_num(np.sqrt(propagate_variance(get_ra_gradient(R_obs, RM0a, fterm, Rb), covars)))
+        f_std = np.nan_to_num(np.sqrt(propagate_variance(get_f_gradient(R_obs, RM0a, fterm, Rb), covars)))
 
         values = {
             'QMT.PD': gM0a * s0,
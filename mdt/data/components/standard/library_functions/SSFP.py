@@ -26,7 +26,32 @@ class SSFP(LibraryFunctionTemplate):
     return_type = 'double'
     parameters = ['double d', 'double delta', 'double G', 'double TR',
                   'double flip_angle', 'double b1', 'double T1', 'double T2']
-    dependencies = ('MRIConstants',)
+    dependencies = ('MRIConstants', 'SSFPFromDiffusionWeighting')
+    cl_code = '''
+        const double q_magnitude_2 = GAMMA_H_SQ * (double)(G * G) * (delta * delta);
+        return SSFPFromDiffusionWeighting(d, q_magnitude_2 * TR, q_magnitude_2 * delta, TR, flip_angle, b1, T1, T2);
+    '''
+
+
+class SSFPFromDiffusionWeighting(LibraryFunctionTemplate):
+    """The SSFP signal attenuation given the diffusion weighting terms.
+
+    This is the same as the ``SSFP`` function, but with the terms depending only on the protocol computed beforehand.
+    Using ``q^2 = (gamma_h * G * delta)^2``, these terms are ``b = q^2 * TR`` and ``beta = q^2 * delta``.
+
+    Args:
+        d: diffusivity or Apparent Diffusion Coefficient (m^2/s)
+        b: the diffusion weighting over the repetition time, ``q^2 * TR``
+        beta: the diffusion weighting over the gradient duration, ``q^2 * delta``
+        TR: repetition time (seconds)
+        flip_angle: the excitation angle (radians)
+        b1: taken from a b1+ map (a.u.)
+        T1: longitudinal relaxation time (s)
+        T2: transversal relaxation time (s)
+    """
+    return_type = 'double'
+    parameters = ['double d', 'double b', 'double beta', 'double TR',
+                  'double flip_angle', 'double b1', 'double T1', 'double T2']
     cl_code = '''
         double cos_b1_corrected_flip_angle;
         const double sin_b1_corrected_flip_angle = sincos(flip_angle * b1, &cos_b1_corrected_flip_angle);
@@ -34,11 +59,6 @@ class SSFP(LibraryFunctionTemplate):
         const double E1 = exp(-TR / T1);
         const double E2 = exp(-TR / T2);
     
-        const double q_magnitude_2 = GAMMA_H_SQ * (double)(G * G) * (delta * delta);
-    
-        const double b = q_magnitude_2 * TR;
-        const double beta = q_magnitude_2 * delta;
-    
         const double A1 = exp(-b * d);
         const double A2 = exp(-beta * d);
     
@@ -1,4 +1,6 @@
 from mdt import LibraryFunctionTemplate
+from mdt.lib.lookup_tables import LookupTable
+from mdt.lib.special_functions import noddi_legendre_gaussian_integral, noddi_watson_sh_coeff
 
 __author__ = 'Robbert Harms'
 __date__ = '2018-10-10'
@@ -19,13 +21,35 @@ class NODDI_SphericalHarmonicsIntegral(LibraryFunctionTemplate):
     parameters = ('double angle_term',
                   'double exponent_term',
                   'double kappa')
-    dependencies = ('NODDI_WatsonSHCoeff', 'NODDI_LegendreGaussianIntegral', 'EvenLegendreTerms')
+    dependencies = ('NODDI_WatsonSHCoeff', 'NODDI_SphericalHarmonicsIntegralFromSHCoeff')
+    cl_code = '''
+        double watson_sh_coeff[7];
+        NODDI_WatsonSHCoeff(kappa, watson_sh_coeff);
+        return NODDI_SphericalHarmonicsIntegralFromSHCoeff(angle_term, exponent_term, watson_sh_coeff);
+    '''
+
+
+class NODDI_SphericalHarmonicsIntegralFromSHCoeff(LibraryFunctionTemplate):
+    """Approximate the integral of the Watson distribution using precomputed spherical harmonics coefficients.
+
+    This is the same as ``NODDI_SphericalHarmonicsIntegral``, but with the coefficients of the Watson distribution
+    given instead of kappa. Since these only depend on kappa, compartments can compute them once per model
+    evaluation instead of once per observation.
+
+    Args:
+        angle_term: the angular term in the exponent of the NODDI integral, positive number
+        exponent_term: the term in the exponent of the NODDI integral, negative number
+        watson_sh_coeff: the 7 spherical harmonics coefficients of the Watson distribution,
+            as computed by ``NODDI_WatsonSHCoeff``
+    """
+    return_type = 'double'
+    parameters = ('double angle_term',
+                  'double exponent_term',
+                  'double* watson_sh_coeff')
+    dependencies = ('NODDI_LegendreGaussianIntegral', 'EvenLegendreTerms')
     cl_code = '''
         // do not change this value! It would require adding approximations
         #define NODDI_IC_MAX_POLYNOMIAL_ORDER 6
-        
-        double watson_sh_coeff[NODDI_IC_MAX_POLYNOMIAL_ORDER + 1];
-        NODDI_WatsonSHCoeff(kappa, watson_sh_coeff);
 
         double lgi[NODDI_IC_MAX_POLYNOMIAL_ORDER + 1];
         NODDI_LegendreGaussianIntegral(-exponent_term, lgi);
@@ -58,16 +82,25 @@ class NODDI_LegendreGaussianIntegral(LibraryFunctionTemplate):
 
     In this implementation, we approximate the integral up to the 12th order.
 
+    For x in [0, 128] the integrals are interpolated in a lookup table computed using numerical quadrature, for
+    other values we use the recursion and series expansion below.
+
     Args:
         x: a positive numbers, specifying the parameters of the gaussian
         result: array of size 7, holding the even terms of the integral
     """
     parameters = ['double x',
                   'double* result']
+    lookup_tables = [LookupTable('NODDI_LegendreGaussianIntegral_table', noddi_legendre_gaussian_integral,
+                                 [(0, 128)], 384, nmr_outputs=7, grid_exponents=2, atol=1e-6)]
     cl_code = '''
         // do not change this value! It would require adding approximations
         #define NODDI_IC_MAX_POLYNOMIAL_ORDER 6
 
+        if(NODDI_LegendreGaussianIntegral_table(x, result)){
+            return;
+        }
+
         if(x > 0.05){
             /* 
                 Computing the related exponent gaussian integrals
@@ -126,6 +159,9 @@ class NODDI_WatsonSHCoeff(LibraryFunctionTemplate):
 
     Note that the SH coefficients of the odd orders are always zero and are therefore not returned.
 
+    For kappa in [0, 64] the coefficients are interpolated in a lookup table computed using numerical quadrature, for
+    other values we use the series expansion and approximations below.
+
     Args:
         kappa: the concentration parameter of the NODDI model
         result: vector with 7 elements, for the spherical harmonic coefficients up to order 12
@@ -139,10 +175,16 @@ class NODDI_WatsonSHCoeff(LibraryFunctionTemplate):
     parameters = ['double kappa',
                   'double* result']
     dependencies = ('erfi',)
+    lookup_tables = [LookupTable('NODDI_WatsonSHCoeff_table', noddi_watson_sh_coeff,
+                                 [(0, 64)], 384, nmr_outputs=7, grid_exponents=2, atol=1e-6)]
     cl_code = '''
         // do not change this value! It would require adding approximations
         #define NODDI_IC_MAX_POLYNOMIAL_ORDER 6
 
+        if(NODDI_WatsonSHCoeff_table(kappa, result)){
+            return;
+        }
+
         result[0] = sqrt(M_PI) * 2;
 
         if(kappa <= 30){
@@ -140,18 +140,24 @@ class VanGelderenCylinder(LibraryFunctionTemplate):
         double sum = 0;
         float alpha;
         float alpha2_d;
+        double exp_delta;
+        double exp_Delta;
         
         #pragma unroll
         for(uint i = 0; i < bessel_roots_jnp_length; i++){
             alpha = bessel_roots_jnp[i] / R;
             alpha2_d = d * alpha * alpha;
 
+            // exp(-alpha2_d * (Delta + delta)) is the product of these two, saving an exponential per term
+            exp_delta = exp(-alpha2_d * delta);
+            exp_Delta = exp(-alpha2_d * Delta);
+
             sum += (2 * alpha2_d * delta
                     -  2
-                    + (2 * exp(-alpha2_d * delta))
-                    + (2 * exp(-alpha2_d * Delta))
+                    + (2 * exp_delta)
+                    + (2 * exp_Delta)
                     - exp(-alpha2_d * (Delta - delta))
-                    - exp(-alpha2_d * (Delta + delta)))
+                    - exp_Delta * exp_delta)
                         / ((alpha2_d * alpha * alpha2_d * alpha) * (bessel_roots_jnp[i] * bessel_roots_jnp[i] - 1));
         }
         return -2 * GAMMA_H_SQ * (G*G) * sum;
@@ -168,7 +174,7 @@ class VanGelderenSphere(LibraryFunctionTemplate):
     """
     return_type = 'double'
     parameters = ['double G', 'double Delta', 'double delta', 'double d', 'double R']
-    dependencies = ['MRIConstants']
+    dependencies = ['MRIConstants', 'BesselRoots']
     cl_code = '''
         if(R == 0.0 || R < MOT_EPSILON){
             return 0;
@@ -177,18 +183,24 @@ class VanGelderenSphere(LibraryFunctionTemplate):
         double sum = 0;
         float alpha;
         float alpha2_d;
+        double exp_delta;
+        double exp_Delta;
         
         #pragma unroll
         for(uint i = 0; i < bessel_roots_j3_2_length; i++){
             alpha = bessel_roots_j3_2[i] / R;
             alpha2_d = d * alpha * alpha;
 
+            // exp(-alpha2_d * (Delta + delta)) is the product of these two, saving an exponential per term
+            exp_delta = exp(-alpha2_d * delta);
+            exp_Delta = exp(-alpha2_d * Delta);
+
             sum += (2 * alpha2_d * delta
                     -  2
-                    + (2 * exp(-alpha2_d * delta))
-                    + (2 * exp(-alpha2_d * Delta))
+                    + (2 * exp_delta)
+                    + (2 * exp_Delta)
                     - exp(-alpha2_d * (Delta - delta))
-                    - exp(-alpha2_d * (Delta + delta)))
+                    - exp_Delta * exp_delta)
                         / ((alpha2_d * alpha * alpha2_d * alpha) * (bessel_roots_j3_2[i] * bessel_roots_j3_2[i] - 2));
         }
         return -2 * GAMMA_H_SQ * (G*G) * sum;
@@ -11,13 +11,27 @@ we wish to apply to these subjects. Furthermore each profile should support some
 if this profile is suitable for a given directory. Using those functions the :func:`mdt.batch_fit` can try
 to auto-recognize the batch profile to use based on the profile that is suitable and returns the most subjects.
 """
+import functools
 import glob
+import hashlib
+import inspect
 import logging
+import marshal
+import multiprocessing
 import numbers
 import os
+import pickle
+import struct
+import traceback
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from textwrap import dedent
+import numpy as np
+from mdt.configuration import get_subject_discovery_cache_dir
 from mdt.lib.components import get_batch_profile, get_component_list
+from mdt.lib.exceptions import BatchApplyError
+from mdt.lib.input_data_cache import hash_input
 from mdt.lib.masking import create_median_otsu_brain_mask
+from mdt.lib.subject_discovery_cache import get_cached_subjects, store_cached_subjects, get_searched_directories
 from mdt.protocols import load_protocol, auto_load_protocol
 from mdt.utils import AutoDict, load_input_data, natural_key_sort_cb
 from mdt.lib.nifti import load_nifti
@@ -64,17 +78,105 @@ class SimpleBatchProfile(BatchProfile):
 
         Implementing classes need only implement the method :meth:`_get_subjects`, then this class will handle the rest.
 
+        The subjects found by :meth:`_get_subjects` are stored in the subject discovery cache (see
+        :mod:`mdt.lib.subject_discovery_cache`), such that subsequent calls on the same data folder do not need to
+        search the data folder again, as long as the directories in that data folder did not change.
+
         Args:
             base_directory (str): the base directory from which we will load the subjects information
         """
         super().__init__()
 
     def get_subjects(self, data_folder):
-        return self._get_subjects(data_folder)
+        cache_dir = get_subject_discovery_cache_dir()
+        if cache_dir is None:
+            return self._get_subjects(data_folder)
+
+        subjects = get_cached_subjects(cache_dir, data_folder, self._get_discovery_cache_key())
+        if subjects is None:
+            subjects = self._get_subjects(data_folder)
+            store_cached_subjects(cache_dir, data_folder, self._get_discovery_cache_key(), subjects,
+                                  self._get_discovery_cache_directories(data_folder, subjects))
+        return subjects
 
     def is_suitable(self, data_folder):
         return len(self.get_subjects(data_folder)) > 0
 
+    def _get_discovery_cache_key(self):
+        """Get the key under which the subjects found by this profile are stored in the subject discovery cache.
+
+        The key consists of an identifier of this profile and a hash of its configuration, see
+        :meth:`_get_discovery_cache_configuration`. Changing the configuration (or the code) of the profile changes the
+        key and hence invalidates the cached subjects.
+
+        Returns:
+            str: the key, as ``<identifier>:<configuration hash>``
+        """
+        hasher = hashlib.sha1(repr(self._get_discovery_cache_configuration()).encode('utf-8'))
+        return '{}:{}'.format(self._get_discovery_cache_identifier(), hasher.hexdigest())
+
+    def _get_discovery_cache_directories(self, data_folder, subjects):
+        """Get the directories whose modification times determine the validity of the cached subjects.
+
+        By default these are the data folder, its direct subdirectories and the directories referenced by the found
+        subjects, see :func:`mdt.lib.subject_discovery_cache.get_searched_directories`. Profiles searching in deeper
+        directories should add the directories they search, also for the subjects they did not find.
+
+        Args:
+            data_folder (str): the data folder searched by this profile
+            subjects (list of SubjectInfo): the subjects found by this profile
+
+        Returns:
+            list of str: the directories, these may include directories which do not exist (yet)
+        """
+        return get_searched_directories(data_folder, subjects)
+
+    def _get_discovery_cache_identifier(self):
+        """Get the identifier of this profile in the subject discovery cache, by default the name of its class.
+
+        Returns:
+            str: the identifier, unique for this batch profile
+        """
+        return '{}.{}'.format(type(self).__module__, type(self).__qualname__)
+
+    def _get_discovery_cache_configuration(self):
+        """Get the configuration of this profile that determines which subjects it finds.
+
+        By default this is the source code of the class of this profile (and of its base classes up to this class),
+        together with the attributes of this profile holding plain values.
+
+        Returns:
+            list: the configuration elements, these should have a deterministic ``repr``
+        """
+        configuration = [sorted((name, value) for name, value in vars(self).items()
+                                if isinstance(value, (str, numbers.Number, tuple, list, dict, type(None))))]
+        for cls in type(self).__mro__:
+            if cls is SimpleBatchProfile:
+                break
+            configuration.append(self._get_source_code(cls))
+        return configuration
+
+    @staticmethod
+    def _get_source_code(obj):
+        """Get the source code of a class or function, for use in the discovery cache configuration.
+
+        If the source is not available, for example for code loaded from a string, we use the marshalled code of the
+        function, or of the functions of the class.
+
+        Args:
+            obj (type or function): the class or function
+
+        Returns:
+            str or bytes or list: the source code or a representation of the compiled code
+        """
+        try:
+            return inspect.getsource(obj)
+        except (OSError, TypeError):
+            if inspect.isclass(obj):
+                return [(name, SimpleBatchProfile._get_source_code(value))
+                        for name, value in sorted(vars(obj).items()) if inspect.isfunction(value)]
+            return marshal.dumps(obj.__code__)
+
     def _autoload_noise_std(self, data_folder, subject_id, file_pattern=None):
         """Try to autoload the noise standard deviation from a noise_std file.
 
@@ -166,19 +268,35 @@ class SubjectInfo:
         """
         raise NotImplementedError()
 
-    def get_input_data(self, use_gradient_deviations=False):
+    def get_input_data(self, use_gradient_deviations=False, cache_dir=None):
         """Get the input data for this subject.
 
         This is the data we will use during model fitting.
 
         Args:
             use_gradient_deviations (boolean): if we should enable the use of the gradient deviations
+            cache_dir (str): if given, the directory of the input data cache, see :func:`mdt.utils.load_input_data`
 
         Returns:
             :class:`~mdt.utils.MRIInputData`: the input data to use during model fitting
         """
         raise NotImplementedError()
 
+    def get_input_fingerprint(self, use_gradient_deviations=False):
+        """Get a fingerprint of the input files of this subject.
+
+        This fingerprint is stored in the fit manifests (see :mod:`mdt.lib.fit_manifest`) and is used by the batch
+        fitting to detect stale outputs. It should be cheap to compute, that is, it should not require loading
+        the input volumes.
+
+        Args:
+            use_gradient_deviations (boolean): if the gradient deviations are used as input
+
+        Returns:
+            str: the fingerprint, or None if not supported (in which case stale outputs are not detected)
+        """
+        return None
+
     def __str__(self):
         return dedent('''
             {class_name}
@@ -230,17 +348,41 @@ class SimpleSubjectInfo(SubjectInfo):
     def subject_base_folder(self):
         return self._subject_base_folder
 
-    def get_input_data(self, use_gradient_deviations=False):
+    def get_input_data(self, use_gradient_deviations=False, cache_dir=None):
+        gradient_deviations = None
         if use_gradient_deviations:
-            gradient_deviations = self._get_gradient_deviations()
-        else:
-            gradient_deviations = None
+            if cache_dir is not None:
+                gradient_deviations = self._gradient_deviations
+            else:
+                gradient_deviations = self._get_gradient_deviations()
 
         return load_input_data(self._dwi_fname,
                                self._protocol_loader.get_protocol(),
                                self._get_mask(),
                                gradient_deviations=gradient_deviations,
-                               noise_std=self._noise_std)
+                               noise_std=self._noise_std,
+                               cache_dir=cache_dir)
+
+    def get_input_fingerprint(self, use_gradient_deviations=False):
+        hasher = hashlib.sha1()
+
+        input_files = [self._dwi_fname, self._mask_fname]
+        if use_gradient_deviations:
+            input_files.append(self._gradient_deviations)
+        if isinstance(self._noise_std, str):
+            input_files.append(self._noise_std)
+        elif self._noise_std is not None:
+            hasher.update(hash_input(np.asarray(self._noise_std)).encode('utf-8'))
+
+        for fname in input_files:
+            if fname is not None and os.path.isfile(fname):
+                stat = os.stat(fname)
+                hasher.update('{}:{}:{}'.format(os.path.abspath(fname), stat.st_size, stat.st_mtime_ns).encode('utf-8'))
+            else:
+                hasher.update(b'None')
+
+        hasher.update(hash_input(self._protocol_loader.get_protocol()).encode('utf-8'))
+        return hasher.hexdigest()
 
     def _get_mask(self):
         if self._mask_fname is None or not os.path.isfile(self._mask_fname):
@@ -452,22 +594,36 @@ def get_subject_information(data_folder, subject_ids, batch_profile=None):
     Raises:
         ValueError: if one of the subjects could not be found.
     """
-    subjects = []
+    batch_profile = batch_profile_factory(batch_profile, data_folder)
+    if batch_profile is None:
+        raise RuntimeError('No suitable batch profile could be '
+                           'found for the directory {0}'.format(os.path.abspath(data_folder)))
 
-    def get_subjects(subject_info):
-        subjects.append(subject_info)
+    subjects = {subject.subject_id: subject for subject in batch_profile.get_subjects(data_folder)}
 
-    batch_apply(data_folder, get_subjects, batch_profile=batch_profile,
-                subjects_selection=SelectedSubjects(subject_ids))
+    requested_ids = [subject_ids] if isinstance(subject_ids, str) else list(subject_ids)
+    missing = [subject_id for subject_id in requested_ids if subject_id not in subjects]
+    if missing:
+        raise ValueError('The subjects {} could not be found in the directory {}.'.format(
+            ', '.join(missing), os.path.abspath(data_folder)))
 
     if isinstance(subject_ids, str):
-        return subjects[0]
-    return subjects
+        return subjects[subject_ids]
+    return [subjects[subject_id] for subject_id in requested_ids]
 
 
-def batch_apply(data_folder, func, batch_profile=None, subjects_selection=None, extra_args=None):
+def batch_apply(data_folder, func, batch_profile=None, subjects_selection=None, extra_args=None,
+                n_jobs=1, use_processes=False, journal_fname=None):
     """Apply a function on the subjects found in the batch profile.
 
+    The function can be applied to multiple subjects in parallel, using either threads or processes. Failures are
+    isolated per subject, that is, if the function raises an exception for a subject we log the error and continue
+    with the other subjects. After all subjects have been processed a :class:`~mdt.lib.exceptions.BatchApplyError` is
+    raised holding the errors and the results of the successful subjects.
+
+    If a journal file is given, the result of every completed subject is appended to that file. When running the batch
+    again with the same journal, the subjects in the journal are skipped and their results are loaded from the journal.
+
     Args:
         func (callable): the function we will apply for every subject, should accept as single argument an instance of
             :class:`SubjectInfo`.
@@ -480,9 +636,17 @@ def batch_apply(data_folder, func, batch_profile=None, subjects_selection=None,
             list are string we use it as subject ids, if they are integers we use it as subject indices.
         extra_args (list): a list of additional arguments that are passed to the function. If this is set,
             the callback function must accept these additional args.
+        n_jobs (int): the number of subjects to process in parallel
+        use_processes (boolean): if set, we use processes instead of threads when processing in parallel. The
+            processes are started using 'spawn', as such, the function, its arguments and its results must be
+            picklable and the calling script should be import safe.
+        journal_fname (str): if given, the results journal to use for skipping already completed subjects.
 
     Returns:
-        dict: per subject id the output from the function
+        dict: per subject id the output from the function, in the order of the subjects
+
+    Raises:
+        mdt.lib.exceptions.BatchApplyError: if the function failed for one or more of the subjects
     """
     batch_profile = batch_profile_factory(batch_profile, data_folder)
     subjects_selection = get_subject_selection(subjects_selection)
@@ -493,15 +657,8 @@ def batch_apply(data_folder, func, batch_profile=None, subjects_selection=None,
 
     subjects = subjects_selection.get_subjects(batch_profile.get_subjects(data_folder))
 
-    results = {}
-    for subject in subjects:
-        def f(subject):
-            if extra_args:
-                return func(subject, *extra_args)
-            return func(subject)
-
-        results[subject.subject_id] = f(subject)
-    return results
+    jobs = [(subject.subject_id, (subject,) + tuple(extra_args or ())) for subject in subjects]
+    return _apply_jobs(func, jobs, n_jobs=n_jobs, use_processes=use_processes, journal_fname=journal_fname)
 
 
 class BatchFitSubjectOutputInfo:
@@ -526,12 +683,16 @@ class BatchFitSubjectOutputInfo:
         '''.format(subject_id=self.subject_id, output_path=self.output_path, model_name=self.model_name)).strip()
 
 
-def run_function_on_batch_fit_output(func, output_folder, subjects_selection=None, model_names=None):
+def run_function_on_batch_fit_output(func, output_folder, subjects_selection=None, model_names=None,
+                                     n_jobs=1, use_processes=False, journal_fname=None):
     """Run a function on the output of a batch fitting routine.
 
     This enables you to run a function on every model output from every subject. This expects the output directory
     to contain directories and files like <subject_id>/<model_name>/<map_name>.nii.gz
 
+    As with :func:`batch_apply`, the function can be run in parallel, failures are isolated per subject and model,
+    and a results journal can be used to skip the outputs already processed.
+
     Args:
         func (Callable[[BatchFitSubjectOutputInfo], any]): the python function we should call for every map and model.
             This should accept as single parameter a :class:`BatchFitSubjectOutputInfo`.
@@ -540,9 +701,16 @@ def run_function_on_batch_fit_output(func, output_folder, subjects_selection=Non
             If None all subjects are processed.
         model_names (list): the list of model names to process. If not given we will run the function on all
             models.
+        n_jobs (int): the number of outputs to process in parallel
+        use_processes (boolean): if set, we use processes instead of threads when processing in parallel,
+            see :func:`batch_apply`.
+        journal_fname (str): if given, the results journal to use for skipping already processed outputs.
 
     Returns:
         dict: indexed by subject->model_name, values are the return values of the users function
+
+    Raises:
+        mdt.lib.exceptions.BatchApplyError: if the function failed for one or more of the outputs
     """
     subject_ids = list(os.listdir(output_folder))
     subject_ids.sort(key=natural_key_sort_cb)
@@ -551,7 +719,7 @@ def run_function_on_batch_fit_output(func, output_folder, subjects_selection=Non
     if subjects_selection:
         subject_ids = subjects_selection.get_selection(subject_ids)
 
-    results = AutoDict()
+    jobs = []
     for subject_id in subject_ids:
         subject_models = model_names
         if subject_models is None:
@@ -560,6 +728,149 @@ def run_function_on_batch_fit_output(func, output_folder, subjects_selection=Non
         for model_name in subject_models:
             info = BatchFitSubjectOutputInfo(os.path.join(output_folder, subject_id, model_name),
                                              subject_id, model_name)
-            results[subject_id][model_name] = func(info)
+            jobs.append(((subject_id, model_name), (info,)))
+
+    def nested(flat_results):
+        results = AutoDict()
+        for (subject_id, model_name), value in flat_results.items():
+            results[subject_id][model_name] = value
+        return results.to_normal_dict()
+
+    try:
+        return nested(_apply_jobs(func, jobs, n_jobs=n_jobs, use_processes=use_processes,
+                                  journal_fname=journal_fname))
+    except BatchApplyError as exc:
+        raise BatchApplyError(exc.errors, nested(exc.results))
 
-    return results.to_normal_dict()
+
+def _apply_jobs(func, jobs, n_jobs=1, use_processes=False, journal_fname=None):
+    """Apply the function to all the jobs, optionally in parallel and with a results journal.
+
+    Args:
+        func (Callable): the function to apply
+        jobs (list of tuple): per job a key and the arguments for the function
+        n_jobs (int): the number of jobs to run in parallel
+        use_processes (boolean): if we use processes instead of threads
+        journal_fname (str): the results journal, if given
+
+    Returns:
+        dict: the results per job key, in the order of the jobs
+
+    Raises:
+        BatchApplyError: if one or more of the jobs failed
+    """
+    logger = logging.getLogger(__name__)
+    journal = _ResultsJournal(journal_fname) if journal_fname else None
+    completed = journal.load() if journal else {}
+
+    if completed:
+        logger.info('Skipping {} item(s) already completed according to the journal {}.'.format(
+            sum(key in completed for key, _ in jobs), journal_fname))
+
+    errors = {}
+
+    def finish(key, get_result):
+        try:
+            result = get_result()
+        except Exception as exc:
+            logger.error('Processing {} failed: {}'.format(
+                key, ''.join(traceback.format_exception(type(exc), exc, exc.__traceback__))))
+            errors[key] = exc
+            return
+        completed[key] = result
+        if journal:
+            journal.append(key, result)
+
+    todo = [(key, args) for key, args in jobs if key not in completed]
+
+    if n_jobs == 1 or len(todo) < 2:
+        for key, args in todo:
+            finish(key, functools.partial(func, *args))
+    else:
+        if use_processes:
+            executor = ProcessPoolExecutor(max_workers=n_jobs, mp_context=multiprocessing.get_context('spawn'))
+        else:
+            executor = ThreadPoolExecutor(max_workers=n_jobs)
+
+        with executor:
+            futures = {executor.submit(func, *args): key for key, args in todo}
+            for future in as_completed(futures):
+                finish(futures[future], future.result)
+
+    results = {key: completed[key] for key, _ in jobs if key in completed}
+    if errors:
+        raise BatchApplyError(errors, results)
+    return results
+
+
+class _ResultsJournal:
+
+    def __init__(self, fname):
+        """An append only journal with the results of completed batch items.
+
+        Every record is a pickled (key, result) tuple, prefixed with the length of the pickled data. A partially
+        written last record (for example, after a crash) is removed from the journal when loading, such that new
+        records are appended directly after the last complete record. Complete records that can not be unpickled
+        anymore (for example, because a class was renamed) are skipped.
+
+        Args:
+            fname (str): the journal filename
+        """
+        self._fname = fname
+        self._header = struct.Struct('<Q')
+
+    def load(self):
+        """Load the completed items from the journal, and truncate a partially written last record.
+
+        Returns:
+            dict: the results per key
+        """
+        logger = logging.getLogger(__name__)
+        results = {}
+        if not os.path.isfile(self._fname):
+            return results
+
+        with open(self._fname, 'r+b') as f:
+            valid_end = 0
+            while True:
+                header = f.read(self._header.size)
+                if len(header) < self._header.size:
+                    break
+                length = self._header.unpack(header)[0]
+                record = f.read(length)
+                if len(record) < length:
+                    break
+                valid_end = f.tell()
+
+                try:
+                    key, result = pickle.loads(record)
+                except Exception as exc:
+                    logger.warning('Skipping a record of the journal {} that can not be loaded: {}'.format(
+                        self._fname, exc))
+                    continue
+                results[key] = result
+
+            if valid_end < os.fstat(f.fileno()).st_size:
+                logger.warning('Removing the partially written last record of the journal {}.'.format(self._fname))
+                f.truncate(valid_end)
+        return results
+
+    def append(self, key, result):
+        """Append a completed item to the journal.
+
+        If the result can not be pickled, the item is not stored, such that it will be processed again in a next run.
+        """
+        try:
+            record = pickle.dumps((key, result))
+        except Exception as exc:
+            logging.getLogger(__name__).warning(
+                'The result of {} can not be stored in the journal: {}'.format(key, exc))
+            return
+
+        if os.path.dirname(self._fname) and not os.path.isdir(os.path.dirname(self._fname)):
+            os.makedirs(os.path.dirname(self._fname))
+
+        with open(self._fname, 'ab') as f:
+            f.write(self._header.pack(len(record)) + record)
+            f.flush()
+            os.fsync(f.fileno())
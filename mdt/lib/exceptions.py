@@ -35,3 +35,27 @@ class NonUniqueComponent(Exception):
 
 class DoubleModelNameException(Exception):
     """Thrown when there are two models with the same name."""
+
+
+class NumpyBackendNotSupported(Exception):
+    """Raised when a model can not be computed using the NumPy compute backend.
+
+    This can for example be raised if the model contains compartments for which no NumPy implementation exists.
+    """
+
+
+class BatchApplyError(Exception):
+
+    def __init__(self, errors, results):
+        """Raised after a batch application in which the function failed for one or more subjects.
+
+        The function is still applied to all the other subjects, this exception is raised at the end of the batch.
+
+        Args:
+            errors (dict): per failed subject (or subject and model) the raised exception
+            results (dict): the results of the subjects that did complete
+        """
+        super().__init__('The batch function failed for {} item(s): {}'.format(
+            len(errors), ', '.join(map(str, errors))))
+        self.errors = errors
+        self.results = results
@@ -0,0 +1,252 @@
+"""Manifests recording the completed model fits.
+
+After a model fit completes, a manifest file is written (atomically) in the output directory of that model. This
+manifest holds the model name, the list of free parameters, the fingerprints of the input data, the MDT version and
+the completion time. Since the manifest is only written after all the output maps have been written, its presence
+indicates that the fit completed.
+
+Batch fitting uses these manifests to decide, per subject, if the models need to be fitted. Reading one small file per
+model is much faster than loading the model and looking up the output maps of every parameter. Additionally, by
+comparing the fingerprint of the subject's input files with the fingerprint in the manifest, we can detect outputs
+which are present but stale.
+
+For very large batches, the manifests of all subjects can additionally be collected in a single index file in the root
+of the batch output directory, see :class:`FitManifestIndex`.
+"""
+import datetime
+import hashlib
+import json
+import os
+import time
+import uuid
+from contextlib import contextmanager
+import numpy as np
+
+from mdt.__version__ import __version__
+from mdt.lib.input_data_cache import hash_input
+
+__author__ = 'Robbert Harms'
+__date__ = '2019-04-03'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+FIT_MANIFEST_NAME = 'fit_manifest.json'
+"""The filename of the fit manifest within a model output directory."""
+
+FIT_MANIFEST_INDEX_NAME = 'fit_manifests.json'
+"""The filename of the index with all the manifests in the root of a batch fit output directory."""
+
+
+def write_fit_manifest(output_path, model_name, parameter_names, input_fingerprint=None, source_fingerprint=None):
+    """Write the manifest of a completed model fit.
+
+    The manifest is written to a temporary file first, which is then moved to its final location.
+
+    Args:
+        output_path (str): the output directory of the model
+        model_name (str): the name of the fitted model
+        parameter_names (list of str): the names of the free parameters of the model
+        input_fingerprint (str): the fingerprint of the input data, see :func:`get_input_data_fingerprint`
+        source_fingerprint (str): the fingerprint of the input files, for example the fingerprint returned by
+            :meth:`mdt.lib.batch_utils.SubjectInfo.get_input_fingerprint`.
+
+    Returns:
+        dict: the manifest as written
+    """
+    manifest = {'model_name': model_name,
+                'parameters': list(parameter_names),
+                'input_fingerprint': input_fingerprint,
+                'source_fingerprint': source_fingerprint,
+                'mdt_version': __version__,
+                'completed': datetime.datetime.now().isoformat()}
+    _write_json_atomic(os.path.join(output_path, FIT_MANIFEST_NAME), manifest)
+    return manifest
+
+
+def load_fit_manifest(output_path):
+    """Load the manifest of a model fit.
+
+    Args:
+        output_path (str): the output directory of the model
+
+    Returns:
+        dict: the manifest, or None if there is no (readable) manifest
+    """
+    try:
+        with open(os.path.join(output_path, FIT_MANIFEST_NAME), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def remove_fit_manifest(output_path):
+    """Remove the manifest of a model fit, if present.
+
+    This should be called before (re)fitting a model, such that an interrupted fit does not leave a manifest.
+
+    Args:
+        output_path (str): the output directory of the model
+    """
+    try:
+        os.remove(os.path.join(output_path, FIT_MANIFEST_NAME))
+    except FileNotFoundError:
+        pass
+
+
+def fit_manifest_is_current(manifest, source_fingerprint=None, input_fingerprint=None):
+    """Check if the given manifest records a fit on the current input files.
+
+    Args:
+        manifest (dict): the manifest to check
+        source_fingerprint (str): the fingerprint of the current input files. If None, or if the manifest does not
+            record a source fingerprint, we can not detect stale outputs and only check for the presence of the manifest.
+        input_fingerprint (str): the fingerprint of the current input data, see :func:`get_input_data_fingerprint`.
+            If given, and if the manifest records an input fingerprint, these should also match.
+
+    Returns:
+        boolean: if the manifest exists and was not made on different input files
+    """
+    if manifest is None:
+        return False
+    for key, fingerprint in [('source_fingerprint', source_fingerprint), ('input_fingerprint', input_fingerprint)]:
+        if fingerprint is not None and manifest.get(key) is not None and manifest[key] != fingerprint:
+            return False
+    return True
+
+
+def get_input_data_fingerprint(input_data):
+    """Get the fingerprint of the given input data.
+
+    This hashes the protocol, the mask, the nifti header and the shape and data type of the observations. We do not
+    hash the observations themselves, since that would require reading all the data after every fit. Changes in the
+    content of the input files are detected using the source fingerprint instead, see :func:`write_fit_manifest`.
+
+    Args:
+        input_data (mdt.utils.MRIInputData): the input data to fingerprint
+
+    Returns:
+        str: the hexadecimal fingerprint
+    """
+    hasher = hashlib.sha1()
+    hasher.update(hash_input(input_data.protocol).encode('utf-8'))
+    hasher.update(hash_input(np.asarray(input_data.mask, dtype=np.bool)).encode('utf-8'))
+    hasher.update('{}:{}'.format(input_data.observations.shape, input_data.observations.dtype).encode('utf-8'))
+    if input_data.nifti_header is not None:
+        hasher.update(input_data.nifti_header.binaryblock)
+    return hasher.hexdigest()
+
+
+class FitManifestIndex:
+
+    def __init__(self, output_folder):
+        """Index of the fit manifests of all the subjects in a batch fit output directory.
+
+        The index is stored in a single file in the root of the batch output directory. This allows checking the
+        fit status of all subjects by reading a single file. The manifests in the model output directories remain
+        leading, the index only mirrors them. Subjects not (yet) in the index are looked up in their output directory.
+
+        Multiple processes can fit subjects in the same output directory. Every process only writes the subjects it
+        updated itself, merged into the index as currently on disk, while holding a lock on the index file.
+
+        Args:
+            output_folder (str): the batch fit output directory, with a directory per subject
+        """
+        self._output_folder = output_folder
+        self._path = os.path.join(output_folder, FIT_MANIFEST_INDEX_NAME)
+        self._manifests = _load_index_file(self._path)
+        self._updated_subjects = set()
+
+    def get_manifest(self, subject_id, model_name):
+        """Get the manifest of a model fitted on a subject.
+
+        Args:
+            subject_id (str): the subject id
+            model_name (str): the model name
+
+        Returns:
+            dict: the manifest, or None if the model was not (completely) fitted on this subject
+        """
+        manifest = self._manifests.get(subject_id, {}).get(model_name)
+        if manifest is None:
+            manifest = load_fit_manifest(os.path.join(self._output_folder, subject_id, model_name))
+            if manifest is not None:
+                self._manifests.setdefault(subject_id, {})[model_name] = manifest
+        return manifest
+
+    def update_subject(self, subject_id, model_names):
+        """Reload the manifests of the given models of a subject from disk.
+
+        Args:
+            subject_id (str): the subject id
+            model_names (list of str): the models for which to reload the manifests
+        """
+        subject_manifests = self._manifests.setdefault(subject_id, {})
+        for model_name in model_names:
+            manifest = load_fit_manifest(os.path.join(self._output_folder, subject_id, model_name))
+            if manifest is None:
+                subject_manifests.pop(model_name, None)
+            else:
+                subject_manifests[model_name] = manifest
+        self._updated_subjects.add(subject_id)
+
+    def write(self):
+        """Write the updated subjects (atomically) to the index file in the root of the output directory.
+
+        This reloads the index file under a lock and only replaces the subjects updated using
+        :meth:`update_subject`, such that we do not lose the updates of other processes writing the same index.
+        """
+        if not os.path.isdir(self._output_folder):
+            os.makedirs(self._output_folder)
+
+        with _file_lock(self._path):
+            manifests = _load_index_file(self._path)
+            for subject_id in self._updated_subjects:
+                manifests[subject_id] = self._manifests[subject_id]
+            _write_json_atomic(self._path, manifests)
+
+        self._manifests = manifests
+        self._updated_subjects = set()
+
+
+def _load_index_file(path):
+    """Load the manifests of an index file, returns an empty dictionary if the index does not exist or is corrupt."""
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+@contextmanager
+def _file_lock(path, stale_timeout=60, poll_interval=0.05):
+    """Hold an exclusive lock on the given path, using a lock file next to it.
+
+    Lock files older than the stale timeout (in seconds) are assumed to be left behind by a killed process and are
+    removed. This is safe since the lock is only held during the (short) writing of the index.
+    """
+    lock_path = path + '.lock'
+    while True:
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > stale_timeout:
+                    os.remove(lock_path)
+                    continue
+            except FileNotFoundError:
+                continue
+            time.sleep(poll_interval)
+    try:
+        yield
+    finally:
+        os.remove(lock_path)
+
+
+def _write_json_atomic(path, data):
+    tmp_path = '{}.tmp-{}'.format(path, uuid.uuid4().hex)
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=4, sort_keys=True)
+    os.replace(tmp_path, path)
@@ -0,0 +1,95 @@
+"""Numerical inversion of monotone one dimensional functions.
+
+Some of the post-processing routines need to invert a scalar function for every voxel, for example to convert the
+NODDI-DTI tau to the NODDI kappa. Instead of solving a non-linear optimization problem per voxel, we tabulate the
+function once on a dense grid and invert by interpolating in that table. Optionally, the interpolated values are
+polished using a few (vectorized) Newton steps on the original function.
+"""
+import numpy as np
+
+__author__ = 'Robbert Harms'
+__date__ = '2019-04-10'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+class MonotoneFunctionInverse:
+
+    def __init__(self, func, lower, upper, derivative=None, nmr_points=4096, grid_exponent=1):
+        """The inverse of a strictly monotone function on a closed interval.
+
+        The lookup table is only computed on first use.
+
+        Args:
+            func (callable): the vectorized function to invert, should map an ndarray of inputs to an ndarray of outputs
+            lower (float): the lower bound of the domain of the inverse
+            upper (float): the upper bound of the domain of the inverse
+            derivative (callable): the vectorized derivative of the function. If not given, we use central finite
+                differences in the Newton steps.
+            nmr_points (int): the number of points in the lookup table
+            grid_exponent (float): the grid points are placed at ``lower + (upper - lower) * t**grid_exponent`` with
+                ``t`` evenly spaced in [0, 1]. Values larger than one place more points near the lower bound.
+        """
+        self._func = func
+        self._derivative = derivative
+        self._lower = lower
+        self._upper = upper
+        self._nmr_points = nmr_points
+        self._grid_exponent = grid_exponent
+        self._table = None
+
+    @property
+    def range(self):
+        """The (minimum, maximum) of the function values on the domain, the range of valid inputs of the inverse."""
+        values = self._get_table()[1]
+        return values[0], values[-1]
+
+    def __call__(self, y, nmr_newton_steps=2):
+        """Invert the function for the given function values.
+
+        Function values outside of the range of the function are mapped to the nearest bound of the domain.
+
+        Args:
+            y (ndarray): the function values to invert, can be of any shape
+            nmr_newton_steps (int): the number of Newton iterations for polishing the interpolated values
+
+        Returns:
+            ndarray: the inputs of the function corresponding to the given function values, of the same shape as y
+        """
+        y = np.asarray(y, dtype=np.float64)
+        points, values = self._get_table()
+
+        x = np.interp(y, values, points)
+        in_range = (y > values[0]) & (y < values[-1])
+
+        for _ in range(nmr_newton_steps):
+            gradient = self._get_gradient(x[in_range])
+            step = np.zeros_like(gradient)
+            np.divide(self._func(x[in_range]) - y[in_range], gradient, out=step, where=(gradient != 0))
+            x[in_range] = np.clip(x[in_range] - step, self._lower, self._upper)
+
+        return x
+
+    def _get_table(self):
+        """Get the lookup table, as (points, values) sorted by increasing function value."""
+        if self._table is None:
+            points = self._lower + (self._upper - self._lower) * \
+                np.linspace(0, 1, self._nmr_points) ** self._grid_exponent
+            values = np.asarray(self._func(points), dtype=np.float64)
+
+            if values[-1] < values[0]:
+                points, values = points[::-1], values[::-1]
+            if np.any(np.diff(values) <= 0):
+                raise ValueError('The function is not strictly monotone on the given interval.')
+            self._table = (points, values)
+        return self._table
+
+    def _get_gradient(self, x):
+        if self._derivative is not None:
+            return self._derivative(x)
+
+        step = 1e-6 * np.maximum(np.abs(x), 1)
+        lower = np.maximum(x - step, self._lower)
+        upper = np.minimum(x + step, self._upper)
+        return (self._func(upper) - self._func(lower)) / (upper - lower)
@@ -0,0 +1,254 @@
+"""Persistent per-subject cache of the prepared model input data.
+
+Loading the input data of a subject means reading (and often decompressing) the DWI volume, applying the mask and
+estimating the noise std. When fitting models multiple times on the same subject, these steps are the same every time.
+This module stores the result of these steps on disk, such that the next load of the same subject only needs to
+memory map the observations.
+
+Every cache entry is a directory named after the combined content hash of the DWI, the protocol and the mask, holding:
+
+- ``index.json``, with the cache metadata
+- ``observations.npy``, the (n, d) float32 matrix with the signal of the n voxels in the mask, memory mapped on load
+- ``mask.npy``, the mask of the observations
+- ``header.bin``, the binary block of the nifti header of the DWI
+- ``protocol.npz``, the (real) columns of the protocol
+- ``noise_std.npy``, the noise std estimated from the observations, only present if the estimation was possible
+- ``gradient_deviations/<hash>.npz``, the compressed ROI of a gradient deviations volume, stored per content hash
+
+The content hashes of files are memoized in the ``file_hashes`` directory of the cache, keyed by the path, size and
+modification time of the file. As such, finding the cache entry of a subject does not require reading the files again.
+
+Entries are written to a temporary directory first and then renamed, such that concurrent processes never see a
+partially written entry.
+"""
+import hashlib
+import json
+import os
+import shutil
+import uuid
+import nibabel as nib
+import numpy as np
+
+from mdt.protocols import Protocol
+
+__author__ = 'Robbert Harms'
+__date__ = '2019-04-01'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+_CACHE_VERSION = 1
+
+
+def get_cache_entry_path(cache_dir, volume_info, protocol, mask):
+    """Get the path to the cache entry for the given input data.
+
+    Args:
+        cache_dir (str): the cache directory
+        volume_info (string or tuple): either the path to the DWI or an (ndarray, img_header) tuple
+        protocol (:class:`~mdt.protocols.Protocol` or str): the protocol or the path to the protocol file
+        mask (ndarray, str): the mask or the path to the mask
+
+    Returns:
+        str: the path to the cache entry directory, this may not exist yet
+    """
+    key = hashlib.sha1('{}:{}:{}:{}'.format(
+        _CACHE_VERSION,
+        hash_input(volume_info, cache_dir),
+        hash_input(protocol, cache_dir),
+        hash_input(mask, cache_dir)).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, key)
+
+
+def hash_input(value, cache_dir=None):
+    """Compute the content hash of an input data element.
+
+    Args:
+        value (str, ndarray, tuple or Protocol): a file name, an array, an (ndarray, img_header) tuple or a protocol
+        cache_dir (str): if given, the hashes of files are memoized in this directory
+
+    Returns:
+        str: the hexadecimal content hash
+    """
+    if isinstance(value, str):
+        return _hash_file(value, cache_dir)
+
+    hasher = hashlib.sha1()
+    if isinstance(value, Protocol):
+        for name in sorted(value.column_names):
+            if value.is_column_real(name):
+                hasher.update(name.encode('utf-8'))
+                _update_array_hash(hasher, np.asarray(value.get_column(name), dtype=np.float64))
+    elif isinstance(value, tuple):
+        _update_array_hash(hasher, np.asarray(value[0]))
+        if value[1] is not None:
+            hasher.update(value[1].binaryblock)
+    else:
+        _update_array_hash(hasher, np.asarray(value))
+    return hasher.hexdigest()
+
+
+def write_cache_entry(path, observations, mask, nifti_header, protocol, noise_std=None):
+    """Write a new cache entry.
+
+    If an entry already exists at the given path (for example, written concurrently by another process), we keep the
+    existing entry.
+
+    Args:
+        path (str): the path of the cache entry directory
+        observations (ndarray): the (n, d) matrix with the signal in the voxels of the mask
+        mask (ndarray): the 3d mask
+        nifti_header: the nifti header of the DWI
+        protocol (Protocol): the protocol
+        noise_std (float or ndarray): the estimated noise std, None if it could not be estimated
+    """
+    tmp_path = '{}.tmp-{}'.format(path, uuid.uuid4().hex)
+    os.makedirs(tmp_path)
+
+    observations_file = np.lib.format.open_memmap(os.path.join(tmp_path, 'observations.npy'), mode='w+',
+                                                  dtype=np.float32, shape=observations.shape)
+    observations_file[:] = observations
+    del observations_file
+
+    np.save(os.path.join(tmp_path, 'mask.npy'), np.asarray(mask, dtype=np.bool))
+    np.savez(os.path.join(tmp_path, 'protocol.npz'),
+             **{name: protocol.get_column(name) for name in protocol.column_names if protocol.is_column_real(name)})
+
+    if noise_std is not None:
+        np.save(os.path.join(tmp_path, 'noise_std.npy'), noise_std)
+
+    header_type = None
+    if nifti_header is not None:
+        header_type = type(nifti_header).__name__
+        with open(os.path.join(tmp_path, 'header.bin'), 'wb') as f:
+            f.write(nifti_header.binaryblock)
+
+    with open(os.path.join(tmp_path, 'index.json'), 'w') as f:
+        json.dump({'version': _CACHE_VERSION,
+                   'nmr_voxels': int(observations.shape[0]),
+                   'nmr_volumes': int(observations.shape[1]),
+                   'header_type': header_type}, f)
+
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+class InputDataCacheEntry:
+
+    def __init__(self, path):
+        """Read access to a cache entry.
+
+        Args:
+            path (str): the path to the cache entry directory
+        """
+        self.path = path
+        with open(os.path.join(path, 'index.json'), 'r') as f:
+            self._index = json.load(f)
+
+    @property
+    def observations(self):
+        """The (n, d) float32 matrix with the observations, memory mapped from disk."""
+        return np.load(os.path.join(self.path, 'observations.npy'), mmap_mode='r')
+
+    @property
+    def mask(self):
+        """The 3d mask of the voxels in the observations."""
+        return np.load(os.path.join(self.path, 'mask.npy'))
+
+    @property
+    def nifti_header(self):
+        """The nifti header of the DWI, None if no header was stored."""
+        if self._index['header_type'] is None:
+            return None
+        header_class = getattr(nib.nifti2, self._index['header_type'], None) or \
+            getattr(nib.nifti1, self._index['header_type'])
+        with open(os.path.join(self.path, 'header.bin'), 'rb') as f:
+            return header_class(binaryblock=f.read())
+
+    @property
+    def protocol(self):
+        """The protocol stored in this entry."""
+        with np.load(os.path.join(self.path, 'protocol.npz')) as columns:
+            return Protocol({name: columns[name] for name in columns.files})
+
+    @property
+    def noise_std(self):
+        """The noise std estimated from the observations, None if the estimation was not possible."""
+        path = os.path.join(self.path, 'noise_std.npy')
+        if not os.path.isfile(path):
+            return None
+        noise_std = np.load(path)
+        if noise_std.ndim == 0:
+            return float(noise_std)
+        return noise_std
+
+    def get_gradient_deviations(self, content_hash):
+        """Get the ROI of the gradient deviations with the given content hash.
+
+        Args:
+            content_hash (str): the content hash of the gradient deviations, see :func:`hash_input`
+
+        Returns:
+            ndarray: the gradient deviations within the mask, or None if not stored in this entry
+        """
+        path = os.path.join(self.path, 'gradient_deviations', content_hash + '.npz')
+        if not os.path.isfile(path):
+            return None
+        with np.load(path) as data:
+            return data['gradient_deviations']
+
+    def add_gradient_deviations(self, content_hash, gradient_deviations):
+        """Store the ROI of gradient deviations in this entry, in compressed form.
+
+        Args:
+            content_hash (str): the content hash of the gradient deviations, see :func:`hash_input`
+            gradient_deviations (ndarray): the gradient deviations within the mask
+        """
+        directory = os.path.join(self.path, 'gradient_deviations')
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        tmp_path = os.path.join(directory, '{}.tmp-{}.npz'.format(content_hash, uuid.uuid4().hex))
+        np.savez_compressed(tmp_path, gradient_deviations=gradient_deviations)
+        os.replace(tmp_path, os.path.join(directory, content_hash + '.npz'))
+
+
+def _update_array_hash(hasher, array):
+    hasher.update('{}:{}'.format(array.dtype.str, array.shape).encode('utf-8'))
+    hasher.update(np.ascontiguousarray(array).view(np.uint8).reshape(-1).data)
+
+
+def _hash_file(path, cache_dir=None, block_size=2 ** 20):
+    """Compute the content hash of a file, memoized by path, size and modification time in the cache directory."""
+    stat = os.stat(path)
+    memo_path = None
+
+    if cache_dir is not None:
+        memo_path = os.path.join(cache_dir, 'file_hashes',
+                                 hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest() + '.json')
+        if os.path.isfile(memo_path):
+            with open(memo_path, 'r') as f:
+                memo = json.load(f)
+            if memo['size'] == stat.st_size and memo['mtime_ns'] == stat.st_mtime_ns:
+                return memo['hash']
+
+    hasher = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            hasher.update(block)
+    content_hash = hasher.hexdigest()
+
+    if memo_path is not None:
+        os.makedirs(os.path.dirname(memo_path), exist_ok=True)
+        tmp_path = '{}.tmp-{}'.format(memo_path, uuid.uuid4().hex)
+        with open(tmp_path, 'w') as f:
+            json.dump({'path': os.path.abspath(path), 'size': stat.st_size,
+                       'mtime_ns': stat.st_mtime_ns, 'hash': content_hash}, f)
+        os.replace(tmp_path, memo_path)
+
+    return content_hash
@@ -0,0 +1,284 @@
+"""Precomputed lookup tables for use in the CL library functions.
+
+Some library functions evaluate expensive series or recursions, for every observation in every iteration of the
+optimization. If such a function depends on only one or two variables, we can instead precompute its values on a grid
+and interpolate in that grid on the device. This module provides the :class:`LookupTable` class for defining such
+tables. The table values are computed using a NumPy reference implementation of the function, checked for accuracy
+and compiled into the CL program as constant data.
+
+The grid points are placed at ``lower + (upper - lower) * t ** exponent`` for ``t`` evenly spaced in [0, 1], such that
+with an exponent larger than one, more points are placed near the lower bound of the domain. Interpolation is done
+using Catmull-Rom splines (tensor product splines for two dimensional tables) in the ``t`` space. At the boundaries of
+the grid, the table is padded with quadratically extrapolated values.
+
+Library functions use the lookup tables by calling the generated CL function, which returns false for points outside
+of the domain of the table, such that the library function can fall back to the exact computation. For example, a table
+with the name ``my_function_table`` with one dimension and two outputs generates the CL function::
+
+    bool my_function_table(double x, double* result);
+
+which writes the interpolated values to ``result`` if ``x`` is within the domain.
+"""
+import numpy as np
+
+__author__ = 'Robbert Harms'
+__date__ = '2019-04-12'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+class LookupTable:
+
+    def __init__(self, name, func, domain, nmr_points, nmr_outputs=1, grid_exponents=1, atol=0, rtol=1e-5):
+        """A lookup table for a one or two dimensional function.
+
+        The table values are computed on first use. At that time, the accuracy of the table is checked within all grid
+        cells, by comparing the interpolated values with the reference function, see :meth:`get_max_error`.
+
+        Args:
+            name (str): the name of the generated CL function
+            func (callable): the vectorized reference function, called with one vector per dimension of the table.
+                It should return an array of shape (n,) or (n, nmr_outputs) with the values at the n given points.
+            domain (tuple): per dimension a (lower, upper) tuple with the domain of the table
+            nmr_points (int or tuple of int): the number of grid points, per dimension
+            nmr_outputs (int): the number of values returned by the function per point
+            grid_exponents (float or tuple of float): the exponent of the grid spacing, per dimension
+            atol (float): the absolute tolerance of the interpolated values
+            rtol (float): the relative tolerance of the interpolated values. The table is accepted if for every
+                tested point ``abs(interpolated - reference) <= atol + rtol * abs(reference)``.
+        """
+        self.name = name
+        self._func = func
+        self._domain = tuple(tuple(float(v) for v in bounds) for bounds in domain)
+        self._nmr_dimensions = len(self._domain)
+        self._nmr_points = _per_dimension(nmr_points, self._nmr_dimensions, int)
+        self._grid_exponents = _per_dimension(grid_exponents, self._nmr_dimensions, float)
+        self._nmr_outputs = nmr_outputs
+        self._atol = atol
+        self._rtol = rtol
+        self._values = None
+        self._cl_code = None
+
+        if self._nmr_dimensions not in (1, 2):
+            raise ValueError('Lookup tables can only have one or two dimensions, {} given.'.format(
+                self._nmr_dimensions))
+        if any(nmr_points < 4 for nmr_points in self._nmr_points):
+            raise ValueError('Lookup tables need at least four points per dimension.')
+
+    @property
+    def values(self):
+        """The padded table values, as a float32 array of shape (n_0 + 2[, n_1 + 2], nmr_outputs).
+
+        Raises:
+            ValueError: if the interpolated values are not within the tolerance of the reference function
+        """
+        if self._values is None:
+            self._values = self._create_table()
+
+            max_error = self.get_max_error()
+            if max_error > 1:
+                self._values = None
+                raise ValueError('The lookup table "{}" is not accurate enough, the largest error is {:.3g} times '
+                                 'the tolerance. Please increase the number of grid points.'.format(self.name,
+                                                                                                     max_error))
+        return self._values
+
+    def __call__(self, *points):
+        """Interpolate the table at the given points, in the same way as the generated CL function.
+
+        Args:
+            *points: per dimension a vector with the coordinates of the points
+
+        Returns:
+            ndarray: a (n, nmr_outputs) array with the interpolated values, NaN for points outside of the domain
+        """
+        return self._interpolate(self._get_values(), *points)
+
+    def get_max_error(self):
+        """Get the largest interpolation error within the grid cells, relative to the tolerance.
+
+        This tests the interpolation at a quarter, half and three quarters of every grid cell, per dimension.
+
+        Returns:
+            float: the largest value of ``abs(interpolated - reference) / (atol + rtol * abs(reference))``, values
+                below one indicate that the table is within the tolerance
+        """
+        offsets = np.array([0.25, 0.5, 0.75])
+        points = [self._t_to_points((np.arange(nmr_points - 1)[:, None] + offsets).ravel(), dimension)
+                  for dimension, nmr_points in enumerate(self._nmr_points)]
+        points = [v.ravel() for v in np.meshgrid(*points, indexing='ij')]
+
+        reference = self._evaluate_func(*points)
+        error = np.abs(self._interpolate(self._get_values(), *points) - reference)
+        return float(np.max(error / (self._atol + self._rtol * np.abs(reference))))
+
+    def get_cl_code(self, use_table=True):
+        """Get the CL code of the lookup function of this table.
+
+        Args:
+            use_table (boolean): if set to False, the generated function always returns false, such that the
+                library functions always use the exact computations.
+
+        Returns:
+            str: the CL code with the table values and the lookup function
+        """
+        arguments = ', '.join('double x{}'.format(ind) for ind in range(self._nmr_dimensions))
+        signature = 'bool {}({}, double* result)'.format(self.name, arguments)
+
+        if not use_table:
+            return signature + '{\n    return false;\n}\n'
+
+        if self._cl_code is None:
+            self._cl_code = self._get_cl_code(signature)
+        return self._cl_code
+
+    def _get_values(self):
+        if self._values is None:
+            self._values = self._create_table()
+        return self._values
+
+    def _create_table(self):
+        grids = [self._t_to_points(np.arange(nmr_points), dimension)
+                 for dimension, nmr_points in enumerate(self._nmr_points)]
+        points = [v.ravel() for v in np.meshgrid(*grids, indexing='ij')]
+
+        values = self._evaluate_func(*points).reshape(tuple(self._nmr_points) + (self._nmr_outputs,))
+        if not np.all(np.isfinite(values)):
+            raise ValueError('The reference function of the lookup table "{}" returned non-finite values '
+                             'on the grid.'.format(self.name))
+        for axis in range(self._nmr_dimensions):
+            values = _pad_quadratic(values, axis)
+        return values.astype(np.float32)
+
+    def _evaluate_func(self, *points):
+        return np.asarray(self._func(*points), dtype=np.float64).reshape((-1, self._nmr_outputs))
+
+    def _t_to_points(self, t, dimension):
+        lower, upper = self._domain[dimension]
+        return lower + (upper - lower) * (t / (self._nmr_points[dimension] - 1)) ** self._grid_exponents[dimension]
+
+    def _interpolate(self, values, *points):
+        points = [np.asarray(p, dtype=np.float64).ravel() for p in points]
+        in_domain = np.ones(points[0].shape, dtype=np.bool)
+        for p, (lower, upper) in zip(points, self._domain):
+            in_domain &= (p >= lower) & (p <= upper)
+
+        indices = []
+        weights = []
+        for dimension, p in enumerate(points):
+            lower, upper = self._domain[dimension]
+            nmr_points = self._nmr_points[dimension]
+            t = ((np.where(in_domain, p, lower) - lower) / (upper - lower)) ** (1 / self._grid_exponents[dimension]) \
+                * (nmr_points - 1)
+            index = np.minimum(t.astype(np.int64), nmr_points - 2)
+            indices.append(index)
+            weights.append(_catmull_rom_weights(t - index))
+
+        values = values.astype(np.float64)
+        result = np.zeros((len(points[0]), self._nmr_outputs))
+        if self._nmr_dimensions == 1:
+            for a in range(4):
+                result += weights[0][:, a, None] * values[indices[0] + a]
+        else:
+            for a in range(4):
+                for b in range(4):
+                    result += (weights[0][:, a] * weights[1][:, b])[:, None] * values[indices[0] + a, indices[1] + b]
+
+        result[~in_domain] = np.nan
+        return result
+
+    def _get_cl_code(self, signature):
+        values = self.values
+        values_name = '{}_values'.format(self.name)
+
+        body = ''
+        in_domain = []
+        for dimension, ((lower, upper), nmr_points, exponent) in enumerate(
+                zip(self._domain, self._nmr_points, self._grid_exponents)):
+            in_domain.append('x{0} >= {1!r} && x{0} <= {2!r}'.format(dimension, lower, upper))
+
+            t = '(x{} - {!r}) / {!r}'.format(dimension, lower, upper - lower)
+            if exponent == 2:
+                t = 'sqrt({})'.format(t)
+            elif exponent != 1:
+                t = 'pow({}, {!r})'.format(t, 1 / exponent)
+
+            body += '''
+                double t{0} = {1} * {2};
+                int i{0} = min((int)t{0}, {3});
+                double w{0}[4];
+                mdt_lookup_table_weights(t{0} - i{0}, w{0});
+            '''.format(dimension, t, nmr_points - 1, nmr_points - 2)
+
+        if self._nmr_dimensions == 1:
+            body += '''
+                for(int k = 0; k < {nmr_outputs}; k++){{
+                    result[k] = 0;
+                    for(int a = 0; a < 4; a++){{
+                        result[k] += w0[a] * {values_name}[(i0 + a) * {nmr_outputs} + k];
+                    }}
+                }}
+            '''.format(nmr_outputs=self._nmr_outputs, values_name=values_name)
+        else:
+            body += '''
+                for(int k = 0; k < {nmr_outputs}; k++){{
+                    result[k] = 0;
+                    for(int a = 0; a < 4; a++){{
+                        for(int b = 0; b < 4; b++){{
+                            result[k] += w0[a] * w1[b] * {values_name}[
+                                ((i0 + a) * {row_length} + i1 + b) * {nmr_outputs} + k];
+                        }}
+                    }}
+                }}
+            '''.format(nmr_outputs=self._nmr_outputs, values_name=values_name, row_length=values.shape[1])
+
+        return '''
+            #ifndef MDT_LOOKUP_TABLE_WEIGHTS
+            #define MDT_LOOKUP_TABLE_WEIGHTS
+            void mdt_lookup_table_weights(double u, double* w){{
+                double u2 = u * u;
+                double u3 = u2 * u;
+                w[0] = (-u + 2 * u2 - u3) / 2.0;
+                w[1] = (2 - 5 * u2 + 3 * u3) / 2.0;
+                w[2] = (u + 4 * u2 - 3 * u3) / 2.0;
+                w[3] = (u3 - u2) / 2.0;
+            }}
+            #endif // MDT_LOOKUP_TABLE_WEIGHTS
+
+            constant float {values_name}[{nmr_values}] = {{{values}}};
+
+            {signature}{{
+                if(!({in_domain})){{
+                    return false;
+                }}
+                {body}
+                return true;
+            }}
+        '''.format(values_name=values_name, nmr_values=values.size,
+                   values=', '.join('{!r}f'.format(float(v)) for v in values.ravel()),
+                   signature=signature, in_domain=' && '.join(in_domain), body=body)
+
+
+def _per_dimension(value, nmr_dimensions, dtype):
+    if np.isscalar(value):
+        return (dtype(value),) * nmr_dimensions
+    return tuple(dtype(v) for v in value)
+
+
+def _pad_quadratic(values, axis):
+    """Pad the values with one point on both sides of the given axis, using quadratic extrapolation."""
+    values = np.moveaxis(values, axis, 0)
+    before = 3 * values[0] - 3 * values[1] + values[2]
+    after = 3 * values[-1] - 3 * values[-2] + values[-3]
+    return np.moveaxis(np.concatenate([before[None], values, after[None]]), 0, axis)
+
+
+def _catmull_rom_weights(u):
+    """Get the (n, 4) weights of the Catmull-Rom spline for the given vector of fractional positions."""
+    u2 = u * u
+    u3 = u2 * u
+    return np.stack([(-u + 2 * u2 - u3) / 2.0,
+                     (2 - 5 * u2 + 3 * u3) / 2.0,
+                     (u + 4 * u2 - 3 * u3) / 2.0,
+                     (u3 - u2) / 2.0], axis=1)
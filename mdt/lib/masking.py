@@ -1,10 +1,11 @@
 import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from scipy.ndimage import binary_dilation, generate_binary_structure, binary_fill_holes
 from mdt.utils import load_brain_mask
 from mdt.protocols import load_protocol
-from mdt.lib.nifti import load_nifti, write_nifti
-import mot.configuration
+from mdt.lib.nifti import load_nifti, write_nifti, close_nifti
 from scipy.ndimage.filters import median_filter
 
 __author__ = 'Robbert Harms'
@@ -16,6 +17,11 @@ __email__ = "robbert.harms@maastrichtuniversity.nl"
 def create_median_otsu_brain_mask(dwi_info, protocol, mask_threshold=0, fill_holes=True, **kwargs):
     """Create a brain mask using the given volume.
 
+    For the median otsu algorithm we only need the mean of the unweighted volumes. If a filename is given, we read
+    only the unweighted volumes from the file, one by one, instead of loading the complete DWI. The file is kept open
+    while reading the volumes, such that a compressed file is decompressed in a single pass instead of once per volume.
+    The weighted volumes are only read if a ``mask_threshold`` is given.
+
     Args:
         dwi_info (string or tuple or image): The information about the volume, either:
 
@@ -33,9 +39,10 @@ def create_median_otsu_brain_mask(dwi_info, protocol, mask_threshold=0, fill_hol
     logger = logging.getLogger(__name__)
     logger.info('Starting calculating a brain mask')
 
+    nifti_image = None
     if isinstance(dwi_info, str):
-        signal_img = load_nifti(dwi_info)
-        dwi = signal_img.get_data()
+        nifti_image = load_nifti(dwi_info, keep_file_open=True)
+        dwi = nifti_image.dataobj
     elif isinstance(dwi_info, (tuple, list)):
         dwi = dwi_info[0]
     else:
@@ -44,29 +51,75 @@ def create_median_otsu_brain_mask(dwi_info, protocol, mask_threshold=0, fill_hol
     if isinstance(protocol, str):
         protocol = load_protocol(protocol)
 
-    if len(dwi.shape) == 4:
-        unweighted_ind = protocol.get_unweighted_indices()
-        if len(unweighted_ind):
-            unweighted = np.mean(dwi[..., unweighted_ind], axis=3)
+    try:
+        if len(dwi.shape) == 4:
+            unweighted_ind = protocol.get_unweighted_indices()
+            if len(unweighted_ind):
+                unweighted = _mean_of_volumes(dwi, unweighted_ind)
+            else:
+                unweighted = _mean_of_volumes(dwi, range(dwi.shape[3]))
         else:
-            unweighted = np.mean(dwi, axis=3)
-    else:
-        unweighted = dwi.copy()
+            unweighted = np.array(dwi)
 
-    brain_mask = median_otsu(unweighted, **kwargs)
-    brain_mask = brain_mask > 0
+        brain_mask = median_otsu(unweighted, **kwargs)
+        brain_mask = brain_mask > 0
 
-    if fill_holes:
-        brain_mask = binary_fill_holes(brain_mask)
+        if fill_holes:
+            brain_mask = binary_fill_holes(brain_mask)
 
-    if mask_threshold:
-        brain_mask = np.mean(dwi[..., protocol.get_weighted_indices()], axis=3) * brain_mask > mask_threshold
+        if mask_threshold:
+            brain_mask = _mean_of_volumes(dwi, protocol.get_weighted_indices()) * brain_mask > mask_threshold
+    finally:
+        if nifti_image is not None:
+            close_nifti(nifti_image)
 
     logger.info('Finished calculating a brain mask')
 
     return brain_mask
 
 
+def create_median_otsu_brain_masks(dwi_infos, protocols, output_fnames=None, nmr_concurrent_subjects=None,
+                                   **kwargs):
+    """Create the brain masks of multiple subjects concurrently.
+
+    The subjects are processed in a thread pool. Since most of the work is done in the median filtering and in
+    reading the data, which both release the GIL, this scales with the number of CPUs. The CPUs are divided over
+    the concurrent subjects, every subject uses the remaining CPUs for the slab parallel median filtering
+    (see :func:`median_otsu`).
+
+    Args:
+        dwi_infos (list): per subject the information about the DWI, see :func:`create_median_otsu_brain_mask`
+        protocols (list): per subject the filename of the protocol file or a Protocol object
+        output_fnames (list of str): if given, per subject the filename to write the brain mask to. This requires
+            the DWI's to be given as filenames or as (ndarray, header) tuples.
+        nmr_concurrent_subjects (int): the number of subjects to process at the same time, defaults to the number
+            of CPUs (bounded by the number of subjects)
+        **kwargs: the additional arguments for :func:`create_median_otsu_brain_mask` and :func:`median_otsu`.
+
+    Returns:
+        list: per subject the created brain mask
+    """
+    dwi_infos = list(dwi_infos)
+    protocols = list(protocols)
+    output_fnames = list(output_fnames) if output_fnames is not None else [None] * len(dwi_infos)
+
+    if not (len(dwi_infos) == len(protocols) == len(output_fnames)):
+        raise ValueError('The number of DWI\'s, protocols and output filenames should be equal.')
+
+    nmr_cpus = os.cpu_count() or 1
+    nmr_concurrent_subjects = max(1, min(nmr_concurrent_subjects or nmr_cpus, len(dwi_infos)))
+    kwargs.setdefault('nmr_threads', max(1, nmr_cpus // nmr_concurrent_subjects))
+
+    def create_mask(subject):
+        dwi_info, protocol, output_fname = subject
+        if output_fname:
+            return create_write_median_otsu_brain_mask(dwi_info, protocol, output_fname, **kwargs)
+        return create_median_otsu_brain_mask(dwi_info, protocol, **kwargs)
+
+    with ThreadPoolExecutor(max_workers=nmr_concurrent_subjects) as executor:
+        return list(executor.map(create_mask, zip(dwi_infos, protocols, output_fnames)))
+
+
 def generate_simple_wm_mask(scalar_map, whole_brain_mask, threshold=0.3, median_radius=1, nmr_filter_passes=2):
     """Generate a simple white matter mask by thresholding the given map and smoothing it using a median filter.
 
@@ -126,20 +179,17 @@ def create_write_median_otsu_brain_mask(dwi_info, protocol, output_fname, **kwar
         ndarray: The created brain mask
     """
     if isinstance(dwi_info, str):
-        signal_img = load_nifti(dwi_info)
-        dwi = signal_img.get_data()
-        header = signal_img.header
+        header = load_nifti(dwi_info).header
     else:
-        dwi = dwi_info[0]
         header = dwi_info[1]
 
-    mask = create_median_otsu_brain_mask(dwi, protocol, **kwargs)
+    mask = create_median_otsu_brain_mask(dwi_info, protocol, **kwargs)
     write_nifti(mask, output_fname, header)
 
     return mask
 
 
-def median_otsu(unweighted_volume, median_radius=4, numpass=4, dilate=1):
+def median_otsu(unweighted_volume, median_radius=4, numpass=4, dilate=1, crop=False, nmr_threads=None):
     """ Simple brain extraction tool for dMRI data.
 
     This function is inspired from the ``median_otsu`` function from ``dipy``
@@ -154,27 +204,41 @@ def median_otsu(unweighted_volume, median_radius=4, numpass=4, dilate=1):
     and 3T data. From GE, Philips, Siemens, the most robust choice is
     ``median_radius=4``, ``numpass=4``.
 
+    The filter passes are run in parallel on slabs of the volume, with an overlap between the slabs such that the
+    result does not depend on the number of threads.
+
+    Optionally, to speed up the median filtering further, we can first crop the volume to the bounding box of a coarse
+    estimate of the foreground, extended by a margin of background voxels (see :func:`_get_foreground_bounding_box`).
+    Please note that the Otsu threshold is then computed within this cropped region instead of over the whole volume.
+    Since this changes the ratio of foreground to background voxels in the histogram, the threshold, and with that a
+    few voxels at the edge of the mask, can differ from the mask computed without cropping.
+
     Args:
         unweighted_volume (ndarray): ndarray of the unweighted volumes brain volumes
         median_radius (int): Radius (in voxels) of the applied median filter (default 4)
         numpass (int): Number of pass of the median filter (default 4)
         dilate (None or int): optional number of iterations for binary dilation
+        crop (boolean): if we crop the volume to the (coarse) foreground before filtering, this is faster but can
+            give a slightly different mask, see above.
+        nmr_threads (int): the number of threads to use for the median filtering, defaults to the number of CPUs
 
     Returns:
         ndarray: a 3D ndarray with the binary brain mask
     """
     b0vol = unweighted_volume
 
-    logger = logging.getLogger(__name__)
-    logger.info('We will use a single precision float type for the calculations.'.format())
-    for env in mot.configuration.get_cl_environments():
-        logger.info('Using device \'{}\'.'.format(str(env)))
+    region = tuple(slice(0, length) for length in b0vol.shape)
+    if crop:
+        region = _get_foreground_bounding_box(b0vol, numpass * median_radius + (dilate or 0) + 1)
+        b0vol = b0vol[region]
 
     for ind in range(numpass):
-        b0vol = median_filter(b0vol, size=median_radius, mode='mirror')
+        b0vol = _median_filter_slabs(b0vol, median_radius, nmr_threads)
 
     thresh = _otsu(b0vol)
-    mask = b0vol > thresh
+
+    mask = np.zeros(unweighted_volume.shape, dtype=np.bool)
+    mask[region] = b0vol > thresh
 
     if dilate is not None:
         cross = generate_binary_structure(3, 1)
@@ -183,6 +247,76 @@ def median_otsu(unweighted_volume, median_radius=4, numpass=4, dilate=1):
     return mask
 
 
+def _mean_of_volumes(dwi, volume_indices):
+    """Compute the mean over the given volumes of a 4d array or nifti data proxy, reading one volume at a time."""
+    volume_indices = list(volume_indices)
+    total = np.zeros(dwi.shape[:3])
+    for ind in volume_indices:
+        total += np.asarray(dwi[..., int(ind)])
+    return total / len(volume_indices)
+
+
+def _get_foreground_bounding_box(volume, margin, stride=4):
+    """Get the bounding box of a coarse estimate of the foreground of the given volume.
+
+    The coarse foreground is estimated on a subsampled version of the volume, by median filtering it with a small
+    window (to remove isolated bright noise voxels) and thresholding it using Otsu's method. This costs only a small
+    fraction of the full median otsu filtering.
+
+    Args:
+        volume (ndarray): the three dimensional volume
+        margin (int): the number of voxels with which to extend the bounding box on every side
+        stride (int): the subsampling factor of the coarse estimate
+
+    Returns:
+        tuple: per dimension a slice with the extent of the bounding box
+    """
+    coarse = median_filter(volume[::stride, ::stride, ::stride], size=3, mode='mirror')
+    foreground = coarse > _otsu(coarse)
+
+    if not np.any(foreground):
+        return tuple(slice(0, length) for length in volume.shape)
+
+    region = []
+    for axis, length in enumerate(volume.shape):
+        indices = np.nonzero(np.any(foreground, axis=tuple(ind for ind in range(3) if ind != axis)))[0]
+        start = max(0, int(indices[0]) * stride - margin)
+        end = min(length, (int(indices[-1]) + 1) * stride + margin)
+        region.append(slice(start, end))
+    return tuple(region)
+
+
+def _median_filter_slabs(volume, size, nmr_threads=None):
+    """Apply a median filter to slabs of the volume in parallel.
+
+    The volume is split into slabs along the first axis. Every slab is filtered together with an overlap of ``size``
+    voxels of the neighbouring slabs, which is discarded afterwards. Since that is at least the extent of the filter
+    window, this gives the same result as filtering the whole volume at once.
+
+    Args:
+        volume (ndarray): the volume to filter
+        size (int): the size of the median filter window
+        nmr_threads (int): the number of threads to use, defaults to the number of CPUs
+
+    Returns:
+        ndarray: the filtered volume
+    """
+    nmr_slabs = int(min(nmr_threads or os.cpu_count() or 1, max(1, volume.shape[0] // (2 * size))))
+    if nmr_slabs == 1:
+        return median_filter(volume, size=size, mode='mirror')
+
+    boundaries = np.linspace(0, volume.shape[0], nmr_slabs + 1).astype(np.int64)
+
+    def filter_slab(slab_ind):
+        start, end = int(boundaries[slab_ind]), int(boundaries[slab_ind + 1])
+        halo_start, halo_end = max(0, start - size), min(volume.shape[0], end + size)
+        filtered = median_filter(volume[halo_start:halo_end], size=size, mode='mirror')
+        return filtered[start - halo_start:end - halo_start]
+
+    with ThreadPoolExecutor(max_workers=nmr_slabs) as executor:
+        return np.concatenate(list(executor.map(filter_slab, range(nmr_slabs))), axis=0)
+
+
 def _otsu(image, nbins=256):
     """
     Return threshold value based on Otsu's method.
@@ -17,6 +17,8 @@ from mdt.utils import create_roi, get_cl_devices, model_output_exists, \
     per_model_logging_context, get_temporary_results_dir, SimpleInitializationData, InitializationData
 from mdt.lib.processing_strategies import FittingProcessor, get_full_tmp_results_path
 from mdt.lib.exceptions import InsufficientProtocolError
+from mdt.lib.fit_manifest import write_fit_manifest, remove_fit_manifest, load_fit_manifest, \
+    fit_manifest_is_current, get_input_data_fingerprint, FitManifestIndex
 import mot.configuration
 from mot.configuration import CLRuntimeInfo, CLRuntimeAction
 from mot.configuration import config_context as mot_config_context
@@ -27,7 +29,7 @@ __maintainer__ = "Robbert Harms"
 __email__ = "robbert.harms@maastrichtuniversity.nl"
 
 
-def get_optimization_inits(model_name, input_data, output_folder, cl_device_ind=None):
+def get_optimization_inits(model_name, input_data, output_folder, cl_device_ind=None, source_fingerprint=None):
     """Get better optimization starting points for the given model.
 
     Since initialization can make quite a difference in optimization results, this function can generate
@@ -55,6 +57,8 @@ def get_optimization_inits(model_name, input_data, output_folder, cl_device_ind=
             model name in it.
         cl_device_ind (int or list): the index of the CL device to use. The index is from the list from the function
             utils.get_cl_devices(). This can also be a list of device indices.
+        source_fingerprint (str): the fingerprint of the input files. Intermediate fits made on other input files
+            are fitted again, see :func:`get_model_output_status`.
 
     Returns:
         dict: a dictionary with initialization points for the selected model
@@ -67,7 +71,8 @@ def get_optimization_inits(model_name, input_data, output_folder, cl_device_ind=
     def get_model_fit(model_name):
         logger.info('Starting intermediate optimization for generating initialization point.')
         results = ModelFit(model_name, input_data, output_folder, recalculate=False,
-                           initialization_data={'inits': get_init_data(model_name)}).run()
+                           initialization_data={'inits': get_init_data(model_name)},
+                           source_fingerprint=source_fingerprint).run()
         logger.info('Finished intermediate optimization for generating initialization point.')
         return results
 
@@ -164,7 +169,8 @@ def get_optimization_inits(model_name, input_data, output_folder, cl_device_ind=
 
 def get_batch_fitting_function(total_nmr_subjects, models_to_fit, output_folder,
                                recalculate=False, cl_device_ind=None, double_precision=False,
-                               tmp_results_dir=True, use_gradient_deviations=False):
+                               tmp_results_dir=True, use_gradient_deviations=False, input_data_cache_dir=None,
+                               use_manifest_index=False):
     """Get the batch fitting function that can fit all desired models on a subject.
 
     Args:
@@ -178,8 +184,14 @@ def get_batch_fitting_function(total_nmr_subjects, models_to_fit, output_folder,
         tmp_results_dir (str, True or None): The temporary dir for the calculations. Set to a string to use
             that path directly, set to True to use the config value, set to None to disable.
         use_gradient_deviations (boolean): if you want to use the gradient deviations if present
+        input_data_cache_dir (str): if given, the directory to use as a persistent cache of the prepared
+            input data of each subject, see :func:`mdt.utils.load_input_data`.
+        use_manifest_index (boolean): if set, we keep an index of the fit manifests of all subjects in a single file
+            in the output folder, see :class:`mdt.lib.fit_manifest.FitManifestIndex`. If not set, we read the fit
+            manifests from the output directories of the subjects.
     """
     logger = logging.getLogger(__name__)
+    manifest_index = FitManifestIndex(output_folder) if use_manifest_index else None
 
     @contextmanager
     def timer(subject_id):
@@ -188,6 +200,16 @@ def get_batch_fitting_function(total_nmr_subjects, models_to_fit, output_folder,
         logger.info('Fitted all models on subject {0} in time {1} (h:m:s)'.format(
             subject_id, time.strftime('%H:%M:%S', time.gmtime(timeit.default_timer() - start_time))))
 
+    def get_model_name(model):
+        return model if isinstance(model, str) else model.name
+
+    def get_output_status(subject_id, model, output_dir, source_fingerprint):
+        """Get the output status of a model, one of 'current', 'stale' or 'missing'."""
+        manifest = None
+        if manifest_index is not None:
+            manifest = manifest_index.get_manifest(subject_id, get_model_name(model))
+        return get_model_output_status(model, output_dir, source_fingerprint=source_fingerprint, manifest=manifest)
+
     class FitFunc:
 
         def __init__(self):
@@ -200,14 +222,21 @@ def get_batch_fitting_function(total_nmr_subjects, models_to_fit, output_folder,
             self._index_counter += 1
 
             output_dir = os.path.join(output_folder, subject_info.subject_id)
+            source_fingerprint = subject_info.get_input_fingerprint(use_gradient_deviations)
 
-            if all(model_output_exists(model, output_dir) for model in models_to_fit) and not recalculate:
-                logger.info('Skipping subject {0}, output exists'.format(subject_info.subject_id))
-                return
+            output_status = {}
+            if not recalculate:
+                output_status = {get_model_name(model): get_output_status(subject_info.subject_id, model,
+                                                                          output_dir, source_fingerprint)
+                                 for model in models_to_fit}
+                if all(status == 'current' for status in output_status.values()):
+                    logger.info('Skipping subject {0}, output exists'.format(subject_info.subject_id))
+                    return
 
             logger.info('Loading the data (DWI, mask and protocol) of subject {0}'.format(subject_info.subject_id))
-            input_data = subject_info.get_input_data(use_gradient_deviations)
+            input_data = subject_info.get_input_data(use_gradient_deviations, cache_dir=input_data_cache_dir)
 
+            fitted_models = []
             with timer(subject_info.subject_id):
                 for model_name in models_to_fit:
                     if isinstance(model_name, str):
@@ -224,37 +253,78 @@ def get_batch_fitting_function(total_nmr_subjects, models_to_fit, output_folder,
 
                     logger.info('Going to fit model {0} on subject {1}'.format(model_name, subject_info.subject_id))
 
+                    recalculate_model = recalculate
+                    if output_status.get(get_model_name(model_name)) == 'stale':
+                        logger.info('The output of model {0} on subject {1} is stale, recalculating.'.format(
+                            model_name, subject_info.subject_id))
+                        recalculate_model = True
+
                     try:
                         if not isinstance(model_instance, DMRICascadeModelInterface):
                             inits = get_optimization_inits(model_name, input_data, output_dir,
-                                                           cl_device_ind=cl_device_ind)
+                                                           cl_device_ind=cl_device_ind,
+                                                           source_fingerprint=source_fingerprint)
                         else:
                             inits = {}
 
                         model_fit = ModelFit(model_name,
                                              input_data,
                                              output_dir,
-                                             recalculate=recalculate,
+                                             recalculate=recalculate_model,
                                              cl_device_ind=cl_device_ind,
                                              double_precision=double_precision,
                                              tmp_results_dir=tmp_results_dir,
-                                             initialization_data={'inits': inits})
+                                             initialization_data={'inits': inits},
+                                             source_fingerprint=source_fingerprint)
                         model_fit.run()
                     except InsufficientProtocolError as ex:
                         logger.info('Could not fit model {0} on subject {1} '
                                     'due to protocol problems. {2}'.format(model_name, subject_info.subject_id, ex))
                     else:
                         logger.info('Done fitting model {0} on subject {1}'.format(model_name, subject_info.subject_id))
+                        fitted_models.append(get_model_name(model_name))
+
+            if manifest_index is not None and fitted_models:
+                manifest_index.update_subject(subject_info.subject_id, fitted_models)
+                manifest_index.write()
 
     return FitFunc()
 
 
+def get_model_output_status(model, output_folder, source_fingerprint=None, input_fingerprint=None, manifest=None):
+    """Get the status of the output of a model fit.
+
+    If the model output directory contains a fit manifest, the output is current if the fingerprints in the manifest
+    match the given fingerprints, see :func:`mdt.lib.fit_manifest.fit_manifest_is_current`. Outputs without a manifest
+    (for example from older versions of MDT) are current if all the output maps exist.
+
+    Args:
+        model (str or model): the model or the name of the model
+        output_folder (str): the folder containing the output directory of the model
+        source_fingerprint (str): the fingerprint of the current input files
+        input_fingerprint (str): the fingerprint of the current input data
+        manifest (dict): the fit manifest of the model, if already loaded (for example from a
+            :class:`~mdt.lib.fit_manifest.FitManifestIndex`). If not given, we load it from the output directory.
+
+    Returns:
+        str: one of 'current', 'stale' or 'missing'
+    """
+    if manifest is None:
+        manifest = load_fit_manifest(os.path.join(output_folder, model if isinstance(model, str) else model.name))
+
+    if manifest is None:
+        return 'current' if model_output_exists(model, output_folder) else 'missing'
+    if fit_manifest_is_current(manifest, source_fingerprint=source_fingerprint, input_fingerprint=input_fingerprint):
+        return 'current'
+    return 'stale'
+
+
 class ModelFit:
 
     def __init__(self, model, input_data, output_folder,
                  method=None, optimizer_options=None, recalculate=False, only_recalculate_last=False,
                  cl_device_ind=None, double_precision=False, tmp_results_dir=True, initialization_data=None,
-                 post_processing=None):
+                 post_processing=None, source_fingerprint=None):
         """Setup model fitting for the given input model and data.
 
         To actually fit the model call run().
@@ -290,7 +360,8 @@ class ModelFit:
                 For valid elements, please see the configuration file settings for ``optimization``
                 under ``post_processing``. Valid input for this parameter is for example: {'covariance': False}
                 to disable automatic calculation of the covariance from the Hessian.
-
+            source_fingerprint (str): the fingerprint of the input files, stored in the fit manifest of every fitted
+                model. This is used by batch fitting to detect stale outputs, see :mod:`mdt.lib.fit_manifest`.
         """
         if isinstance(model, str):
             model = get_model(model)()
@@ -305,6 +376,7 @@ class ModelFit:
         self._optimizer_options = optimizer_options
         self._recalculate = recalculate
         self._only_recalculate_last = only_recalculate_last
+        self._source_fingerprint = source_fingerprint
         self._logger = logging.getLogger(__name__)
 
         self._model_names_list = []
@@ -390,7 +462,8 @@ class ModelFit:
 
             results = fit_composite_model(model, self._input_data, self._output_folder, method,
                                           self._tmp_results_dir, recalculate=recalculate, cascade_names=model_names,
-                                          optimizer_options=self._optimizer_options)
+                                          optimizer_options=self._optimizer_options,
+                                          source_fingerprint=self._source_fingerprint)
 
         map_results = get_all_nifti_data(os.path.join(self._output_folder, model.name))
         return results, map_results
@@ -409,9 +482,12 @@ class ModelFit:
 
 
 def fit_composite_model(model, input_data, output_folder, method, tmp_results_dir,
-                        recalculate=False, cascade_names=None, optimizer_options=None):
+                        recalculate=False, cascade_names=None, optimizer_options=None, source_fingerprint=None):
     """Fits the composite model and returns the results as ROI lists per map.
 
+    After the fit completed, this writes a fit manifest to the output directory of the model,
+    see :mod:`mdt.lib.fit_manifest`.
+
      Args:
         model (:class:`~mdt.models.composite.DMRICompositeModel`): An implementation of an composite model
             that contains the model we want to optimize.
@@ -420,9 +496,11 @@ def fit_composite_model(model, input_data, output_folder, method, tmp_results_di
             The resulting maps are placed in a subdirectory (named after the model name) in this output folder.
         method (str): The optimization routine to use.
         tmp_results_dir (str): the main directory to use for the temporary results
-        recalculate (boolean): If we want to recalculate the results if they are already present.
+        recalculate (boolean): If we want to recalculate the results if they are already present. Results made on
+            other input data are always recalculated, see :func:`get_model_output_status`.
         cascade_names (list): the list of cascade names, meant for logging
         optimizer_options (dict): the additional optimization options
+        source_fingerprint (str): the fingerprint of the input files, to store in the fit manifest
     """
     logger = logging.getLogger(__name__)
     output_path = os.path.join(output_folder, model.name)
@@ -432,10 +510,16 @@ def fit_composite_model(model, input_data, output_folder, method, tmp_results_di
             'The given protocol is insufficient for this model. '
             'The reported errors where: {}'.format(model.get_input_data_problems(input_data)))
 
-    if not recalculate and model_output_exists(model, output_folder):
-        maps = get_all_nifti_data(output_path)
-        logger.info('Not recalculating {} model'.format(model.name))
-        return create_roi(maps, input_data.mask)
+    if not recalculate:
+        output_status = get_model_output_status(model, output_folder, source_fingerprint=source_fingerprint,
+                                                input_fingerprint=get_input_data_fingerprint(input_data))
+        if output_status == 'current':
+            maps = get_all_nifti_data(output_path)
+            logger.info('Not recalculating {} model'.format(model.name))
+            return create_roi(maps, input_data.mask)
+        elif output_status == 'stale':
+            logger.info('The output of model {} was made on other input data, recalculating.'.format(model.name))
+            recalculate = True
 
     with per_model_logging_context(output_path):
         logger.info('Using MDT version {}'.format(__version__))
@@ -444,11 +528,14 @@ def fit_composite_model(model, input_data, output_folder, method, tmp_results_di
 
         model.set_input_data(input_data)
 
+        if os.path.exists(output_path):
+            remove_fit_manifest(output_path)
+
         if recalculate:
             if os.path.exists(output_path):
                 list(map(os.remove, glob.glob(os.path.join(output_path, '*.nii*'))))
-                if os.path.exists(os.path.join(output_path + 'covariances')):
-                    shutil.rmtree(os.path.join(output_path + 'covariances'))
+                if os.path.exists(os.path.join(output_path, 'covariances')):
+                    shutil.rmtree(os.path.join(output_path, 'covariances'))
 
         if not os.path.exists(output_path):
             os.makedirs(output_path)
@@ -462,7 +549,12 @@ def fit_composite_model(model, input_data, output_folder, method, tmp_results_di
                                       tmp_dir, recalculate, optimizer_options=optimizer_options)
 
             processing_strategy = get_processing_strategy('optimization')
-            return processing_strategy.process(worker)
+            results = processing_strategy.process(worker)
+
+        write_fit_manifest(output_path, model.name, model.get_free_param_names(),
+                           input_fingerprint=get_input_data_fingerprint(input_data),
+                           source_fingerprint=source_fingerprint)
+        return results
 
 
 @contextmanager
@@ -1,3 +1,4 @@
+import collections
 from contextlib import contextmanager
 import logging
 import os
@@ -7,8 +8,9 @@ import time
 from mdt import get_processing_strategy
 from mdt.utils import load_samples, per_model_logging_context
 from mdt.lib.processing_strategies import SamplingProcessor, SaveAllSamples, \
-    SaveNoSamples, get_full_tmp_results_path, SaveSpecificMaps
+    SaveNoSamples, get_full_tmp_results_path, SaveSpecificMaps, SamplesStorageStrategy, SaveSpecificSamples
 from mdt.lib.exceptions import InsufficientProtocolError
+from mdt.lib.results_container import RESULTS_CONTAINER_NAME
 
 
 __author__ = 'Robbert Harms'
@@ -19,7 +21,8 @@ __email__ = "robbert.harms@maastrichtuniversity.nl"
 
 def sample_composite_model(model, input_data, output_folder, nmr_samples, thinning, burnin, tmp_dir,
                            method=None, recalculate=False, store_samples=True, sample_items_to_save=None,
-                           initialization_data=None, post_sampling_cb=None, sampler_options=None):
+                           initialization_data=None, post_sampling_cb=None, sampler_options=None,
+                           continue_from=None):
     """Sample a composite model.
 
     Args:
@@ -59,9 +62,15 @@ def sample_composite_model(model, input_data, output_folder, nmr_samples, thinni
                 dictionary with as keys dir-/file-names and as values maps to be stored in the results directory.
         sampler_options (dict): specific options for the MCMC routine. These will be provided to the sampling routine
             as additional keyword arguments to the constructor.
+        continue_from (str): the directory with the samples of a previous run we want to continue. If given, we
+            extend the chains of that run with the requested number of samples, instead of starting new chains.
     """
     samples_storage_strategy = SaveAllSamples()
-    if store_samples:
+    if isinstance(store_samples, SamplesStorageStrategy):
+        samples_storage_strategy = store_samples
+    elif isinstance(store_samples, collections.Sequence):
+        samples_storage_strategy = SaveSpecificSamples(store_samples)
+    elif store_samples:
         if sample_items_to_save:
             samples_storage_strategy = SaveSpecificMaps(included=sample_items_to_save)
     else:
@@ -74,9 +83,10 @@ def sample_composite_model(model, input_data, output_folder, nmr_samples, thinni
 
     logger = logging.getLogger(__name__)
 
-    if not recalculate:
+    if not recalculate and not continue_from:
         if os.path.exists(os.path.join(output_folder, 'UsedMask.nii.gz')) \
-                or os.path.exists(os.path.join(output_folder, 'UsedMask.nii')):
+                or os.path.exists(os.path.join(output_folder, 'UsedMask.nii')) \
+                or os.path.exists(os.path.join(output_folder, RESULTS_CONTAINER_NAME)):
             logger.info('Not recalculating {} model'.format(model.name))
             return load_samples(output_folder)
 
@@ -97,7 +107,8 @@ def sample_composite_model(model, input_data, output_folder, nmr_samples, thinni
                 get_full_tmp_results_path(output_folder, tmp_dir), recalculate,
                 samples_storage_strategy=samples_storage_strategy,
                 post_sampling_cb=post_sampling_cb,
-                sampler_options=sampler_options)
+                sampler_options=sampler_options,
+                continue_from=continue_from)
 
             processing_strategy = get_processing_strategy('sampling')
             return processing_strategy.process(worker)
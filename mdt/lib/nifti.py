@@ -1,13 +1,23 @@
 import glob
 import gzip
+import io
+import logging
 import os
 import copy
+import struct
+import weakref
 import nibabel as nib
 import numpy as np
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 from mdt.lib.deferred_mappings import DeferredActionDict
 
+try:
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
+
 __author__ = 'Robbert Harms'
 __date__ = "2014-08-28"
 __license__ = "LGPL v3"
@@ -15,23 +25,207 @@ __maintainer__ = "Robbert Harms"
 __email__ = "robbert.harms@maastrichtuniversity.nl"
 
 
-def load_nifti(nifti_volume):
+GZIP_INDEX_EXTENSION = '.gzidx'
+"""The extension of the cached seek point index of a gzipped nifti file, stored next to the nifti file."""
+
+INDEXED_GZIP_MIN_FILE_SIZE = 64 * 1024 ** 2
+"""The minimum size (in bytes) of a gzipped nifti file before we use an indexed gzip reader."""
+
+
+def load_nifti(nifti_volume, keep_file_open=None):
     """Load and return a nifti file.
 
     This will apply path resolution if a filename without extension is given. See the function
     :func:`nifti_filepath_resolution` for details.
 
+    Large gzipped files are opened using a random access reader if the package ``indexed_gzip`` is installed, see
+    :func:`load_indexed_gzip_nifti`. In that case, reading parts of the data using the ``dataobj`` proxy of the
+    returned image (for example using :func:`read_nifti_volumes`) only decompresses the requested parts.
+
     Args:
         nifti_volume (string): The filename of the volume to use.
+        keep_file_open (boolean): if True, the file is kept open between reads from the data proxy. For gzipped files
+            this makes consecutive reads of parts of the data continue the decompression where the previous read ended,
+            instead of decompressing from the start of the file for every read. The file is closed when the image is
+            garbage collected, or explicitly using :func:`close_nifti`.
 
     Returns:
         :class:`nibabel.nifti2.Nifti2Image`
     """
     path = nifti_filepath_resolution(nifti_volume)
-    return nifti_info_decorate_nibabel_image(nib.load(path))
+    if indexed_gzip is not None and path.endswith('.gz') and os.path.getsize(path) >= INDEXED_GZIP_MIN_FILE_SIZE:
+        return nifti_info_decorate_nibabel_image(load_indexed_gzip_nifti(path))
+    if keep_file_open and is_nifti_file(path):
+        return nifti_info_decorate_nibabel_image(_load_nifti_from_fileobj(path, nib.openers.ImageOpener(path, 'rb')))
+    return nifti_info_decorate_nibabel_image(nib.load(path, keep_file_open=keep_file_open))
+
+
+def load_indexed_gzip_nifti(path):
+    """Load a gzipped nifti file with random access to the compressed data.
+
+    This uses the ``indexed_gzip`` package to read the file. On first use, this decompresses the file once to build a
+    seek point index, which is then stored next to the nifti file (with the extension :data:`GZIP_INDEX_EXTENSION`).
+    Subsequent loads import that index, after which reading a single volume or slab of the data only requires
+    decompressing the data from the nearest seek point onwards. If the index can not be written (for example in a read
+    only directory), we only keep the index in memory.
+
+    Args:
+        path (str): the path to the .nii.gz file
+
+    Returns:
+        :class:`nibabel.nifti1.Nifti1Image` or :class:`nibabel.nifti2.Nifti2Image`: the loaded image, with the data
+            proxy reading from the indexed gzip file.
+
+    The indexed gzip file is closed when the returned image is garbage collected, or explicitly using
+    :func:`close_nifti`. The package ``indexed_gzip`` is an optional dependency, install it using
+    ``pip install mdt[indexed_gzip]``.
+
+    Raises:
+        ImportError: if the package ``indexed_gzip`` is not installed
+    """
+    if indexed_gzip is None:
+        raise ImportError('The package "indexed_gzip" is required for random access to gzipped nifti files.')
+
+    fileobj = indexed_gzip.IndexedGzipFile(path)
+
+    index_path = path + GZIP_INDEX_EXTENSION
+    if os.path.isfile(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(path):
+        fileobj.import_index(index_path)
+    else:
+        fileobj.build_full_index()
+        try:
+            fileobj.export_index(index_path)
+        except (IOError, OSError):
+            logging.getLogger(__name__).warning('Could not write the gzip index file "{}".'.format(index_path))
+
+    return _load_nifti_from_fileobj(path, fileobj)
+
+
+def _load_nifti_from_fileobj(path, fileobj):
+    """Load a nifti image of which the data proxy reads from the given open file object.
+
+    The file object is closed when the returned image is garbage collected, or explicitly using :func:`close_nifti`.
+
+    Args:
+        path (str): the path to the .nii or .nii.gz file
+        fileobj: the opened (and decompressing) file object of that path
+
+    Returns:
+        :class:`nibabel.nifti1.Nifti1Image` or :class:`nibabel.nifti2.Nifti2Image`: the loaded image
+    """
+    image_class = nib.Nifti1Image
+    if struct.unpack('<i', fileobj.read(4))[0] in (540, 469893120):  # sizeof_hdr of nifti2, little and big endian
+        image_class = nib.Nifti2Image
+    fileobj.seek(0)
+
+    file_holder = nib.FileHolder(filename=path, fileobj=fileobj)
+    image = image_class.from_file_map({'header': file_holder, 'image': file_holder})
+    weakref.finalize(image, fileobj.close)
+    return image
+
+
+def close_nifti(nifti_image):
+    """Close the files kept open by a nifti image.
+
+    This closes the file kept open for images loaded with ``keep_file_open=True`` and the indexed gzip file of images
+    loaded with :func:`load_indexed_gzip_nifti`. Reading from the data proxy afterwards raises an error. Images of
+    which the data proxy opens the file for every read are not affected.
+
+    Args:
+        nifti_image (:class:`nibabel.spatialimages.SpatialImage`): the image loaded with :func:`load_nifti`
+    """
+    fileobj = nifti_image.file_map['image'].fileobj
+    if fileobj is not None:
+        fileobj.close()
+
+
+def read_nifti_volumes(nifti_image, volume_indices):
+    """Read only the given volumes (indices in the fourth dimension) of a nifti image.
+
+    This reads the volumes one by one using the data proxy of the image, such that we do not have to load the whole
+    image. For images loaded using :func:`load_nifti` this only decompresses the requested volumes when the file is
+    opened with an indexed gzip reader and else at most the data up to the last requested volume.
+
+    Args:
+        nifti_image (:class:`nibabel.spatialimages.SpatialImage`): the (unloaded) nifti image
+        volume_indices (list of int): the volume indices to read
+
+    Returns:
+        ndarray: a four dimensional array with the requested volumes, in the given order
+    """
+    proxy = nifti_image.dataobj
+    if not len(volume_indices):
+        return np.zeros(nifti_image.shape[:3] + (0,), dtype=nifti_image.get_data_dtype())
+    return np.stack([np.asarray(proxy[..., int(ind)]) for ind in volume_indices], axis=-1)
+
+
+def read_nifti_region(nifti_image, mask):
+    """Read only the bounding box of the given mask from a nifti image.
+
+    The data outside the bounding box of the mask is not read and set to zero in the returned array. Since the data
+    is read using the data proxy of the image, this reads (and decompresses) only the slabs of the file covering the
+    mask, see :func:`read_nifti_volumes`.
+
+    Args:
+        nifti_image (:class:`nibabel.spatialimages.SpatialImage`): the (unloaded) nifti image
+        mask (ndarray): the three dimensional mask
+
+    Returns:
+        ndarray: the data of the nifti image within the bounding box of the mask, with the same shape as the image
+    """
+    nonzero = np.nonzero(mask)
+    region = tuple(slice(int(np.min(ind)), int(np.max(ind)) + 1) if len(ind) else slice(0, 0) for ind in nonzero)
+
+    region_data = np.asarray(nifti_image.dataobj[region])
+    data = np.zeros(nifti_image.shape, dtype=region_data.dtype)
+    data[region] = region_data
+    return data
+
 
+def read_nifti_roi(nifti_image, mask, max_block_size=2 ** 26):
+    """Read only the voxels within the given mask from a nifti image.
 
-def load_all_niftis(directory, map_names=None):
+    This reads the image in slabs along the z axis using the data proxy of the image, and only keeps the voxels
+    within the mask of every slab. As such, the complete volume is never in memory. For gzipped files, load the image
+    with ``keep_file_open=True`` (see :func:`load_nifti`) to decompress the file only once.
+
+    Args:
+        nifti_image (:class:`nibabel.spatialimages.SpatialImage`): the (unloaded) nifti image
+        mask (ndarray): the three dimensional mask
+        max_block_size (int): the maximum size in bytes of every slab we read
+
+    Returns:
+        ndarray: the voxels within the mask, with as first dimension the voxels in the same order as
+            :func:`mdt.utils.create_roi` and as other dimensions the remaining dimensions of the image (if any).
+    """
+    mask = np.asarray(mask) > 0
+    nmr_voxels = int(np.count_nonzero(mask))
+
+    voxel_rank = np.zeros(mask.shape, dtype=np.int64)
+    voxel_rank[mask] = np.arange(nmr_voxels)
+
+    z_indices = np.nonzero(np.any(mask, axis=(0, 1)))[0]
+    slice_size = 8 * int(np.prod(nifti_image.shape)) // nifti_image.shape[2]
+    slab_length = int(max(1, max_block_size // slice_size))
+
+    if not len(z_indices):
+        return np.zeros((0,) + nifti_image.shape[3:], dtype=nifti_image.get_data_dtype())
+
+    output = None
+    for start in range(int(z_indices[0]), int(z_indices[-1]) + 1, slab_length):
+        end = min(start + slab_length, int(z_indices[-1]) + 1)
+        slab_mask = mask[:, :, start:end]
+        if not np.any(slab_mask):
+            continue
+
+        slab = np.asarray(nifti_image.dataobj[:, :, start:end])
+        if output is None:
+            output = np.zeros((nmr_voxels,) + slab.shape[3:], dtype=slab.dtype)
+        output[voxel_rank[:, :, start:end][slab_mask]] = slab[slab_mask]
+    return output
+
+
+def load_all_niftis(directory, map_names=None, keep_file_open=None, nmr_threads=None):
     """Loads all niftis in the given directory as nibabel nifti files.
 
     This does not load the data directly, it loads the niftis in a dictionary. To get a direct handle to the image
@@ -46,6 +240,8 @@ def load_all_niftis(directory, map_names=None):
     Args:
         directory (str): the directory from which we want to load the niftis
         map_names (list of str): the names of the maps we want to use. If given, we only use and return these maps.
+        keep_file_open (boolean): see :func:`load_nifti`
+        nmr_threads (int): the number of threads to use for opening the files, defaults to the number of CPUs
 
     Returns:
         dict: A dictionary with the loaded nibabel proxies (see :func:`load_nifti`).
@@ -60,30 +256,77 @@ def load_all_niftis(directory, map_names=None):
                 map_name += extension
             maps_paths.update({map_name: path})
 
-    return {k: load_nifti(v) for k, v in maps_paths.items()}
+    return _map_in_threads(lambda path: load_nifti(path, keep_file_open=keep_file_open), maps_paths, nmr_threads)
 
 
-def get_all_nifti_data(directory, map_names=None, deferred=True):
+def get_all_nifti_data(directory, map_names=None, deferred=True, mask=None, nmr_threads=None):
     """Get the data of all the nifti volumes in the given directory.
 
     If map_names is given we will only load the given map names. Else, we load all .nii and .nii.gz files in the
     given directory.
 
+    When not deferred, the maps are loaded (and decompressed) concurrently using multiple threads. If a mask is given,
+    we only read the voxels within the mask of every map (see :func:`read_nifti_roi`), without constructing the
+    volumes. This always loads the maps directly.
+
+    If the directory contains a results container (see :mod:`mdt.lib.results_container`) we load the maps from that
+    container instead. This also works for subdirectories stored in the container, like ``<model>/covariances``.
+
     Args:
         directory (str): the directory from which we want to read a number of maps
         map_names (list of str): the names of the maps we want to use. If given, we only use and return these maps.
         deferred (boolean): if True we return an deferred loading dictionary instead of a dictionary with the values
             loaded as arrays.
+        mask (ndarray): if given, we return per map only the voxels within this (3d) mask, as an array with as first
+            dimension the voxels in the same order as :func:`mdt.utils.create_roi`.
+        nmr_threads (int): the number of threads to use for loading the maps, defaults to the number of CPUs
 
     Returns:
         dict: A dictionary with the volumes. The keys of the dictionary are the filenames
             without the extension of the .nii(.gz) files in the given directory.
     """
-    proxies = load_all_niftis(directory, map_names=map_names)
+    from mdt.lib.results_container import load_results_container_maps
+    container_maps = load_results_container_maps(directory, map_names=map_names,
+                                                 deferred=deferred and mask is None)
+    if container_maps is not None:
+        if mask is not None:
+            mask = np.asarray(mask) > 0
+            return {k: v[mask] for k, v in container_maps.items()}
+        return container_maps
+
+    if mask is not None:
+        def read_roi(proxy):
+            try:
+                return read_nifti_roi(proxy, mask)
+            finally:
+                close_nifti(proxy)
+
+        proxies = load_all_niftis(directory, map_names=map_names, keep_file_open=True, nmr_threads=nmr_threads)
+        return _map_in_threads(read_roi, proxies, nmr_threads)
+
+    proxies = load_all_niftis(directory, map_names=map_names, nmr_threads=nmr_threads)
     if deferred:
         return DeferredActionDict(lambda _, item: item.get_data(), proxies)
     else:
-        return {k: v.get_data() for k, v in proxies.items()}
+        return _map_in_threads(lambda proxy: proxy.get_data(), proxies, nmr_threads)
+
+
+def _map_in_threads(func, items, nmr_threads=None):
+    """Apply the given function to all the values of the given dictionary using a thread pool.
+
+    Args:
+        func (Callable): the function to apply to every value
+        items (dict): the items to apply the function to
+        nmr_threads (int): the number of threads to use, defaults to the number of CPUs
+
+    Returns:
+        dict: the results of the function, with the same keys as the input
+    """
+    nmr_threads = min(nmr_threads or os.cpu_count() or 1, max(len(items), 1))
+    if nmr_threads == 1:
+        return {k: func(v) for k, v in items.items()}
+    with ThreadPoolExecutor(max_workers=nmr_threads) as executor:
+        return dict(zip(items.keys(), executor.map(func, items.values())))
 
 
 def write_nifti(data, output_fname, header=None, affine=None, use_data_dtype=True, **kwargs):
@@ -129,6 +372,105 @@ def write_nifti(data, output_fname, header=None, affine=None, use_data_dtype=Tru
     format(data, affine, header=header, **kwargs).to_filename(output_fname)
 
 
+class IncrementalNiftiWriter:
+
+    def __init__(self, output_fname, shape, dtype, header=None, nmr_threads=None):
+        """Write a nifti file part by part, without holding the whole volume in memory.
+
+        The data is written to a memory mapped, uncompressed, temporary nifti file. On :meth:`close` this file is
+        moved, or compressed if the output filename ends with ``.gz``, to the output filename. Compression is done
+        in parallel on blocks of the file, written as consecutive gzip members (which is a valid gzip file).
+        Parts of the volume can be written using index assignment, for example::
+
+            with IncrementalNiftiWriter('out.nii.gz', (10, 10, 10, 5), np.float32, header) as writer:
+                for z in range(10):
+                    writer[:, :, z] = ...
+
+        Args:
+            output_fname (str): the name of the resulting nifti file, this function will append .nii.gz if no
+                suitable extension is given.
+            shape (tuple): the shape of the volume to write
+            dtype (np.dtype): the data type of the volume to write
+            header (nibabel header): the nibabel header to use as header for the nifti file. If None we will use
+                a default header. Data scaling in the header is disabled.
+            nmr_threads (int): the number of threads to use for the compression, defaults to the number of CPUs
+        """
+        if not (output_fname.endswith('.nii.gz') or output_fname.endswith('.nii')):
+            output_fname += '.nii.gz'
+
+        if os.path.dirname(output_fname) and not os.path.exists(os.path.dirname(output_fname)):
+            os.makedirs(os.path.dirname(output_fname))
+
+        self._output_fname = output_fname
+        self._tmp_fname = '{}.tmp-{}.nii'.format(output_fname, os.getpid())
+        self._nmr_threads = nmr_threads or os.cpu_count() or 1
+
+        header = copy.deepcopy(header if header is not None else nib.nifti2.Nifti2Header())
+        header.set_data_shape(shape)
+        header.set_data_dtype(np.char if np.dtype(dtype) == np.bool else dtype)
+        header.set_slope_inter(None, None)
+        header['magic'] = header.single_magic
+
+        header_size = len(self._get_header_bytes(header))
+        header.set_data_offset(max(header.single_vox_offset, int(np.ceil(header_size / 16.) * 16)))
+
+        with open(self._tmp_fname, 'wb') as f:
+            header_bytes = self._get_header_bytes(header)
+            f.write(header_bytes)
+            f.write(b'\x00' * (header.get_data_offset() - len(header_bytes)))
+
+        self._data = np.memmap(self._tmp_fname, dtype=header.get_data_dtype(), mode='r+',
+                               offset=header.get_data_offset(), shape=tuple(shape), order='F')
+
+    @property
+    def shape(self):
+        """The shape of the volume we are writing."""
+        return self._data.shape
+
+    def __setitem__(self, index, value):
+        self._data[index] = value
+
+    def close(self):
+        """Finish writing and move the nifti file to the output filename."""
+        self._data.flush()
+        del self._data
+
+        if self._output_fname.endswith('.gz'):
+            _parallel_gzip(self._tmp_fname, self._tmp_fname + '.gz', self._nmr_threads)
+            os.remove(self._tmp_fname)
+            os.replace(self._tmp_fname + '.gz', self._output_fname)
+        else:
+            os.replace(self._tmp_fname, self._output_fname)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            del self._data
+            os.remove(self._tmp_fname)
+
+    @staticmethod
+    def _get_header_bytes(header):
+        with io.BytesIO() as f:
+            header.write_to(f)
+            return f.getvalue()
+
+
+def _parallel_gzip(input_fname, output_fname, nmr_threads, block_size=2 ** 24):
+    """Gzip a file by compressing blocks of the file in parallel, writing every block as a separate gzip member."""
+    with open(input_fname, 'rb') as f_in, open(output_fname, 'wb') as f_out, \
+            ThreadPoolExecutor(max_workers=nmr_threads) as executor:
+        while True:
+            blocks = [block for block in (f_in.read(block_size) for _ in range(nmr_threads)) if block]
+            if not blocks:
+                break
+            for compressed in executor.map(lambda block: gzip.compress(block, compresslevel=1), blocks):
+                f_out.write(compressed)
+
+
 def write_all_as_nifti(volumes, directory, nifti_header=None, overwrite_volumes=True, gzip=True):
     """Write a number of volume maps to the specific directory.
 
@@ -204,6 +546,25 @@ def yield_nifti_info(directory):
             yield f, os.path.basename(f)[0:-len(extension)], extension
 
 
+def get_nifti_map_names(directory):
+    """Get the names of the maps in the given directory, without opening the files.
+
+    If the directory contains a results container (see :mod:`mdt.lib.results_container`) we return the names of the
+    maps in that container instead.
+
+    Args:
+        directory (str): the directory to get the names of the available maps from
+
+    Returns:
+        list of str: the sorted names of the maps, the filenames without the .nii(.gz) extension
+    """
+    from mdt.lib.results_container import load_results_container_maps
+    container_maps = load_results_container_maps(directory)
+    if container_maps is not None:
+        return sorted(container_maps)
+    return sorted(set(map_name for _, map_name, _ in yield_nifti_info(directory)))
+
+
 def is_nifti_file(file_name):
     """Check if the given file is a nifti file.
 
@@ -0,0 +1,262 @@
+"""Estimation of the standard deviation of the Gaussian noise in the original complex image domain.
+
+This module contains a few estimators of the noise std, each using a different part of the data:
+
+- ``unweighted_std``: the mean over the voxels in the brain mask of the std over the unweighted volumes. This
+  method is taken from Camino (http://camino.cs.ucl.ac.uk/index.php?n=Man.Estimatesnr).
+- ``unweighted_mad``: the median absolute deviation of the residuals of the unweighted volumes around their
+  voxel-wise mean, in the brain mask. Being based on the median, this is robust to outliers like motion corrupted
+  volumes or voxels.
+- ``background``: the median of the squared signal in the background, that is, outside of the dilated brain mask.
+  Without signal, the magnitude of the noise follows a Rayleigh distribution, or, for data combined from multiple
+  coils using the sum-of-squares, a chi distribution with ``2 * nmr_coils`` degrees of freedom. This assumes the
+  background was not masked or altered by the reconstruction, and does not hold for parallel imaging methods like
+  SENSE or GRAPPA, which make the noise spatially varying.
+
+The function :func:`estimate_noise_std_in_slabs` applies these estimators to slabs of the data (along the z axis),
+reading one slab at a time. This returns either a single estimate or a noise std map with the estimate of every slab,
+both of which can be used as the ``noise_std`` of the input data (see :func:`mdt.utils.load_input_data`).
+"""
+import numpy as np
+from scipy.ndimage import binary_dilation, generate_binary_structure
+from scipy.stats import chi2
+from mdt.lib.exceptions import NoiseStdEstimationNotPossible
+from mdt.lib.nifti import load_nifti, close_nifti
+from mdt.protocols import load_protocol
+from mdt.utils import load_brain_mask
+
+__author__ = 'Robbert Harms'
+__date__ = '2019-04-17'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+class NoiseStdEstimator:
+    """Base class for the noise std estimators.
+
+    The estimators work on voxel lists, such that they can be applied to all voxels at once or to slabs of the data.
+    The estimates of multiple slabs are combined using :meth:`combine`.
+    """
+
+    def get_region(self, brain_mask):
+        """Get the region of the volume used by this estimator.
+
+        Args:
+            brain_mask (ndarray): the three dimensional brain mask
+
+        Returns:
+            ndarray: a three dimensional boolean mask with the voxels to use
+        """
+        return brain_mask > 0
+
+    def get_volume_indices(self, protocol):
+        """Get the indices of the volumes used by this estimator.
+
+        Args:
+            protocol (mdt.protocols.Protocol): the protocol of the data
+
+        Returns:
+            ndarray: the indices of the volumes to use
+
+        Raises:
+            :class:`~mdt.exceptions.NoiseStdEstimationNotPossible`: if the protocol does not have the right volumes
+        """
+        return np.arange(protocol.length)
+
+    def estimate(self, observations):
+        """Estimate the noise std from the given voxels.
+
+        Args:
+            observations (ndarray): a (n, m) matrix with the n voxels in the region and the m volumes given by
+                :meth:`get_region` and :meth:`get_volume_indices`.
+
+        Returns:
+            tuple: the estimated noise std and the number of samples the estimate is based on, which is used as
+                weight when combining estimates.
+        """
+        raise NotImplementedError()
+
+    def combine(self, estimates, nmr_samples):
+        """Combine the estimates of different parts of the data into one estimate.
+
+        By default this takes the median of the estimates, weighted by the number of samples.
+
+        Args:
+            estimates (ndarray): the estimates of every part
+            nmr_samples (ndarray): the number of samples every estimate is based on
+
+        Returns:
+            float: the combined estimate
+        """
+        estimates = np.asarray(estimates, dtype=np.float64)
+        nmr_samples = np.asarray(nmr_samples, dtype=np.float64)
+
+        sort_index = np.argsort(estimates)
+        cumulative = np.cumsum(nmr_samples[sort_index])
+        return float(estimates[sort_index][np.searchsorted(cumulative, cumulative[-1] / 2.)])
+
+
+class UnweightedStdEstimator(NoiseStdEstimator):
+    """Estimates the noise std as the mean of the voxel-wise std over the unweighted volumes."""
+
+    def get_volume_indices(self, protocol):
+        return _get_unweighted_indices(protocol)
+
+    def estimate(self, observations):
+        return float(np.mean(np.std(observations, axis=1))), observations.shape[0]
+
+    def combine(self, estimates, nmr_samples):
+        return float(np.average(estimates, weights=nmr_samples))
+
+
+class UnweightedMADEstimator(NoiseStdEstimator):
+    """Estimates the noise std from the median absolute deviation of the unweighted volumes around their mean."""
+
+    def get_volume_indices(self, protocol):
+        return _get_unweighted_indices(protocol)
+
+    def estimate(self, observations):
+        nmr_volumes = observations.shape[1]
+        residuals = observations - np.mean(observations, axis=1, keepdims=True)
+
+        # 1.4826 is the ratio of the std and the MAD of the normal distribution, the square root corrects for the
+        # reduced variance of the residuals around the voxel-wise mean
+        std = 1.4826 * np.median(np.abs(residuals)) * np.sqrt(nmr_volumes / (nmr_volumes - 1.))
+        return float(std), residuals.size
+
+
+class BackgroundEstimator(NoiseStdEstimator):
+
+    def __init__(self, nmr_coils=1, mask_dilation=2):
+        """Estimates the noise std from the median of the squared signal in the background.
+
+        Voxels with a signal of exactly zero are ignored, since these are typically set to zero by the
+        reconstruction or by previous processing.
+
+        Args:
+            nmr_coils (int): the effective number of coils of a sum-of-squares reconstruction, one for Rician noise
+            mask_dilation (int): the number of voxels with which we dilate the brain mask before taking the inverse
+                as background, to exclude the partial volume voxels at the edge of the brain
+        """
+        self._nmr_coils = nmr_coils
+        self._mask_dilation = mask_dilation
+
+    def get_region(self, brain_mask):
+        brain_mask = brain_mask > 0
+        if self._mask_dilation:
+            brain_mask = binary_dilation(brain_mask, generate_binary_structure(3, 1), iterations=self._mask_dilation)
+        return np.logical_not(brain_mask)
+
+    def estimate(self, observations):
+        squared = observations[observations > 0] ** 2
+        if not squared.size:
+            return np.nan, 0
+        return float(np.sqrt(np.median(squared) / chi2.median(2 * self._nmr_coils))), squared.size
+
+
+def get_noise_std_estimator(method, **kwargs):
+    """Get the noise std estimator with the given name.
+
+    Args:
+        method (str): the name of the estimator, one of ``unweighted_std``, ``unweighted_mad`` or ``background``
+        **kwargs: the arguments for the constructor of the estimator
+
+    Returns:
+        NoiseStdEstimator: the estimator
+    """
+    estimators = {'unweighted_std': UnweightedStdEstimator,
+                  'unweighted_mad': UnweightedMADEstimator,
+                  'background': BackgroundEstimator}
+    if method not in estimators:
+        raise ValueError('The noise std estimation method "{}" is not supported, please use one of {}.'.format(
+            method, ', '.join(estimators)))
+    return estimators[method](**kwargs)
+
+
+def estimate_noise_std_in_slabs(dwi, protocol, mask, method='unweighted_std', noise_map=False, slab_thickness=8,
+                                min_nmr_samples=1000, **kwargs):
+    """Estimate the noise std by applying an estimator to slabs of the data.
+
+    This reads the data one slab of ``slab_thickness`` slices (along the z axis) at a time and, per slab, only the
+    volumes required by the estimator. The estimates of the slabs are combined into one estimate, see
+    :meth:`NoiseStdEstimator.combine`.
+
+    If ``noise_map`` is set, we return a volume with per slab the estimate of that slab, which captures noise levels
+    varying along the z axis. In slabs with fewer than ``min_nmr_samples`` samples we use the combined estimate.
+    Both the scalar and the map can be given directly as the ``noise_std`` of the input data.
+
+    Args:
+        dwi (str or ndarray or tuple): the filename of the DWI, a 4d array or a tuple with the 4d array and the header
+        protocol (str or mdt.protocols.Protocol): the protocol, or the filename of the protocol
+        mask (str or ndarray): the brain mask, or the filename of the brain mask
+        method (str): the estimation method, see :func:`get_noise_std_estimator`
+        noise_map (boolean): if we return a noise std map instead of a single value
+        slab_thickness (int): the number of slices of every slab
+        min_nmr_samples (int): the minimum number of samples in a slab for using the estimate of that slab in the map
+        **kwargs: the additional arguments for the estimator
+
+    Returns:
+        float or ndarray: the estimated noise std, or the 3d noise std map
+
+    Raises:
+        :class:`~mdt.exceptions.NoiseStdEstimationNotPossible`: if the noise could not be estimated
+    """
+    estimator = get_noise_std_estimator(method, **kwargs)
+    protocol = load_protocol(protocol)
+    mask = load_brain_mask(mask)
+
+    nifti = None
+    if isinstance(dwi, str):
+        nifti = load_nifti(dwi, keep_file_open=True)
+        dwi = nifti.dataobj
+    elif isinstance(dwi, (tuple, list)):
+        dwi = dwi[0]
+
+    region = estimator.get_region(mask)
+    volume_indices = estimator.get_volume_indices(protocol)
+
+    slabs = []
+    estimates = []
+    nmr_samples = []
+    try:
+        for start in range(0, mask.shape[2], slab_thickness):
+            slab = slice(start, min(start + slab_thickness, mask.shape[2]))
+            slab_region = region[:, :, slab]
+            if not np.any(slab_region):
+                continue
+
+            observations = np.zeros((np.count_nonzero(slab_region), len(volume_indices)))
+            for ind, volume_ind in enumerate(volume_indices):
+                observations[:, ind] = np.asarray(dwi[:, :, slab, int(volume_ind)])[slab_region]
+
+            estimate, samples = estimator.estimate(observations)
+            if samples and np.isfinite(estimate) and estimate > 0:
+                slabs.append(slab)
+                estimates.append(estimate)
+                nmr_samples.append(samples)
+    finally:
+        if nifti is not None:
+            close_nifti(nifti)
+
+    if not estimates:
+        raise NoiseStdEstimationNotPossible('No part of the data could be used for estimating the noise std.')
+
+    noise_std = estimator.combine(estimates, nmr_samples)
+
+    if not noise_map:
+        return noise_std
+
+    volume = np.full(mask.shape, noise_std)
+    for slab, estimate, samples in zip(slabs, estimates, nmr_samples):
+        if samples >= min_nmr_samples:
+            volume[:, :, slab] = estimate
+    return volume
+
+
+def _get_unweighted_indices(protocol):
+    """Get the indices of the unweighted volumes, at least two are required for estimating a std."""
+    unweighted_indices = protocol.get_unweighted_indices()
+    if len(unweighted_indices) < 2:
+        raise NoiseStdEstimationNotPossible('Not enough unweighted volumes for this estimator.')
+    return unweighted_indices
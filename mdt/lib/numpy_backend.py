@@ -0,0 +1,646 @@
+"""A vectorized NumPy compute backend for small problems.
+
+All regular model fitting and sampling in MDT goes through OpenCL code generation and compilation. For very small
+problems, like a single voxel debug run or a small ROI, the compilation time dominates the total runtime. For a
+limited set of compartment models, this module provides a NumPy implementation of the composite model, the likelihood
+and the prior, evaluated on all (voxels x observations) at once. On top of that it provides a vectorized
+Nelder-Mead simplex optimizer and a (Adaptive) Metropolis-Within-Gibbs sampler.
+
+If enabled in the ``numpy_backend`` section of the configuration (disabled by default), the processing strategies
+switch automatically to this backend if the number of voxels is below the configured threshold, if the model is
+supported by this backend and if the requested optimizer or sampler is implemented by this module. That is, the
+Nelder-Mead optimizer and the AMWG and MWG samplers. All other methods are computed using OpenCL.
+"""
+import ast
+import functools
+import operator
+import re
+import numpy as np
+from scipy.special import i0e
+from mot.sample.base import SimpleSampleOutput
+
+from mdt.lib.exceptions import NumpyBackendNotSupported
+from mdt.model_building.parameter_functions.priors import UniformWithinBoundsPrior
+from mdt.model_building.parameters import ProtocolParameter, FreeParameter, CurrentObservationParam, \
+    CurrentModelSignalParam, DataCacheParameter
+from mdt.utils import spherical_to_cartesian, tensor_spherical_to_cartesian, PackedCovariances
+
+__author__ = 'Robbert Harms'
+__date__ = '2019-03-11'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+def _directional_cosines(g, theta, phi):
+    """Get for every voxel the dot product between the gradient directions and the orientation vector.
+
+    Args:
+        g (ndarray): the (n, 3) gradient directions
+        theta (ndarray): the (d, 1) inclination angles
+        phi (ndarray): the (d, 1) azimuth angles
+
+    Returns:
+        ndarray: a (d, n) matrix with the dot products
+    """
+    return np.dot(spherical_to_cartesian(theta[:, 0], phi[:, 0]), np.transpose(g))
+
+
+def _ball(b, d):
+    return np.exp(-d * b)
+
+
+def _stick(g, b, d, theta, phi):
+    return np.exp(-b * d * _directional_cosines(g, theta, phi) ** 2)
+
+
+def _zeppelin(g, b, d, dperp0, theta, phi):
+    return np.exp(-b * ((d - dperp0) * _directional_cosines(g, theta, phi) ** 2 + dperp0))
+
+
+def _tensor(g, b, d, dperp0, dperp1, theta, phi, psi):
+    vec0, vec1, vec2 = tensor_spherical_to_cartesian(theta[:, 0], phi[:, 0], psi[:, 0])
+    adc = (d * np.dot(vec0, np.transpose(g)) ** 2
+           + dperp0 * np.dot(vec1, np.transpose(g)) ** 2
+           + dperp1 * np.dot(vec2, np.transpose(g)) ** 2)
+    return np.exp(-b * adc)
+
+
+def _s0(s0):
+    return s0
+
+
+def _weight(w):
+    return w
+
+
+_COMPARTMENT_FUNCTIONS = {
+    'Ball': _ball,
+    'Stick': _stick,
+    'Zeppelin': _zeppelin,
+    'Tensor': _tensor,
+    'S0': _s0,
+    'Weight': _weight
+}
+"""The NumPy implementations of the supported compartments, by CL function name."""
+
+
+_COMPARTMENT_PRIORS = {
+    'Tensor': lambda d, dperp0, dperp1, **_: (dperp1 < dperp0) & (dperp0 < d)
+}
+"""The NumPy implementations of the compartment priors, these need to match the ``extra_prior`` of the templates."""
+
+
+def _gaussian(observation, model_evaluation, sigma):
+    return -(observation - model_evaluation) ** 2 / (2 * sigma ** 2) - np.log(sigma * np.sqrt(2 * np.pi))
+
+
+def _offset_gaussian(observation, model_evaluation, sigma):
+    return _gaussian(observation, np.hypot(model_evaluation, sigma), sigma)
+
+
+def _rician(observation, model_evaluation, sigma):
+    obs_div = observation / sigma
+    eval_div = model_evaluation / sigma
+    bessel_arg = obs_div * eval_div
+    with np.errstate(divide='ignore'):
+        return (np.log(obs_div / sigma)
+                - (obs_div * obs_div + eval_div * eval_div) / 2
+                + np.log(i0e(bessel_arg)) + np.abs(bessel_arg))
+
+
+_LIKELIHOOD_FUNCTIONS = {
+    'Gaussian': _gaussian,
+    'OffsetGaussian': _offset_gaussian,
+    'Rician': _rician
+}
+"""The NumPy implementations of the supported likelihood functions, by CL function name."""
+
+
+_OPERATORS = {'*': operator.mul, '/': operator.truediv, '+': operator.add, '-': operator.sub}
+
+
+_CL_FUNCTIONS = {
+    'max': np.maximum, 'fmax': np.maximum, 'min': np.minimum, 'fmin': np.minimum,
+    'fabs': np.abs, 'pow': np.power, 'pown': np.power, 'exp': np.exp, 'log': np.log, 'sqrt': np.sqrt,
+    'sin': np.sin, 'cos': np.cos, 'tan': np.tan, 'acos': np.arccos, 'asin': np.arcsin, 'atan': np.arctan,
+    'atan2': np.arctan2, 'clamp': np.clip
+}
+"""Mapping of the CL functions that may be used in a parameter dependency to their NumPy counterparts."""
+
+_DEPENDENCY_AST_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Call, ast.Name, ast.Load, ast.Num,
+                         ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.USub, ast.UAdd) \
+    + ((ast.Constant,) if hasattr(ast, 'Constant') else ())
+"""The syntax elements allowed in the parameter dependencies, see :meth:`NumpyModelBackend._compile_dependency`."""
+
+
+class NumpyModelBackend:
+
+    def __init__(self, model_tree, likelihood_function, estimable_parameters, fixed_parameters,
+                 dependent_parameters, protocol, observations, lower_bounds, upper_bounds,
+                 volume_weights=None, weight_indices=None):
+        """A NumPy implementation of a composite model, for the voxels currently being analyzed.
+
+        Args:
+            model_tree (mdt.model_building.trees.CompartmentModelTree): the model tree object
+            likelihood_function (mdt.model_building.likelihood_functions.LikelihoodFunction): the likelihood function
+            estimable_parameters (list of tuple): the (compartment, parameter) tuples of the estimable parameters,
+                in the same order as the parameter vectors handed to the methods of this class.
+            fixed_parameters (dict): per fixed parameter (``<compartment>.<param>``) a scalar or a vector with a
+                value per voxel.
+            dependent_parameters (list of tuple): per dependent parameter a tuple with the name
+                (``<compartment>.<param>``) and the assignment code, in CL, with the parameters in underscore notation.
+            protocol (dict): per protocol parameter name the protocol values.
+            observations (ndarray): the (d, n) matrix with the observations for d voxels and n volumes.
+            lower_bounds (ndarray): the (d, p) matrix with the lower bounds for each of the estimable parameters
+            upper_bounds (ndarray): the (d, p) matrix with the upper bounds for each of the estimable parameters
+            volume_weights (ndarray): optional (d, n) matrix with per voxel the weights of the volumes in the
+                likelihood
+            weight_indices (list of int): the indices of the estimable weights that should sum to at most one
+
+        Raises:
+            mdt.lib.exceptions.NumpyBackendNotSupported: if any of the model components is not supported
+        """
+        self._model_tree = model_tree
+        self._likelihood_function = likelihood_function
+        self._estimable_parameters = estimable_parameters
+        self._estimable_names = ['{}.{}'.format(m.name, p.name) for m, p in estimable_parameters]
+        self._observations = np.asarray(observations, dtype=np.float64)
+        self._nmr_voxels, self._nmr_observations = self._observations.shape
+        self._lower_bounds = lower_bounds
+        self._upper_bounds = upper_bounds
+        self._volume_weights = None
+        if volume_weights is not None:
+            self._volume_weights = np.asarray(volume_weights, dtype=np.float64)
+        self._weight_indices = list(weight_indices or [])
+
+        self._compartments = list(model_tree.get_compartment_models())
+        self._check_support()
+
+        self._protocol = {name: self._prepare_protocol_value(name, value) for name, value in protocol.items()}
+        self._fixed_parameters = {name: self._as_voxel_column(value) for name, value in fixed_parameters.items()}
+        self._dependent_parameters = [(name, self._compile_dependency(name, code))
+                                      for name, code in dependent_parameters]
+        self._check_dependencies()
+
+        self._spherical_indices = self._get_spherical_indices()
+        self._moduli = [(ind, p.sampling_proposal_modulus) for ind, (m, p) in enumerate(estimable_parameters)
+                        if getattr(p, 'sampling_proposal_modulus', None) is not None]
+
+    @property
+    def nmr_parameters(self):
+        return len(self._estimable_parameters)
+
+    def evaluate(self, parameters):
+        """Evaluate the composite model for every voxel and every observation.
+
+        Args:
+            parameters (ndarray): the (d, p) matrix with the estimable parameters
+
+        Returns:
+            ndarray: the (d, n) matrix with the model signal
+        """
+        return self._evaluate_model(self._get_parameter_values(parameters))
+
+    def get_log_likelihoods(self, parameters):
+        """Compute the log-likelihood of every voxel.
+
+        Args:
+            parameters (ndarray): the (d, p) matrix with the estimable parameters
+
+        Returns:
+            ndarray: the (d,) vector with the log-likelihoods
+        """
+        values = self._get_parameter_values(parameters)
+
+        kwargs = {}
+        for p in self._likelihood_function.get_parameters():
+            if isinstance(p, CurrentObservationParam):
+                kwargs[p.name] = self._observations
+            elif isinstance(p, CurrentModelSignalParam):
+                kwargs[p.name] = self._evaluate_model(values)
+            else:
+                kwargs[p.name] = values['{}.{}'.format(self._likelihood_function.name, p.name)]
+
+        lls = _LIKELIHOOD_FUNCTIONS[self._likelihood_function.get_cl_function_name()](**kwargs)
+
+        if self._volume_weights is not None:
+            lls = lls * self._volume_weights
+        return np.nan_to_num(np.sum(lls, axis=1))
+
+    def get_log_priors(self, parameters):
+        """Compute the log-prior of every voxel.
+
+        Args:
+            parameters (ndarray): the (d, p) matrix with the estimable parameters
+
+        Returns:
+            ndarray: the (d,) vector with the log-priors, this is either 0 or -inf.
+        """
+        prior = np.all((parameters >= self._lower_bounds) & (parameters <= self._upper_bounds), axis=1)
+
+        if len(self._weight_indices) > 1:
+            prior &= np.sum(parameters[:, self._weight_indices], axis=1) <= 1
+
+        values = self._get_parameter_values(parameters)
+        for compartment in self._compartments:
+            if compartment.get_model_function_priors():
+                kwargs = {p.name: values['{}.{}'.format(compartment.name, p.name)][:, 0]
+                          for p in compartment.get_parameters() if isinstance(p, FreeParameter)}
+                prior &= _COMPARTMENT_PRIORS[compartment.get_cl_function_name()](**kwargs)
+
+        with np.errstate(divide='ignore'):
+            return np.log(prior.astype(np.float64))
+
+    def get_dependent_parameter_maps(self, results_dict):
+        """Compute the maps of the dependent parameters from the estimated parameters.
+
+        Args:
+            results_dict (dict): the maps of (at least) the estimable parameters
+
+        Returns:
+            dict: the maps of the dependent parameters
+        """
+        if not self._dependent_parameters:
+            return {}
+        parameters = np.column_stack([np.squeeze(results_dict[name]) for name in self._estimable_names])
+        values = self._get_parameter_values(parameters)
+        return {name: values[name][:, 0] for name, _ in self._dependent_parameters}
+
+    def minimize(self, x0, patience=200, scale=0.1, xatol=1e-4, fatol=1e-4):
+        """Minimize the negative log-likelihood using a vectorized Nelder-Mead simplex method.
+
+        Every voxel has its own simplex, the simplex operations are performed on all voxels at once. This uses the
+        adaptive coefficients of Gao and Han (2012). Instead of using a parameter transformation, the parameters are
+        projected into the feasible region before each function evaluation.
+
+        Args:
+            x0 (ndarray): the (d, p) matrix with the starting points
+            patience (int): the maximum number of iterations is given by ``patience * (p + 1)``
+            scale (float): the size of the initial simplex relative to the starting point
+            xatol (float): the tolerance on the simplex size, relative to the initial simplex
+            fatol (float): the absolute tolerance on the function value differences in the simplex
+
+        Returns:
+            dict: with the optimized points under 'x' and the return codes under 'status'. Similar to MOT, the
+                return code is 1 if the simplex converged, 6 if we exhausted our patience.
+        """
+        nmr_params = x0.shape[1]
+        x0 = self.project(np.asarray(x0, dtype=np.float64))
+
+        steps = np.where(x0 != 0, scale * np.abs(x0), scale * np.minimum(self._upper_bounds - self._lower_bounds, 1))
+        steps = np.where(x0 + steps > self._upper_bounds, -steps, steps)
+        steps[steps == 0] = 0.00025
+
+        def objective(simplex_point):
+            f = -self.get_log_likelihoods(self.project(x0 + simplex_point * steps))
+            f[~np.isfinite(f)] = np.inf
+            return f
+
+        alpha, gamma, beta, delta = 1, 1 + 2. / nmr_params, 0.75 - 1 / (2. * nmr_params), 1 - 1. / nmr_params
+
+        simplex = np.zeros((self._nmr_voxels, nmr_params + 1, nmr_params))
+        simplex[:, 1:, :] = np.eye(nmr_params)[None, ...]
+        fvals = np.stack([objective(simplex[:, ind]) for ind in range(nmr_params + 1)], axis=1)
+
+        converged = np.zeros(self._nmr_voxels, dtype=np.bool)
+
+        for _ in range(patience * (nmr_params + 1)):
+            order = np.argsort(fvals, axis=1)
+            simplex = np.take_along_axis(simplex, order[..., None], axis=1)
+            fvals = np.take_along_axis(fvals, order, axis=1)
+
+            converged |= ((np.max(np.abs(simplex[:, 1:] - simplex[:, :1]), axis=(1, 2)) <= xatol)
+                          & (np.max(np.abs(fvals[:, 1:] - fvals[:, :1]), axis=1) <= fatol))
+            if np.all(converged):
+                break
+
+            best, worst, second_worst = fvals[:, 0], fvals[:, -1], fvals[:, -2]
+            centroid = np.mean(simplex[:, :-1], axis=1)
+
+            reflected = centroid + alpha * (centroid - simplex[:, -1])
+            f_reflected = objective(reflected)
+
+            expanded = centroid + gamma * (reflected - centroid)
+            f_expanded = objective(expanded)
+
+            outside = f_reflected < worst
+            contracted = np.where(outside[:, None],
+                                  centroid + beta * (reflected - centroid),
+                                  centroid + beta * (simplex[:, -1] - centroid))
+            f_contracted = objective(contracted)
+
+            new_point = np.copy(simplex[:, -1])
+            new_fval = np.copy(worst)
+
+            use_expanded = (f_reflected < best) & (f_expanded < f_reflected)
+            use_reflected = ~use_expanded & (f_reflected < second_worst)
+            use_contracted = (~use_expanded & ~use_reflected
+                              & np.where(outside, f_contracted <= f_reflected, f_contracted < worst))
+            shrink = ~(use_expanded | use_reflected | use_contracted) & ~converged
+
+            for mask, point, fval in [(use_expanded, expanded, f_expanded),
+                                      (use_reflected, reflected, f_reflected),
+                                      (use_contracted, contracted, f_contracted)]:
+                mask = mask & ~converged
+                new_point[mask] = point[mask]
+                new_fval[mask] = fval[mask]
+
+            simplex[:, -1] = new_point
+            fvals[:, -1] = new_fval
+
+            if np.any(shrink):
+                shrunken = simplex[:, :1] + delta * (simplex - simplex[:, :1])
+                for ind in range(1, nmr_params + 1):
+                    f_shrunken = objective(shrunken[:, ind])
+                    simplex[shrink, ind] = shrunken[shrink, ind]
+                    fvals[shrink, ind] = f_shrunken[shrink]
+
+        best_points = simplex[np.arange(self._nmr_voxels), np.argmin(fvals, axis=1)]
+        return {'x': self.project(x0 + best_points * steps),
+                'status': np.where(converged, 1, 6).astype(np.int8)}
+
+    def sample(self, x0, proposal_stds, nmr_samples, burnin=0, thinning=1, adaptive=True,
+               target_acceptance_rate=0.44, batch_size=50, damping_factor=1, min_val=1e-15, max_val=1e3,
+               sampler_state=None, **kwargs):
+        """Sample the posterior using a vectorized (Adaptive) Metropolis-Within-Gibbs sampler.
+
+        With ``adaptive`` set to True, this follows the Adaptive Metropolis-Within-Gibbs method of MOT, else it is
+        a plain Metropolis-Within-Gibbs sampler.
+
+        Since this uses the NumPy random number generator, the ``rng_state`` element of a sampler state is
+        neither used nor returned.
+
+        Args:
+            x0 (ndarray): the (d, p) matrix with the starting points
+            proposal_stds (ndarray): the (d, p) matrix with the initial proposal standard deviations
+            nmr_samples (int): the number of samples to return
+            burnin (int): the number of samples to discard before storing samples
+            thinning (int): we store every n'th sample after the burn-in
+            adaptive (boolean): if we adapt the proposal standard deviations during sampling
+            target_acceptance_rate (float): the target acceptance rate of the adaptive sampler
+            batch_size (int): the number of iterations in between proposal updates
+            damping_factor (int): how fast the adaptation moves to zero
+            min_val (float): the minimum value of the proposal standard deviations
+            max_val (float): the maximum value of the proposal standard deviations
+            sampler_state (dict): the state of a previous sampling run to continue from, see
+                :mod:`mdt.lib.sampler_state`. If given, this takes precedence over ``x0`` and ``proposal_stds``.
+            **kwargs: other sampler settings which have no meaning in this sampler.
+
+        Returns:
+            tuple: the :class:`mot.sample.base.SimpleSampleOutput` with the samples, log likelihoods and log priors,
+                and a dictionary with the final state of the sampler.
+        """
+        thinning = max(thinning, 1)
+        nmr_params = x0.shape[1]
+        sampler_state = sampler_state or {}
+
+        position = np.array(sampler_state.get('current_chain_position', x0), dtype=np.float64)
+        proposal_stds = np.array(np.broadcast_to(sampler_state.get('proposal_stds', proposal_stds), position.shape),
+                                 dtype=np.float64)
+        log_likelihood = self.get_log_likelihoods(position)
+        log_prior = self.get_log_priors(position)
+        acceptance_counter = np.array(sampler_state.get('acceptance_counter', np.zeros(position.shape)),
+                                      dtype=np.uint64)
+        iteration_offset = int(np.max(sampler_state.get('sampling_index', 0)))
+
+        samples = np.zeros((self._nmr_voxels, nmr_params, nmr_samples), dtype=np.float32)
+        log_likelihoods = np.zeros((self._nmr_voxels, nmr_samples), dtype=np.float32)
+        log_priors = np.zeros((self._nmr_voxels, nmr_samples), dtype=np.float32)
+
+        for iteration in range(burnin + nmr_samples * thinning):
+            current_iteration = iteration_offset + iteration
+            if adaptive and current_iteration > 0 and current_iteration % batch_size == 0:
+                adaption = np.exp(np.sqrt(1.0 / (damping_factor * (current_iteration // batch_size))))
+                proposal_stds = np.where(acceptance_counter / float(batch_size) > target_acceptance_rate,
+                                         proposal_stds * adaption, proposal_stds / adaption)
+                proposal_stds = np.clip(proposal_stds, min_val, max_val)
+                acceptance_counter[:] = 0
+
+            for param_ind in range(nmr_params):
+                proposal = np.copy(position)
+                proposal[:, param_ind] += np.random.normal(0, proposal_stds[:, param_ind])
+                proposal = self.finalize_proposal(proposal)
+
+                new_log_prior = self.get_log_priors(proposal)
+                new_log_likelihood = np.full(self._nmr_voxels, -np.inf)
+                within_prior = np.isfinite(new_log_prior)
+                if np.any(within_prior):
+                    new_log_likelihood[within_prior] = self.get_log_likelihoods(proposal)[within_prior]
+
+                with np.errstate(invalid='ignore'):
+                    accepted = within_prior & (np.log(np.random.uniform(size=self._nmr_voxels))
+                                               < (new_log_likelihood + new_log_prior) - (log_likelihood + log_prior))
+
+                position[accepted] = proposal[accepted]
+                log_likelihood[accepted] = new_log_likelihood[accepted]
+                log_prior[accepted] = new_log_prior[accepted]
+                acceptance_counter[accepted, param_ind] += 1
+
+            if iteration >= burnin and (iteration - burnin) % thinning == 0:
+                sample_ind = (iteration - burnin) // thinning
+                samples[..., sample_ind] = position
+                log_likelihoods[:, sample_ind] = log_likelihood
+                log_priors[:, sample_ind] = log_prior
+
+        final_state = {'current_chain_position': position,
+                       'current_log_likelihood': log_likelihood,
+                       'current_log_prior': log_prior,
+                       'proposal_stds': proposal_stds,
+                       'acceptance_counter': acceptance_counter,
+                       'sampling_index': np.full(self._nmr_voxels, iteration_offset + burnin + nmr_samples * thinning,
+                                                 dtype=np.uint64)}
+        return SimpleSampleOutput(samples, log_likelihoods, log_priors), final_state
+
+    def compute_fisher_information_matrix(self, parameters):
+        """Compute the standard deviations and covariances using the inverse of the numerical Hessian.
+
+        This is the NumPy counterpart of the Fisher Information Matrix computation in the composite model. It
+        uses central differences with a step size derived from the numerical differentiation information of the
+        parameters.
+
+        Args:
+            parameters (ndarray): the (d, p) matrix with the estimated parameters
+
+        Returns:
+            dict: with the standard deviations under 'stds' and the covariances under 'covariances', the latter
+                as a :class:`mdt.utils.PackedCovariances`.
+        """
+        nmr_params = parameters.shape[1]
+        scales = np.array([p.numdiff_info.scaling_factor for _, p in self._estimable_parameters])
+        steps = np.array([p.numdiff_info.max_step for _, p in self._estimable_parameters]) / 16. / scales
+
+        def objective(offsets):
+            return -self.get_log_likelihoods(parameters + offsets * steps[None, :])
+
+        def offset(*indices_signs):
+            result = np.zeros(nmr_params)
+            for ind, sign in indices_signs:
+                result[ind] += sign
+            return result
+
+        center = objective(offset())
+        hessian = np.zeros((self._nmr_voxels, nmr_params, nmr_params))
+        for x_ind in range(nmr_params):
+            hessian[:, x_ind, x_ind] = (objective(offset((x_ind, 1))) - 2 * center
+                                        + objective(offset((x_ind, -1)))) / steps[x_ind] ** 2
+
+            for y_ind in range(x_ind + 1, nmr_params):
+                value = (objective(offset((x_ind, 1), (y_ind, 1))) - objective(offset((x_ind, 1), (y_ind, -1)))
+                         - objective(offset((x_ind, -1), (y_ind, 1))) + objective(offset((x_ind, -1), (y_ind, -1))))
+                hessian[:, x_ind, y_ind] = hessian[:, y_ind, x_ind] = value / (4 * steps[x_ind] * steps[y_ind])
+
+        hessian = np.nan_to_num(hessian * np.outer(1 / scales, 1 / scales)[None, ...])
+        covars = np.linalg.pinv(hessian) * np.outer(1 / scales, 1 / scales)[None, ...]
+
+        stds = {}
+        for x_ind in range(nmr_params):
+            with np.errstate(invalid='ignore'):
+                stds[self._estimable_names[x_ind] + '.std'] = np.nan_to_num(np.sqrt(covars[:, x_ind, x_ind]))
+
+        packed = covars[:, np.triu_indices(nmr_params)[0], np.triu_indices(nmr_params)[1]]
+        return {'stds': stds, 'covariances': PackedCovariances(packed, self._estimable_names)}
+
+    def project(self, parameters):
+        """Project the given parameters into the feasible region.
+
+        This clips the parameters to their bounds and scales the estimable weights such that they sum to at most one.
+
+        Args:
+            parameters (ndarray): the (d, p) matrix with parameters
+
+        Returns:
+            ndarray: the feasible parameters
+        """
+        parameters = np.clip(parameters, self._lower_bounds, self._upper_bounds)
+        if len(self._weight_indices) > 1:
+            weight_sum = np.sum(parameters[:, self._weight_indices], axis=1)
+            too_large = weight_sum > 1
+            parameters[np.ix_(too_large, self._weight_indices)] /= weight_sum[too_large, None]
+        return parameters
+
+    def finalize_proposal(self, parameters):
+        """The NumPy counterpart of the proposal callbacks of the compartments.
+
+        This maps the spherical coordinates to the right hemisphere and applies the proposal modulus.
+
+        Args:
+            parameters (ndarray): the (d, p) matrix with parameters, this is altered in place
+
+        Returns:
+            ndarray: the same matrix, for chaining
+        """
+        for theta_ind, phi_ind in self._spherical_indices:
+            outside = (parameters[:, phi_ind] > np.pi) | (parameters[:, phi_ind] < 0)
+            parameters[:, phi_ind] += np.where(parameters[:, phi_ind] > np.pi, -np.pi, 0)
+            parameters[:, phi_ind] += np.where(parameters[:, phi_ind] < 0, np.pi, 0)
+            parameters[outside, theta_ind] = np.pi - parameters[outside, theta_ind]
+
+        for ind, modulus in self._moduli:
+            parameters[:, ind] -= np.floor(parameters[:, ind] / modulus) * modulus
+        return parameters
+
+    def _evaluate_model(self, values):
+        signal = self._evaluate_tree(self._model_tree, values)
+        return np.broadcast_to(signal, (self._nmr_voxels, self._nmr_observations))
+
+    def _evaluate_tree(self, node, values):
+        if not node.children:
+            compartment = node.data
+            kwargs = {}
+            for p in compartment.get_parameters():
+                if isinstance(p, DataCacheParameter):
+                    continue
+                elif isinstance(p, ProtocolParameter):
+                    kwargs[p.name] = self._protocol[p.name]
+                else:
+                    kwargs[p.name] = values['{}.{}'.format(compartment.name, p.name)]
+            return _COMPARTMENT_FUNCTIONS[compartment.get_cl_function_name()](**kwargs)
+        return functools.reduce(_OPERATORS[node.data], [self._evaluate_tree(child, values) for child in node.children])
+
+    def _get_parameter_values(self, parameters):
+        """Get all the free parameter values as (d, 1) columns, keyed by ``<compartment>.<param>``."""
+        values = dict(self._fixed_parameters)
+        for ind, name in enumerate(self._estimable_names):
+            values[name] = parameters[:, [ind]]
+
+        if self._dependent_parameters:
+            namespace = dict(_CL_FUNCTIONS)
+            namespace.update({name.replace('.', '_'): value for name, value in values.items()})
+
+            for name, code in self._dependent_parameters:
+                values[name] = self._as_voxel_column(eval(code, {'__builtins__': {}}, namespace))
+                namespace[name.replace('.', '_')] = values[name]
+        return values
+
+    def _as_voxel_column(self, value):
+        value = np.asarray(value, dtype=np.float64)
+        if value.ndim == 0 or value.size == 1:
+            return np.full((self._nmr_voxels, 1), value.item())
+        return np.reshape(value, (self._nmr_voxels, 1))
+
+    def _prepare_protocol_value(self, name, value):
+        value = np.asarray(value, dtype=np.float64)
+        if value.size == 1 or np.all(value == value.flat[0]):
+            return value.flat[0]
+        if value.shape[0] != self._nmr_observations:
+            raise NumpyBackendNotSupported('Voxel dependent protocol parameter "{}" is not supported.'.format(name))
+        if value.ndim == 1 or value.shape[1] == 1:
+            return np.reshape(value, (1, -1))
+        return value
+
+    def _compile_dependency(self, name, code):
+        """Compile the CL code of a parameter dependency to a Python expression.
+
+        Only arithmetic on names and numbers, and calls to the functions in ``_CL_FUNCTIONS``, are allowed.
+        """
+        cl_casts = r'\(\s*(const\s+)?(double|float|mot_float_type|int|uint|long|ulong)\s*\)'
+        try:
+            tree = ast.parse(re.sub(cl_casts, '', code).strip(), mode='eval')
+        except SyntaxError:
+            raise NumpyBackendNotSupported('The dependency "{}" of "{}" is not supported.'.format(code, name))
+
+        for node in ast.walk(tree):
+            if not isinstance(node, _DEPENDENCY_AST_NODES) \
+                    or (isinstance(node, ast.Name) and node.id.startswith('_')) \
+                    or (isinstance(node, ast.Call) and (not isinstance(node.func, ast.Name)
+                                                        or node.func.id not in _CL_FUNCTIONS or node.keywords)):
+                raise NumpyBackendNotSupported('The dependency "{}" of "{}" is not supported.'.format(code, name))
+        return compile(tree, '<dependency {}>'.format(name), 'eval')
+
+    def _check_dependencies(self):
+        try:
+            self._get_parameter_values(self._lower_bounds)
+        except (NameError, TypeError, ValueError) as exc:
+            raise NumpyBackendNotSupported('The parameter dependencies are not supported: {}'.format(exc))
+
+    def _get_spherical_indices(self):
+        indices = []
+        for compartment in self._compartments:
+            names = ['{}.{}'.format(compartment.name, p) for p in ('theta', 'phi')]
+            if all(name in self._estimable_names for name in names):
+                indices.append(tuple(self._estimable_names.index(name) for name in names))
+        return indices
+
+    def _check_support(self):
+        if self._likelihood_function.get_cl_function_name() not in _LIKELIHOOD_FUNCTIONS:
+            raise NumpyBackendNotSupported('The likelihood function "{}" is not supported.'.format(
+                self._likelihood_function.get_cl_function_name()))
+
+        for compartment in self._compartments:
+            function_name = compartment.get_cl_function_name()
+            if function_name not in _COMPARTMENT_FUNCTIONS:
+                raise NumpyBackendNotSupported('The compartment "{}" is not supported.'.format(function_name))
+            if compartment.get_model_function_priors() and function_name not in _COMPARTMENT_PRIORS:
+                raise NumpyBackendNotSupported('The prior of compartment "{}" is not supported.'.format(function_name))
+            # the NumPy implementations compute the precomputed values themselves, so we can ignore the data cache
+            if not all(isinstance(p, (ProtocolParameter, FreeParameter, DataCacheParameter))
+                       for p in compartment.get_parameters()):
+                raise NumpyBackendNotSupported('The parameters of "{}" are not supported.'.format(function_name))
+
+        for m, p in self._estimable_parameters:
+            if p.name not in [param.name for param in m.get_parameters()]:
+                raise NumpyBackendNotSupported('Prior parameters are not supported.')
+            if not isinstance(p.sampling_prior, UniformWithinBoundsPrior):
+                raise NumpyBackendNotSupported('The prior of parameter "{}.{}" is not supported.'.format(
+                    m.name, p.name))
@@ -1,15 +1,19 @@
 """This module contains various standard post-processing routines for use after optimization or sample."""
+import functools
+import itertools
+import time
 import numpy as np
+from scipy.special import dawsn
 
+from mdt.configuration import get_dki_measures_settings
+from mdt.lib.function_inversion import MonotoneFunctionInverse
+from mdt.lib.special_functions import carlson_rf, carlson_rd
+from mdt.lib.spherical_quadrature import get_hemisphere_quadrature, get_semicircle_angles
 from mdt.lib.sorting import create_2d_sort_matrix
-from mdt.utils import tensor_spherical_to_cartesian, tensor_cartesian_to_spherical, \
-    voxelwise_vector_matrix_vector_product, create_covariance_matrix
-from mot import minimize
-from mot.lib.cl_function import SimpleCLFunction
+from mdt.utils import tensor_cartesian_to_spherical
 from mot.lib.utils import split_in_batches, parse_cl_function
-from mot.lib.kernel_data import Array, Zeros, Scalar, Struct
+from mot.lib.kernel_data import Array, Zeros, Scalar
 from mdt.lib.components import get_component
-from mot.library_functions import dawson
 
 __author__ = 'Robbert Harms'
 __date__ = '2017-12-10'
@@ -126,33 +130,16 @@ class DTIMeasures:
             dict: as keys typical elements like 'FA and 'MD' as interesting output and as per values the maps.
                 These maps are per voxel, and optionally per instance per voxel
         """
-        output = {
-            'FA': DTIMeasures.fractional_anisotropy(results['d'], results['dperp0'], results['dperp1']),
-            'MD': (results['d'] + results['dperp0'] + results['dperp1']) / 3.,
-            'AD': results['d'],
-            'RD': (results['dperp0'] + results['dperp1']) / 2.0,
-        }
+        angles = {}
+        if all(el in results for el in ['theta', 'phi', 'psi']):
+            angles = {'theta': results['theta'], 'phi': results['phi'], 'psi': results['psi']}
 
+        stds = None
         if all('{}.std'.format(el) in results for el in ['d', 'dperp0', 'dperp1']):
-            output.update({
-                'FA.std': DTIMeasures.fractional_anisotropy_std(
-                    results['d'], results['dperp0'], results['dperp1'],
-                    results['d.std'], results['dperp0.std'], results['dperp1.std'],
-                    covariances=results.get('covariances', None)
-                ),
-                'MD.std': np.sqrt(results['d.std'] + results['dperp0.std'] + results['dperp1.std']) / 3.,
-                'AD.std': results['d.std'],
-                'RD.std': (results['dperp0.std'] + results['dperp1.std']) / 2.0,
-            })
+            stds = (results['d.std'], results['dperp0.std'], results['dperp1.std'])
 
-        if all(el in results for el in ['theta', 'phi', 'psi']):
-            eigenvectors = tensor_spherical_to_cartesian(np.squeeze(results['theta']),
-                                                         np.squeeze(results['phi']),
-                                                         np.squeeze(results['psi']))
-            for ind in range(3):
-                output.update({'vec{}'.format(ind): eigenvectors[ind]})
-
-        return output
+        return DTIMeasures.compute_measures(results['d'], results['dperp0'], results['dperp1'], stds=stds,
+                                            covariances=results.get('covariances', None), **angles)
 
     @staticmethod
     def extra_sampling_maps(results):
@@ -200,10 +187,120 @@ class DTIMeasures:
         Returns:
             dict: same set of parameters but then possibly updated with a rotation.
         """
-        sorted_eigenvalues, sorted_eigenvectors, ranking = DTIMeasures._sort_eigensystem(parameters_dict)
-        theta, phi, psi = tensor_cartesian_to_spherical(sorted_eigenvectors[0], sorted_eigenvectors[1])
-        return {'d': sorted_eigenvalues[:, 0], 'dperp0': sorted_eigenvalues[:, 1], 'dperp1': sorted_eigenvalues[:, 2],
-                'theta': theta, 'phi': phi, 'psi': psi}
+        sorted_system = DTIMeasures.compute_measures(
+            parameters_dict['d'], parameters_dict['dperp0'], parameters_dict['dperp1'],
+            theta=parameters_dict['theta'], phi=parameters_dict['phi'], psi=parameters_dict['psi'],
+            sort_eigensystem=True, dtype=np.result_type(parameters_dict['d'], np.float32))
+        return {'d': sorted_system['sorted_eigenvalues'][:, 0],
+                'dperp0': sorted_system['sorted_eigenvalues'][:, 1],
+                'dperp1': sorted_system['sorted_eigenvalues'][:, 2],
+                'theta': sorted_system['sorted_theta'],
+                'phi': sorted_system['sorted_phi'],
+                'psi': sorted_system['sorted_psi']}
+
+    @staticmethod
+    def compute_measures(d, dperp0, dperp1, theta=None, phi=None, psi=None, stds=None, covariances=None,
+                         sort_eigensystem=False, dtype=np.float32, max_batch_size=2 ** 16):
+        """Compute the Tensor measures in a single pass over the voxels.
+
+        This computes all the requested measures per batch of voxels, such that the only full size arrays allocated
+        are the output maps. The eigenvectors are computed analytically from the angles, without explicitly
+        constructing the rotation matrices.
+
+        The standard deviations of the measures are computed using error propagation of the (co)variances of the
+        diffusivities. If no covariances are given, we assume the diffusivities to be uncorrelated.
+
+        Args:
+            d (ndarray): the principal diffusivity per voxel, a (n,) or (n, 1) array
+            dperp0 (ndarray): the first perpendicular diffusivity per voxel
+            dperp1 (ndarray): the second perpendicular diffusivity per voxel
+            theta (ndarray): optionally, the inclination of the principal eigenvector per voxel
+            phi (ndarray): optionally, the azimuth of the principal eigenvector per voxel
+            psi (ndarray): optionally, the rotation angle of the second eigenvector per voxel
+            stds (tuple): optionally, the standard deviations of d, dperp0 and dperp1
+            covariances (PackedCovariances or dict): optionally, the covariances of the diffusivities, either
+                as a :class:`mdt.utils.PackedCovariances` or as a dictionary with keys like '<param_0>_to_<param_1>'.
+                Only used if the standard deviations are given.
+            sort_eigensystem (boolean): if set, we also return the eigensystem sorted by decreasing eigenvalue.
+                This requires the angles.
+            dtype (np.dtype): the data type of the output maps
+            max_batch_size (int): the maximum number of voxels to process at once
+
+        Returns:
+            dict: the maps 'FA', 'MD', 'AD' and 'RD'. If the angles are given, also the eigenvectors 'vec0',
+                'vec1' and 'vec2' as (n, 3) arrays. If the standard deviations are given, also the maps 'FA.std',
+                'MD.std', 'AD.std' and 'RD.std'. If the eigensystem is sorted, also the 'sorted_eigenvalues' as
+                (n, 3) array, the 'sorted_eigenvectors' as (3, n, 3) array, the 'ranking' as (n, 3) array, and the
+                angles 'sorted_theta', 'sorted_phi' and 'sorted_psi' of the sorted eigensystem.
+        """
+        d, dperp0, dperp1 = (np.reshape(v, (-1,)) for v in [d, dperp0, dperp1])
+        nmr_voxels = d.shape[0]
+
+        has_angles = all(v is not None for v in [theta, phi, psi])
+        if has_angles:
+            theta, phi, psi = (np.reshape(v, (-1,)) for v in [theta, phi, psi])
+        elif sort_eigensystem:
+            raise ValueError('Sorting the eigensystem requires the angles theta, phi and psi.')
+
+        map_shapes = {name: (nmr_voxels,) for name in ['FA', 'MD', 'AD', 'RD']}
+        if has_angles:
+            map_shapes.update({'vec{}'.format(ind): (nmr_voxels, 3) for ind in range(3)})
+        if stds is not None:
+            stds = [np.reshape(v, (-1,)) for v in stds]
+            map_shapes.update({name: (nmr_voxels,) for name in ['FA.std', 'MD.std', 'AD.std', 'RD.std']})
+            covariances = _get_diffusivity_covariances(covariances)
+        if sort_eigensystem:
+            map_shapes.update({'sorted_eigenvalues': (nmr_voxels, 3), 'sorted_eigenvectors': (3, nmr_voxels, 3),
+                               'sorted_theta': (nmr_voxels,), 'sorted_phi': (nmr_voxels,), 'sorted_psi': (nmr_voxels,)})
+
+        output = {name: np.zeros(shape, dtype=dtype) for name, shape in map_shapes.items()}
+        if sort_eigensystem:
+            output['ranking'] = np.zeros((nmr_voxels, 3), dtype=np.int64)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for batch_start, batch_end in split_in_batches(nmr_voxels, max_batch_size):
+                batch = slice(batch_start, batch_end)
+                eigenvalues = [v[batch].astype(np.float64) for v in [d, dperp0, dperp1]]
+
+                fa, fa_gradient = _fractional_anisotropy_and_gradient(*eigenvalues)
+                output['FA'][batch] = fa
+                output['MD'][batch] = (eigenvalues[0] + eigenvalues[1] + eigenvalues[2]) / 3.
+                output['AD'][batch] = eigenvalues[0]
+                output['RD'][batch] = (eigenvalues[1] + eigenvalues[2]) / 2.
+
+                if stds is not None:
+                    variances = [v[batch].astype(np.float64) ** 2 for v in stds]
+                    batch_covariances = {k: v[batch] for k, v in covariances.items()}
+
+                    output['FA.std'][batch] = np.nan_to_num(np.sqrt(_propagate_variance(
+                        fa_gradient, variances, batch_covariances)))
+                    output['MD.std'][batch] = np.sqrt(_propagate_variance(
+                        (1 / 3., 1 / 3., 1 / 3.), variances, batch_covariances))
+                    output['AD.std'][batch] = np.sqrt(variances[0])
+                    output['RD.std'][batch] = np.sqrt(_propagate_variance(
+                        (0, 1 / 2., 1 / 2.), variances, batch_covariances))
+
+                if has_angles:
+                    eigenvectors = _tensor_eigenvectors(theta[batch], phi[batch], psi[batch])
+                    for ind in range(3):
+                        output['vec{}'.format(ind)][batch] = eigenvectors[:, ind]
+
+                    if sort_eigensystem:
+                        eigenvalues = np.stack(eigenvalues, axis=1)
+                        ranking = np.argsort(eigenvalues, axis=1, kind='mergesort')[:, ::-1]
+
+                        # flat indices into the (n * 3) eigenvalues and eigenvectors, faster than take_along_axis
+                        sort_indices = (ranking + 3 * np.arange(ranking.shape[0])[:, None]).ravel()
+                        sorted_eigenvectors = eigenvectors.reshape((-1, 3))[sort_indices].reshape((-1, 3, 3))
+
+                        output['ranking'][batch] = ranking
+                        output['sorted_eigenvalues'][batch] = eigenvalues.ravel()[sort_indices].reshape((-1, 3))
+                        output['sorted_eigenvectors'][:, batch] = np.swapaxes(sorted_eigenvectors, 0, 1)
+                        (output['sorted_theta'][batch],
+                         output['sorted_phi'][batch],
+                         output['sorted_psi'][batch]) = tensor_cartesian_to_spherical(sorted_eigenvectors[:, 0],
+                                                                                      sorted_eigenvectors[:, 1])
+        return output
 
     @staticmethod
     def fractional_anisotropy(d, dperp0, dperp1):
@@ -245,12 +342,8 @@ class DTIMeasures:
         Returns:
             ndarray: the standard deviation of the fraction anisotropy using error propagation of the diffusivities.
         """
-        gradient = DTIMeasures._get_fractional_anisotropy_gradient(d, dperp0, dperp1)
-        covars = create_covariance_matrix(
-                {'d.std': d_std, 'dperp0.std': dperp0_std, 'dperp1.std': dperp1_std},
-                ['d', 'dperp0', 'dperp1'], covariances)
-
-        return np.nan_to_num(np.sqrt(voxelwise_vector_matrix_vector_product(gradient, covars, gradient)))
+        return DTIMeasures.compute_measures(d, dperp0, dperp1, stds=(d_std, dperp0_std, dperp1_std),
+                                            covariances=covariances, dtype=np.float64)['FA.std']
 
     @staticmethod
     def _get_fractional_anisotropy_gradient(d, dperp0, dperp1):
@@ -273,28 +366,9 @@ class DTIMeasures:
         Returns:
             ndarray: a 2d vector with the gradient per voxel.
         """
-        np.warnings.simplefilter("ignore")
-
-        d, dperp0, dperp1 = (np.squeeze(el).astype(np.float64) for el in [d, dperp0, dperp1])
-
-        gradient = np.stack([
-            (d ** 2 * (dperp0 + dperp1) + 2 * d * dperp0 * dperp1 - dperp0 ** 3
-             - dperp0 ** 2 * dperp1 - dperp0 * dperp1 ** 2 - dperp1 ** 3)
-            / (2 * (d ** 2 + dperp0 ** 2 + dperp1 ** 2) ** (3 / 2.)
-               * np.sqrt(d ** 2 - d * (dperp0 + dperp1) + dperp0 ** 2 - dperp0 * dperp1 + dperp1 ** 2)),
-            (-d ** 3 - d ** 2 * dperp1 + d * (dperp0 ** 2 + 2 * dperp0 * dperp1 - dperp1 ** 2) + dperp1 * (
-            dperp0 ** 2 - dperp1 ** 2))
-            / (2 * (d ** 2 + dperp0 ** 2 + dperp1 ** 2) ** (3 / 2.)
-               * np.sqrt(d ** 2 - d * (dperp0 + dperp1) + dperp0 ** 2 - dperp0 * dperp1 + dperp1 ** 2)),
-            (-d ** 3 - d ** 2 * dperp0 + d * (
-            -dperp0 ** 2 + 2 * dperp0 * dperp1 + dperp1 ** 2) - dperp0 ** 3 + dperp0 * dperp1 ** 2)
-            / (2 * (d ** 2 + dperp0 ** 2 + dperp1 ** 2) ** (3 / 2.)
-               * np.sqrt(d ** 2 - d * (dperp0 + dperp1) + dperp0 ** 2 - dperp0 * dperp1 + dperp1 ** 2))
-        ], axis=-1)
-
-        if len(gradient.shape) < 2:
-            return gradient[None, :]
-        return gradient
+        eigenvalues = [np.reshape(el, (-1,)).astype(np.float64) for el in [d, dperp0, dperp1]]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.stack(_fractional_anisotropy_and_gradient(*eigenvalues)[1], axis=-1)
 
     @staticmethod
     def _sort_eigensystem(parameters_dict):
@@ -305,37 +379,33 @@ class DTIMeasures:
                 for each voxel either a scalar or a vector.
 
         Returns:
-            tuple: the sorted eigenvalues,
+            tuple: the sorted eigenvalues as (n, 3) array, the sorted eigenvectors as (3, n, 3) array and the
+                (n, 3) ranking used for the sorting.
         """
-        eigenvectors = np.stack(tensor_spherical_to_cartesian(np.squeeze(parameters_dict['theta']),
-                                                              np.squeeze(parameters_dict['phi']),
-                                                              np.squeeze(parameters_dict['psi'])), axis=0)
-
-        eigenvalues = np.atleast_2d(np.squeeze(np.dstack([parameters_dict['d'],
-                                                          parameters_dict['dperp0'],
-                                                          parameters_dict['dperp1']])))
-
-        ranking = np.atleast_2d(np.squeeze(np.argsort(eigenvalues, axis=1, kind='mergesort')[:, ::-1]))
-        voxels_range = np.arange(ranking.shape[0])
-        sorted_eigenvalues = np.concatenate([eigenvalues[voxels_range, ranking[:, ind], None]
-                                             for ind in range(ranking.shape[1])], axis=1)
-        sorted_eigenvectors = np.stack([eigenvectors[ranking[:, ind], voxels_range, :]
-                                        for ind in range(ranking.shape[1])])
-
-        return sorted_eigenvalues, sorted_eigenvectors, ranking
+        sorted_system = DTIMeasures.compute_measures(
+            parameters_dict['d'], parameters_dict['dperp0'], parameters_dict['dperp1'],
+            theta=parameters_dict['theta'], phi=parameters_dict['phi'], psi=parameters_dict['psi'],
+            sort_eigensystem=True, dtype=np.float64)
+        return sorted_system['sorted_eigenvalues'], sorted_system['sorted_eigenvectors'], sorted_system['ranking']
 
 
 class DKIMeasures:
 
+    parameter_names = ('d', 'dperp0', 'dperp1', 'theta', 'phi', 'psi', 'W_0000', 'W_1000', 'W_1100', 'W_1110',
+                       'W_1111', 'W_2000', 'W_2100', 'W_2110', 'W_2111', 'W_2200', 'W_2210', 'W_2211',
+                       'W_2220', 'W_2221', 'W_2222')
+
     @staticmethod
     def extra_optimization_maps(parameters_dict):
         """Calculate DKI statistics like the mean, axial and radial kurtosis.
 
         The Mean Kurtosis (MK) is calculated by averaging the Kurtosis over orientations on the unit sphere.
-        The Axial Kurtosis (AK) is obtained using the principal direction of diffusion (fe; first eigenvec)
-        from the Tensor as its direction and then averaging the Kurtosis over +fe and -fe.
-        Finally, the Radial Kurtosis (RK) is calculated by averaging the Kurtosis over a circle of directions around
-        the first eigenvec.
+        The Axial Kurtosis (AK) is the Kurtosis in the principal direction of diffusion (fe; first eigenvec)
+        of the Tensor. Finally, the Radial Kurtosis (RK) is calculated by averaging the Kurtosis over a circle of
+        directions around the first eigenvec.
+
+        The method and the quality of the computations are taken from the ``dki_measures`` section of the
+        configuration, see :meth:`compute_measures`.
 
         Args:
             parameters_dict (dict): the fitted Kurtosis parameters, this requires a dictionary with at least
@@ -347,399 +417,136 @@ class DKIMeasures:
         Returns:
             dict: maps for the Mean Kurtosis (MK), Axial Kurtosis (AK) and Radial Kurtosis (RK).
         """
-        param_names = ['d', 'dperp0', 'dperp1', 'theta', 'phi', 'psi', 'W_0000', 'W_1000', 'W_1100', 'W_1110',
-                       'W_1111', 'W_2000', 'W_2100', 'W_2110', 'W_2111', 'W_2200', 'W_2210', 'W_2211',
-                       'W_2220', 'W_2221', 'W_2222']
+        return DKIMeasures.compute_measures(parameters_dict, **get_dki_measures_settings())
 
-        parameters = np.column_stack([parameters_dict[n] for n in param_names])
-
-        nmr_voxels = parameters.shape[0]
-        kernel_data = {'parameters': Array(parameters, ctype='mot_float_type'),
-                       'directions': Array(DKIMeasures._get_spherical_samples(), ctype='float4',
-                                           offset_str='0'),
-                       'nmr_directions': Scalar(DKIMeasures._get_spherical_samples().shape[0]),
-                       'nmr_radial_directions': Scalar(256),
-                       'mks': Zeros((nmr_voxels,), ctype='float'),
-                       'aks': Zeros((nmr_voxels,), ctype='float'),
-                       'rks': Zeros((nmr_voxels,), ctype='float')}
+    @staticmethod
+    def compute_measures(parameters_dict, method='closed_form', quadrature_order=16):
+        """Calculate the mean, axial and radial kurtosis using the given method.
 
-        DKIMeasures._get_compute_function(param_names).evaluate(kernel_data, nmr_voxels)
+        With the quadrature method, MK is the weighted average of the apparent Kurtosis over the directions of the
+        quadrature rule of the given order (see :func:`mdt.lib.spherical_quadrature.get_hemisphere_quadrature`) and
+        RK is the average over ``2 * quadrature_order`` directions on the circle around the first eigenvector. These
+        averages are computed using OpenCL.
 
-        return {'MK': kernel_data['mks'].get_data(),
-                'AK': kernel_data['aks'].get_data(),
-                'RK': kernel_data['rks'].get_data()}
+        With the closed form method, the measures are computed in NumPy from the Kurtosis tensor rotated to the
+        eigenframe of the diffusion Tensor, using the analytic expressions of Tabesh et al. [1]. This requires
+        positive eigenvalues, for the other voxels this returns zeros.
 
-    @staticmethod
-    def _get_compute_function(param_names):
-        def get_param_cl_ref(param_name):
-            return 'parameters[{}]'.format(param_names.index(param_name))
+        In both methods, MK is clamped to [0, 3], AK to [0, 10] and RK to be non-negative.
 
-        param_expansions = ['mot_float_type {} = params[{}];'.format(name, ind) for ind, name in enumerate(param_names)]
+        Args:
+            parameters_dict (dict): the fitted Kurtosis parameters, see :meth:`extra_optimization_maps`
+            method (str): either 'quadrature' or 'closed_form'
+            quadrature_order (int): the order of the quadrature rules, only used for the quadrature method
 
-        return parse_cl_function('''
-            double apparent_kurtosis(
-                    global mot_float_type* params,
-                    float4 direction,
-                    float4 vec0,
-                    float4 vec1,
-                    float4 vec2){
+        Returns:
+            dict: maps for the Mean Kurtosis (MK), Axial Kurtosis (AK) and Radial Kurtosis (RK).
 
-                ''' + '\n'.join(param_expansions) + '''
+        References:
+            1. Tabesh A, Jensen JH, Ardekani BA, Helpern JA. Estimation of tensors and tensor-derived measures in
+                diffusional kurtosis imaging. Magn Reson Med. 2011;65(3):823-836. doi:10.1002/mrm.22655.
+        """
+        if method == 'closed_form':
+            return DKIMeasures._compute_closed_form_measures(parameters_dict)
+        elif method == 'quadrature':
+            return DKIMeasures._compute_quadrature_measures(parameters_dict, quadrature_order)
+        raise ValueError('Unknown method "{}" for computing the DKI measures.'.format(method))
 
-                double adc = d *      pown(dot(vec0, direction), 2) +
-                             dperp0 * pown(dot(vec1, direction), 2) +
-                             dperp1 * pown(dot(vec2, direction), 2);
+    @staticmethod
+    def benchmark(parameters_dict, quadrature_orders=(2, 4, 8, 16, 32), reference_order=64):
+        """Compare the accuracy and speed of the methods for computing the DKI measures.
 
-                double tensor_md = (d + dperp0 + dperp1) / 3.0;
+        This computes the DKI measures on the given parameters using the closed form method and the quadrature method
+        at each of the given orders, and compares each of these with the quadrature method at the reference order.
+        Please note that the first run of the quadrature method includes the compilation of the CL kernel. To exclude
+        that from the timings, we compute the measures once before the benchmark.
 
-                double kurtosis_sum = KurtosisMultiplication(
-                    W_0000, W_1111, W_2222, W_1000, W_2000, W_1110,
-                    W_2220, W_2111, W_2221, W_1100, W_2200, W_2211,
-                    W_2100, W_2110, W_2210, direction);
+        Args:
+            parameters_dict (dict): Kurtosis parameters, for example the results of a Kurtosis fit
+            quadrature_orders (tuple of int): the quadrature orders to benchmark
+            reference_order (int): the quadrature order of the reference values
 
-                return pown(tensor_md / adc, 2) * kurtosis_sum;
-            }
-        
-            void get_principal_and_perpendicular_eigenvector(
-                    mot_float_type d,
-                    mot_float_type dperp0,
-                    mot_float_type dperp1,
-                    float4* vec0,
-                    float4* vec1,
-                    float4* vec2,
-                    float4** principal_vec,
-                    float4** perpendicular_vec){
-
-                if(d >= dperp0 && d >= dperp1){
-                    *principal_vec = vec0;
-                    *perpendicular_vec = vec1;
-                }
-                if(dperp0 >= d && dperp0 >= dperp1){
-                    *principal_vec = vec1;
-                    *perpendicular_vec = vec0;
-                }
-                *principal_vec = vec2;
-                *perpendicular_vec = vec0;
-            }
-        
-            void calculate_measures(global mot_float_type* parameters, 
-                                    global float4* directions,
-                                    uint nmr_directions,
-                                    uint nmr_radial_directions,
-                                    global float* mks,
-                                    global float* aks,
-                                    global float* rks){
-                int i, j;
-
-                float4 vec0, vec1, vec2;
-                TensorSphericalToCartesian(
-                    ''' + get_param_cl_ref('theta') + ''',
-                    ''' + get_param_cl_ref('phi') + ''',
-                    ''' + get_param_cl_ref('psi') + ''',
-                    &vec0, &vec1, &vec2);
-
-                float4* principal_vec;
-                float4* perpendicular_vec;
-                get_principal_and_perpendicular_eigenvector(
-                    ''' + get_param_cl_ref('d') + ''',
-                    ''' + get_param_cl_ref('dperp0') + ''',
-                    ''' + get_param_cl_ref('dperp1') + ''',
-                    &vec0, &vec1, &vec2,
-                    &principal_vec, &perpendicular_vec);
-
-                // Mean Kurtosis integrated over a set of directions
-                double mean = 0;
-                for(i = 0; i < nmr_directions; i++){
-                    mean += apparent_kurtosis(parameters, directions[i], vec0, vec1, vec2);
-                }
-                *(mks) = clamp(mean / nmr_directions, 0.0, 3.0);
-
-
-                // Axial Kurtosis over the principal direction of diffusion
-                *(aks) = clamp(apparent_kurtosis(parameters, *principal_vec, vec0, vec1, vec2), 0.0, 10.0);
-
-
-                // Radial Kurtosis integrated over a unit circle around the principal eigenvector.
-                mean = 0;
-                float4 rotated_vec;
-                for(i = 0; i < nmr_radial_directions; i++){
-                    rotated_vec = RotateOrthogonalVector(*principal_vec, *perpendicular_vec,
-                                                         i * (2 * M_PI_F) / nmr_radial_directions);
-
-                    mean += (apparent_kurtosis(parameters, rotated_vec, vec0, vec1, vec2) - mean) / (i + 1);
-                }
-                *(rks) = max(mean, 0.0);
-            }
-        ''', dependencies=[get_component('library_functions', 'RotateOrthogonalVector')(),
-                           get_component('library_functions', 'TensorSphericalToCartesian')(),
-                           get_component('library_functions', 'KurtosisMultiplication')()])
+        Returns:
+            list of dict: per method and order a dictionary with the 'method', the 'quadrature_order', the number of
+                'directions' in the rule, the 'runtime' in seconds and per measure (MK, AK, RK) the maximum and mean
+                absolute difference from the reference, as for example 'MK.max_error' and 'MK.mean_error'.
+        """
+        reference = DKIMeasures.compute_measures(parameters_dict, quadrature_order=reference_order)
+
+        runs = [('closed_form', None)] + [('quadrature', order) for order in quadrature_orders]
+        results = []
+        for method, order in runs:
+            kwargs = {'method': method}
+            if order is not None:
+                kwargs['quadrature_order'] = order
+
+            start = time.time()
+            measures = DKIMeasures.compute_measures(parameters_dict, **kwargs)
+            result = {'method': method, 'quadrature_order': order,
+                      'directions': 2 * order ** 2 if order else None,
+                      'runtime': time.time() - start}
+
+            for name in ['MK', 'AK', 'RK']:
+                error = np.abs(measures[name].astype(np.float64) - reference[name])
+                result.update({name + '.max_error': float(np.max(error)), name + '.mean_error': float(np.mean(error))})
+            results.append(result)
+        return results
 
     @staticmethod
-    def _get_spherical_samples():
-        """Get a number of 3d coordinates mapping an unit sphere.
+    def _compute_quadrature_measures(parameters_dict, quadrature_order):
+        parameters = np.column_stack([np.reshape(parameters_dict[n], (-1,)) for n in DKIMeasures.parameter_names])
+        directions, weights = get_hemisphere_quadrature(quadrature_order)
 
-        List taken from "dki_parameters.m" by Jelle Veraart
-        (https://github.com/NYU-DiffusionMRI/Diffusion-Kurtosis-Imaging/blob/master/dki_parameters.m).
+        nmr_voxels = parameters.shape[0]
+        kernel_data = {'parameters': Array(parameters, ctype='mot_float_type'),
+                       'directions': Array(directions, ctype='float4', offset_str='0'),
+                       'weights': Array(weights, ctype='float', offset_str='0'),
+                       'nmr_directions': Scalar(directions.shape[0]),
+                       'radial_angles': Array(get_semicircle_angles(2 * quadrature_order), ctype='float',
+                                              offset_str='0'),
+                       'nmr_radial_directions': Scalar(2 * quadrature_order),
+                       'mks': Zeros((nmr_voxels,), ctype='float'),
+                       'aks': Zeros((nmr_voxels,), ctype='float'),
+                       'rks': Zeros((nmr_voxels,), ctype='float')}
 
-        Returns:
-            ndarray: a list of 3d coordinates mapping an unit sphere.
-        """
-        return np.array([[0, 0, 1.0000],
-                         [0.5924, 0, 0.8056],
-                         [-0.7191, -0.1575, -0.6768],
-                         [-0.9151, -0.3479, 0.2040],
-                         [0.5535, 0.2437, 0.7964],
-                         [-0.0844, 0.9609, -0.2636],
-                         [0.9512, -0.3015, 0.0651],
-                         [-0.4225, 0.8984, 0.1202],
-                         [0.5916, -0.6396, 0.4909],
-                         [0.3172, 0.8818, -0.3489],
-                         [-0.1988, -0.6687, 0.7164],
-                         [-0.2735, 0.3047, -0.9123],
-                         [0.9714, -0.1171, 0.2066],
-                         [-0.5215, -0.4013, 0.7530],
-                         [-0.3978, -0.9131, -0.0897],
-                         [0.2680, 0.8196, 0.5063],
-                         [-0.6824, -0.6532, -0.3281],
-                         [0.4748, -0.7261, -0.4973],
-                         [0.4504, -0.4036, 0.7964],
-                         [-0.5551, -0.8034, -0.2153],
-                         [0.0455, -0.2169, 0.9751],
-                         [0.0483, 0.5845, 0.8099],
-                         [-0.1909, -0.1544, -0.9694],
-                         [0.8383, 0.5084, 0.1969],
-                         [-0.2464, 0.1148, 0.9623],
-                         [-0.7458, 0.6318, 0.2114],
-                         [-0.0080, -0.9831, -0.1828],
-                         [-0.2630, 0.5386, -0.8005],
-                         [-0.0507, 0.6425, -0.7646],
-                         [0.4476, -0.8877, 0.1081],
-                         [-0.5627, 0.7710, 0.2982],
-                         [-0.3790, 0.7774, -0.5020],
-                         [-0.6217, 0.4586, -0.6350],
-                         [-0.1506, 0.8688, -0.4718],
-                         [-0.4579, 0.2131, 0.8631],
-                         [-0.8349, -0.2124, 0.5077],
-                         [0.7682, -0.1732, -0.6163],
-                         [0.0997, -0.7168, -0.6901],
-                         [0.0386, -0.2146, -0.9759],
-                         [0.9312, 0.1655, -0.3249],
-                         [0.9151, 0.3053, 0.2634],
-                         [0.8081, 0.5289, -0.2593],
-                         [-0.3632, -0.9225, 0.1305],
-                         [0.2709, -0.3327, -0.9033],
-                         [-0.1942, -0.9790, -0.0623],
-                         [0.6302, -0.7641, 0.1377],
-                         [-0.6948, -0.3137, 0.6471],
-                         [-0.6596, -0.6452, 0.3854],
-                         [-0.9454, 0.2713, 0.1805],
-                         [-0.2586, -0.7957, 0.5477],
-                         [-0.3576, 0.6511, 0.6695],
-                         [-0.8490, -0.5275, 0.0328],
-                         [0.3830, 0.2499, -0.8893],
-                         [0.8804, -0.2392, -0.4095],
-                         [0.4321, -0.4475, -0.7829],
-                         [-0.5821, -0.1656, 0.7961],
-                         [0.3963, 0.6637, 0.6344],
-                         [-0.7222, -0.6855, -0.0929],
-                         [0.2130, -0.9650, -0.1527],
-                         [0.4737, 0.7367, -0.4825],
-                         [-0.9956, 0.0891, 0.0278],
-                         [-0.5178, 0.7899, -0.3287],
-                         [-0.8906, 0.1431, -0.4317],
-                         [0.2431, -0.9670, 0.0764],
-                         [-0.6812, -0.3807, -0.6254],
-                         [-0.1091, -0.5141, 0.8507],
-                         [-0.2206, 0.7274, -0.6498],
-                         [0.8359, 0.2674, 0.4794],
-                         [0.9873, 0.1103, 0.1147],
-                         [0.7471, 0.0659, -0.6615],
-                         [0.6119, -0.2508, 0.7502],
-                         [-0.6191, 0.0776, 0.7815],
-                         [0.7663, -0.4739, 0.4339],
-                         [-0.5699, 0.5369, 0.6220],
-                         [0.0232, -0.9989, 0.0401],
-                         [0.0671, -0.4207, -0.9047],
-                         [-0.2145, 0.5538, 0.8045],
-                         [0.8554, -0.4894, 0.1698],
-                         [-0.7912, -0.4194, 0.4450],
-                         [-0.2341, 0.0754, -0.9693],
-                         [-0.7725, 0.6346, -0.0216],
-                         [0.0228, 0.7946, -0.6067],
-                         [0.7461, -0.3966, -0.5348],
-                         [-0.4045, -0.0837, -0.9107],
-                         [-0.4364, 0.6084, -0.6629],
-                         [0.6177, -0.3175, -0.7195],
-                         [-0.4301, -0.0198, 0.9026],
-                         [-0.1489, -0.9706, 0.1892],
-                         [0.0879, 0.9070, -0.4117],
-                         [-0.7764, -0.4707, -0.4190],
-                         [0.9850, 0.1352, -0.1073],
-                         [-0.1581, -0.3154, 0.9357],
-                         [0.8938, -0.3246, 0.3096],
-                         [0.8358, -0.4464, -0.3197],
-                         [0.4943, 0.4679, 0.7327],
-                         [-0.3095, 0.9015, -0.3024],
-                         [-0.3363, -0.8942, -0.2956],
-                         [-0.1271, -0.9274, -0.3519],
-                         [0.3523, -0.8717, -0.3407],
-                         [0.7188, -0.6321, 0.2895],
-                         [-0.7447, 0.0924, -0.6610],
-                         [0.1622, 0.7186, 0.6762],
-                         [-0.9406, -0.0829, -0.3293],
-                         [-0.1229, 0.9204, 0.3712],
-                         [-0.8802, 0.4668, 0.0856],
-                         [-0.2062, -0.1035, 0.9730],
-                         [-0.4861, -0.7586, -0.4338],
-                         [-0.6138, 0.7851, 0.0827],
-                         [0.8476, 0.0504, 0.5282],
-                         [0.3236, 0.4698, -0.8213],
-                         [-0.7053, -0.6935, 0.1473],
-                         [0.1511, 0.3778, 0.9135],
-                         [0.6011, 0.5847, 0.5448],
-                         [0.3610, 0.3183, 0.8766],
-                         [0.9432, 0.3304, 0.0341],
-                         [0.2423, -0.8079, -0.5372],
-                         [0.4431, -0.1578, 0.8825],
-                         [0.6204, 0.5320, -0.5763],
-                         [-0.2806, -0.5376, -0.7952],
-                         [-0.5279, -0.8071, 0.2646],
-                         [-0.4214, -0.6159, 0.6656],
-                         [0.6759, -0.5995, -0.4288],
-                         [0.5670, 0.8232, -0.0295],
-                         [-0.0874, 0.4284, -0.8994],
-                         [0.8780, -0.0192, -0.4782],
-                         [0.0166, 0.8421, 0.5391],
-                         [-0.7741, 0.2931, -0.5610],
-                         [0.9636, -0.0579, -0.2611],
-                         [0, 0, -1.0000],
-                         [-0.5924, 0, -0.8056],
-                         [0.7191, 0.1575, 0.6768],
-                         [0.9151, 0.3479, -0.2040],
-                         [-0.5535, -0.2437, -0.7964],
-                         [0.0844, -0.9609, 0.2636],
-                         [-0.9512, 0.3015, -0.0651],
-                         [0.4225, -0.8984, -0.1202],
-                         [-0.5916, 0.6396, -0.4909],
-                         [-0.3172, -0.8818, 0.3489],
-                         [0.1988, 0.6687, -0.7164],
-                         [0.2735, -0.3047, 0.9123],
-                         [-0.9714, 0.1171, -0.2066],
-                         [0.5215, 0.4013, -0.7530],
-                         [0.3978, 0.9131, 0.0897],
-                         [-0.2680, -0.8196, -0.5063],
-                         [0.6824, 0.6532, 0.3281],
-                         [-0.4748, 0.7261, 0.4973],
-                         [-0.4504, 0.4036, -0.7964],
-                         [0.5551, 0.8034, 0.2153],
-                         [-0.0455, 0.2169, -0.9751],
-                         [-0.0483, -0.5845, -0.8099],
-                         [0.1909, 0.1544, 0.9694],
-                         [-0.8383, -0.5084, -0.1969],
-                         [0.2464, -0.1148, -0.9623],
-                         [0.7458, -0.6318, -0.2114],
-                         [0.0080, 0.9831, 0.1828],
-                         [0.2630, -0.5386, 0.8005],
-                         [0.0507, -0.6425, 0.7646],
-                         [-0.4476, 0.8877, -0.1081],
-                         [0.5627, -0.7710, -0.2982],
-                         [0.3790, -0.7774, 0.5020],
-                         [0.6217, -0.4586, 0.6350],
-                         [0.1506, -0.8688, 0.4718],
-                         [0.4579, -0.2131, -0.8631],
-                         [0.8349, 0.2124, -0.5077],
-                         [-0.7682, 0.1732, 0.6163],
-                         [-0.0997, 0.7168, 0.6901],
-                         [-0.0386, 0.2146, 0.9759],
-                         [-0.9312, -0.1655, 0.3249],
-                         [-0.9151, -0.3053, -0.2634],
-                         [-0.8081, -0.5289, 0.2593],
-                         [0.3632, 0.9225, -0.1305],
-                         [-0.2709, 0.3327, 0.9033],
-                         [0.1942, 0.9790, 0.0623],
-                         [-0.6302, 0.7641, -0.1377],
-                         [0.6948, 0.3137, -0.6471],
-                         [0.6596, 0.6452, -0.3854],
-                         [0.9454, -0.2713, -0.1805],
-                         [0.2586, 0.7957, -0.5477],
-                         [0.3576, -0.6511, -0.6695],
-                         [0.8490, 0.5275, -0.0328],
-                         [-0.3830, -0.2499, 0.8893],
-                         [-0.8804, 0.2392, 0.4095],
-                         [-0.4321, 0.4475, 0.7829],
-                         [0.5821, 0.1656, -0.7961],
-                         [-0.3963, -0.6637, -0.6344],
-                         [0.7222, 0.6855, 0.0929],
-                         [-0.2130, 0.9650, 0.1527],
-                         [-0.4737, -0.7367, 0.4825],
-                         [0.9956, -0.0891, -0.0278],
-                         [0.5178, -0.7899, 0.3287],
-                         [0.8906, -0.1431, 0.4317],
-                         [-0.2431, 0.9670, -0.0764],
-                         [0.6812, 0.3807, 0.6254],
-                         [0.1091, 0.5141, -0.8507],
-                         [0.2206, -0.7274, 0.6498],
-                         [-0.8359, -0.2674, -0.4794],
-                         [-0.9873, -0.1103, -0.1147],
-                         [-0.7471, -0.0659, 0.6615],
-                         [-0.6119, 0.2508, -0.7502],
-                         [0.6191, -0.0776, -0.7815],
-                         [-0.7663, 0.4739, -0.4339],
-                         [0.5699, -0.5369, -0.6220],
-                         [-0.0232, 0.9989, -0.0401],
-                         [-0.0671, 0.4207, 0.9047],
-                         [0.2145, -0.5538, -0.8045],
-                         [-0.8554, 0.4894, -0.1698],
-                         [0.7912, 0.4194, -0.4450],
-                         [0.2341, -0.0754, 0.9693],
-                         [0.7725, -0.6346, 0.0216],
-                         [-0.0228, -0.7946, 0.6067],
-                         [-0.7461, 0.3966, 0.5348],
-                         [0.4045, 0.0837, 0.9107],
-                         [0.4364, -0.6084, 0.6629],
-                         [-0.6177, 0.3175, 0.7195],
-                         [0.4301, 0.0198, -0.9026],
-                         [0.1489, 0.9706, -0.1892],
-                         [-0.0879, -0.9070, 0.4117],
-                         [0.7764, 0.4707, 0.4190],
-                         [-0.9850, -0.1352, 0.1073],
-                         [0.1581, 0.3154, -0.9357],
-                         [-0.8938, 0.3246, -0.3096],
-                         [-0.8358, 0.4464, 0.3197],
-                         [-0.4943, -0.4679, -0.7327],
-                         [0.3095, -0.9015, 0.3024],
-                         [0.3363, 0.8942, 0.2956],
-                         [0.1271, 0.9274, 0.3519],
-                         [-0.3523, 0.8717, 0.3407],
-                         [-0.7188, 0.6321, -0.2895],
-                         [0.7447, -0.0924, 0.6610],
-                         [-0.1622, -0.7186, -0.6762],
-                         [0.9406, 0.0829, 0.3293],
-                         [0.1229, -0.9204, -0.3712],
-                         [0.8802, -0.4668, -0.0856],
-                         [0.2062, 0.1035, -0.9730],
-                         [0.4861, 0.7586, 0.4338],
-                         [0.6138, -0.7851, -0.0827],
-                         [-0.8476, -0.0504, -0.5282],
-                         [-0.3236, -0.4698, 0.8213],
-                         [0.7053, 0.6935, -0.1473],
-                         [-0.1511, -0.3778, -0.9135],
-                         [-0.6011, -0.5847, -0.5448],
-                         [-0.3610, -0.3183, -0.8766],
-                         [-0.9432, -0.3304, -0.0341],
-                         [-0.2423, 0.8079, 0.5372],
-                         [-0.4431, 0.1578, -0.8825],
-                         [-0.6204, -0.5320, 0.5763],
-                         [0.2806, 0.5376, 0.7952],
-                         [0.5279, 0.8071, -0.2646],
-                         [0.4214, 0.6159, -0.6656],
-                         [-0.6759, 0.5995, 0.4288],
-                         [-0.5670, -0.8232, 0.0295],
-                         [0.0874, -0.4284, 0.8994],
-                         [-0.8780, 0.0192, 0.4782],
-                         [-0.0166, -0.8421, -0.5391],
-                         [0.7741, -0.2931, 0.5610],
-                         [-0.9636, 0.0579, 0.2611]])
+        _get_dki_compute_function().evaluate(kernel_data, nmr_voxels)
+
+        return {'MK': kernel_data['mks'].get_data(),
+                'AK': kernel_data['aks'].get_data(),
+                'RK': kernel_data['rks'].get_data()}
+
+    @staticmethod
+    def _compute_closed_form_measures(parameters_dict, max_batch_size=2 ** 14):
+        kurtosis_params = np.column_stack([np.reshape(parameters_dict[n], (-1,))
+                                           for n in DKIMeasures.parameter_names[6:]])
+        eigensystem = DTIMeasures.compute_measures(
+            parameters_dict['d'], parameters_dict['dperp0'], parameters_dict['dperp1'],
+            theta=parameters_dict['theta'], phi=parameters_dict['phi'], psi=parameters_dict['psi'],
+            sort_eigensystem=True, dtype=np.float64)
+
+        nmr_voxels = kurtosis_params.shape[0]
+        output = {name: np.zeros(nmr_voxels, dtype=np.float32) for name in ['MK', 'AK', 'RK']}
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for batch_start, batch_end in split_in_batches(nmr_voxels, max_batch_size):
+                batch = slice(batch_start, batch_end)
+                l1, l2, l3 = eigensystem['sorted_eigenvalues'][batch].T
+                e1, e2, e3 = eigensystem['sorted_eigenvectors'][:, batch]
+
+                W = _get_eigenframe_kurtosis(kurtosis_params[batch], (e1, e2, e3))
+
+                mk = (_tabesh_f1(l1, l2, l3) * W[:, 0, 0] + _tabesh_f1(l2, l1, l3) * W[:, 1, 1]
+                      + _tabesh_f1(l3, l2, l1) * W[:, 2, 2] + _tabesh_f2(l1, l2, l3) * W[:, 1, 2]
+                      + _tabesh_f2(l2, l1, l3) * W[:, 0, 2] + _tabesh_f2(l3, l2, l1) * W[:, 0, 1])
+                ak = ((l1 + l2 + l3) / (3 * l1)) ** 2 * W[:, 0, 0]
+                rk = (_tabesh_g1(l1, l2, l3) * W[:, 1, 1] + _tabesh_g1(l1, l3, l2) * W[:, 2, 2]
+                      + _tabesh_g2(l1, l2, l3) * W[:, 1, 2])
+
+                valid = l3 > 0
+                output['MK'][batch] = np.where(valid, np.clip(mk, 0, 3), 0)
+                output['AK'][batch] = np.where(valid, np.clip(ak, 0, 10), 0)
+                output['RK'][batch] = np.where(valid, np.maximum(rk, 0), 0)
+        return output
 
 
 class NODDIMeasures:
@@ -874,7 +681,11 @@ def noddi_dti_maps(results):
 
 
 def _tau_to_kappa(tau):
-    """Using non-linear optimization, convert the NODDI-DTI Tau variables to NODDI kappa's.
+    """Convert the NODDI-DTI Tau variables to NODDI kappa's.
+
+    This inverts the (monotone) relation between kappa and tau using a lookup table, see :func:`_get_tau_inverse`.
+    As with the previous optimization based conversion, tau's outside of the range of the relation, that is, tau's
+    smaller than the tau at a kappa of zero (1/3) or larger than the tau at a kappa of 64, are mapped to a kappa of one.
 
     Args:
         tau (ndarray): the list of tau's per voxel.
@@ -882,24 +693,285 @@ def _tau_to_kappa(tau):
     Returns:
         ndarray: the list of corresponding kappa's
     """
-    tau_func = SimpleCLFunction.from_string('''
-        double tau(double kappa){
-            if(kappa < 1e-12){
-                return 1/3.0;
-            }
-            return 0.5 * ( 1 / ( sqrt(kappa) * dawson(sqrt(kappa) ) ) - 1/kappa);
-        }''', dependencies=[dawson()])
+    tau_inverse = _get_tau_inverse()
+    kappa = tau_inverse(tau)
+    tau = np.asarray(tau)
+    kappa[(tau < tau_inverse.range[0]) | (tau > tau_inverse.range[1])] = 1
+    return kappa
+
+
+@functools.lru_cache(maxsize=None)
+def _get_tau_inverse():
+    """Get the inverse of the NODDI-DTI relation between kappa and tau, for kappa's between 0 and 64.
+
+    Returns:
+        mdt.lib.function_inversion.MonotoneFunctionInverse: the (lazily tabulated) inverse of tau(kappa)
+    """
+    def tau(kappa):
+        kappa = np.asarray(kappa, dtype=np.float64)
+        result = np.full(kappa.shape, 1 / 3.)
+
+        positive = kappa >= 1e-12
+        sqrt_kappa = np.sqrt(kappa[positive])
+        result[positive] = 0.5 * (1 / (sqrt_kappa * dawsn(sqrt_kappa)) - 1 / kappa[positive])
+        return result
+
+    return MonotoneFunctionInverse(tau, 0, 64, grid_exponent=2)
+
 
-    objective_func = SimpleCLFunction.from_string('''
-        double tau_to_kappa(local const mot_float_type* const x, void* data, local mot_float_type* objective_list){
-            return pown(tau(x[0]) - ((_tau_to_kappa_data*)data)->tau, 2); 
+def _fractional_anisotropy_and_gradient(d, dperp0, dperp1):
+    """Compute the FA and its gradient with respect to the three eigenvalues.
+
+    With ``S`` the sum of the squared deviations of the eigenvalues from their mean and ``Q`` the sum of the squared
+    eigenvalues, we have ``FA = sqrt(3/2 * S / Q)`` and the partial derivatives
+    ``dFA / d_i = FA * ((d_i - mean) / S - d_i / Q)``.
+
+    Returns:
+        tuple: the FA and a tuple with the three partial derivatives
+    """
+    mean = (d + dperp0 + dperp1) / 3.
+    deviations = (d - mean, dperp0 - mean, dperp1 - mean)
+    sum_squared_deviations = deviations[0] ** 2 + deviations[1] ** 2 + deviations[2] ** 2
+    sum_squares = d ** 2 + dperp0 ** 2 + dperp1 ** 2
+
+    fa = np.sqrt(3 / 2. * sum_squared_deviations / sum_squares)
+    gradient = tuple(fa * (deviation / sum_squared_deviations - eigenvalue / sum_squares)
+                     for deviation, eigenvalue in zip(deviations, (d, dperp0, dperp1)))
+    return fa, gradient
+
+
+def _propagate_variance(gradient, variances, covariances):
+    """Compute the variance of a function of the three diffusivities, using first order error propagation.
+
+    Args:
+        gradient (tuple): the three partial derivatives of the function, scalars or (n,) arrays
+        variances (list of ndarray): the variances of the three diffusivities
+        covariances (dict): the off-diagonal covariances, mapping (row, column) pairs to (n,) arrays
+
+    Returns:
+        ndarray: the variance of the function per voxel
+    """
+    variance = sum(gradient[ind] ** 2 * variances[ind] for ind in range(3))
+    for (x, y), values in covariances.items():
+        variance = variance + 2 * gradient[x] * gradient[y] * values
+    return variance
+
+
+def _tensor_eigenvectors(theta, phi, psi):
+    """Compute the (unsorted) eigenvectors of the Tensor from the angles.
+
+    This is the analytic form of :func:`mdt.utils.tensor_spherical_to_cartesian`. With ``v0`` the principal eigenvector
+    at (theta, phi), ``u`` the vector at (theta + pi/2, phi) and ``w = v0 x u = (-sin(phi), cos(phi), 0)``, the other
+    eigenvectors are given by ``v1 = u cos(psi) + w sin(psi)`` and ``v2 = v0 x v1 = w cos(psi) - u sin(psi)``.
+
+    Returns:
+        ndarray: a (n, 3, 3) array with per voxel the three eigenvectors on the second axis.
+    """
+    sin_theta, cos_theta = np.sin(theta), np.cos(theta)
+    sin_phi, cos_phi = np.sin(phi), np.cos(phi)
+    sin_psi, cos_psi = np.sin(psi)[:, None], np.cos(psi)[:, None]
+
+    v0 = np.stack([sin_theta * cos_phi, sin_theta * sin_phi, cos_theta], axis=1)
+    u = np.stack([cos_theta * cos_phi, cos_theta * sin_phi, -sin_theta], axis=1)
+    w = np.stack([-sin_phi, cos_phi, np.zeros_like(phi)], axis=1)
+
+    return np.stack([v0, u * cos_psi + w * sin_psi, w * cos_psi - u * sin_psi], axis=1)
+
+
+def _get_diffusivity_covariances(covariances):
+    """Get the off-diagonal covariances of the diffusivities d, dperp0 and dperp1.
+
+    Args:
+        covariances (PackedCovariances or dict): the covariances as given to :meth:`DTIMeasures.compute_measures`
+
+    Returns:
+        dict: mapping (row, column) index pairs of the upper triangular covariance matrix to (n,) arrays.
+    """
+    names = ['d', 'dperp0', 'dperp1']
+    elements = {}
+    if covariances:
+        for x, y in [(0, 1), (0, 2), (1, 2)]:
+            for key in ['{}_to_{}'.format(names[x], names[y]), '{}_to_{}'.format(names[y], names[x])]:
+                if key in covariances:
+                    elements[(x, y)] = np.reshape(covariances[key], (-1,))
+                    break
+    return elements
+
+
+def _get_kurtosis_tensor_indices():
+    """Get for each of the 81 elements of the Kurtosis tensor the index of the corresponding parameter.
+
+    Returns:
+        ndarray: for every element (i, j, k, l) of the tensor, in row-major order, the index of the matching parameter
+            in ``DKIMeasures.parameter_names[6:]``
+    """
+    names = list(DKIMeasures.parameter_names[6:])
+    return np.array([names.index('W_{}{}{}{}'.format(*sorted(index, reverse=True)))
+                     for index in itertools.product(range(3), repeat=4)])
+
+
+def _get_eigenframe_kurtosis(kurtosis_params, eigenvectors):
+    """Get the elements W_aabb of the Kurtosis tensor in the eigenframe of the diffusion Tensor.
+
+    Args:
+        kurtosis_params (ndarray): (n, 15) array with the Kurtosis parameters, in the order of
+            ``DKIMeasures.parameter_names[6:]``
+        eigenvectors (tuple of ndarray): the three sorted eigenvectors, each as (n, 3) array
+
+    Returns:
+        ndarray: (n, 3, 3) array with at index (a, b) the element W_aabb of the rotated tensor
+    """
+    W = kurtosis_params[:, _get_kurtosis_tensor_indices()].reshape((-1, 3, 3, 3, 3)).astype(np.float64)
+    contracted = [np.einsum('nijkl,nk,nl->nij', W, vec, vec) for vec in eigenvectors]
+    return np.stack([np.stack([np.einsum('nij,ni,nj->n', contracted[b], vec, vec) for b in range(3)], axis=1)
+                     for vec in eigenvectors], axis=1)
+
+
+def _tabesh_f1(a, b, c, tolerance=1e-5):
+    """The function F1 of the closed form Mean Kurtosis of Tabesh et al. (2011).
+
+    The singularities at equal eigenvalues are resolved using the limits of the function, applied if the eigenvalues
+    are within the given relative tolerance of each other. The default tolerance balances the round-off error of the
+    general expression near the singularities against the error of the limits, both about 1e-5.
+    """
+    result = (a + b + c) ** 2 / (18 * (a - b) * (a - c)) * (
+        np.sqrt(b * c) / a * carlson_rf(a / b, a / c, 1)
+        + (3 * a ** 2 - a * b - a * c - b * c) / (3 * a * np.sqrt(b * c)) * carlson_rd(a / b, a / c, 1) - 1)
+
+    equal_ab = np.abs(a - b) < a * tolerance
+    equal_ac = np.abs(a - c) < a * tolerance
+    result = np.where(equal_ab, _tabesh_f2(c, (a + b) / 2., (a + b) / 2.) / 2., result)
+    result = np.where(equal_ac, _tabesh_f2(b, (a + c) / 2., (a + c) / 2.) / 2., result)
+    return np.where(equal_ab & equal_ac, 1 / 5., result)
+
+
+def _tabesh_f2(a, b, c, tolerance=1e-5):
+    """The function F2 of the closed form Mean Kurtosis of Tabesh et al. (2011).
+
+    The singularities at equal eigenvalues are resolved using the limits of the function, applied if the eigenvalues
+    are within the given relative tolerance of each other.
+    """
+    result = (a + b + c) ** 2 / (3 * (b - c) ** 2) * (
+        (b + c) / np.sqrt(b * c) * carlson_rf(a / b, a / c, 1)
+        + (2 * a - b - c) / (3 * np.sqrt(b * c)) * carlson_rd(a / b, a / c, 1) - 2)
+
+    mean_bc = (b + c) / 2.
+    x = 1 - a / mean_bc
+    sqrt_abs_x = np.sqrt(np.abs(x))
+    alpha = np.where(x > 0, np.arctanh(sqrt_abs_x) / sqrt_abs_x, np.arctan(sqrt_abs_x) / sqrt_abs_x)
+    alpha = np.where(x == 0, 1, alpha)
+    limit_bc = 6 * (a + 2 * mean_bc) ** 2 / (144 * mean_bc ** 2 * (a - mean_bc) ** 2) * (
+        mean_bc * (a + 2 * mean_bc) + a * (a - 4 * mean_bc) * alpha)
+
+    equal_bc = np.abs(b - c) < b * tolerance
+    result = np.where(equal_bc, limit_bc, result)
+    return np.where(equal_bc & (np.abs(a - b) < a * tolerance), 6 / 15., result)
+
+
+def _tabesh_g1(a, b, c, tolerance=1e-5):
+    """The function G1 of the closed form Radial Kurtosis of Tabesh et al. (2011), with the limit for b == c."""
+    result = (a + b + c) ** 2 / (18 * b * (b - c) ** 2) * (2 * b + (c ** 2 - 3 * b * c) / np.sqrt(b * c))
+    mean_bc = (b + c) / 2.
+    return np.where(np.abs(b - c) < b * tolerance, (a + 2 * mean_bc) ** 2 / (24 * mean_bc ** 2), result)
+
+
+def _tabesh_g2(a, b, c, tolerance=1e-5):
+    """The function G2 of the closed form Radial Kurtosis of Tabesh et al. (2011), with the limit for b == c."""
+    result = (a + b + c) ** 2 / (3 * (b - c) ** 2) * ((b + c) / np.sqrt(b * c) - 2)
+    mean_bc = (b + c) / 2.
+    return np.where(np.abs(b - c) < b * tolerance, (a + 2 * mean_bc) ** 2 / (12 * mean_bc ** 2), result)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_dki_compute_function():
+    """Get the CL function computing the DKI measures per voxel.
+
+    The quadrature rules are given as kernel data, such that the function, and hence the compiled kernel, is the same
+    for every quadrature order and only needs to be constructed once.
+    """
+    param_names = DKIMeasures.parameter_names
+    param_expansions = ['mot_float_type {} = params[{}];'.format(name, ind) for ind, name in enumerate(param_names)]
+
+    def get_param_cl_ref(param_name):
+        return 'parameters[{}]'.format(param_names.index(param_name))
+
+    return parse_cl_function('''
+        double apparent_kurtosis(
+                global mot_float_type* params,
+                float4 direction,
+                float4 vec0,
+                float4 vec1,
+                float4 vec2){
+
+            ''' + '\n'.join(param_expansions) + '''
+
+            double adc = d *      pown(dot(vec0, direction), 2) +
+                         dperp0 * pown(dot(vec1, direction), 2) +
+                         dperp1 * pown(dot(vec2, direction), 2);
+
+            double tensor_md = (d + dperp0 + dperp1) / 3.0;
+
+            double kurtosis_sum = KurtosisMultiplication(
+                W_0000, W_1111, W_2222, W_1000, W_2000, W_1110,
+                W_2220, W_2111, W_2221, W_1100, W_2200, W_2211,
+                W_2100, W_2110, W_2210, direction);
+
+            return pown(tensor_md / adc, 2) * kurtosis_sum;
         }
-    ''', dependencies=[tau_func])
 
-    kappa = minimize(objective_func, np.ones_like(tau),
-                     data=Struct({'tau': Array(tau, 'mot_float_type', as_scalar=True)},
-                                 '_tau_to_kappa_data')).x
-    kappa[kappa > 64] = 1
-    kappa[kappa < 0] = 1
-    return kappa
+        void calculate_measures(global mot_float_type* parameters,
+                                global float4* directions,
+                                global float* weights,
+                                uint nmr_directions,
+                                global float* radial_angles,
+                                uint nmr_radial_directions,
+                                global float* mks,
+                                global float* aks,
+                                global float* rks){
+            int i;
+
+            float4 vec0, vec1, vec2;
+            TensorSphericalToCartesian(
+                ''' + get_param_cl_ref('theta') + ''',
+                ''' + get_param_cl_ref('phi') + ''',
+                ''' + get_param_cl_ref('psi') + ''',
+                &vec0, &vec1, &vec2);
+
+            mot_float_type d = ''' + get_param_cl_ref('d') + ''';
+            mot_float_type dperp0 = ''' + get_param_cl_ref('dperp0') + ''';
+            mot_float_type dperp1 = ''' + get_param_cl_ref('dperp1') + ''';
+
+            float4 principal_vec = vec2;
+            float4 perpendicular_vec = vec0;
+            if(d >= dperp0 && d >= dperp1){
+                principal_vec = vec0;
+                perpendicular_vec = vec1;
+            }
+            else if(dperp0 >= dperp1){
+                principal_vec = vec1;
+                perpendicular_vec = vec0;
+            }
 
+            // Mean Kurtosis integrated over the sphere using the quadrature rule
+            double mean = 0;
+            for(i = 0; i < nmr_directions; i++){
+                mean += weights[i] * apparent_kurtosis(parameters, directions[i], vec0, vec1, vec2);
+            }
+            *(mks) = clamp(mean, 0.0, 3.0);
+
+            // Axial Kurtosis over the principal direction of diffusion
+            *(aks) = clamp(apparent_kurtosis(parameters, principal_vec, vec0, vec1, vec2), 0.0, 10.0);
+
+            // Radial Kurtosis integrated over a unit circle around the principal eigenvector.
+            mean = 0;
+            for(i = 0; i < nmr_radial_directions; i++){
+                mean += apparent_kurtosis(
+                    parameters,
+                    RotateOrthogonalVector(principal_vec, perpendicular_vec, radial_angles[i]),
+                    vec0, vec1, vec2);
+            }
+            *(rks) = max(mean / nmr_radial_directions, 0.0);
+        }
+    ''', dependencies=[get_component('library_functions', 'RotateOrthogonalVector')(),
+                       get_component('library_functions', 'TensorSphericalToCartesian')(),
+                       get_component('library_functions', 'KurtosisMultiplication')()])
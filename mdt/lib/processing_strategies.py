@@ -23,15 +23,22 @@ from numpy.lib.format import open_memmap
 
 import mot
 from mdt.lib.fsl_sampling_routine import FSLSamplingRoutine
+from mdt.lib.sampling_statistics import RunningSampleStatistics
+from mdt.lib.sampler_state import SAMPLER_STATE_DIR_NAME, get_sampler_state, apply_sampler_state, \
+    write_sampler_state, load_sampler_state, has_sampler_state
 from mdt.lib.nifti import write_all_as_nifti, get_all_nifti_data
-from mdt.configuration import gzip_optimization_results, gzip_sampling_results
-from mdt.utils import create_roi, load_samples
+from mdt.lib.results_container import RESULTS_CONTAINER_NAME, ResultsContainerWriter
+from mdt.configuration import gzip_optimization_results, gzip_sampling_results, use_numpy_backend, \
+    use_results_container_for_optimization, use_results_container_for_sampling
+from mdt.utils import create_roi, load_samples, PackedCovariances, write_covariances_order
 import collections
 
 from mot.sample import AdaptiveMetropolisWithinGibbs, SingleComponentAdaptiveMetropolis
 from mdt.model_building.utils import ObjectiveFunctionWrapper
 from mot.configuration import CLRuntimeInfo
 from mot.optimize import minimize
+from mot.lib.utils import split_in_batches
+from mot.sample.base import SimpleSampleOutput
 from mot.sample.mwg import MetropolisWithinGibbs
 from mot.sample.t_walk import ThoughtfulWalk
 
@@ -261,6 +268,7 @@ class SimpleModelProcessor(ModelProcessor):
         """
         super().__init__()
         self._write_volumes_gzipped = True
+        self._write_results_container = False
         self._used_mask_name = 'UsedMask'
         self._mask = mask
         self._nifti_header = nifti_header
@@ -397,6 +405,38 @@ class SimpleModelProcessor(ModelProcessor):
             write_all_as_nifti({map_name: data}, full_output_dir, nifti_header=nifti_header,
                                gzip=self._write_volumes_gzipped)
 
+    def _combine_all_volumes(self, output_dir, tmp_storage_dir, nifti_header, maps_subdirs):
+        """Combine the volumes of all the given subdirectories, as niftis or as a single results container.
+
+        If we are writing niftis we remove any existing results container and vice versa, such that the output
+        directory never contains results in both formats.
+
+        Args:
+            output_dir (str): the location for the output files
+            tmp_storage_dir (str): the directory with the temporary results
+            nifti_header: the nifti header to use for the output files
+            maps_subdirs (list of str): the subdirectories with the maps to combine, see :meth:`_combine_volumes`.
+        """
+        container_path = os.path.join(output_dir, RESULTS_CONTAINER_NAME)
+
+        if not self._write_results_container:
+            if os.path.isfile(container_path):
+                os.remove(container_path)
+            for subdir in maps_subdirs:
+                self._combine_volumes(output_dir, tmp_storage_dir, nifti_header, maps_subdir=subdir)
+            return
+
+        with ResultsContainerWriter(container_path, self._mask, nifti_header=nifti_header) as writer:
+            for subdir in maps_subdirs:
+                full_output_dir = os.path.join(output_dir, subdir)
+                for fname in glob.glob(os.path.join(full_output_dir, '*.nii*')):
+                    os.remove(fname)
+
+                for path in glob.glob(os.path.join(tmp_storage_dir, subdir, '*.npy')):
+                    map_name = os.path.splitext(os.path.basename(path))[0]
+                    writer.add_map(os.path.join(subdir, map_name).replace(os.sep, '/'),
+                                   np.load(path, mmap_mode='r'))
+
     def _create_roi_to_volume_index_lookup_table(self):
         """Creates and returns a lookup table for roi index -> volume index.
 
@@ -441,56 +481,15 @@ class FittingProcessor(SimpleModelProcessor):
         self._method = method
         self._optimizer_options = optimizer_options
         self._write_volumes_gzipped = gzip_optimization_results()
+        self._write_results_container = use_results_container_for_optimization()
         self._subdirs = set()
+        self._covariances_orders = {}
         self._logger=logging.getLogger(__name__)
 
     def _process(self, roi_indices, next_indices=None):
         with self._model.voxels_to_analyze_context(roi_indices):
-            codec = self._model.get_parameter_codec()
-
-            cl_runtime_info = CLRuntimeInfo()
-
-            self._logger.info('Starting optimization')
-            self._logger.info('Using MOT version {}'.format(mot.__version__))
-            self._logger.info('We will use a {} precision float type for the calculations.'.format(
-                'double' if cl_runtime_info.double_precision else 'single'))
-            for env in cl_runtime_info.cl_environments:
-                self._logger.info('Using device \'{}\'.'.format(str(env)))
-            self._logger.info('Using compile flags: {}'.format(cl_runtime_info.compile_flags))
-
-            if self._optimizer_options:
-                self._logger.info('We will use the optimizer {} '
-                                  'with optimizer settings {}'.format(self._method, self._optimizer_options))
-            else:
-                self._logger.info('We will use the optimizer {} with default settings.'.format(self._method))
-
-            x0 = codec.encode(self._model.get_initial_parameters(), self._model.get_kernel_data())
-            lower_bounds, upper_bounds = codec.encode_bounds(self._model.get_lower_bounds(),
-                                                             self._model.get_upper_bounds())
-
-            wrapper = ObjectiveFunctionWrapper(x0.shape[1])
-            objective_func = wrapper.wrap_objective_function(self._model.get_objective_function(),
-                                                             codec.get_decode_function())
-            input_data = wrapper.wrap_input_data(self._model.get_kernel_data())
-
-            results = minimize(objective_func, x0, method=self._method,
-                               nmr_observations=self._model.get_nmr_observations(),
-                               cl_runtime_info=cl_runtime_info,
-                               data=input_data,
-                               lower_bounds=lower_bounds,
-                               upper_bounds=upper_bounds,
-                               options=self._optimizer_options)
-
-            self._logger.info('Finished optimization')
-            self._logger.info('Starting post-processing')
-
-            x_final = codec.decode(results['x'], self._model.get_kernel_data())
-
-            results = self._model.get_post_optimization_output(x_final, results['status'])
+            results = fit_voxels(self._model, self._method, optimizer_options=self._optimizer_options)
             results.update({self._used_mask_name: np.ones(roi_indices.shape[0], dtype=np.bool)})
-
-            self._logger.info('Finished post-processing')
-
             self._write_output_recursive(results, roi_indices)
 
     def _write_output_recursive(self, results, roi_indices, sub_dir=''):
@@ -498,7 +497,10 @@ class FittingProcessor(SimpleModelProcessor):
         sub_dir = sub_dir
 
         for key, value in results.items():
-            if isinstance(value, collections.Mapping):
+            if isinstance(value, PackedCovariances):
+                current_output[key] = value.packed
+                self._covariances_orders[(sub_dir, key)] = value.param_names
+            elif isinstance(value, collections.Mapping):
                 self._write_output_recursive(value, roi_indices, os.path.join(sub_dir, key))
             else:
                 current_output[key] = value
@@ -508,9 +510,9 @@ class FittingProcessor(SimpleModelProcessor):
 
     def combine(self):
         super().combine()
-        for subdir in self._subdirs:
-            self._combine_volumes(self._output_dir, self._tmp_storage_dir,
-                                  self._nifti_header, maps_subdir=subdir)
+        self._combine_all_volumes(self._output_dir, self._tmp_storage_dir, self._nifti_header, self._subdirs)
+        for (sub_dir, map_name), param_names in self._covariances_orders.items():
+            write_covariances_order(os.path.join(self._output_dir, sub_dir), param_names, map_name=map_name)
         return create_roi(get_all_nifti_data(self._output_dir), self._mask)
 
 
@@ -519,10 +521,21 @@ class SamplingProcessor(SimpleModelProcessor):
     class SampleChainNotStored:
         pass
 
+    _running_statistics_batch_size = 1000
+    """The number of samples per batch, when sampling using running statistics."""
+
     def __init__(self, nmr_samples, thinning, burnin, method, model, mask, nifti_header, output_dir, tmp_storage_dir,
-                 recalculate, samples_storage_strategy=None, post_sampling_cb=None, sampler_options=None):
+                 recalculate, samples_storage_strategy=None, post_sampling_cb=None, sampler_options=None,
+                 continue_from=None):
         """The processing worker for model sample.
 
+        If the samples storage strategy does not store all the samples and the active post-processing does not
+        need the full chain, we sample in batches and only keep the samples we store. The post-sampling maps are then
+        computed from running statistics over the complete chain. Else, the full chain is kept in memory.
+
+        After sampling, the final state of the sampler is stored in the subdirectory ``sampler_state`` of the output
+        directory. Using ``continue_from``, a later run can use that state to extend the existing chains.
+
         Args:
             nmr_samples (int): the number of samples we would like to return.
             burnin (int): the number of samples to burn-in, that is, to discard before returning the desired
@@ -541,6 +554,10 @@ class SamplingProcessor(SimpleModelProcessor):
                     dictionary with as keys dir-/file-names and as values maps to be stored in the results directory.
             sampler_options (dict): specific options for the MCMC routine. These will be provided to the sampling routine
                 as additional keyword arguments to the constructor.
+            continue_from (str): the directory with the samples and sampler state of a previous sampling run.
+                If given, we continue the chains of that run (without burn-in) and append the new samples to
+                the previous samples. The previous run must have stored the samples of all parameters, the
+                log-likelihoods and the log-priors.
         """
         super().__init__(mask, nifti_header, output_dir, tmp_storage_dir, recalculate)
         self._nmr_samples = nmr_samples
@@ -549,83 +566,250 @@ class SamplingProcessor(SimpleModelProcessor):
         self._method = method
         self._model = model
         self._write_volumes_gzipped = gzip_sampling_results()
+        self._write_results_container = use_results_container_for_sampling()
         self._samples_to_save_method = samples_storage_strategy or SaveAllSamples()
         self._subdirs = set()
         self._logger = logging.getLogger(__name__)
         self._samples_output_stored = []
         self._post_sampling_cb = post_sampling_cb
         self._sampler_options = sampler_options or {}
+        self._continue_from = continue_from
+        self._samples_dir = self._output_dir
+        self._sampler_state_dir = os.path.join(self._tmp_storage_dir, SAMPLER_STATE_DIR_NAME)
+
+        if self._continue_from:
+            self._check_continuation(self._continue_from)
+            self._samples_dir = os.path.join(self._tmp_storage_dir, 'samples')
 
     def _process(self, roi_indices, next_indices=None):
         with self._model.voxels_to_analyze_context(roi_indices):
+            numpy_backend = None
+            if self._method in ['AMWG', 'MWG'] and use_numpy_backend(len(roi_indices)):
+                numpy_backend = self._model.get_numpy_backend()
+
+            sampler_state = None
+            if self._continue_from:
+                sampler_state = load_sampler_state(os.path.join(self._continue_from, SAMPLER_STATE_DIR_NAME),
+                                                   roi_indices)
+
+            if numpy_backend is not None:
+                self._logger.info('Using the NumPy backend for sampling.')
+                sampler = _NumpySampler(numpy_backend, self._model, self._method, self._thinning,
+                                        self._sampler_options, sampler_state)
+            else:
+                sampler = self._get_opencl_sampler(sampler_state)
 
-            method = None
-            method_args = [self._model.get_log_likelihood_function(),
-                           self._model.get_log_prior_function(),
-                           self._model.get_initial_parameters()]
-            method_kwargs = {'data': self._model.get_kernel_data()}
-
-            if self._method in ['AMWG', 'SCAM', 'MWG', 'FSL']:
-                method_args.append(self._model.get_rwm_proposal_stds())
-                method_kwargs.update(finalize_proposal_func=self._model.get_finalize_proposal_function())
-
-            if self._method == 'AMWG':
-                method = AdaptiveMetropolisWithinGibbs
-            elif self._method == 'SCAM':
-                method = SingleComponentAdaptiveMetropolis
-                method_kwargs['epsilon'] = self._model.get_rwm_epsilons()
-            elif self._method == 'MWG':
-                method = MetropolisWithinGibbs
-            elif self._method == 'FSL':
-                method = FSLSamplingRoutine
-            elif self._method == 't-walk':
-                method = ThoughtfulWalk
-                method_args.append(self._model.get_random_parameter_positions()[..., 0])
-                method_kwargs.update(finalize_proposal_func=self._model.get_finalize_proposal_function())
-
-            method_kwargs.update(self._sampler_options)
-
-            if method is None:
-                raise ValueError('Could not find the sampler with name {}.'.format(self._method))
-
-            sampler = method(*method_args, **method_kwargs)
-            sampling_output = sampler.sample(self._nmr_samples, burnin=self._burnin, thinning=self._thinning)
-            samples = sampling_output.get_samples()
-
-            self._logger.info('Starting post-processing')
-            maps_to_save = self._model.get_post_sampling_maps(sampling_output)
-            maps_to_save.update({self._used_mask_name: np.ones(samples.shape[0], dtype=np.bool)})
-
-            if self._post_sampling_cb:
-                out = self._post_sampling_cb(sampling_output, self._model)
-                if out:
-                    maps_to_save.update(out)
-
-            self._write_output_recursive(maps_to_save, roi_indices)
-
-            def get_output(output_name):
-                if output_name in self._model.get_free_param_names():
-                    return samples[:, ind, ...]
-                elif output_name == 'LogLikelihood':
-                    return sampling_output.get_log_likelihoods()
-                elif output_name == 'LogPrior':
-                    return sampling_output.get_log_priors()
-
-            items_to_save = {}
-            for ind, name in enumerate(list(self._model.get_free_param_names()) + ['LogLikelihood', 'LogPrior']):
-                if self._samples_to_save_method.store_samples(name):
-                    self._samples_output_stored.append(name)
-                    items_to_save.update({name: get_output(name)})
-            self._write_sample_results(items_to_save, roi_indices)
+            with self._model.numpy_backend_context(numpy_backend):
+                if self._use_running_statistics():
+                    self._sample_with_running_statistics(sampler, roi_indices)
+                else:
+                    self._sample_full_chain(sampler, roi_indices)
 
+            write_sampler_state(self._sampler_state_dir, sampler.get_state(), roi_indices, self._total_nmr_voxels)
             self._logger.info('Finished post-processing')
 
+    def _sample_full_chain(self, sampler, roi_indices):
+        """Sample the full chain in memory, after which we compute the post-sampling maps from the full chain."""
+        sampling_output = sampler.sample(self._nmr_samples, burnin=self._get_burnin())
+
+        if self._continue_from:
+            sampling_output = self._prepend_previous_samples(sampling_output, roi_indices)
+        samples = sampling_output.get_samples()
+
+        self._logger.info('Starting post-processing')
+        maps_to_save = self._model.get_post_sampling_maps(sampling_output)
+        maps_to_save.update({self._used_mask_name: np.ones(samples.shape[0], dtype=np.bool)})
+
+        if self._post_sampling_cb:
+            out = self._post_sampling_cb(sampling_output, self._model)
+            if out:
+                maps_to_save.update(out)
+
+        self._write_output_recursive(maps_to_save, roi_indices)
+
+        items_to_save = {}
+        for name, output in self._get_sample_outputs(sampling_output).items():
+            if self._samples_to_save_method.store_samples(name):
+                items_to_save[name] = output[:, self._samples_to_save_method.indices_to_store(name, output.shape[1])]
+        self._write_sample_results(items_to_save, roi_indices)
+
+    def _sample_with_running_statistics(self, sampler, roi_indices):
+        """Sample the chain in batches, keeping only the samples we store.
+
+        Instead of keeping the full chain in memory, this samples the chain in batches and, per batch, updates the
+        running statistics of the chain and selects the samples we are asked to store. Since the MOT samplers return
+        every sample of a batch, both happen on the host, see :mod:`mdt.lib.sampling_statistics`.
+        """
+        statistics = RunningSampleStatistics(len(roi_indices), len(self._model.get_free_param_names()))
+
+        batches = []
+        if self._continue_from:
+            batches.append(self._get_previous_samples(roi_indices))
+            total_nmr_samples = batches[0].get_samples().shape[2] + self._nmr_samples
+        else:
+            total_nmr_samples = self._nmr_samples
+
+        save_indices = {}
+        for name in list(self._model.get_free_param_names()) + ['LogLikelihood', 'LogPrior']:
+            if self._samples_to_save_method.store_samples(name):
+                save_indices[name] = np.asarray(
+                    self._samples_to_save_method.indices_to_store(name, total_nmr_samples), dtype=np.int64)
+        stored_outputs = {name: [] for name in save_indices}
+
+        def process_batch(sampling_output, batch_start):
+            outputs = self._get_sample_outputs(sampling_output)
+            batch_length = sampling_output.get_samples().shape[2]
+            statistics.update(sampling_output.get_samples(), sampling_output.get_log_likelihoods(),
+                              sampling_output.get_log_priors())
+
+            for name, indices in save_indices.items():
+                in_batch = indices[(indices >= batch_start) & (indices < batch_start + batch_length)]
+                stored_outputs[name].append(np.array(outputs[name][:, in_batch - batch_start]))
+            return batch_start + batch_length
+
+        batch_start = 0
+        for previous_output in batches:
+            batch_start = process_batch(previous_output, batch_start)
+
+        burnin = self._get_burnin()
+        for batch_begin, batch_end in split_in_batches(self._nmr_samples, self._running_statistics_batch_size):
+            batch_start = process_batch(sampler.sample(batch_end - batch_begin, burnin=burnin), batch_start)
+            burnin = 0
+
+        self._logger.info('Starting post-processing')
+        maps_to_save = self._model.get_post_sampling_maps_from_statistics(statistics)
+        maps_to_save.update({self._used_mask_name: np.ones(len(roi_indices), dtype=np.bool)})
+        self._write_output_recursive(maps_to_save, roi_indices)
+
+        self._write_sample_results({name: np.concatenate(outputs, axis=1)
+                                    for name, outputs in stored_outputs.items()}, roi_indices)
+
+    def _use_running_statistics(self):
+        """Check if we can sample using running statistics instead of keeping the full chain in memory.
+
+        This is only useful if we do not store all the samples, and only possible if the post-processing does not
+        require the full chain.
+        """
+        if self._post_sampling_cb or self._model.post_sampling_requires_full_chain():
+            return False
+
+        for name in list(self._model.get_free_param_names()) + ['LogLikelihood', 'LogPrior']:
+            if not self._samples_to_save_method.store_samples(name) \
+                    or len(self._samples_to_save_method.indices_to_store(name, self._nmr_samples)) \
+                    < self._nmr_samples:
+                return True
+        return False
+
+    def _get_sample_outputs(self, sampling_output):
+        """Get the sampled output elements by name, which are the model parameters, LogLikelihood and LogPrior."""
+        samples = sampling_output.get_samples()
+        outputs = {name: samples[:, ind, :] for ind, name in enumerate(self._model.get_free_param_names())}
+        outputs.update({'LogLikelihood': sampling_output.get_log_likelihoods(),
+                        'LogPrior': sampling_output.get_log_priors()})
+        return outputs
+
+    def _get_opencl_sampler(self, sampler_state=None):
+        x0 = self._model.get_initial_parameters()
+        if sampler_state is not None:
+            x0 = sampler_state['current_chain_position']
+
+        method = None
+        method_args = [self._model.get_log_likelihood_function(),
+                       self._model.get_log_prior_function(),
+                       x0]
+        method_kwargs = {'data': self._model.get_kernel_data()}
+
+        if self._method in ['AMWG', 'SCAM', 'MWG', 'FSL']:
+            method_args.append(self._model.get_rwm_proposal_stds())
+            method_kwargs.update(finalize_proposal_func=self._model.get_finalize_proposal_function())
+
+        if self._method == 'AMWG':
+            method = AdaptiveMetropolisWithinGibbs
+        elif self._method == 'SCAM':
+            method = SingleComponentAdaptiveMetropolis
+            method_kwargs['epsilon'] = self._model.get_rwm_epsilons()
+        elif self._method == 'MWG':
+            method = MetropolisWithinGibbs
+        elif self._method == 'FSL':
+            method = FSLSamplingRoutine
+        elif self._method == 't-walk':
+            method = ThoughtfulWalk
+            method_args.append(self._model.get_random_parameter_positions()[..., 0])
+            method_kwargs.update(finalize_proposal_func=self._model.get_finalize_proposal_function())
+
+        method_kwargs.update(self._sampler_options)
+
+        if method is None:
+            raise ValueError('Could not find the sampler with name {}.'.format(self._method))
+
+        sampler = method(*method_args, **method_kwargs)
+        if sampler_state is not None:
+            apply_sampler_state(sampler, sampler_state)
+        return _OpenCLSampler(sampler, self._thinning)
+
+    def _get_burnin(self):
+        """When continuing an existing chain, the chain is already burned in."""
+        if self._continue_from:
+            return 0
+        return self._burnin
+
+    def _check_continuation(self, continue_from):
+        """Check if we can continue the chains stored in the given directory.
+
+        Raises:
+            ValueError: if the sampler state or some of the required samples are missing
+        """
+        if not has_sampler_state(os.path.join(continue_from, SAMPLER_STATE_DIR_NAME)):
+            raise ValueError('No sampler state found in "{}", can not continue sampling.'.format(continue_from))
+
+        required = list(self._model.get_free_param_names()) + ['LogLikelihood', 'LogPrior']
+        missing = [name for name in required
+                   if not os.path.isfile(os.path.join(continue_from, name + '.samples.npy'))]
+        if missing:
+            raise ValueError('Can not continue sampling from "{}", the samples of {} are missing.'.format(
+                continue_from, missing))
+
+    def _get_previous_samples(self, roi_indices):
+        """Get the samples of the run we continue from.
+
+        Returns:
+            mot.sample.base.SimpleSampleOutput: the samples of the previous run
+        """
+        previous = load_samples(self._continue_from)
+        return SimpleSampleOutput(
+            np.stack([previous[name][roi_indices] for name in self._model.get_free_param_names()], axis=1),
+            np.array(previous['LogLikelihood'][roi_indices]),
+            np.array(previous['LogPrior'][roi_indices]))
+
+    def _prepend_previous_samples(self, sampling_output, roi_indices):
+        """Add the samples of the run we continue from in front of the new samples.
+
+        Returns:
+            mot.sample.base.SimpleSampleOutput: the sampling output with the complete chains
+        """
+        previous = self._get_previous_samples(roi_indices)
+        new_samples = sampling_output.get_samples()
+        return SimpleSampleOutput(
+            np.concatenate([previous.get_samples().astype(new_samples.dtype), new_samples], axis=-1),
+            np.concatenate([previous.get_log_likelihoods(), sampling_output.get_log_likelihoods()], axis=-1),
+            np.concatenate([previous.get_log_priors(), sampling_output.get_log_priors()], axis=-1))
+
     def combine(self):
         super().combine()
 
-        for subdir in self._subdirs:
-            self._combine_volumes(self._output_dir, self._tmp_storage_dir,
-                                  self._nifti_header, maps_subdir=subdir)
+        if self._continue_from:
+            for fname in glob.glob(os.path.join(self._output_dir, '*.samples.npy')):
+                os.remove(fname)
+            for fname in glob.glob(os.path.join(self._samples_dir, '*.samples.npy')):
+                shutil.move(fname, os.path.join(self._output_dir, os.path.basename(fname)))
+
+        if os.path.isdir(self._sampler_state_dir):
+            sampler_state_output_dir = os.path.join(self._output_dir, SAMPLER_STATE_DIR_NAME)
+            if os.path.exists(sampler_state_output_dir):
+                shutil.rmtree(sampler_state_output_dir)
+            shutil.move(self._sampler_state_dir, sampler_state_output_dir)
+
+        self._combine_all_volumes(self._output_dir, self._tmp_storage_dir, self._nifti_header, self._subdirs)
 
         if self._samples_output_stored:
             return load_samples(self._output_dir)
@@ -653,36 +837,98 @@ class SamplingProcessor(SimpleModelProcessor):
         On storing it should also be given a list of voxel indices with the indices of the voxels that are being stored.
 
         Args:
-            results (dict): the samples to write
+            results (dict): the samples to write, these should already be selected using the samples storage strategy
             roi_indices (ndarray): the roi indices of the voxels we computed
         """
-        if not os.path.exists(self._output_dir):
-            os.makedirs(self._output_dir)
+        if not os.path.exists(self._samples_dir):
+            os.makedirs(self._samples_dir)
 
-        for fname in os.listdir(self._output_dir):
+        for fname in os.listdir(self._samples_dir):
             if fname.endswith('.samples.npy'):
                 chain_name = fname[0:-len('.samples.npy')]
                 if chain_name not in results:
-                    os.remove(os.path.join(self._output_dir, fname))
+                    os.remove(os.path.join(self._samples_dir, fname))
 
         for output_name, samples in results.items():
-            save_indices = self._samples_to_save_method.indices_to_store(output_name, samples.shape[1])
-            samples_path = os.path.join(self._output_dir, output_name + '.samples.npy')
+            self._samples_output_stored.append(output_name)
+            samples_path = os.path.join(self._samples_dir, output_name + '.samples.npy')
             mode = 'w+'
 
             if os.path.isfile(samples_path):
                 mode = 'r+'
                 current_results = open_memmap(samples_path, mode='r')
-                if current_results.shape[1] != len(save_indices):
+                if current_results.shape[1] != samples.shape[1]:
                     mode = 'w+'
                 del current_results  # closes the memmap
 
             saved = open_memmap(samples_path, mode=mode, dtype=samples.dtype,
-                                shape=(self._total_nmr_voxels, len(save_indices)))
-            saved[roi_indices, :] = samples[:, save_indices]
+                                shape=(self._total_nmr_voxels, samples.shape[1]))
+            saved[roi_indices, :] = samples
             del saved
 
 
+class _OpenCLSampler:
+
+    def __init__(self, sampler, thinning):
+        """Wraps a MOT sampler for use in the sampling processor.
+
+        Args:
+            sampler (mot.sample.base.AbstractSampler): the MOT sampler
+            thinning (int): the thinning to use during sampling
+        """
+        self._sampler = sampler
+        self._thinning = thinning
+
+    def sample(self, nmr_samples, burnin=0):
+        """Continue the chain with the given number of samples.
+
+        Returns:
+            mot.sample.base.SamplingOutput: the sampling output
+        """
+        return self._sampler.sample(nmr_samples, burnin=burnin, thinning=self._thinning)
+
+    def get_state(self):
+        """Get the current state of the sampler, see :mod:`mdt.lib.sampler_state`."""
+        return get_sampler_state(self._sampler)
+
+
+class _NumpySampler:
+
+    def __init__(self, numpy_backend, model, method, thinning, sampler_options, sampler_state=None):
+        """Provides the same interface as the :class:`_OpenCLSampler`, using the NumPy backend of the model.
+
+        Args:
+            numpy_backend (mdt.lib.numpy_backend.NumpyModelBackend): the backend to sample with
+            model (mdt.models.composite.DMRICompositeModel): the model we are sampling
+            method (str): the sampling method, one of 'AMWG' or 'MWG'
+            thinning (int): the thinning to use during sampling
+            sampler_options (dict): additional options for the sampler
+            sampler_state (dict): an optional sampler state to continue from
+        """
+        self._numpy_backend = numpy_backend
+        self._x0 = model.get_initial_parameters()
+        self._proposal_stds = model.get_rwm_proposal_stds()
+        self._adaptive = method == 'AMWG'
+        self._thinning = thinning
+        self._sampler_options = sampler_options
+        self._state = sampler_state
+
+    def sample(self, nmr_samples, burnin=0):
+        """Continue the chain with the given number of samples.
+
+        Returns:
+            mot.sample.base.SamplingOutput: the sampling output
+        """
+        sampling_output, self._state = self._numpy_backend.sample(
+            self._x0, self._proposal_stds, nmr_samples, burnin=burnin, thinning=self._thinning,
+            adaptive=self._adaptive, sampler_state=self._state, **self._sampler_options)
+        return sampling_output
+
+    def get_state(self):
+        """Get the current state of the sampler, see :mod:`mdt.lib.sampler_state`."""
+        return self._state
+
+
 class SamplesStorageStrategy:
     """Defines if and how many samples are being stored, per output item.
 
@@ -805,6 +1051,103 @@ class SaveSpecificSamples(SamplesStorageStrategy):
         return self._sample_indices
 
 
+def fit_voxels(model, method, optimizer_options=None):
+    """Fit the model to the voxels it is set to analyze and return the post-processed results in memory.
+
+    This is the core of the :class:`FittingProcessor`, without any of the storage logic. It uses the NumPy backend
+    if applicable, that is, if enabled, if the model is supported and if the Nelder-Mead method is requested.
+    Else it uses OpenCL for the optimization.
+
+    Args:
+        model (mdt.models.composite.DMRICompositeModel): the model to fit, with the input data already set
+        method (str): the optimization routine to use
+        optimizer_options (dict): the additional optimization options
+
+    Returns:
+        dict: the post-processed optimization results, with for every map a value per voxel
+    """
+    logger = logging.getLogger(__name__)
+
+    numpy_backend = None
+    if _numpy_optimizer_supported(method, optimizer_options) and use_numpy_backend(model.get_nmr_problems()):
+        numpy_backend = model.get_numpy_backend()
+
+    if numpy_backend is not None:
+        x_final, return_codes = _minimize_numpy(model, numpy_backend, optimizer_options)
+    else:
+        x_final, return_codes = _minimize_opencl(model, method, optimizer_options)
+
+    logger.info('Starting post-processing')
+    with model.numpy_backend_context(numpy_backend):
+        results = model.get_post_optimization_output(x_final, return_codes)
+    logger.info('Finished post-processing')
+    return results
+
+
+def _minimize_opencl(model, method, optimizer_options):
+    logger = logging.getLogger(__name__)
+    codec = model.get_parameter_codec()
+
+    cl_runtime_info = CLRuntimeInfo()
+
+    logger.info('Starting optimization')
+    logger.info('Using MOT version {}'.format(mot.__version__))
+    logger.info('We will use a {} precision float type for the calculations.'.format(
+        'double' if cl_runtime_info.double_precision else 'single'))
+    for env in cl_runtime_info.cl_environments:
+        logger.info('Using device \'{}\'.'.format(str(env)))
+    logger.info('Using compile flags: {}'.format(cl_runtime_info.compile_flags))
+
+    if optimizer_options:
+        logger.info('We will use the optimizer {} '
+                    'with optimizer settings {}'.format(method, optimizer_options))
+    else:
+        logger.info('We will use the optimizer {} with default settings.'.format(method))
+
+    x0 = codec.encode(model.get_initial_parameters(), model.get_kernel_data())
+    lower_bounds, upper_bounds = codec.encode_bounds(model.get_lower_bounds(), model.get_upper_bounds())
+
+    wrapper = ObjectiveFunctionWrapper(x0.shape[1])
+    objective_func = wrapper.wrap_objective_function(model.get_objective_function(), codec.get_decode_function())
+    input_data = wrapper.wrap_input_data(model.get_kernel_data())
+
+    results = minimize(objective_func, x0, method=method,
+                       nmr_observations=model.get_nmr_observations(),
+                       cl_runtime_info=cl_runtime_info,
+                       data=input_data,
+                       lower_bounds=lower_bounds,
+                       upper_bounds=upper_bounds,
+                       options=optimizer_options)
+
+    logger.info('Finished optimization')
+    return codec.decode(results['x'], model.get_kernel_data()), results['status']
+
+
+def _numpy_optimizer_supported(method, optimizer_options):
+    """Check if the NumPy backend implements the given optimization method and options.
+
+    The NumPy backend only implements the Nelder-Mead method, with the ``patience`` and ``scale`` options.
+    """
+    if method != 'Nelder-Mead':
+        return False
+    return not (set(optimizer_options or {}) - set(_numpy_optimizer_options))
+
+
+_numpy_optimizer_options = ('patience', 'scale')
+"""The optimizer options supported by the NumPy backend."""
+
+
+def _minimize_numpy(model, numpy_backend, optimizer_options):
+    logger = logging.getLogger(__name__)
+    logger.info('Starting optimization')
+    logger.info('Using the NumPy backend with the Nelder-Mead optimizer.')
+
+    results = numpy_backend.minimize(model.get_initial_parameters(), **(optimizer_options or {}))
+
+    logger.info('Finished optimization')
+    return results['x'], results['status']
+
+
 def get_full_tmp_results_path(output_dir, tmp_dir):
     """Get a temporary results path for processing.
 
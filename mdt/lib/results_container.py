@@ -0,0 +1,365 @@
+"""Single file storage of all the result maps of a model.
+
+Instead of writing every output map as a separate nifti file, the results of a model can be written to a single results
+container file. This container is a zip archive holding:
+
+- ``index.json``, with the container metadata and, per map, the data type and the shape of the map per voxel
+- ``mask.npy``, the mask of the voxels in the container
+- ``header.bin``, the binary block of the nifti header to use when exporting the maps to nifti (optional)
+- ``maps/<map_name>/<chunk_index>.npy``, the compressed chunks of ROI voxels of every map
+
+Maps in subdirectories of the nifti output are stored with the subdirectory in the map name, for example
+``univariate_normal/S0.s0`` for the sampling output. The covariances of the parameters are stored packed, as the single
+map ``covariances`` with per voxel the upper triangular elements of the covariance matrix. The parameter order of that
+map is written to the sidecar file ``covariances.order.txt`` next to the container, as for the nifti output
+(see :class:`mdt.utils.PackedCovariances` and :func:`mdt.utils.load_covariances`).
+
+Since every chunk is compressed separately, we can load a single map, or only a few voxels of a map, without
+decompressing the rest of the container. The functions :func:`mdt.lib.nifti.get_all_nifti_data` and
+:func:`mdt.load_volume_maps` read results containers transparently.
+"""
+import io
+import json
+import os
+import zipfile
+import nibabel as nib
+import numpy as np
+
+from mdt.lib.deferred_mappings import DeferredActionDict
+from mdt.lib.nifti import nifti_info_decorate_array, NiftiInfo, write_all_as_nifti
+
+__author__ = 'Robbert Harms'
+__date__ = '2019-03-25'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+RESULTS_CONTAINER_NAME = 'results.mdtc'
+"""The filename of the results container within a model output directory."""
+
+_CONTAINER_VERSION = 1
+
+
+class ResultsContainerWriter:
+
+    def __init__(self, path, mask, nifti_header=None, chunk_size=10000):
+        """Write a results container file.
+
+        The container is first written to a temporary file which is moved to the final path on :meth:`close`, such
+        that there is never a partially written container at the given path.
+
+        Args:
+            path (str): the path of the container file to write
+            mask (ndarray): the 3d mask of the voxels we are storing
+            nifti_header: the nifti header to store with the maps, used when exporting the maps to nifti
+            chunk_size (int): the number of voxels per compressed chunk
+        """
+        self._path = path
+        self._tmp_path = path + '.tmp'
+        self._mask = np.asarray(mask, dtype=np.bool)
+        self._roi_flat_indices = np.flatnonzero(self._mask)
+        self._chunk_size = chunk_size
+        self._maps_info = {}
+
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        self._zipfile = zipfile.ZipFile(self._tmp_path, mode='w', compression=zipfile.ZIP_DEFLATED, allowZip64=True)
+        self._write_array('mask.npy', self._mask)
+
+        self._header_type = None
+        if nifti_header is not None:
+            self._header_type = type(nifti_header).__name__
+            self._zipfile.writestr('header.bin', nifti_header.binaryblock)
+
+    def add_map(self, map_name, data):
+        """Add a map to the container.
+
+        Args:
+            map_name (str): the name of the map, can contain forward slashes to store maps in a subdirectory
+            data (ndarray): either a volume, with as first three dimensions the shape of the mask, or a ROI array
+                with as first dimension the voxels in the mask
+        """
+        if data.ndim >= 3 and data.shape[:3] == self._mask.shape:
+            data = data.reshape((-1,) + data.shape[3:])[self._roi_flat_indices]
+
+        for chunk_ind, start in enumerate(range(0, data.shape[0], self._chunk_size)):
+            self._write_array('maps/{}/{}.npy'.format(map_name, chunk_ind), data[start:start + self._chunk_size])
+
+        self._maps_info[map_name] = {'dtype': np.dtype(data.dtype).str, 'shape': list(data.shape[1:])}
+
+    def close(self):
+        """Write the index and move the container to its final location."""
+        self._zipfile.writestr('index.json', json.dumps({
+            'version': _CONTAINER_VERSION,
+            'nmr_voxels': int(self._roi_flat_indices.shape[0]),
+            'chunk_size': self._chunk_size,
+            'header_type': self._header_type,
+            'maps': self._maps_info}))
+        self._zipfile.close()
+        os.replace(self._tmp_path, self._path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._zipfile.close()
+            os.remove(self._tmp_path)
+
+    def _write_array(self, member_name, array):
+        with io.BytesIO() as f:
+            np.save(f, np.ascontiguousarray(array))
+            self._zipfile.writestr(member_name, f.getvalue())
+
+
+class ResultsContainer:
+
+    def __init__(self, path):
+        """Read access to a results container file.
+
+        All the read functions are lazy, they only decompress the chunks needed for the requested maps and voxels.
+
+        Args:
+            path (str): the path to the container file
+        """
+        self.path = path
+        self._zipfile = zipfile.ZipFile(path, mode='r')
+        self._index = json.loads(self._zipfile.read('index.json').decode('utf-8'))
+        self._mask = None
+        self._roi_flat_indices = None
+
+    @property
+    def map_names(self):
+        """Get the names of all the maps in this container.
+
+        Returns:
+            list of str: the names of all the maps, with maps in a subdirectory prefixed by that subdirectory
+        """
+        return list(self._index['maps'])
+
+    @property
+    def nmr_voxels(self):
+        """The number of voxels in the mask of this container."""
+        return self._index['nmr_voxels']
+
+    @property
+    def mask(self):
+        """The 3d mask of the voxels in this container."""
+        if self._mask is None:
+            self._mask = self._read_array('mask.npy')
+        return self._mask
+
+    @property
+    def nifti_header(self):
+        """The nifti header stored with the maps, None if no header was stored."""
+        if self._index['header_type'] is None:
+            return None
+        header_class = getattr(nib.nifti2, self._index['header_type'], None) or \
+            getattr(nib.nifti1, self._index['header_type'])
+        return header_class(binaryblock=self._zipfile.read('header.bin'))
+
+    def get_roi(self, map_name, roi_indices=None):
+        """Get the data of the given map as a ROI array.
+
+        Args:
+            map_name (str): the name of the map to load
+            roi_indices (ndarray): if given, we only load these voxels. Only the chunks containing these voxels
+                are decompressed.
+
+        Returns:
+            ndarray: the map data with on the first axis the voxels
+        """
+        chunk_size = self._index['chunk_size']
+        nmr_chunks = (self.nmr_voxels + chunk_size - 1) // chunk_size
+
+        if roi_indices is None:
+            chunks = [self._read_chunk(map_name, chunk_ind) for chunk_ind in range(nmr_chunks)]
+            if not chunks:
+                return self._get_empty_roi(map_name)
+            return np.concatenate(chunks)
+
+        roi_indices = np.asarray(roi_indices, dtype=np.int64)
+        output = np.zeros((roi_indices.shape[0],) + tuple(self._index['maps'][map_name]['shape']),
+                          dtype=self._index['maps'][map_name]['dtype'])
+        chunk_indices = roi_indices // chunk_size
+        for chunk_ind in np.unique(chunk_indices):
+            positions = chunk_indices == chunk_ind
+            output[positions] = self._read_chunk(map_name, chunk_ind)[roi_indices[positions] - chunk_ind * chunk_size]
+        return output
+
+    def get_volume(self, map_name):
+        """Get the data of the given map as a volume, in the space of the mask.
+
+        Args:
+            map_name (str): the name of the map to load
+
+        Returns:
+            ndarray: the volume, decorated with the nifti information of this container
+        """
+        roi = self.get_roi(map_name)
+        volume = np.zeros((self.mask.size,) + roi.shape[1:], dtype=roi.dtype)
+        volume[self._get_roi_flat_indices()] = roi
+        volume = volume.reshape(self.mask.shape + roi.shape[1:])
+        return nifti_info_decorate_array(volume, NiftiInfo(header=self.nifti_header, filepath=self.path))
+
+    def get_maps(self, map_names=None, subdir='', deferred=True):
+        """Get the volumes of the maps of one (sub)directory of this container.
+
+        This mimics loading all the nifti files from a directory, that is, we return the maps directly in the
+        given subdirectory, excluding the maps in deeper subdirectories.
+
+        Args:
+            map_names (list of str): if given, we only return these maps
+            subdir (str): the subdirectory to load the maps from, use an empty string for the top level maps
+            deferred (boolean): if True we return a deferred loading dictionary instead of a dictionary with the
+                values loaded as arrays.
+
+        Returns:
+            dict: the volumes by map name, the map names are without the subdirectory prefix
+        """
+        names = self._get_subdir_map_names(map_names, subdir)
+        if deferred:
+            return DeferredActionDict(lambda _, full_name: self.get_volume(full_name), names)
+        return {name: self.get_volume(full_name) for name, full_name in names.items()}
+
+    def export_nifti(self, output_dir, map_names=None, gzip=True):
+        """Export (a selection of) the maps in this container to nifti files.
+
+        Maps with a subdirectory in their name are written to that subdirectory of the output directory.
+
+        Args:
+            output_dir (str): the directory to write the nifti files to
+            map_names (list of str): if given, we only export these maps
+            gzip (boolean): if True we write the files as .nii.gz, if False we write the files as .nii
+        """
+        header = self.nifti_header
+        for map_name in self.map_names:
+            if not map_names or map_name in map_names:
+                subdir, name = os.path.split(map_name)
+                write_all_as_nifti({name: self.get_volume(map_name)}, os.path.join(output_dir, subdir),
+                                   nifti_header=header, gzip=gzip)
+
+    def close(self):
+        """Close the underlying file."""
+        self._zipfile.close()
+
+    def __contains__(self, map_name):
+        return map_name in self._index['maps']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _get_subdir_map_names(self, map_names, subdir):
+        """Get the full names of the maps directly in the given subdirectory, by their name in that subdirectory."""
+        prefix = subdir.strip('/') + '/' if subdir.strip('/') else ''
+
+        names = {}
+        for full_name in self.map_names:
+            if full_name.startswith(prefix) and '/' not in full_name[len(prefix):]:
+                name = full_name[len(prefix):]
+                if not map_names or name in map_names:
+                    names[name] = full_name
+        return names
+
+    def _get_roi_flat_indices(self):
+        if self._roi_flat_indices is None:
+            self._roi_flat_indices = np.flatnonzero(self.mask)
+        return self._roi_flat_indices
+
+    def _get_empty_roi(self, map_name):
+        info = self._index['maps'][map_name]
+        return np.zeros([0] + info['shape'], dtype=info['dtype'])
+
+    def _read_chunk(self, map_name, chunk_ind):
+        return self._read_array('maps/{}/{}.npy'.format(map_name, chunk_ind))
+
+    def _read_array(self, member_name):
+        with io.BytesIO(self._zipfile.read(member_name)) as f:
+            return np.load(f)
+
+
+def find_results_container(path):
+    """Find the results container for the given output path.
+
+    The given path can be the container file itself, a directory containing a results container or a (non-existing)
+    subdirectory of such a directory, like ``<model>/covariances``.
+
+    Args:
+        path (str): the path to look for a container
+
+    Returns:
+        tuple: (container_path, subdir) with the path to the container file and the subdirectory within the container,
+            or None if no results container could be found.
+    """
+    subdir = ''
+    current = os.path.abspath(path)
+    while True:
+        if os.path.isfile(current) and current.endswith(os.path.splitext(RESULTS_CONTAINER_NAME)[1]):
+            return current, subdir
+
+        candidate = os.path.join(current, RESULTS_CONTAINER_NAME)
+        if os.path.isfile(candidate):
+            return candidate, subdir
+
+        if os.path.exists(current):
+            return None
+
+        current, basename = os.path.split(current)
+        if not basename:
+            return None
+        subdir = os.path.join(basename, subdir) if subdir else basename
+
+
+def load_results_container_maps(path, map_names=None, deferred=True):
+    """Load the maps of the results container found for the given path.
+
+    The container file is only kept open while reading, the deferred loading dictionary reopens the container for
+    every map it loads.
+
+    Args:
+        path (str): the path to find the container for, see :func:`find_results_container`.
+        map_names (list of str): if given, we only return these maps
+        deferred (boolean): if True we return a deferred loading dictionary instead of a dictionary with the values
+            loaded as arrays.
+
+    Returns:
+        dict: the volumes by map name, or None if no results container could be found.
+    """
+    location = find_results_container(path)
+    if location is None:
+        return None
+    container_path, subdir = location
+
+    with ResultsContainer(container_path) as container:
+        if not deferred:
+            return container.get_maps(map_names=map_names, subdir=subdir, deferred=False)
+        names = container._get_subdir_map_names(map_names, subdir)
+
+    def load_volume(_, full_name):
+        with ResultsContainer(container_path) as container:
+            return container.get_volume(full_name)
+    return DeferredActionDict(load_volume, names)
+
+
+def export_results_container(container_path, output_dir=None, map_names=None, gzip=True):
+    """Export the maps of a results container to nifti files.
+
+    Args:
+        container_path (str): the path to the container file, or the directory containing the container
+        output_dir (str): the directory to write the nifti files to, defaults to the directory of the container
+        map_names (list of str): if given, we only export these maps
+        gzip (boolean): if True we write the files as .nii.gz, if False we write the files as .nii
+    """
+    if os.path.isdir(container_path):
+        container_path = os.path.join(container_path, RESULTS_CONTAINER_NAME)
+
+    with ResultsContainer(container_path) as container:
+        container.export_nifti(output_dir or os.path.dirname(os.path.abspath(container_path)),
+                               map_names=map_names, gzip=gzip)
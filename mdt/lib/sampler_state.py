@@ -0,0 +1,133 @@
+"""Persisting and restoring the state of an MCMC sampler.
+
+After sampling, the sampling processor stores for every voxel the final state of the sampler. This contains the last
+position of the chain with its log-likelihood and log-prior, the (adapted) proposal standard deviations, the random
+number generator state and any method specific state (like the acceptance counters of the AMWG and FSL samplers). Using
+that state, a later run can continue the existing chains instead of restarting the sampling from scratch.
+
+The state is stored as a dictionary of arrays, with for every element one value (or vector) per voxel. On disk, every
+element is written as a ``.npy`` file with as first dimension all the voxels in the mask, in the directory
+:data:`SAMPLER_STATE_DIR_NAME` within the samples output directory.
+"""
+import glob
+import os
+import numpy as np
+from numpy.lib.format import open_memmap
+
+__author__ = 'Robbert Harms'
+__date__ = '2019-03-18'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+SAMPLER_STATE_DIR_NAME = 'sampler_state'
+
+_SAMPLER_STATE_ATTRIBUTES = ('current_chain_position', 'current_log_likelihood', 'current_log_prior',
+                             'rng_state', 'proposal_stds', 'acceptance_counter',
+                             'parameter_means', 'parameter_variances',
+                             'x1', 'x1_log_likelihood', 'x1_log_prior')
+
+
+def get_sampler_state(sampler):
+    """Get the current state of a MOT sampler.
+
+    Args:
+        sampler (mot.sample.base.AbstractSampler): the sampler from which we want to get the state
+
+    Returns:
+        dict: the state elements, with for every element one value or vector per voxel.
+    """
+    state = {}
+    for name in _SAMPLER_STATE_ATTRIBUTES:
+        value = getattr(sampler, '_' + name, None)
+        if isinstance(value, np.ndarray):
+            state[name] = np.copy(value)
+    state['sampling_index'] = np.full(sampler._nmr_problems, sampler._sampling_index, dtype=np.uint64)
+    return state
+
+
+def apply_sampler_state(sampler, state):
+    """Set the state of a MOT sampler, such that it continues where a previous sampler stopped.
+
+    Elements which are not present in the given state, or which are not used by the given sampler are ignored. As such,
+    it is possible to continue a chain using a different sampling method, albeit without the method specific state.
+
+    Args:
+        sampler (mot.sample.base.AbstractSampler): the sampler to update, this is updated in place
+        state (dict): the sampler state as returned by :func:`get_sampler_state` or :func:`load_sampler_state`.
+    """
+    for name in _SAMPLER_STATE_ATTRIBUTES:
+        current = getattr(sampler, '_' + name, None)
+        if name in state and isinstance(current, np.ndarray) and current.shape == state[name].shape:
+            np.copyto(current, state[name], casting='unsafe')
+
+    if 'sampling_index' in state:
+        sampler._sampling_index = int(np.max(state['sampling_index']))
+
+
+def write_sampler_state(output_dir, state, roi_indices, total_nmr_voxels):
+    """Write the sampler state of the given voxels to the given directory.
+
+    If the state files already exist, we only update the given voxels.
+
+    Args:
+        output_dir (str): the directory to write the state files to
+        state (dict): the sampler state to write
+        roi_indices (ndarray): the ROI indices of the voxels in the given state
+        total_nmr_voxels (int): the total number of voxels in the mask
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    for name, value in state.items():
+        path = os.path.join(output_dir, name + '.npy')
+        shape = (total_nmr_voxels,) + value.shape[1:]
+
+        mode = 'w+'
+        if os.path.isfile(path):
+            current = open_memmap(path, mode='r')
+            if current.shape == shape and current.dtype == value.dtype:
+                mode = 'r+'
+            del current  # closes the memmap
+
+        saved = open_memmap(path, mode=mode, dtype=value.dtype, shape=shape)
+        saved[roi_indices] = value
+        del saved
+
+
+def load_sampler_state(input_dir, roi_indices=None):
+    """Load the sampler state from the given directory.
+
+    Args:
+        input_dir (str): the directory with the sampler state files
+        roi_indices (ndarray): if given, we only load the state of these voxels.
+
+    Returns:
+        dict: the sampler state, with for every element one value or vector per voxel.
+
+    Raises:
+        ValueError: if no sampler state could be found in the given directory
+    """
+    if not has_sampler_state(input_dir):
+        raise ValueError('No sampler state found in the directory "{}".'.format(input_dir))
+
+    state = {}
+    for path in glob.glob(os.path.join(input_dir, '*.npy')):
+        value = np.load(path, mmap_mode='r')
+        if roi_indices is not None:
+            value = value[roi_indices]
+        state[os.path.basename(path)[:-len('.npy')]] = np.array(value)
+    return state
+
+
+def has_sampler_state(input_dir):
+    """Check if the given directory contains a sampler state we can continue from.
+
+    Args:
+        input_dir (str): the directory with the sampler state files
+
+    Returns:
+        boolean: if there is a sampler state in the given directory
+    """
+    return os.path.isfile(os.path.join(input_dir, 'current_chain_position.npy'))
@@ -0,0 +1,118 @@
+"""Running statistics over MCMC chains, computed batch by batch.
+
+By updating these statistics with consecutive batches of samples, we can compute the post-sampling statistics of the
+full chain without having the full chain in memory at any point in time. This allows the sampling processor to only
+keep the samples it is asked to store.
+
+The statistics are accumulated on the host. The MOT samplers run the chain in their own kernels and return every sample
+of a batch, without a hook to thin the chain or to update running sums on the device. As such, every sample is still
+transferred from the device once, but at most one batch of samples is held in host memory at any time.
+"""
+import numpy as np
+
+__author__ = 'Robbert Harms'
+__date__ = '2019-03-20'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+class RunningSampleStatistics:
+
+    def __init__(self, nmr_problems, nmr_params):
+        """Accumulates statistics over a chain of samples, updated with consecutive batches of samples.
+
+        The statistics computed are the mean and standard deviation per parameter (using the parallel algorithm of
+        Chan et al.), the samples with the highest log-likelihood and highest log-posterior and the number of
+        changes in the chain per parameter, to compute the acceptance rate.
+
+        Args:
+            nmr_problems (int): the number of problems (voxels) in the samples
+            nmr_params (int): the number of parameters in the samples
+        """
+        self._nmr_samples = 0
+        self._mean = np.zeros((nmr_problems, nmr_params), dtype=np.float64)
+        self._sum_of_squares = np.zeros((nmr_problems, nmr_params), dtype=np.float64)
+        self._nmr_changes = np.zeros((nmr_problems, nmr_params), dtype=np.uint64)
+        self._last_sample = None
+
+        self._mle_values = np.full(nmr_problems, -np.inf)
+        self._mle_indices = np.zeros(nmr_problems, dtype=np.uint64)
+        self._mle_samples = np.zeros((nmr_problems, nmr_params))
+
+        self._map_values = np.full(nmr_problems, -np.inf)
+        self._map_indices = np.zeros(nmr_problems, dtype=np.uint64)
+        self._map_samples = np.zeros((nmr_problems, nmr_params))
+
+    def update(self, samples, log_likelihoods, log_priors):
+        """Update the statistics with the next batch of samples of the chain.
+
+        Args:
+            samples (ndarray): a (d, p, n) matrix for d problems, p parameters and n samples.
+            log_likelihoods (ndarray): a (d, n) matrix with the log-likelihoods of the samples
+            log_priors (ndarray): a (d, n) matrix with the log-priors of the samples
+        """
+        nmr_new = samples.shape[2]
+        if nmr_new == 0:
+            return
+
+        batch_mean = np.mean(samples, axis=2, dtype=np.float64)
+        batch_sum_of_squares = np.sum((samples - batch_mean[..., None]) ** 2, axis=2, dtype=np.float64)
+
+        total = self._nmr_samples + nmr_new
+        delta = batch_mean - self._mean
+        self._mean += delta * (nmr_new / total)
+        self._sum_of_squares += batch_sum_of_squares + delta ** 2 * (self._nmr_samples * nmr_new / total)
+
+        self._nmr_changes += np.count_nonzero(np.diff(samples, axis=2), axis=2).astype(np.uint64)
+        if self._last_sample is not None:
+            self._nmr_changes += (samples[..., 0] != self._last_sample).astype(np.uint64)
+        self._last_sample = np.copy(samples[..., -1])
+
+        self._update_maximum(samples, log_likelihoods, self._mle_values, self._mle_indices, self._mle_samples)
+        self._update_maximum(samples, log_likelihoods + log_priors,
+                             self._map_values, self._map_indices, self._map_samples)
+
+        self._nmr_samples = total
+
+    @property
+    def nmr_samples(self):
+        """The number of samples processed so far."""
+        return self._nmr_samples
+
+    @property
+    def mean(self):
+        """The (d, p) matrix with the mean of every parameter."""
+        return self._mean
+
+    @property
+    def std(self):
+        """The (d, p) matrix with the (population) standard deviation of every parameter."""
+        return np.sqrt(self._sum_of_squares / max(self._nmr_samples, 1))
+
+    @property
+    def acceptance_rate(self):
+        """The (d, p) matrix with the fraction of samples in which the parameter changed value."""
+        return self._nmr_changes / max(self._nmr_samples, 1)
+
+    @property
+    def maximum_likelihood(self):
+        """Tuple of the samples, log-likelihoods and sample indices of the Maximum Likelihood Estimator."""
+        return self._mle_samples, self._mle_values, self._mle_indices
+
+    @property
+    def maximum_a_posteriori(self):
+        """Tuple of the samples, log-posteriors and sample indices of the Maximum A Posteriori estimator."""
+        return self._map_samples, self._map_values, self._map_indices
+
+    def _update_maximum(self, samples, values, max_values, max_indices, max_samples):
+        """Update the running maximum of the given values in place."""
+        batch_indices = np.argmax(values, axis=1)
+        batch_values = values[range(values.shape[0]), batch_indices]
+
+        improved = batch_values > max_values
+        if self._nmr_samples == 0:
+            improved[:] = True
+        max_values[improved] = batch_values[improved]
+        max_indices[improved] = batch_indices[improved] + self._nmr_samples
+        max_samples[improved] = samples[improved, :, batch_indices[improved]]
@@ -0,0 +1,379 @@
+"""Monte Carlo simulation studies for estimating the bias, variance and RMSE of model fits.
+
+A simulation study draws ground truth parameters from user specified distributions, simulates the model signal for
+a given protocol, adds Rician noise at a number of SNR levels and fits the model to the noisy signals. This is
+repeated a number of times per ground truth parameter set, after which the estimates are compared to the ground
+truth in terms of bias, variance and root mean squared error (RMSE).
+
+The ground truth parameters are processed in chunks, which can be distributed over multiple processes. Within a chunk
+all signals are processed as a list of voxels, without constructing any volumes. Every chunk has its own random
+seed derived from the study seed, such that the results are reproducible and independent of the number of processes.
+The same ground truth parameters are used for all SNR levels.
+
+The orientation of a compartment, given by a pair of ``theta`` and ``phi`` parameters, is not compared per angle.
+Since the orientations are antipodally symmetric and the azimuth wraps around, the difference in the angles does not
+represent the orientation error. Instead, we report the angle between the estimated and the ground truth orientation
+(in [0, pi/2]) as the error of the orientation, under the name ``<compartment>.orientation``.
+"""
+import collections
+import csv
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from mdt.configuration import get_optimizer_for_model
+from mdt.lib.components import get_model
+from mdt.lib.processing_strategies import fit_voxels
+from mdt.simulations import simulate_signals, add_rician_noise
+from mdt.utils import MockMRIInputData, VoxelListMRIInputData, spherical_to_cartesian
+
+__author__ = 'Robbert Harms'
+__date__ = '2019-03-25'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+class ParameterDistribution:
+    """The distribution from which we draw the ground truth values of a parameter."""
+
+    def sample(self, nmr_samples, random_state):
+        """Draw values from this distribution.
+
+        Args:
+            nmr_samples (int): the number of values to draw
+            random_state (numpy.random.RandomState): the random state to use for drawing the values
+
+        Returns:
+            ndarray: a vector with the drawn values
+        """
+        raise NotImplementedError()
+
+
+class ConstantDistribution(ParameterDistribution):
+
+    def __init__(self, value):
+        """Use the same value for every simulation.
+
+        Args:
+            value (float): the value to use
+        """
+        self._value = value
+
+    def sample(self, nmr_samples, random_state):
+        return np.full(nmr_samples, self._value, dtype=np.float64)
+
+
+class UniformDistribution(ParameterDistribution):
+
+    def __init__(self, low, high):
+        """Draw the values uniformly from the interval [low, high).
+
+        Args:
+            low (float): the lower limit of the interval
+            high (float): the upper limit of the interval
+        """
+        self._low = low
+        self._high = high
+
+    def sample(self, nmr_samples, random_state):
+        return random_state.uniform(self._low, self._high, size=nmr_samples)
+
+
+class NormalDistribution(ParameterDistribution):
+
+    def __init__(self, mean, std, low=-np.inf, high=np.inf):
+        """Draw the values from a normal distribution, clipped to the interval [low, high].
+
+        Args:
+            mean (float): the mean of the normal distribution
+            std (float): the standard deviation of the normal distribution
+            low (float): the lower limit of the values
+            high (float): the upper limit of the values
+        """
+        self._mean = mean
+        self._std = std
+        self._low = low
+        self._high = high
+
+    def sample(self, nmr_samples, random_state):
+        return np.clip(random_state.normal(self._mean, self._std, size=nmr_samples), self._low, self._high)
+
+
+class PolarAngleDistribution(ParameterDistribution):
+    """Draws the polar angle (theta) of orientations uniformly distributed on the sphere.
+
+    Combined with a uniform distribution on [0, pi) for the azimuth angle (phi), this draws orientations uniformly
+    distributed on the hemisphere.
+    """
+
+    def sample(self, nmr_samples, random_state):
+        return np.arccos(random_state.uniform(-1, 1, size=nmr_samples))
+
+
+def run_simulation_study(model, protocol, parameter_distributions, snr_levels, nmr_simulations=1000,
+                         nmr_repetitions=10, chunk_size=10000, nmr_processes=1, seed=None,
+                         method=None, optimizer_options=None, use_ground_truth_inits=False):
+    """Run a Monte Carlo simulation study on the given model and protocol.
+
+    For every ground truth parameter set and every SNR level, this simulates ``nmr_repetitions`` noisy signals and fits
+    the model to them. The SNR is defined with respect to the mean of the unweighted (b < 250 s/mm^2) noise-free
+    simulated signal of every ground truth parameter set, that is, the noise std. equals that unweighted signal
+    divided by the SNR.
+
+    The model free parameters not given in ``parameter_distributions`` are set to their default initial value.
+
+    Args:
+        model (str): the name of the composite model to use. If ``nmr_processes`` is one, this can also be a
+            model instance.
+        protocol (mdt.protocols.Protocol): the protocol to simulate
+        parameter_distributions (dict): for (some of) the free parameters the distribution of the ground truth
+            values. Values can be a scalar, a (low, high) tuple for a uniform distribution, or a
+            :class:`ParameterDistribution`.
+        snr_levels (list of float): the SNR levels to simulate
+        nmr_simulations (int): the number of ground truth parameter sets to draw
+        nmr_repetitions (int): the number of noise realizations per ground truth parameter set and SNR level
+        chunk_size (int): the maximum number of voxels to simulate and fit at once, we use at least one ground truth
+            parameter set per chunk.
+        nmr_processes (int): the number of processes to use, the chunks are distributed over these processes.
+            The processes are started using 'spawn', as such, the calling script should be import safe.
+        seed (int): the seed for the random number generation, if not given we use a random seed.
+        method (str): the optimization method to use, if not given we use the configured optimizer for this model.
+        optimizer_options (dict): additional options for the optimizer
+        use_ground_truth_inits (boolean): if we initialize the fits at the ground truth parameters. If False,
+            we use the model's default initialization, with the S0 initialized to the mean unweighted signal.
+
+    Returns:
+        dict: the results per SNR level per parameter, as ``results[snr][param_name]``. Each element is a dictionary
+            with the keys 'bias', 'variance', 'rmse', 'mean' and 'nmr_voxels'. The variance is the average over the
+            ground truth parameter sets of the variance of the estimates over the repetitions. Pairs of ``theta`` and
+            ``phi`` parameters are reported as one ``<compartment>.orientation`` element, with as estimates the angle
+            between the estimated and the ground truth orientation. For these, the bias and mean are the mean angular
+            error and the rmse is the root mean squared angular error.
+    """
+    logger = logging.getLogger(__name__)
+
+    if seed is None:
+        seed = np.random.randint(np.iinfo(np.int32).max)
+
+    model_name = model if isinstance(model, str) else model.name
+    method = method or get_optimizer_for_model([model_name])
+
+    distributions = {name: _prepare_distribution(value) for name, value in parameter_distributions.items()}
+
+    nmr_per_chunk = max(chunk_size // nmr_repetitions, 1)
+    tasks = [_SimulationChunk(model, protocol, distributions, snr_levels, chunk_ind, chunk_start,
+                              min(chunk_start + nmr_per_chunk, nmr_simulations), nmr_repetitions, seed,
+                              method, optimizer_options, use_ground_truth_inits)
+             for chunk_ind, chunk_start in enumerate(range(0, nmr_simulations, nmr_per_chunk))]
+
+    logger.info('Running a simulation study of {} with {} ground truth sets, {} SNR levels and {} repetitions, '
+                'in {} chunks.'.format(model_name, nmr_simulations, len(snr_levels), nmr_repetitions, len(tasks)))
+
+    statistics = None
+    if nmr_processes > 1:
+        # spawn instead of fork, a forked OpenCL runtime is not guaranteed to work in the child processes
+        with ProcessPoolExecutor(max_workers=nmr_processes,
+                                 mp_context=multiprocessing.get_context('spawn')) as executor:
+            for chunk_statistics in executor.map(_process_simulation_chunk, tasks):
+                statistics = _combine_statistics(statistics, chunk_statistics)
+    else:
+        for task in tasks:
+            statistics = _combine_statistics(statistics, _process_simulation_chunk(task))
+
+    return _statistics_to_results(statistics)
+
+
+def write_simulation_study_table(results, output_file):
+    """Write the results of a simulation study as a CSV table.
+
+    Args:
+        results (dict): the results of :func:`run_simulation_study`
+        output_file (str): the CSV file to write to
+    """
+    with open(output_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['snr', 'parameter', 'bias', 'variance', 'rmse', 'mean', 'nmr_voxels'])
+        for snr, param_results in results.items():
+            for param_name, values in param_results.items():
+                writer.writerow([snr, param_name] + [values[key] for key in
+                                                     ['bias', 'variance', 'rmse', 'mean', 'nmr_voxels']])
+
+
+_SimulationChunk = collections.namedtuple('_SimulationChunk', [
+    'model', 'protocol', 'distributions', 'snr_levels', 'chunk_ind', 'start', 'end', 'nmr_repetitions', 'seed',
+    'method', 'optimizer_options', 'use_ground_truth_inits'])
+
+
+def _prepare_distribution(value):
+    """Convert the user provided distribution specification to a distribution object."""
+    if isinstance(value, ParameterDistribution):
+        return value
+    if isinstance(value, (tuple, list)):
+        return UniformDistribution(*value)
+    return ConstantDistribution(value)
+
+
+def _process_simulation_chunk(task):
+    """Simulate and fit one chunk of the simulation study.
+
+    Args:
+        task (_SimulationChunk): the chunk to process
+
+    Returns:
+        dict: per SNR level the summed statistics of this chunk
+    """
+    model = task.model
+    if isinstance(model, str):
+        model = get_model(model)()
+
+    nmr_simulations = task.end - task.start
+    ground_truth = _get_ground_truth(model, task.protocol, task.distributions, nmr_simulations,
+                                     np.random.RandomState([task.seed, task.chunk_ind]))
+    param_names = list(ground_truth.keys())
+    ground_truth_array = np.column_stack([ground_truth[name] for name in param_names])
+
+    signals = simulate_signals(model, task.protocol, ground_truth_array).astype(np.float64)
+    unweighted_signal = np.mean(signals[:, _get_unweighted_indices(task.protocol)], axis=1)
+
+    signals = np.repeat(signals, task.nmr_repetitions, axis=0)
+    ground_truth_array = np.repeat(ground_truth_array, task.nmr_repetitions, axis=0)
+    unweighted_signal = np.repeat(unweighted_signal, task.nmr_repetitions, axis=0)
+
+    statistics = {}
+    for snr_ind, snr in enumerate(task.snr_levels):
+        noise_std = unweighted_signal / snr
+        noise_seed = np.random.RandomState([task.seed, task.chunk_ind, snr_ind + 1]).randint(np.iinfo(np.int32).max)
+        noisy_signals = add_rician_noise(signals, noise_std[:, None], seed=noise_seed)
+
+        input_data = VoxelListMRIInputData(task.protocol, noisy_signals, noise_std=noise_std)
+        model.set_input_data(input_data)
+        _initialize_model(model, input_data, param_names, ground_truth_array, task.use_ground_truth_inits)
+
+        results = fit_voxels(model, task.method, optimizer_options=task.optimizer_options)
+        estimates = np.column_stack([np.asarray(results[name], dtype=np.float64) for name in param_names])
+
+        statistics[snr] = _get_chunk_statistics(param_names, estimates, ground_truth_array, task.nmr_repetitions)
+    return statistics
+
+
+def _get_ground_truth(model, protocol, distributions, nmr_simulations, random_state):
+    """Draw the ground truth values of all free parameters.
+
+    Returns:
+        OrderedDict: per free parameter a vector with values
+    """
+    model.set_input_data(MockMRIInputData(protocol=protocol))
+    defaults = model.get_initial_parameters()[0]
+
+    ground_truth = collections.OrderedDict()
+    for ind, name in enumerate(model.get_free_param_names()):
+        if name in distributions:
+            ground_truth[name] = distributions[name].sample(nmr_simulations, random_state)
+        else:
+            ground_truth[name] = np.full(nmr_simulations, defaults[ind], dtype=np.float64)
+    return ground_truth
+
+
+def _get_unweighted_indices(protocol):
+    """Get the indices of the unweighted volumes, used for defining the SNR.
+
+    Raises:
+        ValueError: if the protocol has no unweighted volumes
+    """
+    unweighted = np.where(protocol.get_column('b').flatten() < 250e6)[0]
+    if not len(unweighted):
+        raise ValueError('The protocol needs unweighted volumes to define the SNR.')
+    return unweighted
+
+
+def _initialize_model(model, input_data, param_names, ground_truth, use_ground_truth_inits):
+    """Set the initial parameters of the model for the fit."""
+    if use_ground_truth_inits:
+        model.set_initial_parameters({name: ground_truth[:, ind] for ind, name in enumerate(param_names)})
+    elif 'S0.s0' in param_names:
+        unweighted = _get_unweighted_indices(input_data.protocol)
+        model.set_initial_parameters({'S0.s0': np.mean(input_data.observations[:, unweighted], axis=1)})
+
+
+def _get_chunk_statistics(param_names, estimates, ground_truth, nmr_repetitions):
+    """Compute the summed statistics of one chunk, such that they can be combined over the chunks.
+
+    Returns:
+        dict: the summed statistics per parameter
+    """
+    param_names, estimates, errors = _get_errors(param_names, estimates, ground_truth)
+    grouped_estimates = np.reshape(estimates, (-1, nmr_repetitions, estimates.shape[1]))
+
+    within_group_variance = np.zeros(grouped_estimates.shape[0::2])
+    if nmr_repetitions > 1:
+        within_group_variance = np.var(grouped_estimates, axis=1, ddof=1)
+
+    return {name: {'sum_errors': np.sum(errors[:, ind]),
+                   'sum_squared_errors': np.sum(errors[:, ind] ** 2),
+                   'sum_estimates': np.sum(estimates[:, ind]),
+                   'sum_variances': np.sum(within_group_variance[:, ind]),
+                   'nmr_groups': grouped_estimates.shape[0],
+                   'nmr_voxels': estimates.shape[0]}
+            for ind, name in enumerate(param_names)}
+
+
+def _get_errors(param_names, estimates, ground_truth):
+    """Get the estimation errors, with the orientation pairs replaced by the angle to the ground truth orientation.
+
+    Returns:
+        tuple: the names, estimates and errors of the statistics. For the orientations, the estimates and the errors
+            are both the angle between the estimated and the ground truth orientation, folded to [0, pi/2].
+    """
+    names = []
+    columns = []
+    errors = []
+    for ind, name in enumerate(param_names):
+        compartment, _, param = name.rpartition('.')
+        if param in ('theta', 'phi') and compartment + '.theta' in param_names \
+                and compartment + '.phi' in param_names:
+            if param == 'theta':
+                angle = _orientation_angle(estimates, ground_truth, ind, param_names.index(compartment + '.phi'))
+                names.append(compartment + '.orientation')
+                columns.append(angle)
+                errors.append(angle)
+        else:
+            names.append(name)
+            columns.append(estimates[:, ind])
+            errors.append(estimates[:, ind] - ground_truth[:, ind])
+    return names, np.column_stack(columns), np.column_stack(errors)
+
+
+def _orientation_angle(estimates, ground_truth, theta_ind, phi_ind):
+    """Get the angle between the estimated and ground truth orientations, folded to [0, pi/2]."""
+    estimated_vectors = spherical_to_cartesian(estimates[:, theta_ind], estimates[:, phi_ind])
+    true_vectors = spherical_to_cartesian(ground_truth[:, theta_ind], ground_truth[:, phi_ind])
+    return np.arccos(np.clip(np.abs(np.sum(estimated_vectors * true_vectors, axis=1)), 0, 1))
+
+
+def _combine_statistics(statistics, chunk_statistics):
+    """Add the statistics of a chunk to the total statistics."""
+    if statistics is None:
+        return chunk_statistics
+
+    for snr, param_statistics in chunk_statistics.items():
+        for name, values in param_statistics.items():
+            for key, value in values.items():
+                statistics[snr][name][key] += value
+    return statistics
+
+
+def _statistics_to_results(statistics):
+    """Compute the final results from the summed statistics."""
+    results = collections.OrderedDict()
+    for snr, param_statistics in statistics.items():
+        results[snr] = collections.OrderedDict()
+        for name, values in param_statistics.items():
+            nmr_voxels = values['nmr_voxels']
+            results[snr][name] = {'bias': values['sum_errors'] / nmr_voxels,
+                                  'variance': values['sum_variances'] / values['nmr_groups'],
+                                  'rmse': np.sqrt(values['sum_squared_errors'] / nmr_voxels),
+                                  'mean': values['sum_estimates'] / nmr_voxels,
+                                  'nmr_voxels': nmr_voxels}
+    return results
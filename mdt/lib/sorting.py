@@ -3,12 +3,20 @@
 For example, in some applications it can be desired to sort volume fractions voxel-wise over an entire volume. This
 module contains functions for creating sort index matrices (determining the sort order), sorting volumes and lists
 and anti-sorting volumes (reversing the sort operation based on the sort index).
+
+The sorting works on the maps as they are given, without concatenating them into one large volume. The maps to sort
+on all have the same shape, for example (x, y, z) for volumes, (n,) for ROI's or (n, nmr_samples) for samples.
+We call every element of these maps a voxel. The maps to sort can have the same shape as the maps we sort on, or have
+one additional trailing dimension for vectors (like the (x, y, z, 3) orientation vectors), which are sorted as a whole.
 """
 import collections
+import os
+import shutil
+import tempfile
 from copy import copy
-import itertools
 import numpy as np
-from mdt.lib.nifti import get_all_nifti_data, load_nifti
+from numpy.lib.format import open_memmap
+from mdt.lib.nifti import get_all_nifti_data, load_nifti, nifti_filepath_resolution, write_nifti
 
 
 __author__ = 'Robbert Harms'
@@ -18,11 +26,9 @@ __email__ = 'robbert.harms@maastrichtuniversity.nl'
 __licence__ = 'LGPL v3'
 
 
-def sort_orientations(data_input, weight_names, extra_sortable_maps):
+def sort_orientations(data_input, weight_names, extra_sortable_maps, max_block_size=2 ** 24):
     """Sort the orientations of multi-direction models voxel-wise.
 
-    This expects as input 3d/4d volumes. Do not use this with 2d arrays.
-
     This can be used to sort, for example, simulations of the BallStick_r3 model (with three Sticks).
     There is no voxel-wise order over Sticks since for the model they are all equal compartments.
     However, when using optimization or ARD with sample, there is order within the compartments since the ARD is
@@ -31,7 +37,10 @@ def sort_orientations(data_input, weight_names, extra_sortable_maps):
     has to be the first.
 
     This method accepts as input results from (MDT) model fitting and is able to sort all the maps belonging to
-    a given set of equal compartments per voxel.
+    a given set of equal compartments per voxel. The maps can be volumes, ROI's or samples, see the module
+    documentation. The sorting is done in blocks of voxels, such that, next to the input and output maps, we only
+    need memory for one block at a time. To sort the maps in a directory without loading them all at once, please
+    use :func:`sort_orientations_in_directory`.
 
     Example::
 
@@ -47,6 +56,7 @@ def sort_orientations(data_input, weight_names, extra_sortable_maps):
         extra_sortable_maps (iterable of iterable): the list of additional maps to sort. Every element in the given
             list should be another list with the names of the maps. The length of these second layer of lists should
             match the length of the ``weight_names``.
+        max_block_size (int): the maximum size in bytes of the blocks of voxels we sort at once
 
     Returns:
         dict: the sorted results in a new dictionary. This returns all input maps with some of them sorted.
@@ -59,19 +69,131 @@ def sort_orientations(data_input, weight_names, extra_sortable_maps):
         result_maps = copy(input_maps)
 
     weight_names = list(weight_names)
-    sortable_maps = copy(extra_sortable_maps)
-    sortable_maps.append(weight_names)
+    sortable_maps = [list(names) for names in extra_sortable_maps] + [weight_names]
 
-    sort_index_matrix = create_4d_sort_matrix([input_maps[k] for k in weight_names], reversed_sort=True)
+    groups = [[np.asarray(input_maps[k]) for k in names] for names in sortable_maps]
+    outputs = [[np.empty(m.shape, dtype=m.dtype) for m in group] for group in groups]
 
-    for sortable_map_names in sortable_maps:
-        sorted = dict(zip(sortable_map_names, sort_volumes_per_voxel([input_maps[k] for k in sortable_map_names],
-                                                                     sort_index_matrix)))
-        result_maps.update(sorted)
+    _sort_in_blocks(groups[-1], groups, outputs, max_block_size)
 
+    for names, sorted_maps in zip(sortable_maps, outputs):
+        result_maps.update(zip(names, sorted_maps))
     return result_maps
 
 
+def sort_orientations_in_directory(directory, weight_names, extra_sortable_maps, output_directory=None,
+                                   max_block_size=2 ** 24):
+    """Sort the orientations of multi-direction models voxel-wise, for the maps in a directory.
+
+    This is the streaming counterpart of :func:`sort_orientations`, which rewrites the sorted maps without loading
+    all the maps at once. This works with both the nifti maps of optimization results and the ``.samples.npy`` files
+    of sample results. For nifti maps, we first create the sort index from the weights, after which we load, sort and
+    write the maps one group at a time. For samples, we sort the memory mapped sample files one block of voxels at
+    a time.
+
+    Maps that are not sorted are not copied to the output directory. When overwriting the maps in the input
+    directory, the sorted maps are first written to a temporary directory within the input directory, after which
+    they replace the input maps. As such, an interruption while sorting leaves the input maps untouched, at the cost
+    of temporarily needing the disk space for a second copy of the sorted maps.
+
+    Args:
+        directory (str): the directory containing the maps, either nifti files or ``.samples.npy`` files
+        weight_names (iterable of str): The names of the maps we use for sorting all other maps. These will be sorted
+            as well.
+        extra_sortable_maps (iterable of iterable): the list of additional maps to sort, see :func:`sort_orientations`
+        output_directory (str): the directory to write the sorted maps to. If not given, we overwrite the maps in the
+            input directory.
+        max_block_size (int): the maximum size in bytes of the blocks of voxels we sort at once (for the samples)
+    """
+    output_directory = output_directory or directory
+    if not os.path.exists(output_directory):
+        os.makedirs(output_directory)
+
+    weight_names = list(weight_names)
+    sortable_maps = [list(names) for names in extra_sortable_maps] + [weight_names]
+
+    def sort_to(target_directory):
+        if os.path.isfile(os.path.join(directory, weight_names[0] + '.samples.npy')):
+            _sort_samples_in_directory(directory, sortable_maps, target_directory, max_block_size)
+        else:
+            _sort_niftis_in_directory(directory, sortable_maps, target_directory)
+
+    if os.path.abspath(directory) != os.path.abspath(output_directory):
+        sort_to(output_directory)
+        return
+
+    tmp_directory = tempfile.mkdtemp(prefix='.sorting-', dir=directory)
+    try:
+        sort_to(tmp_directory)
+        for name in os.listdir(tmp_directory):
+            os.replace(os.path.join(tmp_directory, name), os.path.join(directory, name))
+    finally:
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+
+
+def create_voxel_sort_index(input_maps, reversed_sort=False):
+    """Create an index matrix that sorts the given maps per voxel from small to large values.
+
+    Args:
+        input_maps (list): the maps to sort on, all with the same shape, for example (n,) or (x, y, z). A trailing
+            singleton dimension, like in (n, 1) or (x, y, z, 1), is ignored.
+        reversed_sort (boolean): if True we reverse the sort and we sort from large to small.
+
+    Returns:
+        ndarray: an integer matrix with the shape of the input maps (without trailing singleton dimension) plus one
+            dimension with for every voxel the indices of the maps in sorted order.
+    """
+    input_maps = [np.asarray(m) for m in input_maps]
+    voxel_shape = _get_voxel_shape(input_maps[0])
+
+    for m in input_maps:
+        if m.shape not in (voxel_shape, voxel_shape + (1,)):
+            raise ValueError('The maps to sort on should all have the same shape, '
+                             'got the shapes {} and {}.'.format(input_maps[0].shape, m.shape))
+
+    sort_index = np.argsort(np.stack([np.reshape(m, voxel_shape) for m in input_maps], axis=-1), axis=-1)
+
+    if reversed_sort:
+        sort_index = sort_index[..., ::-1]
+    return sort_index.astype(np.min_scalar_type(len(input_maps)))
+
+
+def sort_maps_per_voxel(input_maps, sort_index, out=None):
+    """Sort the given maps per voxel using the given sort index.
+
+    Per voxel, this takes the value of the map indicated by the first index of the sort index and places that in the
+    first output map, and so on for the other indices. If the maps have a trailing vector dimension, for example
+    the (x, y, z, 3) orientation vectors, the vectors are sorted as a whole.
+
+    Args:
+        input_maps (list): the maps to sort, all with the same shape, with either the voxel shape of the sort index
+            or one additional trailing dimension.
+        sort_index (ndarray): the sort index, as for example generated by :func:`create_voxel_sort_index`, with
+            for every voxel the order of the maps.
+        out (list): if given, the list of arrays to write the sorted maps to. This can be the input maps themselves,
+            to sort in place.
+
+    Returns:
+        list: the sorted maps, with the same shapes as the input maps
+    """
+    sort_index = np.asarray(sort_index)
+    input_maps = [np.asarray(m) for m in input_maps]
+    nmr_maps = len(input_maps)
+    nmr_voxels = int(np.prod(sort_index.shape[:-1]))
+    vector_size = int(np.prod(input_maps[0].shape[sort_index.ndim - 1:]))
+
+    # gather using indices into the flattened (voxels * maps, vector) matrix, which is faster than fancy indexing
+    stacked = np.stack([np.reshape(m, (nmr_voxels, vector_size)) for m in input_maps], axis=1)
+    flat_index = np.arange(nmr_voxels)[:, None] * nmr_maps + np.reshape(sort_index, (nmr_voxels, nmr_maps))
+    sorted_maps = np.reshape(stacked, (nmr_voxels * nmr_maps, vector_size))[flat_index]
+
+    if out is None:
+        out = [np.empty(m.shape, dtype=m.dtype) for m in input_maps]
+    for ind, (output, input_map) in enumerate(zip(out, input_maps)):
+        output[...] = np.reshape(sorted_maps[:, ind], input_map.shape)
+    return out
+
+
 def create_2d_sort_matrix(input_volumes, reversed_sort=False):
     """Create an index matrix that sorts the given input on the 2th dimension from small to large values.
 
@@ -105,28 +227,13 @@ def create_4d_sort_matrix(input_volumes, reversed_sort=False):
     Returns:
         ndarray: a 4d matrix with on the 4th dimension the indices of the elements in sorted order.
     """
-    def load_maps(map_list):
-        tmp = []
-        for data in map_list:
-            if isinstance(data, str):
-                data = load_nifti(data).get_data()
-
-            if len(data.shape) < 4:
-                data = data[..., None]
-
-            if data.shape[3] > 1:
-                raise ValueError('Can not sort input volumes where one has more than one items on the 4th dimension.')
-
-            tmp.append(data)
-        return tmp
-
     if isinstance(input_volumes, collections.Sequence):
-        maps_to_sort_on = load_maps(input_volumes)
-        input_4d_vol = np.concatenate([m for m in maps_to_sort_on], axis=3)
-    else:
-        input_4d_vol = input_volumes
+        maps_to_sort_on = _load_maps(input_volumes)
+        if any(m.ndim > 3 and m.shape[3] > 1 for m in maps_to_sort_on):
+            raise ValueError('Can not sort input volumes where one has more than one items on the 4th dimension.')
+        return create_voxel_sort_index(maps_to_sort_on, reversed_sort=reversed_sort)
 
-    sort_index = np.argsort(input_4d_vol, axis=3)
+    sort_index = np.argsort(input_volumes, axis=3)
 
     if reversed_sort:
         return sort_index[..., ::-1]
@@ -140,8 +247,8 @@ def sort_volumes_per_voxel(input_volumes, sort_matrix):
     What this essentially does is to look per voxel from which map we should take the first value. Then we place that
     value in the first volume and we repeat for the next value and finally for the next voxel.
 
-    If the length of the 4th dimension is > 1 we shift the 4th dimension to the 5th dimension and sort
-    the array as if the 4th dimension values where a single value. This is useful for sorting (eigen)vector matrices.
+    If the length of the 4th dimension is > 1 we sort the 4th dimension values as if they where a single value.
+    This is useful for sorting (eigen)vector matrices.
 
     Args:
         input_volumes (:class:`list`): list of 4d ndarray
@@ -150,30 +257,8 @@ def sort_volumes_per_voxel(input_volumes, sort_matrix):
     Returns:
         :class:`list`: the same input volumes but then with every voxel sorted according to the given sort index.
     """
-    def load_maps(map_list):
-        tmp = []
-        for data in map_list:
-            if isinstance(data, str):
-                data = load_nifti(data).get_data()
-
-            if len(data.shape) < 4:
-                data = data[..., None]
-
-            tmp.append(data)
-        return tmp
-
-    input_volumes = load_maps(input_volumes)
-
-    if input_volumes[0].shape[3] > 1:
-        volume = np.concatenate([np.reshape(m, m.shape[0:3] + (1,) + (m.shape[3],)) for m in input_volumes], axis=3)
-        grid = np.ogrid[[slice(x) for x in volume.shape]]
-        sorted_volume = volume[list(grid[:-2]) + [np.reshape(sort_matrix, sort_matrix.shape + (1,))] + list(grid[-1])]
-        return [sorted_volume[..., ind, :] for ind in range(len(input_volumes))]
-    else:
-        volume = np.concatenate([m for m in input_volumes], axis=3)
-        sorted_volume = volume[list(np.ogrid[[slice(x) for x in volume.shape]][:-1])+[sort_matrix]]
-        return [np.reshape(sorted_volume[..., ind], sorted_volume.shape[0:3] + (1,))
-                for ind in range(len(input_volumes))]
+    input_volumes = [m if m.ndim > 3 else m[..., None] for m in _load_maps(input_volumes)]
+    return sort_maps_per_voxel(input_volumes, sort_matrix)
 
 
 def undo_sort_volumes_per_voxel(input_volumes, sort_matrix):
@@ -190,13 +275,75 @@ def undo_sort_volumes_per_voxel(input_volumes, sort_matrix):
     Returns:
         :class:`list`: the same input volumes but then with every voxel anti-sorted according to the given sort index.
     """
-    results = [np.zeros_like(vol) for vol in input_volumes]
+    return sort_maps_per_voxel(input_volumes, np.argsort(sort_matrix, axis=-1))
+
+
+def _load_maps(map_list):
+    """Load the maps given as filenames, returns arrays as is."""
+    return [np.asarray(load_nifti(data).get_data()) if isinstance(data, str) else np.asarray(data)
+            for data in map_list]
+
+
+def _get_voxel_shape(map_to_sort_on):
+    """Get the shape of the voxels of a map to sort on, that is, the shape without trailing singleton dimension."""
+    if map_to_sort_on.ndim > 1 and map_to_sort_on.shape[-1] == 1:
+        return map_to_sort_on.shape[:-1]
+    return map_to_sort_on.shape
+
+
+def _sort_in_blocks(maps_to_sort_on, groups, outputs, max_block_size):
+    """Sort the groups of maps per voxel, in blocks over the first dimension of the voxels.
+
+    Args:
+        maps_to_sort_on (list): the maps we sort on, sorted from large to small
+        groups (list of list): the groups of maps to sort, every group with one map per map to sort on
+        outputs (list of list): per group the arrays to write the sorted maps to, can be the maps themselves
+        max_block_size (int): the maximum size in bytes of the stacked maps in every block
+    """
+    voxel_shape = _get_voxel_shape(maps_to_sort_on[0])
+    row_size = 8 * len(maps_to_sort_on) * max(m[0].size for group in groups for m in group)
+    block_length = int(max(1, max_block_size // row_size))
+
+    for start in range(0, voxel_shape[0], block_length):
+        block = slice(start, min(start + block_length, voxel_shape[0]))
+        sort_index = create_voxel_sort_index([m[block] for m in maps_to_sort_on], reversed_sort=True)
+
+        for group, output in zip(groups, outputs):
+            sort_maps_per_voxel([m[block] for m in group], sort_index, out=[m[block] for m in output])
+
+
+def _sort_samples_in_directory(directory, sortable_maps, output_directory, max_block_size):
+    """Sort the ``.samples.npy`` files of the given groups of maps, see :func:`sort_orientations_in_directory`."""
+    groups = [[open_memmap(os.path.join(directory, name + '.samples.npy'), mode='r') for name in names]
+              for names in sortable_maps]
+
+    outputs = [[open_memmap(os.path.join(output_directory, name + '.samples.npy'), mode='w+',
+                            dtype=samples.dtype, shape=samples.shape)
+                for name, samples in zip(names, group)] for names, group in zip(sortable_maps, groups)]
+
+    _sort_in_blocks(groups[-1], groups, outputs, max_block_size)
+
+    for output in outputs:
+        for samples in output:
+            samples.flush()
+
 
-    shape = input_volumes[0].shape
+def _sort_niftis_in_directory(directory, sortable_maps, output_directory):
+    """Sort the nifti files of the given groups of maps, see :func:`sort_orientations_in_directory`."""
+    def load_group(names):
+        paths = [nifti_filepath_resolution(os.path.join(directory, name)) for name in names]
+        niftis = [load_nifti(path) for path in paths]
+        return paths, niftis, [nifti.get_data() for nifti in niftis]
 
-    for x, y, z in itertools.product(range(shape[0]), range(shape[1]), range(shape[2])):
-        for ind, sort_ind in enumerate(list(sort_matrix[x, y, z])):
-            results[sort_ind][x, y, z] = input_volumes[ind][x, y, z]
+    def write_group(paths, niftis, volumes):
+        for path, nifti, volume in zip(paths, niftis, volumes):
+            write_nifti(volume, os.path.join(output_directory, os.path.basename(path)), header=nifti.header)
 
-    return results
+    weights = load_group(sortable_maps[-1])
+    sort_index = create_voxel_sort_index(weights[2], reversed_sort=True)
+    write_group(weights[0], weights[1], sort_maps_per_voxel(weights[2], sort_index))
+    del weights
 
+    for names in sortable_maps[:-1]:
+        paths, niftis, volumes = load_group(names)
+        write_group(paths, niftis, sort_maps_per_voxel(volumes, sort_index))
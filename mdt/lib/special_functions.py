@@ -0,0 +1,195 @@
+"""NumPy implementations of some of the special functions of the CL library functions.
+
+These are used to precompute the lookup tables of the library functions (see :mod:`mdt.lib.lookup_tables`) and as
+reference when checking the accuracy of these tables. Where the CL implementations use series expansions or fitted
+approximations, the functions in this module compute the defining integrals using Gauss-Legendre quadrature, which is
+accurate to about 1e-12 on the domains of interest.
+"""
+import numpy as np
+from numpy.polynomial.legendre import leggauss
+from scipy.special import eval_legendre
+
+__author__ = 'Robbert Harms'
+__date__ = '2019-04-12'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+_QUADRATURE_NODES, _QUADRATURE_WEIGHTS = leggauss(200)
+
+_EVEN_LEGENDRE_POLYNOMIALS = np.stack([eval_legendre(2 * ind, _QUADRATURE_NODES) for ind in range(7)], axis=1)
+"""The Legendre polynomials of order 0, 2, ..., 12 at the quadrature nodes."""
+
+
+def noddi_watson_sh_coeff(kappa):
+    """Computes the even spherical harmonic coefficients of the Watson's distribution up to the 12th order.
+
+    This is the exact counterpart of the library function ``NODDI_WatsonSHCoeff``, computing the coefficients by
+    integrating the Watson's distribution against the Legendre polynomials.
+
+    Args:
+        kappa (ndarray): the concentration parameters, a vector of length n
+
+    Returns:
+        ndarray: a (n, 7) matrix with the coefficients of order 0, 2, ..., 12
+    """
+    kappa = np.atleast_1d(np.asarray(kappa, dtype=np.float64))
+
+    # scaled by exp(-kappa) to prevent overflow, this cancels in the normalization
+    distribution = np.exp(kappa[:, None] * (_QUADRATURE_NODES ** 2 - 1))
+    integrals = (distribution * _QUADRATURE_WEIGHTS).dot(_EVEN_LEGENDRE_POLYNOMIALS)
+
+    return 2 * np.sqrt(np.pi) * np.sqrt(4 * np.arange(7) + 1) * integrals / integrals[:, :1]
+
+
+def noddi_legendre_gaussian_integral(x):
+    """Computes the Legendre Gaussian integrals of the even orders up to the 12th order.
+
+    This is the exact counterpart of the library function ``NODDI_LegendreGaussianIntegral``, that is, for every
+    ``x`` and ``n`` in 0, ..., 6 it computes the integral of ``exp(-x * mu**2) * P_2n(mu)`` for ``mu`` in [-1, 1].
+
+    Args:
+        x (ndarray): the positive parameters of the Gaussian, a vector of length n
+
+    Returns:
+        ndarray: a (n, 7) matrix with the integrals of order 0, 2, ..., 12
+    """
+    x = np.atleast_1d(np.asarray(x, dtype=np.float64))
+    return (np.exp(-x[:, None] * _QUADRATURE_NODES ** 2) * _QUADRATURE_WEIGHTS).dot(_EVEN_LEGENDRE_POLYNOMIALS)
+
+
+def confluent_hypergeometric_first_kind(e0, e1, e2):
+    """Computes 1F1(1/2; 3/2; e), the confluent hypergeometric function of the first kind for a 3x3 matrix.
+
+    This is the NumPy version of the library function ``ConfluentHyperGeometricFirstKind``, using the same saddlepoint
+    approximation. Like the library function, this returns one for the zero matrix.
+
+    Args:
+        e0 (ndarray): the first eigenvalues of the matrices
+        e1 (ndarray): the second eigenvalues of the matrices
+        e2 (ndarray): the third eigenvalues of the matrices
+
+    Returns:
+        ndarray: the function values
+    """
+    e = np.stack(np.broadcast_arrays(*[np.asarray(v, dtype=np.float64) for v in (e0, e1, e2)]), axis=-1)
+    return np.where(np.all(e == 0, axis=-1), 1, np.exp(log_bingham_saddlepoint_approximation(e)))
+
+
+def log_bingham_saddlepoint_approximation(e):
+    """The logarithm of the saddlepoint approximation of 1F1(1/2; 3/2; e) by Kume and Wood (2005).
+
+    This does not special case the zero matrix, for which the approximation differs from the exact value of one.
+
+    Args:
+        e (ndarray): a (..., 3) array with the eigenvalues
+
+    Returns:
+        ndarray: the logarithm of the approximated function values
+    """
+    e = np.asarray(e, dtype=np.float64)
+
+    # the saddlepoint is the unique solution of sum(1 / (2 * (e - t))) = 1 below the smallest eigenvalue,
+    # which lies within 1.5 of the smallest eigenvalue
+    upper = np.min(e, axis=-1)
+    lower = upper - 1.5
+    for _ in range(100):
+        t = (lower + upper) / 2
+        too_large = np.sum(0.5 / (e - t[..., None]), axis=-1) > 1
+        upper = np.where(too_large, t, upper)
+        lower = np.where(too_large, lower, t)
+    t = (lower + upper) / 2
+
+    diff = e - t[..., None]
+    k2 = 0.5 * np.sum(1 / diff ** 2, axis=-1)
+    k3 = np.sum(1 / diff ** 3, axis=-1)
+    k4 = 3 * np.sum(1 / diff ** 4, axis=-1)
+    correction = (1 / 8.) * (k4 / k2 ** 2) - (5 / 24.) * (k3 ** 2 / k2 ** 3)
+
+    return np.log(np.pi * np.sqrt(2.0 / k2)) - 0.5 * np.sum(np.log(diff), axis=-1) - t + correction
+
+
+def carlson_rf(x, y, z, tolerance=1e-3):
+    """Computes Carlson's elliptic integral of the first kind, RF(x, y, z).
+
+    This uses the duplication theorem until the arguments are within the given relative tolerance of their mean,
+    followed by a fifth order Taylor expansion [1]. The truncation error scales with the sixth power of the tolerance,
+    the default gives double precision accuracy.
+
+    Args:
+        x (ndarray): the first arguments, non-negative
+        y (ndarray): the second arguments, non-negative
+        z (ndarray): the third arguments, non-negative. At most one of the arguments can be zero.
+        tolerance (float): the relative tolerance on the arguments at which to stop the duplication
+
+    Returns:
+        ndarray: the integrals, with the broadcasted shape of the arguments
+
+    References:
+        1. Carlson BC. Numerical computation of real or complex elliptic integrals. Numer Algorithms. 1995;10(1):13-26.
+    """
+    x, y, z = np.broadcast_arrays(*[np.asarray(v, dtype=np.float64) for v in (x, y, z)])
+    x, y, z = x.copy(), y.copy(), z.copy()
+
+    for _ in range(100):
+        mean = (x + y + z) / 3.
+        if np.all(np.abs(np.stack([mean - x, mean - y, mean - z])) <= tolerance * mean):
+            break
+        sqrt_x, sqrt_y, sqrt_z = np.sqrt(x), np.sqrt(y), np.sqrt(z)
+        lambda_ = sqrt_x * sqrt_y + sqrt_x * sqrt_z + sqrt_y * sqrt_z
+        x, y, z = (x + lambda_) / 4., (y + lambda_) / 4., (z + lambda_) / 4.
+
+    mean = (x + y + z) / 3.
+    dx = (mean - x) / mean
+    dy = (mean - y) / mean
+    dz = -(dx + dy)
+    e2 = dx * dy - dz ** 2
+    e3 = dx * dy * dz
+    return (1 - e2 / 10. + e3 / 14. + e2 ** 2 / 24. - 3 * e2 * e3 / 44.) / np.sqrt(mean)
+
+
+def carlson_rd(x, y, z, tolerance=1e-3):
+    """Computes Carlson's elliptic integral of the second kind, RD(x, y, z).
+
+    Like :func:`carlson_rf`, this uses the duplication theorem followed by a Taylor expansion [1].
+
+    Args:
+        x (ndarray): the first arguments, non-negative
+        y (ndarray): the second arguments, non-negative. At most one of x and y can be zero.
+        z (ndarray): the third arguments, positive
+        tolerance (float): the relative tolerance on the arguments at which to stop the duplication
+
+    Returns:
+        ndarray: the integrals, with the broadcasted shape of the arguments
+
+    References:
+        1. Carlson BC. Numerical computation of real or complex elliptic integrals. Numer Algorithms. 1995;10(1):13-26.
+    """
+    x, y, z = np.broadcast_arrays(*[np.asarray(v, dtype=np.float64) for v in (x, y, z)])
+    x, y, z = x.copy(), y.copy(), z.copy()
+
+    partial_sum = np.zeros(x.shape)
+    factor = 1.
+    for _ in range(100):
+        mean = (x + y + 3 * z) / 5.
+        if np.all(np.abs(np.stack([mean - x, mean - y, mean - z])) <= tolerance * mean):
+            break
+        sqrt_x, sqrt_y, sqrt_z = np.sqrt(x), np.sqrt(y), np.sqrt(z)
+        lambda_ = sqrt_x * sqrt_y + sqrt_x * sqrt_z + sqrt_y * sqrt_z
+        partial_sum += factor / (sqrt_z * (z + lambda_))
+        factor /= 4.
+        x, y, z = (x + lambda_) / 4., (y + lambda_) / 4., (z + lambda_) / 4.
+
+    mean = (x + y + 3 * z) / 5.
+    dx = (mean - x) / mean
+    dy = (mean - y) / mean
+    dz = (mean - z) / mean
+    ea = dx * dy
+    eb = dz ** 2
+    ec = ea - eb
+    ed = ea - 6 * eb
+    ee = ed + 2 * ec
+    return 3 * partial_sum + factor * (
+        1 + ed * (-3 / 14. + 9 / 88. * ed - 9 / 52. * dz * ee)
+        + dz * (ee / 6. + dz * (-9 / 22. * ec + 3 / 26. * dz * ea))) / (mean * np.sqrt(mean))
@@ -0,0 +1,67 @@
+"""Quadrature rules for averaging functions over the unit sphere and over great circles.
+
+Some post-processing routines average a function of the direction over the sphere, like the mean kurtosis, or over a
+circle, like the radial kurtosis. For antipodally symmetric functions, that is, functions with ``f(n) == f(-n)``,
+it suffices to integrate over a hemisphere or a semicircle. The rules in this module exploit that symmetry.
+
+The rules are computed once per order and cached, the returned arrays are read-only.
+"""
+import functools
+import numpy as np
+from numpy.polynomial.legendre import leggauss
+
+__author__ = 'Robbert Harms'
+__date__ = '2019-04-15'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+@functools.lru_cache(maxsize=None)
+def get_hemisphere_quadrature(order):
+    """Get a quadrature rule for averaging an antipodally symmetric function over the unit sphere.
+
+    This is a product rule of ``order`` Gauss-Legendre nodes in the cosine of the polar angle on [0, 1], with
+    ``2 * order`` evenly spaced azimuths per node, for a total of ``2 * order**2`` directions on the upper hemisphere.
+    The rule exactly averages the even spherical harmonics up to degree ``2 * order - 1`` over the sphere.
+
+    Args:
+        order (int): the order of the rule, the number of polar nodes
+
+    Returns:
+        tuple: the directions as (m, 3) array with unit vectors and the weights as (m,) array, summing to one
+    """
+    if order < 1:
+        raise ValueError('The order of the quadrature rule should be at least one, {} given.'.format(order))
+
+    nodes, weights = leggauss(order)
+    cos_theta = (nodes + 1) / 2.
+    sin_theta = np.sqrt(1 - cos_theta ** 2)
+    phi = np.arange(2 * order) * np.pi / order
+
+    directions = np.stack([np.outer(sin_theta, np.cos(phi)),
+                           np.outer(sin_theta, np.sin(phi)),
+                           np.outer(cos_theta, np.ones_like(phi))], axis=-1).reshape((-1, 3))
+    weights = np.repeat(weights / (4. * order), 2 * order)
+
+    directions.setflags(write=False)
+    weights.setflags(write=False)
+    return directions, weights
+
+
+@functools.lru_cache(maxsize=None)
+def get_semicircle_angles(nmr_angles):
+    """Get evenly spaced angles for averaging an antipodally symmetric function over a great circle.
+
+    Since such a function has a period of pi on the circle, the trapezoidal rule on [0, pi) with equal weights is
+    exact for all trigonometric polynomials of degree below ``2 * nmr_angles``.
+
+    Args:
+        nmr_angles (int): the number of angles
+
+    Returns:
+        ndarray: the (nmr_angles,) read-only array of angles in [0, pi)
+    """
+    angles = np.arange(nmr_angles) * np.pi / nmr_angles
+    angles.setflags(write=False)
+    return angles
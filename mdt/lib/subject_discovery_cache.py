@@ -0,0 +1,288 @@
+"""Persistent cache of the subjects found by the batch profiles.
+
+Finding the subjects in a data folder requires a batch profile to walk the data folder and glob for the DWI, protocol,
+mask and gradient deviations files of every subject. Auto-detecting the batch profile does this for every registered
+profile. On network storage this can take a long time for large datasets. This cache is disabled by default, enable it
+in the ``subject_discovery_cache`` section of the configuration.
+
+This module stores the subjects found by a batch profile in a JSON cache file, one file per data folder. With the
+subjects we store the modification times of the directories involved in the search, as given by the batch profile (see
+:meth:`mdt.lib.batch_utils.SimpleBatchProfile._get_discovery_cache_directories`). By default these are the data folder,
+its direct subdirectories, the base folders of the subjects and the directories holding the subject files. Batch
+profiles globbing in deeper directories add the directories visited by their glob patterns, for all candidate subjects,
+including the subjects which were rejected. Adding, removing or renaming files in any of these directories, or creating
+one of these directories, updates the recorded modification time and invalidates the cached subjects. Hence, validating
+the cache only requires a stat call per directory instead of walking and globbing the data folder.
+
+Only subjects of the classes known to this module (:class:`~mdt.lib.batch_utils.SimpleSubjectInfo` with a
+:class:`~mdt.lib.batch_utils.BatchFitProtocolLoader`) holding plain values are cached, other subjects are searched
+for every time.
+
+Modifying the contents of a file does not change the directory modification times. This is not a problem since the
+cache only records the file paths, with the exception of the noise std values which are read from file during the
+search. Use :func:`clear_subject_discovery_cache` after changing these files in place.
+"""
+import glob
+import hashlib
+import importlib
+import json
+import logging
+import numbers
+import os
+import re
+import shutil
+import uuid
+
+__author__ = 'Robbert Harms'
+__date__ = '2019-04-08'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+_CACHE_VERSION = 2
+
+_serializable_classes = ('mdt.lib.batch_utils.SimpleSubjectInfo', 'mdt.lib.batch_utils.BatchFitProtocolLoader')
+"""The classes of the objects we can store in and restore from the cache file, as ``<module>.<class name>``."""
+
+_glob_magic = re.compile('[*?[]')
+
+_loaded_caches = {}
+"""Per cache file the last loaded (modification time, contents), to prevent reading the same cache file repeatedly."""
+
+
+def get_cached_subjects(cache_dir, data_folder, profile_key):
+    """Get the subjects a batch profile found previously in the given data folder.
+
+    Args:
+        cache_dir (str): the cache directory
+        data_folder (str): the data folder searched by the batch profile
+        profile_key (str): the unique key of the batch profile
+
+    Returns:
+        list of :class:`mdt.lib.batch_utils.SubjectInfo`: the cached subjects, or None if there are no subjects cached
+            for this profile or if one of the searched directories changed since.
+    """
+    entry = _load_cache_file(get_cache_file_path(cache_dir, data_folder)).get(profile_key)
+    if entry is None:
+        return None
+
+    if any(_get_mtime(directory) != mtime for directory, mtime in entry['directories'].items()):
+        return None
+
+    try:
+        return [_from_json(subject) for subject in entry['subjects']]
+    except (ValueError, TypeError, KeyError, AttributeError, ImportError):
+        return None
+
+
+def store_cached_subjects(cache_dir, data_folder, profile_key, subjects, directories):
+    """Store the subjects found by a batch profile in the cache.
+
+    If the subjects can not be stored as JSON, for example for custom subject info classes, the subjects are not cached.
+
+    Profile keys of the form ``<identifier>:<configuration hash>`` replace the cached subjects of previous
+    configurations of the same profile, such that the cache file does not grow with every change of a profile.
+
+    Args:
+        cache_dir (str): the cache directory
+        data_folder (str): the data folder searched by the batch profile
+        profile_key (str): the unique key of the batch profile
+        subjects (list of :class:`mdt.lib.batch_utils.SubjectInfo`): the subjects found by the profile
+        directories (list of str): the directories whose modification times determine the validity of the found
+            subjects, these may include directories which do not exist (yet).
+    """
+    try:
+        serialized_subjects = [_to_json(subject) for subject in subjects]
+    except ValueError as exc:
+        logging.getLogger(__name__).debug('Could not cache the subjects of the batch profile '
+                                          '"{}", {}'.format(profile_key, exc))
+        return
+
+    path = get_cache_file_path(cache_dir, data_folder)
+    identifier = profile_key.rpartition(':')[0]
+    contents = {key: value for key, value in _load_cache_file(path).items()
+                if not identifier or key.rpartition(':')[0] != identifier}
+    contents[profile_key] = {'directories': {directory: _get_mtime(directory) for directory in directories},
+                             'subjects': serialized_subjects}
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = '{}.tmp-{}'.format(path, uuid.uuid4().hex)
+    with open(tmp_path, 'w') as f:
+        json.dump({'version': _CACHE_VERSION, 'data_folder': os.path.abspath(data_folder), 'profiles': contents}, f)
+    os.replace(tmp_path, path)
+
+
+def get_cache_file_path(cache_dir, data_folder):
+    """Get the path to the cache file of the given data folder.
+
+    Args:
+        cache_dir (str): the cache directory
+        data_folder (str): the data folder
+
+    Returns:
+        str: the path to the cache file, this file may not exist yet
+    """
+    key = hashlib.sha1(os.path.realpath(data_folder).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, key + '.json')
+
+
+def clear_subject_discovery_cache(cache_dir, data_folder=None):
+    """Remove the cached subjects.
+
+    Args:
+        cache_dir (str): the cache directory
+        data_folder (str): if given, we only remove the cached subjects of this data folder
+    """
+    _loaded_caches.clear()
+
+    if data_folder is None:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        return
+
+    try:
+        os.remove(get_cache_file_path(cache_dir, data_folder))
+    except FileNotFoundError:
+        pass
+
+
+def _load_cache_file(path):
+    """Load the per profile entries of a cache file, returns an empty dictionary if the file can not be read."""
+    mtime = _get_mtime(path)
+    if mtime is None:
+        return {}
+
+    if path in _loaded_caches and _loaded_caches[path][0] == mtime:
+        return _loaded_caches[path][1]
+
+    try:
+        with open(path, 'r') as f:
+            contents = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    if not isinstance(contents, dict) or contents.get('version') != _CACHE_VERSION:
+        return {}
+
+    _loaded_caches[path] = (mtime, contents['profiles'])
+    return contents['profiles']
+
+
+def get_searched_directories(data_folder, subjects):
+    """Get the default directories whose modification times determine the validity of the found subjects.
+
+    These are the data folder, its direct subdirectories, the base folders of the subjects and the directories holding
+    the files referenced by the subjects.
+
+    Args:
+        data_folder (str): the data folder searched by the batch profile
+        subjects (list of :class:`mdt.lib.batch_utils.SubjectInfo`): the subjects found by the profile
+
+    Returns:
+        list of str: the absolute paths of the directories
+    """
+    directories = {os.path.abspath(data_folder)}
+
+    with os.scandir(data_folder) as entries:
+        directories.update(os.path.abspath(entry.path) for entry in entries if entry.is_dir())
+
+    for subject in subjects:
+        directories.add(os.path.abspath(subject.subject_base_folder))
+        directories.update(_get_file_directories(subject))
+
+    return sorted(directory for directory in directories if os.path.isdir(directory))
+
+
+def get_glob_directories(pattern):
+    """Get the directories whose contents determine the matches of the given glob pattern.
+
+    If the directory part of the pattern has no wildcards, this is that directory, whether it exists or not. Else, these
+    are the deepest directory without wildcards and all the directories matched by the pattern on every level below.
+
+    Args:
+        pattern (str): the glob pattern, for a file or a directory
+
+    Returns:
+        list of str: the absolute paths of the directories
+    """
+    directory = os.path.dirname(os.path.abspath(pattern))
+    if not _glob_magic.search(directory):
+        return [directory]
+
+    parts = directory.split(os.sep)
+    first_magic = next(ind for ind, part in enumerate(parts) if _glob_magic.search(part))
+
+    directories = [os.sep.join(parts[:first_magic]) or os.sep]
+    for ind in range(first_magic + 1, len(parts) + 1):
+        directories.extend(path for path in glob.glob(os.sep.join(parts[:ind])) if os.path.isdir(path))
+    return directories
+
+
+def _to_json(value):
+    """Convert a subject info (or one of its attributes) to plain JSON values.
+
+    Raises:
+        ValueError: if the value can not be stored in the cache file
+    """
+    if value is None or isinstance(value, (str, bool)):
+        return value
+    if isinstance(value, numbers.Integral):
+        return int(value)
+    if isinstance(value, numbers.Real):
+        return float(value)
+    if isinstance(value, (list, tuple)):
+        return [_to_json(element) for element in value]
+    if isinstance(value, dict) and all(isinstance(key, str) for key in value):
+        return {'dict': {key: _to_json(element) for key, element in value.items()}}
+
+    class_name = '{}.{}'.format(type(value).__module__, type(value).__qualname__)
+    if class_name in _serializable_classes:
+        return {'class': class_name, 'attributes': _to_json(vars(value))['dict']}
+    raise ValueError('Objects of type "{}" can not be stored in the subject discovery cache.'.format(class_name))
+
+
+def _from_json(value):
+    """Restore a subject info (or one of its attributes) from the values created by :func:`_to_json`."""
+    if isinstance(value, list):
+        return [_from_json(element) for element in value]
+    if isinstance(value, dict):
+        if 'dict' in value:
+            return {key: _from_json(element) for key, element in value['dict'].items()}
+        if value['class'] not in _serializable_classes:
+            raise ValueError('The class "{}" can not be restored from the cache.'.format(value['class']))
+
+        module_name, _, class_name = value['class'].rpartition('.')
+        cls = getattr(importlib.import_module(module_name), class_name)
+        obj = cls.__new__(cls)
+        obj.__dict__.update({key: _from_json(element) for key, element in value['attributes'].items()})
+        return obj
+    return value
+
+
+def _get_file_directories(value, depth=0):
+    """Get the directories of the paths referenced by a subject info attribute, searched recursively.
+
+    For paths to a directory (like the directory from which the protocol is auto-loaded) we return the directory
+    itself, for paths to a file we return the directory holding the file.
+    """
+    if isinstance(value, str):
+        if not (os.path.isabs(value) or os.path.sep in value):
+            return []
+        if os.path.isdir(value):
+            return [os.path.abspath(value)]
+        return [os.path.abspath(os.path.dirname(value))]
+
+    if depth < 2 and hasattr(value, '__dict__'):
+        directories = []
+        for element in vars(value).values():
+            directories.extend(_get_file_directories(element, depth + 1))
+        return directories
+
+    return []
+
+
+def _get_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
@@ -0,0 +1,167 @@
+"""Vectorized error propagation using packed covariance matrices.
+
+Given the covariance matrix ``C`` of the parameters and the gradient ``g`` of a derived quantity with respect to
+these parameters, the first order approximation of the variance of the derived quantity is ``g^T C g``. The functions
+in this module compute this directly on the packed upper triangular elements of the covariance matrices (see
+:class:`mdt.utils.PackedCovariances`), that is, as ``sum_p w_p c_p g_{i_p} g_{j_p}`` over the packed elements
+``p = (i_p, j_p)``, with weight one for the diagonal and two for the off-diagonal elements. As such, we never construct
+the full (n, m, m) covariance matrices. The computations are done in batches of voxels, such that the memory use is
+bounded for large numbers of voxels, for example when processing the concatenated ROI's of a cohort.
+
+For example, to compute the std of the orientation dispersion index ``ODI = 2 / pi * arctan(1 / kappa)`` of the NODDI
+model from the optimization results::
+
+    covariances = get_packed_covariances(results, ['NODDI_IC.kappa'], results['covariances'])
+    stds = propagate_uncertainty(
+        lambda kappa: {'ODI.std': [-2 / (np.pi * (1 + kappa ** 2))]},
+        results, covariances)
+"""
+import numpy as np
+from mdt.utils import PackedCovariances
+
+__author__ = 'Robbert Harms'
+__date__ = '2019-04-18'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+def get_packed_covariances(results, names, covariances=None):
+    """Get the packed covariances of the given parameters, with the variances taken from the std maps.
+
+    This is the packed counterpart of :func:`mdt.utils.create_covariance_matrix`, with the same semantics.
+
+    Args:
+        results (dict): the results dictionary from optimization, containing the standard deviation maps
+            as '<name>.std' for each of the given names. If a map is not present we will use 0 for that variance.
+        names (List[str]): the names of the parameters, in the order of the covariance matrix
+        covariances (PackedCovariances or dict): the covariances, either as a :class:`PackedCovariances` or as a
+            dictionary of covariance terms with the names specified as '<name>_to_<name>'.
+            Since the order is undefined, this tests for <x>_to_<y> as <y>_to_<x>.
+
+    Returns:
+        PackedCovariances: the covariances as (n, m(m+1)/2) matrix for n voxels and m names.
+            If no covariance elements are given, we use zero for all off-diagonal terms.
+    """
+    shape = results[list(results.keys())[0]].shape
+    n = 1 if not len(shape) else shape[0]
+    rows, columns = np.triu_indices(len(names))
+
+    if isinstance(covariances, PackedCovariances) and all(name in covariances.param_names for name in names):
+        packed = np.array(covariances.get_subset(names).packed, dtype=np.float64).reshape((n, rows.shape[0]))
+    else:
+        packed = np.zeros((n, rows.shape[0]))
+        if covariances:
+            for ind, (x, y) in enumerate(zip(rows, columns)):
+                for key in ('{}_to_{}'.format(names[x], names[y]), '{}_to_{}'.format(names[y], names[x])):
+                    if x != y and key in covariances:
+                        packed[:, ind] = np.squeeze(covariances[key])
+                        break
+
+    for name, ind in zip(names, np.nonzero(rows == columns)[0]):
+        packed[:, ind] = np.squeeze(results.get(name + '.std', 0)) ** 2
+    return PackedCovariances(packed, names)
+
+
+def propagate_variance(gradient, covariances, max_batch_size=2 ** 16):
+    """Compute the variance of a derived quantity using first order error propagation.
+
+    Args:
+        gradient (ndarray or list): the partial derivatives of the derived quantity with respect to the parameters of
+            the covariances, either as a (n, m) matrix, as a (m,) vector with the same gradient for every voxel, or as
+            a list with per parameter a scalar or a (n,) array.
+        covariances (PackedCovariances): the covariances of the parameters, with the voxels on the first axii
+        max_batch_size (int): the maximum number of voxels we process at once
+
+    Returns:
+        ndarray: the variances, with the voxel shape of the covariances
+    """
+    voxel_shape = covariances.packed.shape[:-1]
+    packed = np.reshape(covariances.packed, (-1, covariances.packed.shape[-1]))
+    gradient = _get_gradient_columns(gradient)
+
+    variances = np.zeros(packed.shape[0])
+    for start in range(0, packed.shape[0], max_batch_size):
+        batch = slice(start, min(start + max_batch_size, packed.shape[0]))
+        variances[batch] = _propagate_packed(_get_gradient_matrix(gradient, batch, batch.stop - batch.start),
+                                             packed[batch])
+    return np.reshape(variances, voxel_shape)
+
+
+def propagate_uncertainty(gradient_func, parameters, covariances, max_batch_size=2 ** 16):
+    """Compute the standard deviations of derived quantities using first order error propagation.
+
+    The gradient function is called per batch of voxels with, for every parameter of the covariances, a vector with
+    the values of that parameter in the voxels of the batch. It should return a dictionary with per derived quantity
+    the gradient, in any of the formats supported by :func:`propagate_variance`. For example::
+
+        def gradient_func(d, dperp0):
+            return {'ratio.std': [1 / dperp0, -d / dperp0 ** 2]}
+
+    Args:
+        gradient_func (callable): the function returning the gradients of the derived quantities
+        parameters (dict): the parameter maps, with one value per voxel for every parameter of the covariances
+        covariances (PackedCovariances): the covariances of the parameters, with the voxels on the first axii
+        max_batch_size (int): the maximum number of voxels we process at once
+
+    Returns:
+        dict: per derived quantity the standard deviations, with the voxel shape of the covariances
+    """
+    voxel_shape = covariances.packed.shape[:-1]
+    packed = np.reshape(covariances.packed, (-1, covariances.packed.shape[-1]))
+    parameters = [np.reshape(parameters[name], (-1,)) for name in covariances.param_names]
+
+    stds = {}
+    for start in range(0, packed.shape[0], max_batch_size):
+        batch = slice(start, min(start + max_batch_size, packed.shape[0]))
+        gradients = gradient_func(*[np.broadcast_to(p, (packed.shape[0],))[batch] for p in parameters])
+
+        for name, gradient in gradients.items():
+            if name not in stds:
+                stds[name] = np.zeros(packed.shape[0])
+            variances = _propagate_packed(
+                _get_gradient_matrix(_get_gradient_columns(gradient), slice(0, None), batch.stop - batch.start),
+                packed[batch])
+            stds[name][batch] = np.sqrt(np.maximum(variances, 0))
+
+    return {name: np.reshape(std, voxel_shape) for name, std in stds.items()}
+
+
+def covariances_to_correlations(covariances):
+    """Transform packed covariances into packed correlations.
+
+    Args:
+        covariances (PackedCovariances): the covariances
+
+    Returns:
+        PackedCovariances: the correlation coefficients, with ones on the diagonal, and NaN where a variance is zero
+    """
+    rows, columns = np.triu_indices(len(covariances.param_names))
+    stds = np.sqrt(covariances.get_variances())
+    with np.errstate(divide='ignore', invalid='ignore'):
+        correlations = covariances.packed / (stds[..., rows] * stds[..., columns])
+    return PackedCovariances(correlations, covariances.param_names)
+
+
+def _propagate_packed(gradient, packed):
+    """Compute ``g^T C g`` for a (b, m) gradient matrix and the (b, m(m+1)/2) packed covariances."""
+    rows, columns = np.triu_indices(gradient.shape[1])
+    weights = np.where(rows == columns, 1., 2.)
+    return np.einsum('bp,bp->b', packed, gradient[:, rows] * gradient[:, columns] * weights)
+
+
+def _get_gradient_columns(gradient):
+    """Get the gradient as a list with per parameter a scalar or a vector with one value per voxel."""
+    if isinstance(gradient, np.ndarray) and gradient.ndim == 2:
+        return [gradient[:, ind] for ind in range(gradient.shape[1])]
+    return [np.reshape(np.asarray(g, dtype=np.float64), (-1,)) for g in gradient]
+
+
+def _get_gradient_matrix(gradient_columns, batch, batch_size):
+    """Get the (b, m) gradient matrix of the given batch of voxels, broadcasting the scalar gradients."""
+    columns = []
+    for column in gradient_columns:
+        if column.shape[0] > 1:
+            column = column[batch]
+        columns.append(np.broadcast_to(column, (batch_size,)))
+    return np.stack(columns, axis=1)
@@ -1,3 +1,5 @@
+import inspect
+import numpy as np
 from mot.lib.cl_function import SimpleCLFunctionParameter
 from .parameter_functions.numdiff_info import SimpleNumDiffInfo
 from .parameter_functions.priors import UniformWithinBoundsPrior
@@ -41,6 +43,40 @@ class ProtocolParameter(InputDataParameter):
         super().__init__(declaration, value=value)
 
 
+class DerivedProtocolParameter(ProtocolParameter):
+
+    def __init__(self, declaration, function, gradient_power=0):
+        """Carries data per observation, computed from other protocol parameters.
+
+        The values of this parameter are computed once (in NumPy) from the protocol parameters named by the arguments
+        of the given function, instead of for every evaluation of the model. If the input data contains a column with
+        the name of this parameter, that column is used instead.
+
+        Args:
+            declaration (str): the declaration of this parameter. For example ``double foo``.
+            function (Callable): the function computing the values of this parameter. The names of the arguments
+                of this function are used as the names of the protocol parameters to use as input.
+            gradient_power (int): the power of the gradient amplitude in this parameter, for example 2 for a
+                b-value like term. With gradient deviations, the values are scaled by the relative gradient length
+                to this power, like the ``b`` and ``G`` protocol parameters.
+        """
+        super().__init__(declaration)
+        self.function = function
+        self.gradient_power = gradient_power
+        self.input_names = list(inspect.signature(function).parameters)
+
+    def compute_value(self, get_input_value):
+        """Compute the value of this parameter.
+
+        Args:
+            get_input_value (Callable[[str], ndarray]): function returning the value of a protocol parameter by name
+
+        Returns:
+            ndarray: the values of this parameter
+        """
+        return np.asarray(self.function(*[get_input_value(name) for name in self.input_names]), dtype=np.float64)
+
+
 class FreeParameter(SimpleCLFunctionParameter):
 
     def __init__(self, declaration, fixed, value, lower_bound, upper_bound,
@@ -1,5 +1,8 @@
+from collections.abc import Mapping
+import numpy as np
 from mdt.model_building.model_functions import SimpleModelCLFunction, WeightType, ModelCLFunction
-from mdt.model_building.parameters import FreeParameter, DataCacheParameter, NoiseStdInputParameter
+from mdt.model_building.parameters import FreeParameter, DataCacheParameter, NoiseStdInputParameter, \
+    DerivedProtocolParameter
 from mot.lib.cl_function import SimpleCLFunction
 from mot.lib.kernel_data import Struct, PrivateMemory, LocalMemory
 
@@ -185,6 +188,10 @@ class DMRICompartmentModelFunction(CompartmentModel, SimpleModelCLFunction):
             dependencies=cache_init_funcs + self.get_dependencies())
 
     def evaluate(self, *args, **kwargs):
+        if isinstance(args[0], Mapping):
+            args = list(args)
+            args[0] = self._add_derived_protocol_inputs(args[0])
+
         if not any(isinstance(p, DataCacheParameter) for p in self._parameter_list):
             return super().evaluate(*args, **kwargs)
 
@@ -214,6 +221,18 @@ class DMRICompartmentModelFunction(CompartmentModel, SimpleModelCLFunction):
 
         return with_cache_func.evaluate(*args, **kwargs)
 
+    def _add_derived_protocol_inputs(self, inputs):
+        """Add the values of the derived protocol parameters which are not in the given inputs.
+
+        The derived values are only added if all the protocol parameters they depend on are in the given inputs.
+        """
+        inputs = dict(inputs)
+        for p in self._parameter_list:
+            if isinstance(p, DerivedProtocolParameter) and p.name not in inputs \
+                    and all(name in inputs for name in p.input_names):
+                inputs[p.name] = p.compute_value(lambda name: np.asarray(inputs[name]))
+        return inputs
+
     def _get_cache_parameter(self):
         for p in self.get_parameters():
             if isinstance(p, DataCacheParameter):
@@ -7,7 +7,9 @@ import numpy as np
 from contextlib import contextmanager
 from mdt.configuration import get_active_post_processing
 from mdt.lib.deferred_mappings import DeferredFunctionDict
-from mdt.lib.exceptions import DoubleModelNameException
+from mdt.lib.exceptions import DoubleModelNameException, NumpyBackendNotSupported
+from mdt.lib.numpy_backend import NumpyModelBackend
+from mdt.lib.uncertainty import get_packed_covariances, propagate_variance
 from mdt.model_building.model_functions import WeightType
 from mdt.model_building.parameter_functions.dependencies import SimpleAssignment, AbstractParameterDependency
 from mdt.model_building.utils import ParameterCodec
@@ -15,15 +17,15 @@ from mdt.model_building.utils import ParameterCodec
 from mot.lib.cl_function import SimpleCLFunction, SimpleCLFunctionParameter
 from mot.cl_routines import compute_log_likelihood, numerical_hessian
 from mdt.model_building.parameters import ProtocolParameter, FreeParameter, CurrentObservationParam, \
-    DataCacheParameter, CurrentModelSignalParam, NoiseStdFreeParameter, NoiseStdInputParameter
+    DataCacheParameter, CurrentModelSignalParam, NoiseStdFreeParameter, NoiseStdInputParameter, \
+    DerivedProtocolParameter
 from mot.configuration import CLRuntimeInfo
 from mot.lib.utils import all_elements_equal, get_single_value
 from mot.lib.kernel_data import Array, Zeros, Scalar, LocalMemory, Struct, CompositeArray, PrivateMemory
 
 from mdt.models.base import MissingProtocolInput
 from mdt.models.base import DMRIOptimizable
-from mdt.utils import calculate_point_estimate_information_criterions, is_scalar, results_to_dict, \
-    create_covariance_matrix
+from mdt.utils import calculate_point_estimate_information_criterions, is_scalar, results_to_dict, PackedCovariances
 from mot.library_functions import pseudo_inverse_real_symmetric_matrix_upper_triangular
 from mot.mcmc_diagnostics import multivariate_ess, univariate_ess
 
@@ -95,6 +97,7 @@ class DMRICompositeModel(DMRIOptimizable):
                               self._model_functions_info.get_free_parameters_list()}
 
         self._input_data = None
+        self._derived_protocol_values = {}
         if input_data:
             self.set_input_data(input_data)
 
@@ -128,6 +131,7 @@ class DMRICompositeModel(DMRIOptimizable):
         self._post_processing = get_active_post_processing()
 
         self._voxels_to_analyze = None
+        self._numpy_backend = None
 
     @property
     def name(self):
@@ -145,6 +149,86 @@ class DMRICompositeModel(DMRIOptimizable):
         yield
         self._voxels_to_analyze = tmp
 
+    @contextmanager
+    def numpy_backend_context(self, numpy_backend):
+        """Temporarily use the given NumPy backend for the post-processing computations.
+
+        While active, the dependent parameters, log-likelihoods and Fisher Information Matrix computed during
+        post-processing are computed using the NumPy backend instead of using OpenCL.
+
+        Args:
+            numpy_backend (Optional[mdt.lib.numpy_backend.NumpyModelBackend]): the backend to use, set to None to
+                use OpenCL.
+        """
+        tmp = self._numpy_backend
+        self._numpy_backend = numpy_backend
+        yield
+        self._numpy_backend = tmp
+
+    def get_numpy_backend(self):
+        """Get a NumPy implementation of this model for the voxels in ``voxels_to_analyze``.
+
+        Only a limited set of compartments and likelihood functions can be computed using NumPy, see
+        :mod:`mdt.lib.numpy_backend` for details.
+
+        Returns:
+            Optional[mdt.lib.numpy_backend.NumpyModelBackend]: the NumPy backend, or None if this model can not
+                be computed using NumPy.
+        """
+        if self._signal_noise_model is not None or self._get_protocol_update_callbacks():
+            return None
+
+        estimable_parameters = self._model_functions_info.get_estimable_parameters_list()
+
+        dependent_parameters = []
+        for m, p in self._model_functions_info.get_dependency_fixed_parameters_list(exclude_priors=True):
+            dependency = self._model_functions_info.get_parameter_value('{}.{}'.format(m.name, p.name))
+            if dependency.pre_transform_code:
+                return None
+            dependent_parameters.append(('{}.{}'.format(m.name, p.name),
+                                         self._convert_parameters_dot_to_bar(dependency.assignment_code)))
+
+        def get_bounds(bounds):
+            columns = []
+            for m, p in estimable_parameters:
+                value = bounds['{}.{}'.format(m.name, p.name)]
+                if is_scalar(value):
+                    value = np.full(self._get_nmr_problems(self._voxels_to_analyze), value)
+                elif self._voxels_to_analyze is not None:
+                    value = value[self._voxels_to_analyze, ...]
+                columns.append(np.reshape(value, (-1,)))
+            return np.column_stack(columns).astype(np.float64)
+
+        observations = self._input_data.observations
+        if observations is None:
+            return None
+        if self._voxels_to_analyze is not None:
+            observations = observations[self._voxels_to_analyze, ...]
+
+        volume_weights = self._input_data.volume_weights
+        if volume_weights is not None and self._voxels_to_analyze is not None:
+            volume_weights = volume_weights[self._voxels_to_analyze, ...]
+
+        weight_indices = []
+        if self._enforce_weights_sum_to_one:
+            weight_indices = [self._model_functions_info.get_parameter_estimable_index(m, p)
+                              for m, p in self._model_functions_info.get_estimable_weights()]
+
+        try:
+            return NumpyModelBackend(
+                self._model_tree, self._likelihood_function, estimable_parameters,
+                self._get_fixed_parameter_maps(self._voxels_to_analyze),
+                dependent_parameters,
+                {p.name: self._get_protocol_value(p)
+                 for p in self._model_functions_info.get_unique_protocol_parameters()},
+                self._transform_observations(observations),
+                get_bounds(self._lower_bounds), get_bounds(self._upper_bounds),
+                volume_weights=volume_weights,
+                weight_indices=weight_indices)
+        except NumpyBackendNotSupported as exc:
+            self._logger.debug('Not using the NumPy backend: {}'.format(exc))
+            return None
+
     def get_composite_model_function(self):
         """Get the composite model function for the current model tree.
 
@@ -177,8 +261,11 @@ class DMRICompositeModel(DMRIOptimizable):
         data_items.update(self._get_observations_data(self._voxels_to_analyze))
         data_items.update(self._get_fixed_parameters_as_var_data(self._voxels_to_analyze))
 
-        if self._input_data.volume_weights is not None:
-            data_items.update({'volume_weights': Array(self._input_data.volume_weights.astype(np.float16))})
+        volume_weights = self._input_data.volume_weights
+        if volume_weights is not None:
+            if self._voxels_to_analyze is not None:
+                volume_weights = volume_weights[self._voxels_to_analyze, ...]
+            data_items.update({'volume_weights': Array(volume_weights, ctype='float')})
 
         return Struct(data_items, '_mdt_model_data')
 
@@ -402,7 +489,10 @@ class DMRICompositeModel(DMRIOptimizable):
             results_array, log_likelihoods=log_likelihoods))
 
         if self._post_processing['optimization']['uncertainties']:
-            fim = self._compute_fisher_information_matrix(results_array)
+            if self._numpy_backend is not None:
+                fim = self._numpy_backend.compute_fisher_information_matrix(results_array)
+            else:
+                fim = self._compute_fisher_information_matrix(results_array)
             results_dict.update(fim['stds'])
             results_dict['covariances'] = fim['covariances']
 
@@ -454,6 +544,51 @@ class DMRICompositeModel(DMRIOptimizable):
 
         return DeferredFunctionDict(items, cache=False)
 
+    def get_post_sampling_maps_from_statistics(self, statistics):
+        """Get the post sample volume maps using the running statistics of the chain.
+
+        This is the counterpart of :meth:`get_post_sampling_maps` for when the full chain is not available, but only
+        statistics accumulated while sampling. This only supports the post-processing options that can be computed
+        from the running statistics, see :meth:`post_sampling_requires_full_chain`.
+
+        Args:
+            statistics (mdt.lib.sampling_statistics.RunningSampleStatistics): the statistics of the complete chain
+
+        Returns:
+            dict: a dictionary with for every subdirectory the maps to save
+        """
+        items = {}
+
+        if self._post_processing['sampling']['univariate_normal']:
+            items.update({'univariate_normal': lambda: self._get_univariate_normal_from_statistics(statistics)})
+        if self._post_processing['sampling']['average_acceptance_rate']:
+            items.update({'average_acceptance_rate': lambda: results_to_dict(statistics.acceptance_rate,
+                                                                             self.get_free_param_names())})
+        if self._post_processing['sampling']['maximum_likelihood'] \
+                or self._post_processing['sampling']['maximum_a_posteriori']:
+            mle_maps_cb, map_maps_cb = self._get_mle_map_maps_functions(*(statistics.maximum_likelihood +
+                                                                           statistics.maximum_a_posteriori))
+            if self._post_processing['sampling']['maximum_likelihood']:
+                items.update({'maximum_likelihood': mle_maps_cb})
+            if self._post_processing['sampling']['maximum_a_posteriori']:
+                items.update({'maximum_a_posteriori': map_maps_cb})
+
+        return DeferredFunctionDict(items, cache=False)
+
+    def post_sampling_requires_full_chain(self):
+        """Check if the active post-sampling maps can only be computed using the full chain of samples.
+
+        The Effective Sample Size statistics and the model defined sampling maps require all the samples in memory. The
+        other post-processing options can also be computed from running statistics using
+        :meth:`get_post_sampling_maps_from_statistics`.
+
+        Returns:
+            boolean: if we need the full chain for the post-processing
+        """
+        return bool(self._post_processing['sampling']['univariate_ess']
+                    or self._post_processing['sampling']['multivariate_ess']
+                    or (self._post_processing['sampling']['model_defined_maps'] and self._extra_sampling_maps_funcs))
+
     def get_model_eval_function(self):
         return self._get_model_eval_function(include_cache_init_func=True)
 
@@ -502,6 +637,23 @@ class DMRICompositeModel(DMRIOptimizable):
         mle_samples = samples[range(samples.shape[0]), :, mle_indices]
         map_samples = samples[range(samples.shape[0]), :, map_indices]
 
+        return self._get_mle_map_maps_functions(mle_samples, mle_values, mle_indices,
+                                                map_samples, map_values, map_indices)
+
+    def _get_mle_map_maps_functions(self, mle_samples, mle_values, mle_indices, map_samples, map_values, map_indices):
+        """Get the functions generating the maps of the MLE and MAP estimators.
+
+        Args:
+            mle_samples (ndarray): the (d, p) matrix with the samples with the maximum likelihood
+            mle_values (ndarray): the maximum log-likelihood values
+            mle_indices (ndarray): the indices of the MLE samples in the chain
+            map_samples (ndarray): the (d, p) matrix with the samples with the maximum posterior
+            map_values (ndarray): the maximum log-posterior values
+            map_indices (ndarray): the indices of the MAP samples in the chain
+
+        Returns:
+            tuple(Func, Func): the function that generates the maps for the MLE and for the MAP estimators.
+        """
         def mle_maps():
             results = results_to_dict(mle_samples, self.get_free_param_names())
             maps = self.post_process_optimization_maps(results, results_array=mle_samples, log_likelihoods=mle_values)
@@ -532,6 +684,23 @@ class DMRICompositeModel(DMRIOptimizable):
             results['{}.std'.format(param_name)] = np.std(samples[:, ind, :], axis=1)
         return results
 
+    def _get_univariate_normal_from_statistics(self, statistics):
+        """Get the mean and std. of each parameter from the running statistics of the chain.
+
+        Args:
+            statistics (mdt.lib.sampling_statistics.RunningSampleStatistics): the statistics of the chain
+
+        Returns:
+            dict: the volume maps with the univariate normal distribution fits (mean and std.)
+        """
+        results = {}
+        mean = statistics.mean
+        std = statistics.std
+        for ind, param_name in enumerate(self.get_free_param_names()):
+            results['{}'.format(param_name)] = mean[:, ind]
+            results['{}.std'.format(param_name)] = std[:, ind]
+        return results
+
     def _get_univariate_ess(self, samples):
         """Get the univariate Effective Sample Size statistics for the given set of samples.
 
@@ -657,17 +826,10 @@ class DMRICompositeModel(DMRIOptimizable):
         param_names = ['{}.{}'.format(m.name, p.name)
                        for m, p in self._model_functions_info.get_estimable_parameters_list()]
 
-        stds = {}
-        covariances = {}
-
-        ind_counter = 0
-        for x_ind in range(nmr_params):
-            stds[param_names[x_ind] + '.std'] = np.nan_to_num(np.sqrt(covars[..., ind_counter]))
-            ind_counter += 1
-
-            for y_ind in range(x_ind + 1, nmr_params):
-                covariances['{}_to_{}'.format(param_names[x_ind], param_names[y_ind])] = covars[..., ind_counter]
-                ind_counter += 1
+        covariances = PackedCovariances(covars, param_names)
+        with np.errstate(invalid='ignore'):
+            variance_stds = np.nan_to_num(np.sqrt(covariances.get_variances()))
+        stds = {name + '.std': variance_stds[:, ind] for ind, name in enumerate(param_names)}
 
         return {'stds': stds, 'covariances': covariances}
 
@@ -685,8 +847,11 @@ class DMRICompositeModel(DMRIOptimizable):
             dict: the calculated information criterion maps
         """
         if log_likelihoods is None:
-            log_likelihoods = compute_log_likelihood(self.get_log_likelihood_function(),
-                                                     results_array, data=self.get_kernel_data())
+            if self._numpy_backend is not None:
+                log_likelihoods = self._numpy_backend.get_log_likelihoods(results_array)
+            else:
+                log_likelihoods = compute_log_likelihood(self.get_log_likelihood_function(),
+                                                         results_array, data=self.get_kernel_data())
             log_likelihoods[np.isinf(log_likelihoods)] = 0
             log_likelihoods = np.nan_to_num(log_likelihoods)
 
@@ -923,6 +1088,7 @@ class DMRICompositeModel(DMRIOptimizable):
             self._logger.info('Using the gradient deviations in the model optimization.')
 
         self._input_data = input_data
+        self._derived_protocol_values = {}
         if self._input_data.noise_std is not None:
             std_param = self._model_functions_info.get_noise_std_param()
             self._model_functions_info.set_parameter_value(
@@ -938,6 +1104,14 @@ class DMRICompositeModel(DMRIOptimizable):
         """
         return self._input_data
 
+    def get_nmr_problems(self):
+        """Get the number of problems (voxels) we will analyze, taking into account the voxels to analyze.
+
+        Returns:
+            int: the number of problems
+        """
+        return self._get_nmr_problems(self._voxels_to_analyze)
+
     def get_nmr_observations(self):
         return self._input_data.nmr_observations
 
@@ -965,8 +1139,13 @@ class DMRICompositeModel(DMRIOptimizable):
         Returns:
             list: A list of columns names that need to be present in the protocol
         """
-        return list(set([p.name for m, p in self._model_functions_info.get_model_parameter_list() if
-                         isinstance(p, ProtocolParameter)]))
+        names = set()
+        for m, p in self._model_functions_info.get_model_parameter_list():
+            if isinstance(p, DerivedProtocolParameter):
+                names.update(p.input_names)
+            elif isinstance(p, ProtocolParameter):
+                names.add(p.name)
+        return list(names)
 
     def is_input_data_sufficient(self, input_data=None):
         return not self.get_input_data_problems(input_data=input_data)
@@ -980,9 +1159,10 @@ class DMRICompositeModel(DMRIOptimizable):
         missing_columns = []
         for name in self.get_required_protocol_names():
             if not input_data.has_input_data(name):
-                for p in self._model_functions_info.get_unique_protocol_parameters():
-                    if p.name == name and p.value is None:
-                        missing_columns.append(name)
+                default_values = [p.value for p in self._model_functions_info.get_unique_protocol_parameters()
+                                  if p.name == name and not isinstance(p, DerivedProtocolParameter)]
+                if not default_values or any(value is None for value in default_values):
+                    missing_columns.append(name)
 
         if missing_columns:
             problems.append(MissingProtocolInput(missing_columns))
@@ -999,8 +1179,8 @@ class DMRICompositeModel(DMRIOptimizable):
     def _get_propagate_weights_uncertainty(self, results):
         weight_names = ['{}.{}'.format(m.name, p.name) for (m, p) in self._model_functions_info.get_weights()]
         if len(weight_names) > 1:
-            covar_matrix = create_covariance_matrix(results, weight_names[1:], results.get('covariances', None))
-            covar_sum = np.sum(np.sum(covar_matrix, axis=1), axis=1)
+            covars = get_packed_covariances(results, weight_names[1:], results.get('covariances', None))
+            covar_sum = propagate_variance(np.ones(len(weight_names) - 1), covars)
             covar_sum[np.isinf(covar_sum) | np.isnan(covar_sum) | (covar_sum < 0)] = 0
             std = np.sqrt(covar_sum)
             return {weight_names[0] + '.std': std}
@@ -1098,6 +1278,9 @@ class DMRICompositeModel(DMRIOptimizable):
         gradient_deviations, zero_locations = compress_zeros(gradient_deviations)
 
         parameters_needed = [p for p in ['g', 'b', 'G'] if self._model_functions_info.has_protocol_parameter(p)]
+        derived_parameters = [p for p in self._model_functions_info.get_unique_protocol_parameters()
+                              if isinstance(p, DerivedProtocolParameter) and p.gradient_power]
+        parameters_needed.extend(p.name for p in derived_parameters)
 
         function_arguments = [self._model_functions_info.get_protocol_parameter_by_name(p).ctype
                               + '* ' + p for p in parameters_needed]
@@ -1117,6 +1300,8 @@ class DMRICompositeModel(DMRIOptimizable):
             body += '*b *= new_g_length * new_g_length;' + "\n"
         if 'G' in parameters_needed:
             body += '*G *= new_g_length;' + "\n"
+        for p in derived_parameters:
+            body += '*{} *= pown(new_g_length, {});'.format(p.name, p.gradient_power) + "\n"
 
         class GradientDeviationProtocolUpdate(ProtocolAdaptionCallbacks):
 
@@ -1228,7 +1413,10 @@ class DMRICompositeModel(DMRIOptimizable):
         estimable_parameters = self._model_functions_info.get_estimable_parameters_list(exclude_priors=True)
         dependent_parameters = self._model_functions_info.get_dependency_fixed_parameters_list(exclude_priors=True)
 
-        if len(dependent_parameters):
+        if len(dependent_parameters) and self._numpy_backend is not None:
+            def calculator(model, results_dict):
+                return self._numpy_backend.get_dependent_parameter_maps(results_dict)
+        elif len(dependent_parameters):
             func = ''
             func += self._get_fixed_parameters_listing()
             func += self._get_estimable_parameters_listing()
@@ -1379,8 +1567,22 @@ class DMRICompositeModel(DMRIOptimizable):
 
             if self._input_data.has_input_data(parameter.name):
                 value = self._input_data.get_input_data(parameter.name)
+            elif isinstance(parameter, DerivedProtocolParameter):
+                if parameter.name not in self._derived_protocol_values:
+                    self._derived_protocol_values[parameter.name] = parameter.compute_value(
+                        self._get_protocol_value_by_name)
+                value = self._derived_protocol_values[parameter.name]
             return value
 
+    def _get_protocol_value_by_name(self, name):
+        """Get the value of a protocol parameter by name, used as input to the derived protocol parameters."""
+        if self._input_data.has_input_data(name):
+            return self._input_data.get_input_data(name)
+        for p in self._model_functions_info.get_unique_protocol_parameters():
+            if p.name == name and not isinstance(p, DerivedProtocolParameter) and p.value is not None:
+                return p.value
+        raise ValueError('Could not find a suitable value for the protocol parameter "{}".'.format(name))
+
     def _get_observations_data(self, voxels_to_analyze):
         """Get the observations to use in the kernel.
 
@@ -1,3 +1,5 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import collections
 from mdt.lib.components import get_model
@@ -92,6 +94,8 @@ def add_rician_noise(signals, noise_level, seed=None):
     To calculate the noise level divide the signal of the unweighted volumes by the SNR you want. For example,
     for a unweighted signal b0=1e4 and a desired SNR of 20, you need an noise level of 1e4/20 = 500.
 
+    This is a shorthand for :func:`add_noise` with the noise type set to 'rician'.
+
     Args:
         signals: the signals to make Rician distributed
         noise_level: the level of noise to add. The actual Rician stdev depends on the signal. See ricestat in
@@ -101,10 +105,100 @@ def add_rician_noise(signals, noise_level, seed=None):
     Returns:
         ndarray: make every element of the input signals contain Rician distributed noise.
     """
-    random_state = np.random.RandomState(seed)
-    x = noise_level * random_state.normal(size=signals.shape) + signals
-    y = noise_level * random_state.normal(size=signals.shape)
-    return np.sqrt(x**2, y**2).astype(signals.dtype)
+    signals = np.asarray(signals)
+    return add_noise(signals, noise_level, noise_type='rician', seed=seed).astype(signals.dtype, copy=False)
+
+
+def add_noise(signals, noise_std, noise_type='rician', nmr_coils=1, seed=None, nmr_threads=None,
+              block_size=10000):
+    """Add Gaussian, Rician or non-central chi distributed noise to the given signals.
+
+    The random numbers are taken from a single counter-based (Philox) random stream derived from the given seed, in
+    which every voxel has its own fixed position. The signals are processed in blocks of voxels, where every block jumps
+    directly to the position of its first voxel. As such, the output is bitwise reproducible for a given seed,
+    independent of the number of threads and of the block size.
+
+    The noise std. can be given as a scalar, as one value per voxel (for example, the unweighted signal divided by an
+    SNR map) or as one value per signal element.
+
+    Args:
+        signals (ndarray): the noise free signals, a 2d (voxels, volumes) or 4d (x, y, z, volumes) array.
+        noise_std (float or ndarray): the standard deviation of the Gaussian noise in every (real and imaginary)
+            channel. If an array, it should either have one value per voxel or be broadcastable to the signals.
+        noise_type (str): one of 'gaussian', 'rician' or 'noncentral_chi'. Gaussian noise is added directly to the
+            signal. Rician noise is the magnitude of the signal with complex Gaussian noise and non-central chi noise is
+            the root sum of squares over ``nmr_coils`` coils with complex Gaussian noise, with the signal in one coil.
+        nmr_coils (int): the number of coils, only used for the non-central chi noise.
+        seed (int): the seed for the random number generation, if not given we use a random seed.
+        nmr_threads (int): the number of threads to use, defaults to the number of CPUs.
+        block_size (int): the number of voxels processed at once per thread, this does not change the noise.
+
+    Returns:
+        ndarray: the noisy signals, of the same shape as the input signals
+    """
+    if noise_type not in ('gaussian', 'rician', 'noncentral_chi'):
+        raise ValueError('The noise type "{}" is not supported.'.format(noise_type))
+    if noise_type == 'rician':
+        nmr_coils = 1
+
+    signals = np.asarray(signals)
+    dtype = signals.dtype if signals.dtype in (np.float32, np.float64) else np.float64
+
+    noise_std = np.asarray(noise_std, dtype=dtype)
+    if signals.ndim > 1 and noise_std.shape == signals.shape[:-1]:
+        noise_std = noise_std[..., None]
+
+    nmr_observations = signals.shape[-1] if signals.ndim else 1
+    signals_2d = signals.reshape((-1, nmr_observations))
+    noise_std_2d = np.broadcast_to(noise_std, signals.shape).reshape((-1, nmr_observations))
+    output = np.zeros(signals_2d.shape, dtype=dtype)
+
+    nmr_normals = nmr_observations * (1 if noise_type == 'gaussian' else 2 * nmr_coils)
+    counters_per_voxel = int(np.ceil(nmr_normals / 4.))
+
+    block_starts = range(0, signals_2d.shape[0], block_size)
+    seed_sequence = np.random.SeedSequence(seed)
+
+    def process_block(block_ind):
+        block = slice(block_starts[block_ind], block_starts[block_ind] + block_size)
+        bit_generator = np.random.Philox(seed_sequence).advance(block_starts[block_ind] * counters_per_voxel)
+        _add_noise_block(signals_2d[block], noise_std_2d[block], output[block], noise_type, nmr_coils,
+                         np.random.Generator(bit_generator), counters_per_voxel)
+
+    nmr_threads = min(nmr_threads or os.cpu_count() or 1, len(block_starts))
+    if nmr_threads > 1:
+        with ThreadPoolExecutor(max_workers=nmr_threads) as executor:
+            list(executor.map(process_block, range(len(block_starts))))
+    else:
+        for block_ind in range(len(block_starts)):
+            process_block(block_ind)
+
+    return output.reshape(signals.shape)
+
+
+def _add_noise_block(signals, noise_std, output, noise_type, nmr_coils, generator, counters_per_voxel):
+    """Add the noise to one block of voxels, the result is written to the given output array.
+
+    Every voxel uses the random numbers of ``counters_per_voxel`` Philox counters (four doubles each), such that the
+    position of a voxel in the random stream does not depend on the block it is in. Since the number of random numbers
+    used by the ziggurat method of ``standard_normal`` is not fixed, we use the Box-Muller transform instead.
+    """
+    uniforms = generator.random(size=(signals.shape[0], 4 * counters_per_voxel))
+    radius = np.sqrt(-2 * np.log1p(-uniforms[:, 0::2]))
+    angle = 2 * np.pi * uniforms[:, 1::2]
+    normals = np.concatenate([radius * np.cos(angle), radius * np.sin(angle)], axis=1).astype(output.dtype)
+
+    def noise(ind):
+        return noise_std * normals[:, ind * signals.shape[1]:(ind + 1) * signals.shape[1]]
+
+    if noise_type == 'gaussian':
+        np.add(signals, noise(0), out=output)
+        return
+
+    output[:] = (signals + noise(0)) ** 2
+    for ind in range(1, 2 * nmr_coils):
+        output += noise(ind) ** 2
+    np.sqrt(output, out=output)
 
 
 def _get_simulate_function(model):
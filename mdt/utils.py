@@ -1,6 +1,7 @@
 import collections
 import gzip
 import numbers
+import itertools
 import glob
 import logging
 import logging.config as logging_config
@@ -19,8 +20,11 @@ from mdt.configuration import get_config_dir
 from mdt.configuration import get_logging_configuration_dict, get_tmp_results_dir
 from mdt.lib.deferred_mappings import DeferredActionDict, DeferredActionTuple
 from mdt.lib.exceptions import NoiseStdEstimationNotPossible
+from mdt.lib.input_data_cache import get_cache_entry_path, hash_input, write_cache_entry, InputDataCacheEntry
 from mdt.lib.log_handlers import ModelOutputLogHandler
-from mdt.lib.nifti import load_nifti, write_nifti
+from mdt.lib.nifti import load_nifti, write_nifti, read_nifti_volumes, read_nifti_region, IncrementalNiftiWriter, \
+    close_nifti, get_nifti_map_names
+from mdt.lib.results_container import RESULTS_CONTAINER_NAME, ResultsContainer
 from mdt.protocols import load_protocol, write_protocol
 from mot.lib.cl_environments import CLEnvironmentFactory
 from mdt.model_building.parameter_functions.dependencies import AbstractParameterDependency
@@ -479,8 +483,206 @@ class MockMRIInputData(SimpleMRIInputData):
         return 1
 
 
+class VoxelListMRIInputData(MRIInputData):
+
+    def __init__(self, protocol, observations, noise_std=1, volume_weights=None):
+        """Input data for a list of voxels, instead of for a volume.
+
+        This is meant for simulations and other cases where the data does not originate from a volume. The
+        observations are used as given, such that no mask or volume needs to be constructed.
+
+        Args:
+            protocol (Protocol): The protocol object used as input data to the model
+            observations (ndarray): a (n, d) matrix with for n voxels and d volumes the measured signal
+            noise_std (number or ndarray): either a scalar or a vector with one value per voxel
+            volume_weights (ndarray): if given, a (n, d) matrix with per voxel and volume a weight in [0, 1].
+        """
+        self._protocol = protocol
+        self._observations = observations
+        self._noise_std = noise_std
+        self._volume_weights = volume_weights
+
+        if protocol.length != 0 and protocol.length != observations.shape[1]:
+            raise ValueError('Length of the protocol ({}) does not equal the number of volumes ({}).'.format(
+                protocol.length, observations.shape[1]))
+
+    def has_input_data(self, parameter_name):
+        return parameter_name in self._protocol
+
+    def get_input_data(self, parameter_name):
+        if parameter_name in self._protocol:
+            return self._protocol[parameter_name]
+        raise ValueError('No input data could be find for the parameter "{}".'.format(parameter_name))
+
+    @property
+    def nmr_problems(self):
+        return self._observations.shape[0]
+
+    @property
+    def nmr_observations(self):
+        return self._observations.shape[1]
+
+    @property
+    def observations(self):
+        return self._observations
+
+    @property
+    def noise_std(self):
+        return self._noise_std
+
+    @property
+    def protocol(self):
+        return self._protocol
+
+    @property
+    def signal4d(self):
+        return self._observations[:, None, None, :]
+
+    @property
+    def nifti_header(self):
+        return None
+
+    @property
+    def mask(self):
+        return np.ones(self._observations.shape[:1] + (1, 1), dtype=np.bool)
+
+    @property
+    def volume_weights(self):
+        if self._volume_weights is None:
+            return None
+        return self._volume_weights.astype(np.float16)
+
+    def get_subset(self, volumes_to_keep=None, volumes_to_remove=None):
+        if (volumes_to_keep is not None) == (volumes_to_remove is not None):
+            raise ValueError('Please specify either the list with volumes to keep or the list with volumes to remove.')
+
+        if volumes_to_keep is None:
+            volumes_to_keep = [ind for ind in range(self.nmr_observations)
+                               if ind not in np.atleast_1d(volumes_to_remove)]
+        volumes_to_keep = np.atleast_1d(volumes_to_keep)
+
+        volume_weights = self._volume_weights
+        if volume_weights is not None:
+            volume_weights = volume_weights[:, volumes_to_keep]
+
+        return VoxelListMRIInputData(self._protocol.get_new_protocol_with_indices(volumes_to_keep),
+                                     self._observations[:, volumes_to_keep], noise_std=self._noise_std,
+                                     volume_weights=volume_weights)
+
+
+class ROIMRIInputData(SimpleMRIInputData):
+
+    def __init__(self, protocol, observations, mask, nifti_header, extra_protocol=None, gradient_deviations=None,
+                 noise_std=None, volume_weights=None):
+        """Input data for diffusion MRI models with the signal already restricted to the voxels in the mask.
+
+        This is the same as :class:`SimpleMRIInputData`, except that the signal is given as a matrix with the
+        observations of the voxels in the mask, instead of as a 4d volume. The 4d volume is only constructed when
+        requested. This is used for the input data cache of :func:`load_input_data`, where the observations
+        are memory mapped from disk.
+
+        Args:
+            protocol (Protocol): The protocol object used as input data to the model
+            observations (ndarray): a (n, d) matrix with for the n voxels in the mask (in C-order) and d volumes the
+                measured signal
+            mask (ndarray): The mask used to create the observations list
+            nifti_header (nifti header): The header of the nifti file to use for writing the results.
+            extra_protocol (Dict[str, val]): additional protocol items, see :class:`SimpleMRIInputData`.
+            gradient_deviations (ndarray): the gradient deviations of the voxels in the mask, either as a (n, 9) matrix
+                in the HCP format, as a (n, 3, 3) matrix or as a (n, m, 3, 3) matrix with per volume a deformation
+                matrix. See :class:`SimpleMRIInputData` for more information.
+            noise_std (number or ndarray): either None for automatic detection, a scalar, a 3d matrix with one
+                value per voxel or a vector with one value per voxel in the mask.
+            volume_weights (ndarray): if given, a (n, d) matrix with per voxel in the mask and per volume
+                a weight in [0, 1].
+        """
+        self._logger = logging.getLogger(__name__)
+        self._observation_list = observations
+        self._nifti_header = nifti_header
+        self._mask = mask
+        self._protocol = protocol
+        self._extra_protocol = self._preload_extra_protocol_items(extra_protocol)
+        self._noise_std = noise_std
+
+        self._gradient_deviations = gradient_deviations
+        self._gradient_deviations_list = None
+
+        self._volume_weights = volume_weights
+        self._volume_weights_list = None
+
+        self._nmr_observations = observations.shape[1]
+
+        if protocol.length != 0 and protocol.length != observations.shape[1]:
+            raise ValueError('Length of the protocol ({}) does not equal the number of volumes ({}).'.format(
+                protocol.length, observations.shape[1]))
+
+        if self._volume_weights is not None and self._volume_weights.shape != observations.shape:
+            raise ValueError('The dimensions of the volume weights does not match the dimensions of the observations.')
+
+    def _get_constructor_args(self):
+        args = [self._protocol, self._observation_list, self._mask, self.nifti_header]
+        kwargs = dict(extra_protocol=self._extra_protocol, gradient_deviations=self._gradient_deviations,
+                      noise_std=self._noise_std, volume_weights=self._volume_weights)
+        return args, kwargs
+
+    def get_subset(self, volumes_to_keep=None, volumes_to_remove=None):
+        if (volumes_to_keep is not None) == (volumes_to_remove is not None):
+            raise ValueError('Please specify either the list with volumes to keep or the list with volumes to remove.')
+
+        if volumes_to_keep is None:
+            volumes_to_keep = [ind for ind in range(self.nmr_observations)
+                               if ind not in np.atleast_1d(volumes_to_remove)]
+        volumes_to_keep = np.atleast_1d(volumes_to_keep)
+
+        volume_weights = self._volume_weights
+        if volume_weights is not None:
+            volume_weights = volume_weights[:, volumes_to_keep]
+
+        gradient_deviations = self._gradient_deviations
+        if gradient_deviations is not None and gradient_deviations.ndim == 4 \
+                and gradient_deviations.shape[1] == self.nmr_observations:
+            gradient_deviations = gradient_deviations[:, volumes_to_keep]
+
+        return self.copy_with_updates(self._protocol.get_new_protocol_with_indices(volumes_to_keep),
+                                      self._observation_list[:, volumes_to_keep],
+                                      gradient_deviations=gradient_deviations, volume_weights=volume_weights)
+
+    @property
+    def signal4d(self):
+        return restore_volumes(self._observation_list, self._mask)
+
+    @property
+    def observations(self):
+        return self._observation_list
+
+    @property
+    def gradient_deviations(self):
+        if self._gradient_deviations is None:
+            return None
+        if self._gradient_deviations_list is None:
+            grad_dev = self._gradient_deviations
+            if grad_dev.ndim == 2 and grad_dev.shape[-1] == 9:  # HCP WUMINN format, see SimpleMRIInputData
+                grad_dev = np.reshape(grad_dev, (-1, 3, 3), order='F') + np.eye(3)
+            self._gradient_deviations_list = grad_dev
+        return self._gradient_deviations_list
+
+    @property
+    def volume_weights(self):
+        if self._volume_weights is None:
+            return None
+        if self._volume_weights_list is None:
+            self._volume_weights_list = np.asarray(self._volume_weights, dtype=np.float16)
+        return self._volume_weights_list
+
+    @property
+    def noise_std(self):
+        if isinstance(self._noise_std, np.ndarray) and self._noise_std.ndim < 3:
+            return self._noise_std
+        return super().noise_std
+
+
 def load_input_data(volume_info, protocol, mask, extra_protocol=None, gradient_deviations=None,
-                    noise_std=None, volume_weights=None):
+                    noise_std=None, volume_weights=None, read_mask_region_only=False, cache_dir=None):
     """Load and create the input data object for diffusion MRI modeling.
 
     Args:
@@ -520,15 +722,34 @@ def load_input_data(volume_info, protocol, mask, extra_protocol=None, gradient_d
             a weight in [0, 1]. If set, these weights are used during model fitting to weigh the objective function
             values per observation.
 
+        read_mask_region_only (boolean): if set, and if the volume is given as a filename, we only read the bounding
+            box of the mask from the volume and set the other voxels to zero. For large (compressed) volumes with
+            a small mask, this avoids reading and decompressing the whole volume.
+
+        cache_dir (str): if given, we use this directory as a persistent cache of the prepared input data. The first
+            load of a subject stores the observations in the mask, the estimated noise std, the gradient deviations
+            and the protocol in this directory, keyed by the content hashes of the DWI, protocol and mask. Subsequent
+            loads of the same subject memory map the observations from the cache instead of reading the DWI again.
+            See :mod:`mdt.lib.input_data_cache` for the details.
+
     Returns:
-        SimpleMRIInputData: the input data object containing all the info needed for diffusion MRI model fitting
+        SimpleMRIInputData: the input data object containing all the info needed for diffusion MRI model fitting.
+            If a cache directory is given we return a :class:`ROIMRIInputData` instead.
     """
+    if cache_dir is not None:
+        return _load_cached_input_data(cache_dir, volume_info, protocol, mask, extra_protocol=extra_protocol,
+                                       gradient_deviations=gradient_deviations, noise_std=noise_std,
+                                       volume_weights=volume_weights, read_mask_region_only=read_mask_region_only)
+
     protocol = load_protocol(protocol)
     mask = load_brain_mask(mask)
 
     if isinstance(volume_info, str):
         info = load_nifti(volume_info)
-        signal4d = info.get_data()
+        if read_mask_region_only:
+            signal4d = read_nifti_region(info, mask)
+        else:
+            signal4d = info.get_data()
         img_header = info.header
     else:
         signal4d, img_header = volume_info
@@ -543,6 +764,49 @@ def load_input_data(volume_info, protocol, mask, extra_protocol=None, gradient_d
                               gradient_deviations=gradient_deviations, volume_weights=volume_weights)
 
 
+def _load_cached_input_data(cache_dir, volume_info, protocol, mask, extra_protocol=None, gradient_deviations=None,
+                            noise_std=None, volume_weights=None, read_mask_region_only=False):
+    """Load the input data using the input data cache in the given directory, see :func:`load_input_data`."""
+    entry_path = get_cache_entry_path(cache_dir, volume_info, protocol, mask)
+
+    if not os.path.isdir(entry_path):
+        logger = logging.getLogger(__name__)
+        logger.info('Writing the input data to the cache in {}.'.format(entry_path))
+
+        input_data = load_input_data(volume_info, protocol, mask, read_mask_region_only=read_mask_region_only)
+        try:
+            estimated_noise_std = estimate_noise_std(input_data)
+        except NoiseStdEstimationNotPossible:
+            estimated_noise_std = None
+
+        write_cache_entry(entry_path, input_data.observations, input_data.mask, input_data.nifti_header,
+                          input_data.protocol, noise_std=estimated_noise_std)
+
+    entry = InputDataCacheEntry(entry_path)
+    cached_mask = entry.mask
+
+    if isinstance(protocol, str):
+        protocol = entry.protocol
+
+    if noise_std is None:
+        noise_std = entry.noise_std
+
+    if gradient_deviations is not None:
+        content_hash = hash_input(gradient_deviations, cache_dir)
+        cached_deviations = entry.get_gradient_deviations(content_hash)
+        if cached_deviations is None:
+            cached_deviations = create_roi(gradient_deviations, cached_mask)
+            entry.add_gradient_deviations(content_hash, cached_deviations)
+        gradient_deviations = cached_deviations
+
+    if volume_weights is not None:
+        volume_weights = create_roi(volume_weights, cached_mask)
+
+    return ROIMRIInputData(protocol, entry.observations, cached_mask, entry.nifti_header,
+                           extra_protocol=extra_protocol, gradient_deviations=gradient_deviations,
+                           noise_std=noise_std, volume_weights=volume_weights)
+
+
 class InitializationData:
 
     def apply_to_model(self, model, input_data):
@@ -943,7 +1207,10 @@ def create_roi(data, brain_mask):
         return DeferredActionDict(lambda _, item: create_roi(item, brain_mask), data)
     elif isinstance(data, str):
         if os.path.isdir(data):
-            return create_roi(load_volume_maps(data), brain_mask)
+            def load_roi(map_name, _):
+                roi = load_volume_maps(data, map_names=[map_name], mask=brain_mask)[map_name]
+                return roi if roi.ndim > 1 else roi[:, None]
+            return DeferredActionDict(load_roi, {map_name: None for map_name in get_nifti_map_names(data)})
         return creator(load_nifti(data).get_data())
     elif isinstance(data, (list, tuple, collections.Sequence)):
         return DeferredActionTuple(lambda _, item: create_roi(item, brain_mask), data)
@@ -1453,6 +1720,11 @@ def model_output_exists(model, output_folder, append_model_name_to_path=True):
     if not os.path.exists(output_path):
         return False
 
+    container_path = os.path.join(output_path, RESULTS_CONTAINER_NAME)
+    if os.path.isfile(container_path):
+        with ResultsContainer(container_path) as container:
+            return all(parameter_name in container for parameter_name in parameter_names)
+
     for parameter_name in parameter_names:
         if not glob.glob(os.path.join(output_path, parameter_name + '*')):
             return False
@@ -1597,41 +1869,49 @@ def load_sample(fname, mode='r'):
     return open_memmap(fname, mode=mode)
 
 
-def estimate_noise_std(input_data):
+def estimate_noise_std(input_data, method='unweighted_std', **kwargs):
     """Estimate the noise standard deviation.
 
-    This calculates per voxel (in the brain mas) the std over all unweighted volumes
+    By default, this calculates per voxel (in the brain mask) the std over all unweighted volumes
     and takes the mean of those estimates as the standard deviation of the noise.
+    This method is taken from Camino (http://camino.cs.ucl.ac.uk/index.php?n=Man.Estimatesnr).
 
-    The method is taken from Camino (http://camino.cs.ucl.ac.uk/index.php?n=Man.Estimatesnr).
+    For the other methods, see :mod:`mdt.lib.noise_std_estimation`. The estimators using the voxels in the mask
+    are applied to all voxels at once, the ``background`` estimator requires the complete volume and is applied
+    using :func:`~mdt.lib.noise_std_estimation.estimate_noise_std_in_slabs`. As such, the ``background`` estimator
+    is not possible with a :class:`ROIMRIInputData`, which only holds the voxels in the mask. To estimate a spatially
+    varying noise std map, or the background noise of a cached subject, please use that function directly.
 
     Args:
         input_data (SimpleMRIInputData): the input data we can use to do the estimation
+        method (str): the estimation method, one of ``unweighted_std``, ``unweighted_mad`` or ``background``
+        **kwargs: the additional arguments for the estimator
 
     Returns:
-        the noise std estimated from the data. This can either be a single float, or an ndarray.
+        float: the noise std estimated from the data.
 
     Raises:
-        :class:`~mdt.exceptions.NoiseStdEstimationNotPossible`: if the noise could not be estimated
+        :class:`~mdt.exceptions.NoiseStdEstimationNotPossible`: if the noise could not be estimated, or if the
+            background method is used with input data restricted to the mask
     """
+    from mdt.lib.noise_std_estimation import get_noise_std_estimator, estimate_noise_std_in_slabs
+
     logger = logging.getLogger(__name__)
     logger.info('Trying to estimate a noise std.')
 
-    def all_unweighted_volumes(input_data):
-        unweighted_indices = input_data.protocol.get_unweighted_indices()
-        unweighted_volumes = input_data.signal4d[..., unweighted_indices]
-
-        if len(unweighted_indices) < 2:
-            raise NoiseStdEstimationNotPossible('Not enough unweighted volumes for this estimator.')
+    estimator = get_noise_std_estimator(method, **kwargs)
 
-        voxel_list = create_roi(unweighted_volumes, input_data.mask)
-        return np.mean(np.std(voxel_list, axis=1))
-
-    noise_std = all_unweighted_volumes(input_data)
-
-    if isinstance(noise_std, np.ndarray) and not is_scalar(noise_std):
-        logger.info('Estimated voxel-wise noise std.')
-        return noise_std
+    if method == 'background':
+        if isinstance(input_data, ROIMRIInputData):
+            raise NoiseStdEstimationNotPossible(
+                'The background method requires the complete DWI volume, which is not available in input data '
+                'restricted to the mask (for example, when loaded from the input data cache). Please use '
+                'estimate_noise_std_in_slabs on the DWI volume instead.')
+        noise_std = estimate_noise_std_in_slabs(input_data.signal4d, input_data.protocol, input_data.mask,
+                                                method=method, **kwargs)
+    else:
+        observations = input_data.observations[:, estimator.get_volume_indices(input_data.protocol)]
+        noise_std = estimator.estimate(observations)[0]
 
     if np.isfinite(noise_std) and noise_std > 0:
         logger.info('Estimated global noise std {}.'.format(noise_std))
@@ -1770,12 +2050,17 @@ def create_blank_mask(volume4d_path, output_fname=None):
     write_nifti(mask, output_fname, volume_info.header)
 
 
-def volume_merge(volume_paths, output_fname, sort=False):
+def volume_merge(volume_paths, output_fname, sort=False, protocol_paths=None, output_protocol_fname=None,
+                 nmr_threads=None):
     """Merge a list of volumes on the 4th dimension. Writes the result as a file.
 
     You can enable sorting the list of volume names based on a natural key sort. This is
     the most convenient option in the case of globbing files. By default this behaviour is disabled.
 
+    The volumes are copied one block of volumes at the time into the (preallocated) output file, such that we never
+    hold more than a few input volumes in memory. See :class:`~mdt.lib.nifti.IncrementalNiftiWriter` for the details
+    of writing the output.
+
     Example usage with globbing:
 
     .. code-block:: python
@@ -1787,28 +2072,59 @@ def volume_merge(volume_paths, output_fname, sort=False):
         output_fname (str): the output filename
         sort (boolean): if true we natural sort the list of DWI images before we merge them. If false we don't.
             The default is False.
+        protocol_paths (list of str): if given, a protocol file per volume, merged in the same order as the volumes.
+            If sorting is enabled, the protocols are kept paired with their volumes.
+        output_protocol_fname (str): the output filename for the merged protocol, required if protocol_paths is given
+        nmr_threads (int): the number of threads to use for compressing the output, defaults to the number of CPUs
 
     Returns:
-        list of str: the list with the filenames in the order of concatenation.
+        list of str: the list with the filenames in the order of concatenation, the given lists are not modified.
     """
-    images = []
-    header = None
+    if protocol_paths is not None:
+        if len(protocol_paths) != len(volume_paths):
+            raise ValueError('The number of protocols ({}) does not match the number of volumes ({}).'.format(
+                len(protocol_paths), len(volume_paths)))
+        if output_protocol_fname is None:
+            raise ValueError('Please provide the output protocol filename when merging protocols.')
+
+    volume_paths = list(volume_paths)
+    if protocol_paths is not None:
+        protocol_paths = list(protocol_paths)
 
     if sort:
+        if protocol_paths is not None:
+            pairs = sorted(zip(volume_paths, protocol_paths), key=lambda pair: natural_key_sort_cb(pair[0]))
+            protocol_paths = [protocol_path for _, protocol_path in pairs]
         volume_paths.sort(key=natural_key_sort_cb)
 
-    for volume in volume_paths:
-        nib_container = load_nifti(volume)
-        header = header or nib_container.header
-        image_data = nib_container.get_data()
-
-        if len(image_data.shape) < 4:
-            image_data = np.expand_dims(image_data, axis=3)
-
-        images.append(image_data)
-
-    combined_image = np.concatenate(images, axis=3)
-    write_nifti(combined_image, output_fname, header)
+    images = [load_nifti(volume, keep_file_open=True) for volume in volume_paths]
+    try:
+        nmr_volumes = [image.shape[3] if len(image.shape) > 3 else 1 for image in images]
+
+        if protocol_paths is not None:
+            protocols = list(map(load_protocol, protocol_paths))
+            for volume_path, protocol, nmr_volumes_in_image in zip(volume_paths, protocols, nmr_volumes):
+                if protocol.length != nmr_volumes_in_image:
+                    raise ValueError('The length of the protocol ({}) does not match the number of volumes '
+                                     'in "{}" ({}).'.format(protocol.length, volume_path, nmr_volumes_in_image))
+
+        dtype = np.result_type(*map(_get_nifti_data_dtype, images))
+
+        with IncrementalNiftiWriter(output_fname, images[0].shape[:3] + (sum(nmr_volumes),), dtype,
+                                    header=images[0].header, nmr_threads=nmr_threads) as writer:
+            output_offset = 0
+            for image, nmr_volumes_in_image in zip(images, nmr_volumes):
+                _copy_nifti_volumes(image, range(nmr_volumes_in_image), writer, output_offset)
+                output_offset += nmr_volumes_in_image
+    finally:
+        for image in images:
+            close_nifti(image)
+
+    if protocol_paths is not None:
+        protocol = protocols[0]
+        for i in range(1, len(protocols)):
+            protocol = protocol.append_protocol(protocols[i])
+        write_protocol(protocol, output_protocol_fname)
 
     return volume_paths
 
@@ -1900,11 +2216,15 @@ def create_brain_mask(dwi_info, protocol, output_fname=None, **kwargs):
     return create_median_otsu_brain_mask(dwi_info, protocol, output_fname=output_fname, **kwargs)
 
 
-def extract_volumes(input_volume_fname, input_protocol, output_volume_fname, output_protocol, volume_indices):
+def extract_volumes(input_volume_fname, input_protocol, output_volume_fname, output_protocol, volume_indices,
+                    nmr_threads=None):
     """Extract volumes from the given volume and save them to separate files.
 
     This will index the given input volume in the 4th dimension, as is usual in multi shell DWI files.
 
+    The volumes are copied one block of volumes at the time into the (preallocated) output file, such that we never
+    hold the whole input or output in memory. The protocol is only written after the volumes were written successfully.
+
     Args:
         input_volume_fname (str): the input volume from which to get the specific volumes
         input_protocol (str or :class:`~mdt.protocols.Protocol`): the input protocol,
@@ -1912,15 +2232,64 @@ def extract_volumes(input_volume_fname, input_protocol, output_volume_fname, out
         output_volume_fname (str): the output filename for the selected volumes
         output_protocol (str): the output protocol for the selected volumes
         volume_indices (:class:`list`): the desired indices, indexing the input_volume
+        nmr_threads (int): the number of threads to use for compressing the output, defaults to the number of CPUs
     """
     input_protocol = load_protocol(input_protocol)
+    input_volume = load_nifti(input_volume_fname, keep_file_open=True)
+    try:
+        nmr_volumes = input_volume.shape[3] if len(input_volume.shape) > 3 else 1
+        if input_protocol.length != nmr_volumes:
+            raise ValueError('The length of the protocol ({}) does not match the number of volumes ({}).'.format(
+                input_protocol.length, nmr_volumes))
+
+        with IncrementalNiftiWriter(output_volume_fname, input_volume.shape[:3] + (len(volume_indices),),
+                                    _get_nifti_data_dtype(input_volume), header=input_volume.header,
+                                    nmr_threads=nmr_threads) as writer:
+            _copy_nifti_volumes(input_volume, volume_indices, writer, 0)
+    finally:
+        close_nifti(input_volume)
+
+    write_protocol(input_protocol.get_new_protocol_with_indices(volume_indices), output_protocol)
+
+
+def _get_nifti_data_dtype(image):
+    """Get the data type of the volumes read from the given image, without reading any data.
 
-    new_protocol = input_protocol.get_new_protocol_with_indices(volume_indices)
-    write_protocol(new_protocol, output_protocol)
+    This is the data type in the header, promoted to double precision if the data proxy applies data scaling.
+    """
+    dtype = image.header.get_data_dtype()
+    if getattr(image.dataobj, 'slope', 1) == 1 and getattr(image.dataobj, 'inter', 0) == 0:
+        return dtype
+    return np.result_type(dtype, np.float64)
+
+
+def _read_nifti_volume_block(image, volume_indices):
+    """Read a block of volumes from the data proxy of the given image, returns a 4d array."""
+    if len(image.shape) < 4:
+        return np.asarray(image.dataobj)[..., None]
+    if len(volume_indices) > 1 and np.all(np.diff(volume_indices) == 1):
+        return np.asarray(image.dataobj[..., volume_indices[0]:volume_indices[-1] + 1])
+    return read_nifti_volumes(image, volume_indices)
+
+
+def _copy_nifti_volumes(image, volume_indices, writer, output_offset, max_block_size=2 ** 28):
+    """Copy the given volumes of a nifti image to an incremental nifti writer, in blocks of at most the given bytes.
+
+    Args:
+        image (nibabel image): the nifti image to copy from
+        volume_indices (list of int): the volumes to copy
+        writer (IncrementalNiftiWriter): the writer we are copying to
+        output_offset (int): the volume index in the output of the first copied volume
+        max_block_size (int): the maximum number of bytes (in the output data type) to copy at once
+    """
+    volume_indices = list(volume_indices)
+    volume_size = int(np.prod(image.shape[:3])) * 8
+    block_length = int(max(1, max_block_size // volume_size))
 
-    input_volume = load_nifti(input_volume_fname)
-    image_data = input_volume.get_data()[..., volume_indices]
-    write_nifti(image_data, output_volume_fname, input_volume.header)
+    for start in range(0, len(volume_indices), block_length):
+        block_indices = volume_indices[start:start + block_length]
+        writer[..., output_offset + start:output_offset + start + len(block_indices)] = \
+            _read_nifti_volume_block(image, block_indices)
 
 
 def natural_key_sort_cb(_str):
@@ -1984,9 +2353,11 @@ def results_to_dict(results, param_names):
 def covariance_to_correlation(input_maps):
     """Transform the covariance maps to correlation maps.
 
-    This function is meant to be used on standard MDT output maps. It will look for maps named
-    ``Covariance_{m0}_to_{m1}`` and ``{m[0-1]}.std`` where m0 and m1 are two map names. It will use the std. maps of m0
-    and m1 to transform the covariance map into a correlation map.
+    This function is meant to be used on standard MDT output maps. If the maps contain packed covariances
+    (``covariances`` with the sidecar file ``covariances.order.txt``, see :func:`load_covariances`), we compute the
+    correlations from these. Else, it will look for maps named ``Covariance_{m0}_to_{m1}`` and ``{m[0-1]}.std`` where
+    m0 and m1 are two map names. It will use the std. maps of m0 and m1 to transform the covariance map into a
+    correlation map.
 
     Typical use case examples (both are equal)::
 
@@ -1999,13 +2370,25 @@ def covariance_to_correlation(input_maps):
     Returns:
         dict: the correlation maps computed from the input maps. The naming scheme is ``Correlation_{m0}_to_{m1}``.
     """
+    from mdt.lib.uncertainty import covariances_to_correlations
+
+    covariances = None
     if isinstance(input_maps, str):
-        input_maps = load_volume_maps(input_maps)
+        if os.path.isfile(os.path.join(input_maps, 'covariances.order.txt')):
+            covariances = load_covariances(input_maps)
+        else:
+            input_maps = load_volume_maps(input_maps)
+    elif isinstance(input_maps.get('covariances', None), PackedCovariances):
+        covariances = input_maps['covariances']
+
+    if covariances is not None:
+        return {'Correlation_' + key: value for key, value in covariances_to_correlations(covariances).items()}
 
     correlation_maps = {}
+    pattern = re.compile(r'Covariance_(.*)_to_(.*)')
 
     for map_name in input_maps:
-        match = re.match('Covariance\_(.*)\_to\_(.*)', map_name)
+        match = pattern.match(map_name)
         if match is not None:
             m0 = match.group(1)
             m1 = match.group(2)
@@ -2015,7 +2398,7 @@ def covariance_to_correlation(input_maps):
     return correlation_maps
 
 
-def load_volume_maps(directory, map_names=None, deferred=True):
+def load_volume_maps(directory, map_names=None, deferred=True, mask=None, nmr_threads=None):
     """Read a number of Nifti volume maps from a directory.
 
     Args:
@@ -2023,13 +2406,18 @@ def load_volume_maps(directory, map_names=None, deferred=True):
         map_names (list or tuple): the names of the maps we want to use. If given we only use and return these maps.
         deferred (boolean): if True we return an deferred loading dictionary instead of a dictionary with the values
             loaded as arrays.
+        mask (ndarray or str): if given, we only load the voxels within this mask. Instead of volumes we then return
+            per map an array with as first dimension the voxels in the mask, in the same order as :func:`create_roi`.
+        nmr_threads (int): the number of threads to use for loading the maps, defaults to the number of CPUs
 
     Returns:
         dict: A dictionary with the volumes. The keys of the dictionary are the filenames (without the extension) of the
             files in the given directory.
     """
     from mdt.lib.nifti import get_all_nifti_data
-    return get_all_nifti_data(directory, map_names=map_names, deferred=deferred)
+    if mask is not None:
+        mask = load_brain_mask(mask)
+    return get_all_nifti_data(directory, map_names=map_names, deferred=deferred, mask=mask, nmr_threads=nmr_threads)
 
 
 def unzip_nifti(in_file, out_file=None, remove_old=False):
@@ -2084,15 +2472,9 @@ def voxelwise_vector_matrix_vector_product(a, B, c):
         c (ndarray): of size (n, m) or (x, y, z, m), vector elements per voxel
 
     Returns:
-        ndarray: either of size (n, 1) or of size (x, y, z, 1), the voxelwise matrix multiplication of aBc.
+        ndarray: either of size (n,) or of size (x, y, z), the voxelwise matrix multiplication of aBc.
     """
-    m = a.shape[-1]
-
-    tmp = np.zeros_like(a)
-    for ind in range(m):
-        tmp[..., ind] = np.sum(a * B[..., ind, :], axis=-1)
-
-    return np.sum(tmp * c, axis=-1)
+    return np.einsum('...i,...ij,...j->...', a, B, c)
 
 
 def create_covariance_matrix(results, names, result_covars=None):
@@ -2103,26 +2485,190 @@ def create_covariance_matrix(results, names, result_covars=None):
             as '<name>.std' for each of the given names. If a map is not present we will use 0 for that variance.
         names (List[str]): the names of the maps to load, the order of the names is the order of the diagonal
             elements.
-        result_covars (dict): dictionary of covariance terms with the names specified as '<name>_to_<name>'.
+        result_covars (PackedCovariances or dict): the covariances, either as a :class:`PackedCovariances` or as a
+            dictionary of covariance terms with the names specified as '<name>_to_<name>'.
             Since the order is undefined, this tests for <x>_to_<y> as <y>_to_<x>.
 
     Returns:
-        ndarray: matrix of size (n, m) for n voxels and m names.
+        ndarray: matrix of size (n, m, m) for n voxels and m names.
             If no covariance elements are given, we use zero for all off-diagonal terms.
+            For error propagation, please consider using :mod:`mdt.lib.uncertainty` instead, which works on the
+            packed covariances.
+    """
+    from mdt.lib.uncertainty import get_packed_covariances
+    return get_packed_covariances(results, names, result_covars).get_matrix()
+
+
+class PackedCovariances(collections.Mapping):
+
+    def __init__(self, packed, param_names):
+        """Covariance matrices stored as their packed upper triangular elements.
+
+        For m parameters, the last axis of the packed array holds the m(m+1)/2 elements of the upper triangular part
+        of the covariance matrix (including the diagonal), in row-major order. That is, for three parameters, the
+        elements are ordered as: (0, 0), (0, 1), (0, 2), (1, 1), (1, 2), (2, 2).
+
+        For backwards compatibility, this also acts as a read-only dictionary with as keys '<p_i>_to_<p_j>' for every
+        off-diagonal pair of parameters (with i < j), and as values the covariance maps.
+
+        Args:
+            packed (ndarray): the packed covariances, with the voxels on the first axii and the m(m+1)/2 packed elements
+                on the last axis.
+            param_names (list of str): the names of the m parameters, in the order of the covariance matrix.
+        """
+        self.packed = packed
+        self.param_names = list(param_names)
+
+        m = len(self.param_names)
+        if packed.shape[-1] != m * (m + 1) // 2:
+            raise ValueError('The packed covariances have {} elements, expected {} for {} parameters.'.format(
+                packed.shape[-1], m * (m + 1) // 2, m))
+
+        rows, columns = np.triu_indices(m)
+        self._index_matrix = np.zeros((m, m), dtype=np.int64)
+        self._index_matrix[rows, columns] = np.arange(rows.shape[0])
+        self._index_matrix[columns, rows] = np.arange(rows.shape[0])
+
+        self._param_indices = {name: ind for ind, name in enumerate(self.param_names)}
+        self._keys = collections.OrderedDict(
+            ('{}_to_{}'.format(self.param_names[x], self.param_names[y]), self._index_matrix[x, y])
+            for x, y in zip(rows, columns) if x != y)
+
+    def get_matrix(self, names=None):
+        """Get the full covariance matrices.
+
+        Args:
+            names (list of str): if given, the names of the parameters (and the order) we want in the covariance
+                matrices. Defaults to all parameters.
+
+        Returns:
+            ndarray: the covariance matrices of size (..., m, m), with the voxel axii of the packed array.
+        """
+        indices = [self._param_indices[name] for name in (names or self.param_names)]
+        return self.packed[..., self._index_matrix[np.ix_(indices, indices)]]
+
+    def get_variances(self):
+        """Get the variances, the diagonal elements of the covariance matrices.
+
+        Returns:
+            ndarray: the variances of size (..., m), with the voxel axii of the packed array.
+        """
+        return self.packed[..., np.diag(self._index_matrix)]
+
+    def get_subset(self, names, new_names=None):
+        """Get the packed covariances of a subset of the parameters.
+
+        Args:
+            names (list of str): the names of the parameters we want to keep
+            new_names (list of str): if given, the names of the parameters in the new covariances object
+
+        Returns:
+            PackedCovariances: the covariances of the selected parameters
+        """
+        indices = [self._param_indices[name] for name in names]
+        rows, columns = np.triu_indices(len(indices))
+        packed_indices = self._index_matrix[np.array(indices)[rows], np.array(indices)[columns]]
+        return PackedCovariances(self.packed[..., packed_indices], new_names or names)
+
+    def get_compartment_covariances(self, compartment_name):
+        """Get the covariances between the parameters of one compartment, without the compartment name prefix.
+
+        Args:
+            compartment_name (str): the name of the compartment
+
+        Returns:
+            PackedCovariances: the covariances of the parameters of the given compartment
+        """
+        names = [name for name in self.param_names if name.startswith(compartment_name + '.')]
+        return self.get_subset(names, [name[len(compartment_name) + 1:] for name in names])
+
+    def __getitem__(self, key):
+        return self.packed[..., self._keys[key]]
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+
+def write_covariances_order(directory, param_names, map_name='covariances'):
+    """Write the parameter order of a packed covariances map to its sidecar file.
+
+    Args:
+        directory (str): the directory containing the packed covariances map
+        param_names (list of str): the names of the parameters, in the order of the covariance matrix
+        map_name (str): the name of the packed covariances map
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(os.path.join(directory, map_name + '.order.txt'), 'w') as f:
+        f.write('\n'.join(param_names) + '\n')
+
+
+def load_covariances(directory, brain_mask=None, map_name='covariances'):
+    """Load the packed covariances map of a model, with the parameter order from its sidecar file.
+
+    Use the method :meth:`PackedCovariances.get_matrix` on the result to get the full covariance matrices.
+
+    Results written by earlier versions of MDT store the covariances as one map per pair of parameters, either in the
+    subdirectory ``covariances`` as ``<p_i>_to_<p_j>`` or as ``Covariance_<p_i>_to_<p_j>`` maps, with the variances
+    in the ``<p_i>.std`` maps. If the sidecar file of the packed covariances does not exist, we load and pack these
+    per-pair maps instead.
+
+    Args:
+        directory (str): the model output directory, containing the packed covariances map and its sidecar file
+        brain_mask (ndarray or str): if given, we only load the voxels in this mask.
+        map_name (str): the name of the packed covariances map
+
+    Returns:
+        PackedCovariances: the covariances, as (x, y, z, m(m+1)/2) volume, or as (n, m(m+1)/2) if a mask was given.
+
+    Raises:
+        ValueError: if neither the packed covariances nor the per-pair covariance maps could be found
+    """
+    if not os.path.isfile(os.path.join(directory, map_name + '.order.txt')):
+        return _load_per_pair_covariances(directory, brain_mask, map_name)
+
+    with open(os.path.join(directory, map_name + '.order.txt'), 'r') as f:
+        param_names = [line.strip() for line in f if line.strip()]
+
+    packed = load_volume_maps(directory, map_names=[map_name])[map_name]
+    if brain_mask is not None:
+        packed = create_roi(packed, brain_mask)
+    return PackedCovariances(packed, param_names)
+
+
+def _load_per_pair_covariances(directory, brain_mask, map_name):
+    """Load and pack the covariances stored as one map per pair of parameters, see :func:`load_covariances`.
+
+    The order of the parameters is reconstructed from the pairs, which are named ``<p_i>_to_<p_j>`` with i < j.
     """
-    shape = results[list(results.keys())[0]].shape
-    n = 1 if not len(shape) else shape[0]
-    m = len(names)
-    covars = np.zeros((n, m, m)).astype(np.float64)
-
-    for ind in range(m):
-        covars[:, ind, ind] = results.get(names[ind] + '.std', 0)**2
-
-    if result_covars:
-        for x in range(m):
-            for y in range(m):
-                if '{}_to_{}'.format(names[x], names[y]) in result_covars:
-                    covars[:, x, y] = result_covars['{}_to_{}'.format(names[x], names[y])]
-                elif '{}_to_{}'.format(names[y], names[x]) in result_covars:
-                    covars[:, x, y] = result_covars['{}_to_{}'.format(names[y], names[x])]
-    return covars
+    from mdt.lib.uncertainty import get_packed_covariances
+
+    covariance_maps = dict(load_volume_maps(os.path.join(directory, map_name), mask=brain_mask))
+    if not covariance_maps:
+        map_names = [name for name in get_nifti_map_names(directory) if name.startswith('Covariance_')]
+        covariance_maps = {name[len('Covariance_'):]: value for name, value in
+                           load_volume_maps(directory, map_names=map_names, mask=brain_mask).items()}
+
+    pairs = [match.groups() for match in map(re.compile(r'(.*)_to_(.*)').match, covariance_maps) if match]
+    if not pairs:
+        raise ValueError('Neither the packed covariances "{}" nor per-pair covariance maps '
+                         'could be found in "{}".'.format(map_name, directory))
+
+    param_names = sorted(set(itertools.chain.from_iterable(pairs)),
+                         key=lambda name: -sum(pair[0] == name for pair in pairs))
+    std_maps = load_volume_maps(directory, map_names=[name + '.std' for name in param_names], mask=brain_mask)
+
+    maps = dict(covariance_maps, **std_maps)
+    spatial_shape = None
+    if brain_mask is None:
+        spatial_shape = next(iter(maps.values())).shape[:3]
+        maps = {name: np.reshape(value, (-1,)) for name, value in maps.items()}
+
+    covariances = get_packed_covariances({name: maps[name] for name in std_maps}, param_names,
+                                         {name: maps[name] for name in covariance_maps})
+    if spatial_shape is not None:
+        return PackedCovariances(np.reshape(covariances.packed, spatial_shape + (-1,)), param_names)
+    return covariances
@@ -551,6 +551,12 @@ class SingleMapInfo:
         """
         return np.isnan(self.data).any()
 
+    def _get_data_subset(self, index):
+        """Index the data, reading only the requested part from file if the data is not yet loaded."""
+        if isinstance(self._data, nibabel.spatialimages.SpatialImage) and not self._data.in_memory:
+            return np.asarray(self._data.dataobj[tuple(index)])
+        return self.data[tuple(index)]
+
     def max_dimension(self):
         """Get the maximum dimension index in this map.
 
@@ -584,7 +590,7 @@ class SingleMapInfo:
         """
         slice_indexing = [slice(None)] * (self.max_dimension() + 1)
         slice_indexing[dimension] = slice_index
-        return np.count_nonzero(self.data[slice_indexing])
+        return np.count_nonzero(self._get_data_subset(slice_indexing))
 
     def max_volume_index(self):
         """Get the maximum volume index in this map.
@@ -614,7 +620,7 @@ class SingleMapInfo:
 
         for index in range(self.shape[dimension]):
             slice_index[dimension] = index
-            if np.count_nonzero(self.data[slice_index]) > 0:
+            if np.count_nonzero(self._get_data_subset(slice_index)) > 0:
                 return index
         return 0
 
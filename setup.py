@@ -82,13 +82,13 @@ info_dict = dict(
         'Operating System :: MacOS :: MacOS X',
         'Operating System :: Microsoft :: Windows',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.4',
         'Programming Language :: Python :: 3.5',
         'Programming Language :: Python :: 3.6',
         'Topic :: Scientific/Engineering'
     ],
     test_suite='tests',
     tests_require=requirements_tests,
+    extras_require={'indexed_gzip': ['indexed_gzip']},
     entry_points=load_entry_points()
 )
 
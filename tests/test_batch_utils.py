@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_batch_utils
+----------------------------------
+
+Tests for the batch processing utilities.
+"""
+import glob
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from mdt.component_templates.batch_profiles import BatchProfileTemplate
+from mdt.configuration import config_context, YamlStringAction
+from mdt.lib.batch_utils import _apply_jobs, _ResultsJournal, SimpleBatchProfile, SimpleSubjectInfo
+from mdt.lib.components import temporary_component_updates
+from mdt.lib.subject_discovery_cache import get_cache_file_path, _load_cache_file
+
+
+class ResultsJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_batch_utils_test')
+        self._journal_fname = os.path.join(self._tmp_dir, 'journal.pickle')
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_resume(self):
+        jobs = [(key, (key,)) for key in ['a', 'b', 'c']]
+        results = _apply_jobs(lambda key: key * 2, jobs, journal_fname=self._journal_fname)
+        self.assertEqual(results, {'a': 'aa', 'b': 'bb', 'c': 'cc'})
+
+        calls = []
+        resumed = _apply_jobs(lambda key: calls.append(key), jobs + [('d', ('d',))], journal_fname=self._journal_fname)
+        self.assertEqual(calls, ['d'])
+        self.assertEqual(resumed, {'a': 'aa', 'b': 'bb', 'c': 'cc', 'd': None})
+
+    def test_torn_last_record(self):
+        journal = _ResultsJournal(self._journal_fname)
+        for key in ['a', 'b', 'c']:
+            journal.append(key, key * 2)
+
+        with open(self._journal_fname, 'r+b') as f:
+            f.truncate(os.path.getsize(self._journal_fname) - 3)
+
+        self.assertEqual(journal.load(), {'a': 'aa', 'b': 'bb'})
+
+        journal.append('d', 'dd')
+        self.assertEqual(journal.load(), {'a': 'aa', 'b': 'bb', 'd': 'dd'})
+
+    def test_unpicklable_result(self):
+        jobs = [(key, (key,)) for key in ['a', 'b']]
+        _apply_jobs(lambda key: threading.Lock() if key == 'b' else key, jobs, journal_fname=self._journal_fname)
+        self.assertEqual(_ResultsJournal(self._journal_fname).load(), {'a': 'a'})
+
+        calls = []
+        _apply_jobs(lambda key: calls.append(key), jobs, journal_fname=self._journal_fname)
+        self.assertEqual(calls, ['b'])
+
+
+class SubjectDiscoveryCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_batch_utils_test')
+        self._cache_dir = os.path.join(self._tmp_dir, 'cache')
+        self._data_folder = os.path.join(self._tmp_dir, 'data')
+        for subject_id in ['s1', 's2']:
+            self._add_subject(subject_id)
+        _SearchCountingProfile.searches.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_cache_hit(self):
+        subject_ids = [self._get_subject_ids(_SearchCountingProfile()) for _ in range(2)]
+        self.assertEqual(subject_ids, [['s1', 's2']] * 2)
+        self.assertEqual(len(_SearchCountingProfile.searches), 1)
+
+    def test_new_subject_invalidates(self):
+        self._get_subject_ids(_SearchCountingProfile())
+        self._add_subject('s3')
+        self.assertEqual(self._get_subject_ids(_SearchCountingProfile()), ['s1', 's2', 's3'])
+        self.assertEqual(len(_SearchCountingProfile.searches), 2)
+
+    def test_changed_configuration_invalidates(self):
+        self._get_subject_ids(_SearchCountingProfile())
+        self.assertEqual(self._get_subject_ids(_SearchCountingProfile(subject_pattern='s1')), ['s1'])
+        self.assertEqual(len(_SearchCountingProfile.searches), 2)
+        self.assertEqual(len(_load_cache_file(get_cache_file_path(self._cache_dir, self._data_folder))), 1)
+
+    def test_changed_template_invalidates(self):
+        with temporary_component_updates():
+            class DiscoveryCacheTestProfile(BatchProfileTemplate):
+                data_fname = '{subject_base_folder}/*.nii*'
+
+            profile_class = DiscoveryCacheTestProfile._builder.create_class(DiscoveryCacheTestProfile)
+            self.assertEqual(self._get_subject_ids(profile_class()), ['s1', 's2'])
+
+            DiscoveryCacheTestProfile.data_fname = '{subject_base_folder}/*.nii'
+            self.assertEqual(self._get_subject_ids(profile_class()), [])
+
+    def test_nested_directories_of_rejected_subjects(self):
+        with temporary_component_updates():
+            class NestedDiscoveryCacheTestProfile(BatchProfileTemplate):
+                data_fname = '{subject_base_folder}/T1w/Diffusion/*.nii*'
+
+            profile_class = NestedDiscoveryCacheTestProfile._builder.create_class(NestedDiscoveryCacheTestProfile)
+
+            for subject_id in ['s1', 's2']:
+                os.makedirs(os.path.join(self._data_folder, subject_id, 'T1w'))
+            self._add_subject('s2', 'T1w/Diffusion')
+            self.assertEqual(self._get_subject_ids(profile_class()), ['s2'])
+
+            self._add_subject('s1', 'T1w/Diffusion')
+            self.assertEqual(self._get_subject_ids(profile_class()), ['s1', 's2'])
+
+            os.remove(os.path.join(self._data_folder, 's2', 'T1w', 'Diffusion', 'dwi.nii.gz'))
+            self.assertEqual(self._get_subject_ids(profile_class()), ['s1'])
+
+    def test_disabled_by_default(self):
+        for _ in range(2):
+            self.assertEqual([subject.subject_id for subject in
+                              _SearchCountingProfile().get_subjects(self._data_folder)], ['s1', 's2'])
+        self.assertEqual(len(_SearchCountingProfile.searches), 2)
+        self.assertFalse(os.path.exists(self._cache_dir))
+
+    def _get_subject_ids(self, profile):
+        with config_context(YamlStringAction('subject_discovery_cache: {{enabled: True, location: {}}}'.format(
+                self._cache_dir))):
+            return [subject.subject_id for subject in profile.get_subjects(self._data_folder)]
+
+    def _add_subject(self, subject_id, subdirectory=''):
+        os.makedirs(os.path.join(self._data_folder, subject_id, subdirectory), exist_ok=True)
+        open(os.path.join(self._data_folder, subject_id, subdirectory, 'dwi.nii.gz'), 'w').close()
+
+
+class _SearchCountingProfile(SimpleBatchProfile):
+
+    searches = []
+
+    def __init__(self, subject_pattern='*'):
+        super().__init__()
+        self._subject_pattern = subject_pattern
+
+    def _get_subjects(self, data_folder):
+        self.searches.append(data_folder)
+        subjects = []
+        for subject_base_folder in sorted(glob.glob(os.path.join(data_folder, self._subject_pattern))):
+            subjects.append(SimpleSubjectInfo(data_folder, subject_base_folder, os.path.basename(subject_base_folder),
+                                              os.path.join(subject_base_folder, 'dwi.nii.gz'), None, None))
+        return subjects
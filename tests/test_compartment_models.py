@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_compartment_models
+----------------------------------
+
+Tests for the compartments with precomputed values, comparing them against their expressions without precomputation.
+"""
+import unittest
+import numpy as np
+from numpy.testing import assert_allclose
+
+from mdt.component_templates.compartment_models import CompartmentTemplate
+from mdt.lib.components import get_component, get_template, has_component, temporary_component_updates
+
+_ssfp_code = '''
+    return SSFPFromDiffusionWeighting(adc, SSFP_b, SSFP_beta, TR, flip_angle, b1, T1, T2);
+'''
+
+_old_expressions = {
+    'Stick': (['SphericalToCartesian'], '''
+        return exp(-b * d * pown(dot(g, SphericalToCartesian(theta, phi)), 2));
+    '''),
+    'Zeppelin': (['SphericalToCartesian'], '''
+        return exp(-b * (((d - dperp0) * pown(dot(g, SphericalToCartesian(theta, phi)), 2)) + dperp0));
+    '''),
+    'Tensor': (['TensorApparentDiffusion'], '''
+        double adc = TensorApparentDiffusion(theta, phi, psi, d, dperp0, dperp1, g);
+        return exp(-b * adc);
+    '''),
+    'KurtosisTensor': (['TensorApparentDiffusion', 'KurtosisMultiplication'], '''
+        double adc = TensorApparentDiffusion(theta, phi, psi, d, dperp0, dperp1, g);
+
+        if(adc <= 0.0){
+            return 1;
+        }
+
+        double tensor_md_2 = pown((d + dperp0 + dperp1) / 3.0, 2);
+
+        double kurtosis_sum = KurtosisMultiplication(
+            W_0000, W_1111, W_2222, W_1000, W_2000, W_1110,
+            W_2220, W_2111, W_2221, W_1100, W_2200, W_2211,
+            W_2100, W_2110, W_2210, g);
+
+        if(kurtosis_sum < 0 || (((tensor_md_2 * b) / adc) * kurtosis_sum) > 3.0){
+            return INFINITY;
+        }
+
+        return exp(-b*adc + (b*b)/6.0 * tensor_md_2 * kurtosis_sum);
+    '''),
+    'CylinderGPD': (['VanGelderenCylinder', 'SphericalToCartesian'], '''
+        double direction_2 = pown(dot(g, SphericalToCartesian(theta, phi)), 2);
+
+        double signal_par = -b * d * direction_2;
+        double signal_perp = (1 - direction_2) * VanGelderenCylinder(G, Delta, delta, d, R);
+
+        return exp(signal_perp + signal_par);
+    '''),
+    'CHARMEDRestricted': (['SphericalToCartesian', 'NeumanCylinderLongApprox'], '''
+        double direction_2 = pown(dot(g, SphericalToCartesian(theta, phi)), 2);
+        double signal_par = -b * d * direction_2;
+
+        float weights[] = {0.021184720085574, 0.107169623942214, 0.194400551313197,
+                           0.266676876170322, 0.214921653661151, 0.195646574827541};
+        float radii[] = {1.5e-6f, 2.5e-6f, 3.5e-6f, 4.5e-6f, 5.5e-6f, 6.5e-6f};
+
+        double sum = 0;
+        mot_float_type signal_perp;
+
+        for(uint i = 0; i < 6; i++){
+            signal_perp = (1 - direction_2) * (delta * delta) * NeumanCylinderLongApprox(G, TE/2.0, d, radii[i]);
+            sum += weights[i] * exp(signal_par + signal_perp);
+        }
+
+        return sum;
+    '''),
+    'GDRCylinders': (['VanGelderenCylinder', 'SphericalToCartesian', 'gamma_ppf', 'gamma_pdf'], '''
+        uint nmr_radii = 16;
+        double radius_spacing = (*cache->upper_radius - *cache->lower_radius) / nmr_radii;
+
+        double direction_2 = pown(dot(g, SphericalToCartesian(theta, phi)), 2);
+        double diffusivity_par = -b * d * direction_2;
+
+        double radius;
+        double diffusivity_perp;
+        double weight_sum = 0;
+        double signal_sum = 0;
+
+        for(uint i = 0; i < nmr_radii; i++){
+            radius = *cache->lower_radius + (i + 0.5) * radius_spacing;
+
+            diffusivity_perp = (1 - direction_2) * VanGelderenCylinder(G, Delta, delta, d, radius);
+            signal_sum += cache->weights[i] * exp(diffusivity_par + diffusivity_perp);
+            weight_sum += cache->weights[i];
+        }
+        return signal_sum / weight_sum;
+    '''),
+    'TimeDependentZeppelin': (['SphericalToCartesian'], '''
+        double dperp0 = d_bulk + A * (log(Delta/delta) + 3/2.0)/(Delta - delta/3.0);
+        return exp(-b * (((d - dperp0) * pown(dot(g, SphericalToCartesian(theta, phi)), 2)) + dperp0));
+    '''),
+    'NODDI_EC': (['NODDI_WatsonHinderedDiffusionCoeff', 'SphericalToCartesian'], '''
+        NODDI_WatsonHinderedDiffusionCoeff(&d, &dperp0, kappa);
+        return exp(-b * (((d - dperp0) * pown(dot(g, SphericalToCartesian(theta, phi)), 2)) + dperp0));
+    '''),
+    'NODDI_EC_Integration': (['NODDI_SphericalHarmonicsIntegral', 'SphericalToCartesian'], '''
+        return exp(-b * dperp0) * NODDI_SphericalHarmonicsIntegral(dot(g, SphericalToCartesian(theta, phi)),
+                                                                   -b * (d - dperp0), kappa);
+    '''),
+    'NODDI_IC': (['NODDI_SphericalHarmonicsIntegral', 'SphericalToCartesian'], '''
+        return NODDI_SphericalHarmonicsIntegral(dot(g, SphericalToCartesian(theta, phi)), -b*d, kappa);
+    '''),
+    'BinghamNODDI_EN': (['ConfluentHyperGeometricFirstKind', 'TensorApparentDiffusion'], '''
+        double d_mu_1 = dperp0 + (d - dperp0) * *cache->diff_kappa;
+        double d_mu_2 = dperp0 + (d - dperp0) * *cache->diff_beta;
+        double d_mu_3 = d + 2*dperp0 - d_mu_1 - d_mu_2;
+
+        return exp(-b * TensorApparentDiffusion(theta, phi, psi, d_mu_1, d_mu_2, d_mu_3, g));
+    '''),
+    'BinghamNODDI_IN': (['eigenvalues_3x3_symmetric', 'ConfluentHyperGeometricFirstKind',
+                         'TensorSphericalToCartesian'], '''
+        double kappa = k1;
+        double beta = k1 / kw;
+
+        float4 v1, v2, v3;
+        TensorSphericalToCartesian(theta, phi, psi, &v1, &v2, &v3);
+
+        double Q[6];
+        Q[0] = pown(dot(g, v3), 2) * (-b * d);
+        Q[1] = dot(g, v3) * dot(g, v2) * (-b * d);
+        Q[2] = dot(g, v3) * dot(g, v1) * (-b * d);
+        Q[3] = pown(dot(g, v2), 2) * (-b * d);
+        Q[4] = dot(g, v2) * dot(g, v1) * (-b * d);
+        Q[5] = pown(dot(g, v1), 2) * (-b * d);
+
+        Q[3] += beta;
+        Q[5] += kappa;
+
+        double e[3];
+        eigenvalues_3x3_symmetric(Q,e);
+
+        return ConfluentHyperGeometricFirstKind(-e[0], -e[1], -e[2]) / *cache->denom;
+    '''),
+    'SSFP_Stick': (['SSFPFromDiffusionWeighting', 'SphericalToCartesian'], '''
+        double adc = d * pown(dot(g, SphericalToCartesian(theta, phi)), 2);
+    ''' + _ssfp_code),
+    'SSFP_Zeppelin': (['SSFPFromDiffusionWeighting', 'SphericalToCartesian'], '''
+        double adc = dperp0 + (d - dperp0) * pown(dot(g, SphericalToCartesian(theta, phi)), 2);
+    ''' + _ssfp_code),
+    'SSFP_Tensor': (['SSFPFromDiffusionWeighting', 'TensorApparentDiffusion'], '''
+        double adc = TensorApparentDiffusion(theta, phi, psi, d, dperp0, dperp1, g);
+    ''' + _ssfp_code),
+}
+
+_parameter_ranges = {
+    'b': (0, 3e9), 'G': (0.01, 0.1), 'Delta': (0.02, 0.04), 'delta': (0.005, 0.015), 'TE': (0.06, 0.1),
+    'TR': (0.02, 0.04), 'flip_angle': (0.3, 1.5), 'b1': (0.8, 1.2), 'T1': (0.5, 1.5), 'T2': (0.03, 0.1),
+    'd': (0.5e-9, 2e-9), 'dperp0': (0.1e-9, 0.5e-9), 'dperp1': (0.01e-9, 0.1e-9), 'd_bulk': (0.1e-9, 0.5e-9),
+    'theta': (0, np.pi), 'phi': (0, np.pi), 'psi': (0, np.pi), 'kappa': (0.5, 30), 'R': (1e-6, 5e-6),
+    'shape': (1, 5), 'scale': (0.5e-6, 2e-6), 'A': (1e-7, 1e-6), 'k1': (1, 20), 'kw': (1, 5),
+    'W_0000': (0.1, 1), 'W_1111': (0.1, 1), 'W_2222': (0.1, 1),
+}
+
+
+class PrecomputedValuesTest(unittest.TestCase):
+
+    def test_equals_old_expressions(self):
+        unavailable = []
+        for name, (dependencies, cl_code) in sorted(_old_expressions.items()):
+            try:
+                get_component('compartment_models', name)()
+            except ValueError as exc:
+                # some library functions are only available in more recent versions of MOT
+                unavailable.append('{} ({})'.format(name, exc))
+                continue
+
+            with self.subTest(name):
+                with temporary_component_updates():
+                    old_compartment = _get_old_compartment(name, dependencies, cl_code)
+                    compartment = get_component('compartment_models', name)()
+
+                    inputs = _get_inputs(compartment, np.random.RandomState(0), 50)
+                    assert_allclose(compartment.evaluate(inputs, 50), old_compartment.evaluate(inputs, 50),
+                                    rtol=1e-5)
+
+        if unavailable:
+            self.skipTest('Could not build: {}'.format(', '.join(unavailable)))
+
+    def test_reject_as_dependency(self):
+        with temporary_component_updates():
+            class DependsOnStick(CompartmentTemplate):
+                parameters = ('g', 'b', 'd', 'theta', 'phi')
+                dependencies = ['Stick']
+                cl_code = 'return Stick(g, b, d, theta, phi);'
+
+            with self.assertRaises(ValueError):
+                get_component('compartment_models', 'DependsOnStick')()
+
+
+def _get_old_compartment(name, dependencies, cl_code):
+    """Create the compartment with the given name as it was before it used precomputed values."""
+    template = get_template('compartment_models', name)
+
+    class OldCompartment(CompartmentTemplate):
+        parameters = template.parameters
+        protocol_columns = template.protocol_columns
+        cache_info = template.cache_info
+    OldCompartment.name = 'Old' + name
+    OldCompartment.dependencies = dependencies
+    OldCompartment.cl_code = cl_code
+    OldCompartment.subcomponents = template.subcomponents
+
+    return OldCompartment._builder.create_class(OldCompartment)()
+
+
+def _get_inputs(compartment, rng, nmr_instances):
+    """Random protocol and parameter values for all the inputs of the given compartment.
+
+    This also contains the protocol values from which the derived protocol parameters are computed.
+    """
+    g = rng.normal(size=(nmr_instances, 3))
+    g /= np.linalg.norm(g, axis=1)[:, None]
+
+    inputs = {'g': np.c_[g, np.zeros(nmr_instances)]}
+    for name, (lower, upper) in _parameter_ranges.items():
+        inputs[name] = rng.uniform(lower, upper, nmr_instances)
+
+    for p in compartment.get_parameters():
+        if p.name not in inputs and p.name.startswith('W_'):
+            inputs[p.name] = rng.uniform(-0.05, 0.05, nmr_instances)
+
+    return inputs
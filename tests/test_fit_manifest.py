@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_fit_manifest
+----------------------------------
+
+Tests for the fit manifests and the index of the manifests of a batch fit.
+"""
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import numpy as np
+
+import mdt
+from mdt.lib.batch_utils import SubjectInfo
+from mdt.lib.components import get_model
+from mdt.lib.fit_manifest import write_fit_manifest, FitManifestIndex, get_input_data_fingerprint
+from mdt.lib.model_fitting import get_model_output_status, get_optimization_inits, get_batch_fitting_function
+from mdt.lib.nifti import write_nifti
+from mdt.protocols import Protocol
+from mdt.utils import VoxelListMRIInputData
+
+
+class FitManifestIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_fit_manifest_test')
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_concurrent_indices(self):
+        indices = [FitManifestIndex(self._tmp_dir) for _ in range(2)]
+        for subject_id, index in zip(['s1', 's2'], indices):
+            self._write_manifest(subject_id, 'Tensor')
+            index.update_subject(subject_id, ['Tensor'])
+            index.write()
+
+        index = FitManifestIndex(self._tmp_dir)
+        for subject_id in ['s1', 's2']:
+            self.assertEqual(index._manifests[subject_id]['Tensor']['model_name'], 'Tensor')
+
+    def test_concurrent_threads(self):
+        subject_ids = ['s{}'.format(ind) for ind in range(20)]
+
+        def fit(subject_id):
+            self._write_manifest(subject_id, 'Tensor')
+            index = FitManifestIndex(self._tmp_dir)
+            index.update_subject(subject_id, ['Tensor'])
+            index.write()
+
+        threads = [threading.Thread(target=fit, args=(subject_id,)) for subject_id in subject_ids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(FitManifestIndex(self._tmp_dir)._manifests), sorted(subject_ids))
+        self.assertFalse(os.path.exists(os.path.join(self._tmp_dir, 'fit_manifests.json.lock')))
+
+    def _write_manifest(self, subject_id, model_name):
+        output_path = os.path.join(self._tmp_dir, subject_id, model_name)
+        os.makedirs(output_path)
+        write_fit_manifest(output_path, model_name, ['S0.s0'])
+
+
+class InputDataFingerprintTest(unittest.TestCase):
+
+    def test_fingerprint(self):
+        protocol = Protocol({'b': np.array([0, 1e9, 2e9])})
+        observations = np.random.RandomState(0).uniform(size=(10, 3))
+
+        fingerprint = get_input_data_fingerprint(VoxelListMRIInputData(protocol, observations))
+        self.assertEqual(get_input_data_fingerprint(VoxelListMRIInputData(protocol, observations.copy())), fingerprint)
+        self.assertNotEqual(get_input_data_fingerprint(
+            VoxelListMRIInputData(Protocol({'b': np.array([0, 1e9, 3e9])}), observations)), fingerprint)
+        self.assertNotEqual(get_input_data_fingerprint(
+            VoxelListMRIInputData(protocol, observations[:5])), fingerprint)
+
+
+class ModelOutputStatusTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_fit_manifest_test')
+
+        rng = np.random.RandomState(0)
+        b = np.repeat([0, 1e9, 2e9, 3e9], 5)
+        g = rng.normal(size=(20, 3))
+        g /= np.linalg.norm(g, axis=1)[:, None]
+        self._input_data = mdt.load_input_data((rng.uniform(100, 1000, (2, 2, 1, 20)), None),
+                                               Protocol({'b': b, 'g': g}), np.ones((2, 2, 1), dtype=bool))
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_status(self):
+        input_fingerprint = get_input_data_fingerprint(self._input_data)
+
+        def get_status(source_fingerprint, input_fingerprint=None):
+            return get_model_output_status('BallStick_r1', self._tmp_dir, source_fingerprint=source_fingerprint,
+                                           input_fingerprint=input_fingerprint)
+
+        self.assertEqual(get_status('a'), 'missing')
+
+        self._write_output('BallStick_r1', manifest=False)
+        self.assertEqual(get_status('a'), 'current')
+
+        self._write_output('BallStick_r1', source_fingerprint='a', input_fingerprint=input_fingerprint)
+        self.assertEqual(get_status('a', input_fingerprint), 'current')
+        self.assertEqual(get_status(None), 'current')
+        self.assertEqual(get_status('b', input_fingerprint), 'stale')
+        self.assertEqual(get_status('a', 'other'), 'stale')
+
+    def test_current_intermediate_fit_is_used(self):
+        self._write_output('BallStick_r1', source_fingerprint='a',
+                           input_fingerprint=get_input_data_fingerprint(self._input_data))
+
+        inits = get_optimization_inits('Tensor', self._input_data, self._tmp_dir, source_fingerprint='a')
+        np.testing.assert_allclose(inits['Tensor.theta'], 0.5)
+
+    def test_batch_fitting_skips_current_fits(self):
+        for use_manifest_index in [False, True]:
+            with self.subTest(use_manifest_index=use_manifest_index):
+                shutil.rmtree(self._tmp_dir)
+                fit_func = get_batch_fitting_function(1, ['BallStick_r1'], self._tmp_dir,
+                                                      use_manifest_index=use_manifest_index)
+
+                with self.assertRaises(_InputDataLoaded):
+                    fit_func(_SubjectInfo('s1', 'a'))
+
+                self._write_output('BallStick_r1', subject_id='s1', source_fingerprint='a')
+                if use_manifest_index:
+                    index = FitManifestIndex(self._tmp_dir)
+                    index.update_subject('s1', ['BallStick_r1'])
+                    index.write()
+
+                fit_func = get_batch_fitting_function(1, ['BallStick_r1'], self._tmp_dir,
+                                                      use_manifest_index=use_manifest_index)
+                fit_func(_SubjectInfo('s1', 'a'))
+
+                with self.assertRaises(_InputDataLoaded):
+                    fit_func(_SubjectInfo('s1', 'b'))
+
+    def _write_output(self, model_name, subject_id='', manifest=True, source_fingerprint=None,
+                      input_fingerprint=None):
+        output_path = os.path.join(self._tmp_dir, subject_id, model_name)
+        parameter_names = get_model(model_name)().get_free_param_names()
+        for name in parameter_names:
+            write_nifti(np.full((2, 2, 1), 0.5), os.path.join(output_path, name + '.nii.gz'))
+        if manifest:
+            write_fit_manifest(output_path, model_name, parameter_names, input_fingerprint=input_fingerprint,
+                               source_fingerprint=source_fingerprint)
+
+
+class _InputDataLoaded(Exception):
+    pass
+
+
+class _SubjectInfo(SubjectInfo):
+    """Subject information which signals when the input data is loaded, that is, when a model would be fitted."""
+
+    def __init__(self, subject_id, input_fingerprint):
+        self._subject_id = subject_id
+        self._input_fingerprint = input_fingerprint
+
+    @property
+    def subject_id(self):
+        return self._subject_id
+
+    def get_input_fingerprint(self, use_gradient_deviations=False):
+        return self._input_fingerprint
+
+    def get_input_data(self, use_gradient_deviations=False, cache_dir=None):
+        raise _InputDataLoaded()
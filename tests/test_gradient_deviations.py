@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_gradient_deviations
+----------------------------------
+
+Tests for the gradient deviations, comparing the deviated model against a model with the deviations applied to the
+protocol beforehand.
+"""
+import unittest
+import numpy as np
+from numpy.testing import assert_allclose
+from mot.cl_routines import compute_log_likelihood
+
+import mdt
+from mdt.protocols import Protocol
+from mdt.utils import ROIMRIInputData
+
+
+class GradientDeviationsTest(unittest.TestCase):
+
+    def test_ssfp_tensor(self):
+        rng = np.random.RandomState(0)
+        nmr_voxels, nmr_volumes = 4, 30
+
+        g = rng.normal(size=(nmr_volumes, 3))
+        g /= np.linalg.norm(g, axis=1)[:, None]
+        G = np.repeat([0, 0.02, 0.04], nmr_volumes // 3)
+        deviations = np.eye(3) + rng.uniform(-0.1, 0.1, (3, 3))
+
+        deviated_g = np.dot(g, deviations.T)
+        deviated_length = np.linalg.norm(deviated_g, axis=1)
+
+        observations = rng.uniform(500, 1000, (nmr_voxels, nmr_volumes))
+
+        lls = _get_log_likelihoods(_get_protocol(g, G), observations,
+                                   gradient_deviations=np.tile(deviations, (nmr_voxels, 1, 1)))
+        expected = _get_log_likelihoods(
+            _get_protocol(deviated_g / deviated_length[:, None], G * deviated_length), observations)
+        assert_allclose(lls, expected, rtol=1e-5)
+
+
+def _get_protocol(g, G):
+    nmr_volumes = g.shape[0]
+    return Protocol({'g': g, 'G': G, 'delta': np.full(nmr_volumes, 0.01), 'TR': np.full(nmr_volumes, 0.03),
+                     'flip_angle': np.full(nmr_volumes, np.pi / 6), 'b1': np.ones(nmr_volumes),
+                     'T1': np.full(nmr_volumes, 0.5), 'T2': np.full(nmr_volumes, 0.05)})
+
+
+def _get_log_likelihoods(protocol, observations, gradient_deviations=None):
+    model = mdt.get_model('SSFP_Tensor-ExVivo')()
+    model.set_input_data(ROIMRIInputData(protocol, observations, np.ones((observations.shape[0], 1, 1), dtype=bool),
+                                         None, gradient_deviations=gradient_deviations, noise_std=20))
+
+    parameters = model.get_initial_parameters().astype(np.float64)
+    parameters *= np.random.RandomState(1).uniform(0.9, 1.1, parameters.shape)
+    return compute_log_likelihood(model.get_log_likelihood_function(), parameters, data=model.get_kernel_data())
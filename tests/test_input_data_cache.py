@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_input_data_cache
+----------------------------------
+
+Tests for the persistent cache of the prepared input data, checking cache hits, misses and invalidation.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+
+import mdt
+import mdt.utils
+from mdt.lib.input_data_cache import get_cache_entry_path, write_cache_entry
+from mdt.lib.nifti import write_nifti
+from mdt.protocols import Protocol, write_protocol
+from mdt.utils import ROIMRIInputData
+
+
+class InputDataCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_input_data_cache_test')
+        self._cache_dir = os.path.join(self._tmp_dir, 'cache')
+
+        rng = np.random.RandomState(0)
+        self._mask = np.zeros((8, 7, 6), dtype=np.bool)
+        self._mask[1:7, 2:6, 1:5] = True
+
+        b = np.r_[np.zeros(3), np.full(5, 1e9)]
+        g = rng.normal(size=(len(b), 3))
+        self._protocol = Protocol({'b': b, 'g': g / np.linalg.norm(g, axis=1)[:, None]})
+        self._signal4d = np.abs(1000 * np.exp(-b * 1e-9) + rng.normal(0, 20, self._mask.shape + b.shape))
+
+        self._dwi = os.path.join(self._tmp_dir, 'dwi.nii.gz')
+        self._protocol_fname = os.path.join(self._tmp_dir, 'dwi.prtcl')
+        self._mask_fname = os.path.join(self._tmp_dir, 'mask.nii.gz')
+        write_nifti(self._signal4d, self._dwi)
+        write_protocol(self._protocol, self._protocol_fname)
+        write_nifti(self._mask.astype(np.uint8), self._mask_fname)
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_miss_equals_uncached(self):
+        cached = self._load()
+        uncached = mdt.load_input_data(self._dwi, self._protocol_fname, self._mask_fname)
+
+        self.assertIsInstance(cached, ROIMRIInputData)
+        self.assertEqual(self._get_entries(), [os.path.basename(self._get_entry_path())])
+        assert_allclose(cached.observations, uncached.observations, rtol=1e-6)
+        assert_array_equal(cached.mask, uncached.mask)
+        assert_allclose(cached.protocol.get_column('b'), uncached.protocol.get_column('b'))
+        assert_allclose(cached.noise_std, mdt.estimate_noise_std(uncached))
+        self.assertEqual(cached.nifti_header.get_data_shape(), uncached.nifti_header.get_data_shape())
+
+    def test_hit(self):
+        self._load()
+        with mock.patch('mdt.utils.write_cache_entry', wraps=write_cache_entry) as write_entry, \
+                mock.patch('mdt.utils.load_nifti', side_effect=AssertionError('The DWI should not be read.')):
+            input_data = self._load()
+            write_entry.assert_not_called()
+
+        self.assertEqual(len(self._get_entries()), 1)
+        self.assertIsInstance(input_data.observations, np.memmap)
+        assert_allclose(input_data.observations, self._signal4d[self._mask], rtol=1e-6)
+
+    def test_hit_on_equal_content(self):
+        self._load()
+
+        # a rewrite with the same content changes the modification time, but not the content hash
+        write_nifti(self._signal4d, self._dwi)
+        os.utime(self._dwi, ns=(0, 0))
+        self._load()
+        self.assertEqual(len(self._get_entries()), 1)
+
+        self._load(volume_info=(self._signal4d, None), protocol=self._protocol, mask=self._mask)
+        self._load(volume_info=(self._signal4d, None), protocol=self._protocol, mask=self._mask)
+        self.assertEqual(len(self._get_entries()), 2)
+
+    def test_invalidation(self):
+        self._load()
+
+        write_nifti(2 * self._signal4d, self._dwi)
+        input_data = self._load()
+        self.assertEqual(len(self._get_entries()), 2)
+        assert_allclose(input_data.observations, 2 * self._signal4d[self._mask], rtol=1e-6)
+
+        protocol = Protocol({'b': 2 * self._protocol.get_column('b'), 'g': self._protocol.get_column('g')})
+        write_protocol(protocol, self._protocol_fname)
+        input_data = self._load()
+        self.assertEqual(len(self._get_entries()), 3)
+        assert_allclose(input_data.protocol.get_column('b'), protocol.get_column('b'))
+
+        mask = np.copy(self._mask)
+        mask[1] = False
+        write_nifti(mask.astype(np.uint8), self._mask_fname)
+        input_data = self._load()
+        self.assertEqual(len(self._get_entries()), 4)
+        self.assertEqual(input_data.observations.shape[0], np.count_nonzero(mask))
+
+    def test_gradient_deviations(self):
+        grad_dev = np.random.RandomState(1).normal(0, 0.01, self._mask.shape + (9,))
+        grad_dev_fname = os.path.join(self._tmp_dir, 'grad_dev.nii.gz')
+        write_nifti(grad_dev, grad_dev_fname)
+
+        deviations_dir = os.path.join(self._get_entry_path(), 'gradient_deviations')
+        for _ in range(2):
+            input_data = self._load(gradient_deviations=grad_dev_fname)
+            self.assertEqual(len(os.listdir(deviations_dir)), 1)
+
+        expected = mdt.load_input_data(self._dwi, self._protocol_fname, self._mask_fname,
+                                       gradient_deviations=grad_dev_fname).gradient_deviations
+        assert_allclose(input_data.gradient_deviations, expected, rtol=1e-6)
+
+        self._load(gradient_deviations=2 * grad_dev)
+        self.assertEqual(len(os.listdir(deviations_dir)), 2)
+
+    def test_keep_existing_entry(self):
+        input_data = self._load()
+        write_cache_entry(self._get_entry_path(), np.zeros_like(input_data.observations), self._mask,
+                          None, self._protocol)
+
+        self.assertEqual(len(self._get_entries()), 1)
+        assert_allclose(self._load().observations, self._signal4d[self._mask], rtol=1e-6)
+
+    def _load(self, volume_info=None, protocol=None, mask=None, **kwargs):
+        return mdt.load_input_data(volume_info or self._dwi, protocol or self._protocol_fname,
+                                   self._mask_fname if mask is None else mask, cache_dir=self._cache_dir, **kwargs)
+
+    def _get_entry_path(self):
+        return get_cache_entry_path(self._cache_dir, self._dwi, self._protocol_fname, self._mask_fname)
+
+    def _get_entries(self):
+        return sorted(name for name in os.listdir(self._cache_dir) if name != 'file_hashes')
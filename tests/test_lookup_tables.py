@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_lookup_tables
+----------------------------------
+
+Tests for the lookup tables of the library functions.
+"""
+import unittest
+import numpy as np
+from numpy.testing import assert_allclose
+from scipy.integrate import quad
+from scipy.special import eval_legendre, hyp1f1, ellipk, ellipe
+
+from mdt.lib.components import get_template
+from mdt.lib.lookup_tables import LookupTable
+from mdt.lib.special_functions import noddi_watson_sh_coeff, noddi_legendre_gaussian_integral, \
+    log_bingham_saddlepoint_approximation, carlson_rf, carlson_rd
+
+
+class LookupTableTest(unittest.TestCase):
+
+    def test_polynomials_are_exact(self):
+        table = LookupTable('test_table', lambda x: np.stack([x ** 2, 3 - x], axis=1), [(-1, 2)], 8, nmr_outputs=2)
+        x = np.linspace(-1, 2, 101)
+        assert_allclose(table(x), np.stack([x ** 2, 3 - x], axis=1), atol=1e-6)
+
+    def test_two_dimensional(self):
+        table = LookupTable('test_table', lambda x, y: np.exp(-x) * np.sin(y), [(0, 4), (0, 3)], (96, 64),
+                            grid_exponents=(2, 1), atol=1e-5)
+        table.values
+        x, y = np.random.RandomState(0).uniform(0, 1, (2, 1000)) * [[4], [3]]
+        assert_allclose(table(x, y)[:, 0], np.exp(-x) * np.sin(y), atol=1e-5)
+
+    def test_outside_domain(self):
+        table = LookupTable('test_table', lambda x: x, [(0, 1)], 16)
+        self.assertTrue(np.all(np.isnan(table([-0.1, 1.1, np.nan]))))
+
+    def test_accuracy_check(self):
+        table = LookupTable('test_table', np.sin, [(0, 100)], 8, rtol=0, atol=1e-6)
+        with self.assertRaises(ValueError):
+            table.values
+
+    def test_cl_code(self):
+        table = LookupTable('test_table', lambda x, y: x * y, [(0, 1), (0, 1)], 4)
+        self.assertIn('bool test_table(double x0, double x1, double* result)', table.get_cl_code())
+        self.assertIn('constant float test_table_values[36]', table.get_cl_code())
+        self.assertIn('return false;', table.get_cl_code(use_table=False))
+
+
+class SpecialFunctionsTest(unittest.TestCase):
+
+    def test_watson_sh_coeff(self):
+        for kappa in [0, 0.15, 5, 40, 64]:
+            normalization = hyp1f1(0.5, 1.5, kappa)
+            expected = [2 * np.pi * np.sqrt((4 * order + 1) / (4 * np.pi)) *
+                        quad(lambda x: np.exp(kappa * x ** 2) / normalization * eval_legendre(2 * order, x),
+                             -1, 1, epsabs=1e-13)[0] for order in range(7)]
+            assert_allclose(noddi_watson_sh_coeff(kappa)[0], expected, atol=1e-9)
+
+    def test_legendre_gaussian_integral(self):
+        for x in [0, 0.06, 3, 50, 128]:
+            expected = [quad(lambda mu: np.exp(-x * mu ** 2) * eval_legendre(2 * order, mu), -1, 1,
+                             epsabs=1e-13)[0] for order in range(7)]
+            assert_allclose(noddi_legendre_gaussian_integral(x)[0], expected, atol=1e-9)
+
+    def test_saddlepoint_shift_invariance(self):
+        e = np.random.RandomState(0).uniform(-20, 20, (100, 3))
+        shift = np.random.RandomState(1).uniform(-20, 20, (100, 1))
+        assert_allclose(log_bingham_saddlepoint_approximation(e + shift),
+                        log_bingham_saddlepoint_approximation(e) - shift[:, 0], atol=1e-8)
+
+    def test_carlson_elliptic_integrals(self):
+        m = np.linspace(0, 0.99, 100)
+        assert_allclose(carlson_rf(0, 1 - m, 1), ellipk(m), rtol=1e-13)
+        assert_allclose(carlson_rf(0, 1 - m, 1) - m / 3. * carlson_rd(0, 1 - m, 1), ellipe(m), rtol=1e-13)
+
+
+class LibraryFunctionTablesTest(unittest.TestCase):
+
+    def test_watson_sh_coeff_table(self):
+        table = _get_table('NODDI_WatsonSHCoeff')
+        kappa = np.random.RandomState(0).uniform(0, 64, 10000)
+        assert_allclose(table(kappa), noddi_watson_sh_coeff(kappa), atol=1e-6)
+
+    def test_legendre_gaussian_integral_table(self):
+        table = _get_table('NODDI_LegendreGaussianIntegral')
+        x = np.random.RandomState(0).uniform(0, 128, 10000)
+        assert_allclose(table(x), noddi_legendre_gaussian_integral(x), atol=1e-6)
+
+    def test_confluent_hypergeometric_table(self):
+        table = _get_table('ConfluentHyperGeometricFirstKind')
+        e = np.sort(np.random.RandomState(0).uniform(-60, 60, (10000, 3)), axis=1)
+        assert_allclose(table(e[:, 2] - e[:, 1], e[:, 1] - e[:, 0])[:, 0] - e[:, 0],
+                        log_bingham_saddlepoint_approximation(e), atol=5e-4)
+
+
+def _get_table(library_function_name):
+    table = get_template('library_functions', library_function_name).lookup_tables[0]
+    table.values  # raises an error if the table is not within its tolerance
+    return table
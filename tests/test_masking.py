@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_masking
+----------------------------------
+
+Tests for the median otsu brain masking.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+from numpy.testing import assert_array_equal
+from nibabel.openers import Opener
+from scipy.ndimage import median_filter, binary_dilation, generate_binary_structure
+
+from mdt.lib.masking import median_otsu, _otsu, create_median_otsu_brain_mask
+from mdt.lib.nifti import write_nifti
+from mdt.protocols import Protocol
+
+
+class MedianOtsuTest(unittest.TestCase):
+
+    def test_equals_reference(self):
+        volume = _get_phantom()
+        expected = _reference_median_otsu(volume)
+        for nmr_threads in [1, 3]:
+            assert_array_equal(median_otsu(volume, nmr_threads=nmr_threads), expected)
+
+    def test_crop(self):
+        volume = _get_phantom()
+        mask = median_otsu(volume, crop=True)
+        self.assertLess(np.count_nonzero(mask != _reference_median_otsu(volume)), 0.01 * np.count_nonzero(mask))
+
+
+class CreateMedianOtsuBrainMaskTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_masking_test')
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_read_from_file(self):
+        volume = _get_phantom(shape=(32, 28, 20))
+        b = np.r_[np.zeros(6), np.full(4, 1e9)]
+        dwi = np.stack([volume * np.exp(-value * 1e-9) for value in b], axis=-1)
+        protocol = Protocol({'b': b, 'g': np.tile([1., 0, 0], (len(b), 1))})
+
+        fname = os.path.join(self._tmp_dir, 'dwi.nii.gz')
+        write_nifti(dwi, fname)
+
+        opened = []
+        open_file = Opener.__init__
+
+        def counting_open(opener, fileish, *args, **kwargs):
+            if isinstance(fileish, str):
+                opened.append(fileish)
+            open_file(opener, fileish, *args, **kwargs)
+
+        with mock.patch.object(Opener, '__init__', counting_open):
+            mask = create_median_otsu_brain_mask(fname, protocol, mask_threshold=1)
+
+        assert_array_equal(mask, create_median_otsu_brain_mask(dwi, protocol, mask_threshold=1))
+
+        # once for the header and the data, instead of once per volume
+        self.assertEqual(len(opened), 1)
+        self.assertEqual([name for name in os.listdir('/proc/self/fd')
+                          if os.path.realpath(os.path.join('/proc/self/fd', name)) == os.path.realpath(fname)], [])
+
+
+def _get_phantom(shape=(64, 56, 40), sigma=20):
+    """An ellipsoid with a smooth edge and Rician noise, in a larger field of view.
+
+    For this phantom, cropping changes the Otsu threshold and with that a few voxels of the mask.
+    """
+    coordinates = np.meshgrid(*[np.linspace(-1, 1, length) for length in shape], indexing='ij')
+    radius = np.sqrt(sum((x / (0.5 + 0.1 * ind)) ** 2 for ind, x in enumerate(coordinates)))
+    signal = 200. / (1 + np.exp((radius - 1) / 0.05))
+
+    rng = np.random.RandomState(0)
+    return np.hypot(signal + rng.normal(0, sigma, shape), rng.normal(0, sigma, shape))
+
+
+def _reference_median_otsu(volume, median_radius=4, numpass=4, dilate=1):
+    """The single threaded median otsu on the whole volume."""
+    for ind in range(numpass):
+        volume = median_filter(volume, size=median_radius, mode='mirror')
+    mask = volume > _otsu(volume)
+    return binary_dilation(mask, generate_binary_structure(3, 1), iterations=dilate)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_math_img
+----------------------------------
+
+Tests for the chunked evaluation of mdt-math-img and the incremental nifti writer it uses.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+
+from mdt.cli_scripts.mdt_math_img import MathImg
+from mdt.lib.nifti import write_nifti, load_nifti, IncrementalNiftiWriter
+
+
+class MathImgChunkedTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_math_img_test')
+        rng = np.random.RandomState(0)
+        self._input_files = [os.path.join(self._tmp_dir, 'a.nii.gz'),
+                             os.path.join(self._tmp_dir, 'b.nii'),
+                             os.path.join(self._tmp_dir, 'mask.nii.gz')]
+        write_nifti(rng.normal(size=(12, 10, 9, 7)), self._input_files[0])
+        write_nifti(rng.normal(size=(12, 10, 9, 7)), self._input_files[1])
+        write_nifti((rng.uniform(size=(12, 10, 9)) > 0.5).astype(np.float64), self._input_files[2])
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_equals_unchunked(self):
+        expressions = {'z': ['a * b + 1', 'np.mean(a, axis=3) * c', 'np.concatenate([a, b], axis=3)'],
+                       'volume': ['a * b + 1', 'np.sqrt(a ** 2 + b ** 2) * c[..., None]']}
+
+        for chunk_axis, chunk_expressions in expressions.items():
+            for expr in chunk_expressions:
+                expected = self._run(expr, 'expected.nii.gz')
+                for memory_limit, nmr_threads in [(0.001, 1), (0.01, 3), (1024, 2)]:
+                    with self.subTest(chunk_axis=chunk_axis, expr=expr, memory_limit=memory_limit):
+                        assert_allclose(self._run(expr, 'chunked.nii.gz', '--chunked', '--chunk-axis', chunk_axis,
+                                                  '--memory-limit', str(memory_limit),
+                                                  '--nmr-threads', str(nmr_threads)),
+                                        expected)
+
+    def test_inplace(self):
+        expected = self._run('a * 2', 'expected.nii.gz')
+        self._run('a * 2', None, '--chunked', '--memory-limit', '0.001')
+        assert_allclose(load_nifti(self._input_files[0]).get_data(), expected)
+
+    def test_not_chunkable(self):
+        with self.assertRaises(ValueError):
+            self._run('np.mean(a)', 'chunked.nii.gz', '--chunked')
+
+    def _run(self, expr, output_name, *extra_args):
+        args = self._input_files + [expr, '-w']
+        if output_name:
+            args += ['-o', os.path.join(self._tmp_dir, output_name)]
+        app = MathImg()
+        app.run(app._get_arg_parser().parse_args(args + list(extra_args)), [])
+        return load_nifti(os.path.join(self._tmp_dir, output_name or 'a.nii.gz')).get_data()
+
+
+class IncrementalNiftiWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_incremental_nifti_writer_test')
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_equals_write_nifti(self):
+        volume = np.random.RandomState(0).normal(size=(11, 9, 8, 5)).astype(np.float32)
+        header = load_nifti(self._write_reference(volume)).header
+
+        for extension in ['.nii', '.nii.gz']:
+            for nmr_threads in [1, 4]:
+                fname = os.path.join(self._tmp_dir, 'incremental' + extension)
+                with IncrementalNiftiWriter(fname, volume.shape, volume.dtype, header,
+                                            nmr_threads=nmr_threads) as writer:
+                    for z in reversed(range(volume.shape[2])):
+                        writer[:, :, z] = volume[:, :, z]
+
+                nifti = load_nifti(fname)
+                assert_array_equal(nifti.get_data(), volume)
+                assert_array_equal(nifti.affine, header.get_best_affine())
+                self.assertEqual(sorted(os.listdir(self._tmp_dir)), sorted(['reference.nii.gz', 'incremental' + extension]))
+                os.remove(fname)
+
+    def test_cleanup_on_error(self):
+        with self.assertRaises(RuntimeError):
+            with IncrementalNiftiWriter(os.path.join(self._tmp_dir, 'out.nii.gz'), (2, 2, 2), np.float64):
+                raise RuntimeError()
+        self.assertEqual(os.listdir(self._tmp_dir), [])
+
+    def _write_reference(self, volume):
+        fname = os.path.join(self._tmp_dir, 'reference.nii.gz')
+        write_nifti(volume, fname, affine=np.diag([2., 2, 3, 1]))
+        return fname
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_nifti
+----------------------------------
+
+Tests for reading (parts of) nifti files.
+"""
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import numpy as np
+from numpy.testing import assert_array_equal
+
+import mdt
+from mdt.lib.nifti import write_nifti, load_nifti, read_nifti_roi, get_all_nifti_data, _map_in_threads, close_nifti, \
+    read_nifti_volumes, read_nifti_region, load_indexed_gzip_nifti, indexed_gzip, GZIP_INDEX_EXTENSION
+from mdt.protocols import Protocol
+from mdt.utils import create_roi
+
+
+class ReadNiftiRoiTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_nifti_test')
+        self._volume, self._mask = _get_volume_and_mask()
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_equals_indexing(self):
+        fname = os.path.join(self._tmp_dir, 'volume.nii.gz')
+        write_nifti(self._volume, fname)
+
+        for max_block_size in [1, 10 * 8 * 9 * 4, 2 ** 26]:
+            nifti = load_nifti(fname, keep_file_open=True)
+            assert_array_equal(read_nifti_roi(nifti, self._mask, max_block_size=max_block_size),
+                               self._volume[self._mask])
+            assert_array_equal(read_nifti_roi(nifti, self._mask.astype(np.uint8), max_block_size=max_block_size),
+                               self._volume[self._mask])
+
+    def test_empty_mask(self):
+        fname = os.path.join(self._tmp_dir, 'volume.nii')
+        write_nifti(self._volume, fname)
+        self.assertEqual(read_nifti_roi(load_nifti(fname), np.zeros(self._volume.shape[:3])).shape, (0, 4))
+
+    def test_masked_loading(self):
+        maps = {'a': self._volume, 'b': self._volume[..., 0], 'c': self._volume[..., 1] * 2}
+        for name, volume in maps.items():
+            write_nifti(volume, os.path.join(self._tmp_dir, name + ('.nii' if name == 'a' else '.nii.gz')))
+
+        mask = self._mask
+        for nmr_threads in [1, 3]:
+            rois = get_all_nifti_data(self._tmp_dir, mask=mask, nmr_threads=nmr_threads)
+            self.assertEqual(_get_open_files(self._tmp_dir), [])
+            self.assertEqual(sorted(rois), ['a', 'b', 'c'])
+            for name, volume in maps.items():
+                assert_array_equal(rois[name], volume[mask])
+
+        rois = mdt.load_volume_maps(self._tmp_dir, map_names=['b'], mask=mask)
+        self.assertEqual(list(rois), ['b'])
+        assert_array_equal(rois['b'], maps['b'][mask])
+
+        rois = create_roi(self._tmp_dir, mask)
+        self.assertEqual(sorted(rois), ['a', 'b', 'c'])
+        assert_array_equal(rois['a'], self._volume[mask])
+        assert_array_equal(rois['b'], maps['b'][mask][:, None])
+
+
+class PartialReadingTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_nifti_test')
+        self._volume, self._mask = _get_volume_and_mask()
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_keep_file_open(self):
+        for extension in ['.nii', '.nii.gz']:
+            fname = os.path.join(self._tmp_dir, 'volume' + extension)
+            write_nifti(self._volume, fname)
+
+            nifti = load_nifti(fname, keep_file_open=True)
+            assert_array_equal(read_nifti_volumes(nifti, [3, 1]), self._volume[..., [3, 1]])
+            assert_array_equal(read_nifti_volumes(nifti, [0]), self._volume[..., [0]])
+            self.assertEqual(_get_open_files(self._tmp_dir), [os.path.realpath(fname)])
+
+            close_nifti(nifti)
+            self.assertEqual(_get_open_files(self._tmp_dir), [])
+            with self.assertRaises(ValueError):
+                read_nifti_volumes(nifti, [0])
+
+    def test_close_not_kept_open(self):
+        fname = os.path.join(self._tmp_dir, 'volume.nii.gz')
+        write_nifti(self._volume, fname)
+
+        nifti = load_nifti(fname)
+        close_nifti(nifti)
+        assert_array_equal(read_nifti_volumes(nifti, [2]), self._volume[..., [2]])
+
+    @unittest.skipIf(indexed_gzip is None, 'The package indexed_gzip is not installed.')
+    def test_indexed_gzip(self):
+        fname = os.path.join(self._tmp_dir, 'volume.nii.gz')
+        write_nifti(self._volume, fname)
+
+        for _ in range(2):
+            nifti = load_indexed_gzip_nifti(fname)
+            self.assertTrue(os.path.isfile(fname + GZIP_INDEX_EXTENSION))
+            assert_array_equal(read_nifti_volumes(nifti, [3, 0]), self._volume[..., [3, 0]])
+            assert_array_equal(read_nifti_region(nifti, self._mask)[self._mask], self._volume[self._mask])
+            close_nifti(nifti)
+            self.assertEqual(_get_open_files(self._tmp_dir), [])
+
+    def test_read_mask_region_only(self):
+        fname = os.path.join(self._tmp_dir, 'volume.nii.gz')
+        write_nifti(self._volume, fname)
+
+        mask = np.zeros(self._mask.shape, dtype=bool)
+        mask[2:5, 3:7, 4:6] = self._mask[2:5, 3:7, 4:6]
+        protocol = Protocol({'b': np.r_[0, 1e9, 1e9, 1e9], 'g': np.eye(4, 3)})
+
+        expected = np.zeros_like(self._volume)
+        expected[2:5, 3:7, 4:6] = self._volume[2:5, 3:7, 4:6]
+
+        input_data = mdt.load_input_data(fname, protocol, mask, read_mask_region_only=True)
+        assert_array_equal(input_data.signal4d, expected)
+        assert_array_equal(input_data.observations,
+                           mdt.load_input_data(fname, protocol, mask).observations)
+
+
+class MapInThreadsTest(unittest.TestCase):
+
+    def test_results(self):
+        items = {str(ind): ind for ind in range(20)}
+        for nmr_threads in [None, 1, 4, 50]:
+            results = _map_in_threads(lambda v: v ** 2, items, nmr_threads=nmr_threads)
+            self.assertEqual(list(results), list(items))
+            self.assertEqual(results, {k: v ** 2 for k, v in items.items()})
+
+    def test_uses_threads(self):
+        thread_ids = _map_in_threads(lambda _: threading.get_ident(), {ind: ind for ind in range(4)}, nmr_threads=4)
+        self.assertNotIn(threading.get_ident(), thread_ids.values())
+        self.assertEqual(_map_in_threads(lambda _: threading.get_ident(), {'a': 1}, nmr_threads=4),
+                         {'a': threading.get_ident()})
+
+    def test_empty(self):
+        self.assertEqual(_map_in_threads(lambda v: v, {}), {})
+
+
+def _get_open_files(directory):
+    """The files in the given directory opened by this process, only available on Linux."""
+    if not os.path.isdir('/proc/self/fd'):
+        return []
+    paths = [os.path.realpath(os.path.join('/proc/self/fd', fd)) for fd in os.listdir('/proc/self/fd')]
+    return [path for path in paths if path.startswith(os.path.realpath(directory))]
+
+
+def _get_volume_and_mask(shape=(10, 8, 9, 4)):
+    rng = np.random.RandomState(0)
+    volume = rng.normal(size=shape).astype(np.float32)
+    mask = rng.uniform(size=shape[:3]) > 0.5
+    mask[:, :, 3] = False
+    return volume, mask
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_noise_std_estimation
+----------------------------------
+
+Tests for the noise std estimators, on a phantom with Rician noise.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from numpy.testing import assert_allclose
+from scipy.special import gamma
+
+import mdt
+from mdt.lib.exceptions import NoiseStdEstimationNotPossible
+from mdt.lib.nifti import write_nifti
+from mdt.lib.noise_std_estimation import estimate_noise_std_in_slabs
+from mdt.protocols import Protocol
+from mdt.utils import ROIMRIInputData
+
+_noise_std = 20
+
+
+class NoiseStdEstimationTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_noise_std_estimation_test')
+        self._signal4d, self._protocol, self._mask = _get_phantom()
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_estimators(self):
+        # the mean of the uncorrected std over the six unweighted volumes underestimates the noise std by about 13%
+        expected = {'unweighted_std': _noise_std * gamma(3) / gamma(2.5) * np.sqrt(2 / 5.) * np.sqrt(5 / 6.),
+                    'unweighted_mad': _noise_std,
+                    'background': _noise_std}
+        for method, expected_std in expected.items():
+            noise_std = estimate_noise_std_in_slabs(self._signal4d, self._protocol, self._mask, method=method)
+            assert_allclose(noise_std, expected_std, rtol=0.05, err_msg=method)
+
+    def test_unweighted_std_equals_whole_volume(self):
+        dwi_fname = os.path.join(self._tmp_dir, 'dwi.nii.gz')
+        write_nifti(self._signal4d, dwi_fname)
+
+        expected = _camino_noise_std(self._signal4d, self._protocol, self._mask)
+        assert_allclose(estimate_noise_std_in_slabs(dwi_fname, self._protocol, self._mask, slab_thickness=3), expected)
+
+        input_data = mdt.load_input_data((self._signal4d, None), self._protocol, self._mask)
+        assert_allclose(mdt.estimate_noise_std(input_data), expected)
+
+    def test_noise_map(self):
+        noise_map = estimate_noise_std_in_slabs(self._signal4d, self._protocol, self._mask, noise_map=True,
+                                                slab_thickness=4, min_nmr_samples=1)
+        self.assertEqual(noise_map.shape, self._mask.shape)
+
+        for start in range(0, self._mask.shape[2], 4):
+            slab = slice(start, start + 4)
+            if np.any(self._mask[:, :, slab]):
+                assert_allclose(noise_map[:, :, slab], _camino_noise_std(
+                    self._signal4d[:, :, slab], self._protocol, self._mask[:, :, slab]))
+
+    def test_background_requires_complete_volume(self):
+        input_data = mdt.load_input_data((self._signal4d, None), self._protocol, self._mask)
+        assert_allclose(mdt.estimate_noise_std(input_data, method='background'), _noise_std, rtol=0.05)
+
+        roi_input_data = ROIMRIInputData(self._protocol, self._signal4d[self._mask], self._mask, None)
+        with self.assertRaises(NoiseStdEstimationNotPossible):
+            mdt.estimate_noise_std(roi_input_data, method='background')
+        assert_allclose(mdt.estimate_noise_std(roi_input_data), mdt.estimate_noise_std(input_data))
+
+    def test_not_enough_unweighted_volumes(self):
+        protocol = Protocol({'b': np.r_[0, np.full(self._protocol.length - 1, 1e9)],
+                             'g': self._protocol.get_column('g')})
+        for method in ['unweighted_std', 'unweighted_mad']:
+            with self.assertRaises(NoiseStdEstimationNotPossible):
+                estimate_noise_std_in_slabs(self._signal4d, protocol, self._mask, method=method)
+
+
+def _get_phantom(shape=(30, 30, 20), nmr_unweighted=6, nmr_weighted=12):
+    """An ellipsoid with a mono-exponential decay, with Rician noise."""
+    b = np.r_[np.zeros(nmr_unweighted), np.full(nmr_weighted, 1e9)]
+
+    coordinates = np.meshgrid(*[np.linspace(-1, 1, length) for length in shape], indexing='ij')
+    mask = sum((x / 0.7) ** 2 for x in coordinates) < 1
+
+    rng = np.random.RandomState(0)
+    signal = mask[..., None] * 1000 * np.exp(-b * rng.uniform(0.5e-9, 2e-9, shape)[..., None])
+    signal4d = np.hypot(signal + rng.normal(0, _noise_std, signal.shape), rng.normal(0, _noise_std, signal.shape))
+    g = rng.normal(size=(len(b), 3))
+    g /= np.linalg.norm(g, axis=1)[:, None]
+    return signal4d, Protocol({'b': b, 'g': g}), mask
+
+
+def _camino_noise_std(signal4d, protocol, mask):
+    """The mean over the voxels in the mask of the std over the unweighted volumes."""
+    return np.mean(np.std(signal4d[mask][:, protocol.get_unweighted_indices()], axis=1))
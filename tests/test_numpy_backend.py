@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_numpy_backend
+----------------------------------
+
+Tests for the NumPy compute backend, comparing it against the OpenCL implementation.
+"""
+import unittest
+import numpy as np
+from numpy.testing import assert_allclose
+from mot.cl_routines import compute_log_likelihood
+
+import mdt
+from mdt.lib.exceptions import NumpyBackendNotSupported
+from mdt.lib.processing_strategies import _numpy_optimizer_supported
+from mdt.protocols import Protocol
+from mdt.utils import VoxelListMRIInputData
+
+
+class NumpyBackendTest(unittest.TestCase):
+
+    def test_log_likelihoods(self):
+        for model_name in ['BallStick_r1', 'Tensor']:
+            model, parameters = _get_model(model_name)
+            self._assert_log_likelihoods_equal(model, parameters)
+
+    def test_log_likelihoods_with_volume_weights(self):
+        model, parameters = _get_model('BallStick_r1', use_volume_weights=True)
+        self._assert_log_likelihoods_equal(model, parameters)
+
+        voxels = np.array([1, 4, 5])
+        with model.voxels_to_analyze_context(voxels):
+            self._assert_log_likelihoods_equal(model, parameters[voxels])
+
+    def test_dependencies(self):
+        backend = _get_model('BallStick_r1')[0].get_numpy_backend()
+        a = np.array([1., 2.])
+        assert_allclose(eval(backend._compile_dependency('x', '1 - exp(-a) * (double)2'), {'exp': np.exp, 'a': a}),
+                        1 - np.exp(-a) * 2)
+
+        for code in ['a.__class__', '__import__("os")', 'a[0]', 'open("file")', 'exp(x=a)', '(lambda: 1)()']:
+            with self.assertRaises(NumpyBackendNotSupported):
+                backend._compile_dependency('x', code)
+
+    def test_optimizer_methods(self):
+        self.assertTrue(_numpy_optimizer_supported('Nelder-Mead', None))
+        self.assertTrue(_numpy_optimizer_supported('Nelder-Mead', {'patience': 10}))
+        self.assertFalse(_numpy_optimizer_supported('Nelder-Mead', {'alpha': 2}))
+        self.assertFalse(_numpy_optimizer_supported('Powell', None))
+
+    def _assert_log_likelihoods_equal(self, model, parameters):
+        backend = model.get_numpy_backend()
+        self.assertIsNotNone(backend)
+        cl_lls = compute_log_likelihood(model.get_log_likelihood_function(), parameters,
+                                        data=model.get_kernel_data())
+        assert_allclose(backend.get_log_likelihoods(parameters), cl_lls, rtol=1e-4)
+
+
+def _get_model(model_name, use_volume_weights=False):
+    rng = np.random.RandomState(0)
+    nmr_voxels, nmr_volumes = 8, 40
+
+    b = np.repeat([0, 1e9, 2e9, 3e9], nmr_volumes // 4)
+    g = rng.normal(size=(nmr_volumes, 3))
+    g /= np.linalg.norm(g, axis=1)[:, None]
+    protocol = Protocol({'b': b, 'g': g, 'G': np.full(nmr_volumes, 0.04), 'Delta': np.full(nmr_volumes, 0.03),
+                         'delta': np.full(nmr_volumes, 0.01), 'TE': np.full(nmr_volumes, 0.08)})
+
+    observations = 1000 * np.exp(-b[None, :] * rng.uniform(0.5e-9, 2e-9, (nmr_voxels, 1)))
+    observations += rng.normal(0, 20, observations.shape)
+
+    volume_weights = None
+    if use_volume_weights:
+        volume_weights = rng.uniform(0, 1, (nmr_voxels, nmr_volumes))
+
+    model = mdt.get_model(model_name)()
+    model.set_input_data(VoxelListMRIInputData(protocol, observations, noise_std=20,
+                                               volume_weights=volume_weights))
+
+    parameters = model.get_initial_parameters().astype(np.float64)
+    parameters *= rng.uniform(0.9, 1.1, parameters.shape)
+    return model, parameters
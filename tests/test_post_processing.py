@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_post_processing
+----------------------------------
+
+Tests for the post-processing of the model fit results.
+"""
+import unittest
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+from scipy.special import dawsn
+
+from mdt.lib.post_processing import _tau_to_kappa, DTIMeasures, DKIMeasures, _tabesh_f1, _tabesh_f2, _tabesh_g1, \
+    _tabesh_g2
+from mdt.utils import tensor_spherical_to_cartesian, tensor_cartesian_to_spherical, PackedCovariances
+
+
+class TauToKappaTest(unittest.TestCase):
+
+    def test_inverse(self):
+        kappa = np.linspace(0.1, 63, 50)
+        sqrt_kappa = np.sqrt(kappa)
+        tau = 0.5 * (1 / (sqrt_kappa * dawsn(sqrt_kappa)) - 1 / kappa)
+        assert_allclose(_tau_to_kappa(tau), kappa, rtol=1e-6)
+
+    def test_out_of_range(self):
+        assert_array_equal(_tau_to_kappa(np.array([0, 0.2, 0.99, 1])), 1)
+
+
+class DTIMeasuresTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        nmr_voxels = 1000
+        self._results = {'d': rng.uniform(0.1e-9, 3e-9, nmr_voxels),
+                         'dperp0': rng.uniform(0.1e-9, 3e-9, nmr_voxels),
+                         'dperp1': rng.uniform(0.1e-9, 3e-9, nmr_voxels),
+                         'theta': rng.uniform(0, np.pi, nmr_voxels),
+                         'phi': rng.uniform(0, np.pi, nmr_voxels),
+                         'psi': rng.uniform(0, np.pi, nmr_voxels)}
+
+        factors = rng.normal(0, 1e-10, (nmr_voxels, 3, 3))
+        self._covariance_matrices = np.einsum('nij,nkj->nik', factors, factors)
+        for ind, name in enumerate(['d', 'dperp0', 'dperp1']):
+            self._results[name + '.std'] = np.sqrt(self._covariance_matrices[:, ind, ind])
+
+        # equal eigenvalues, for which the FA gradient is undefined
+        self._results['dperp0'][:5] = self._results['d'][:5]
+        self._results['dperp1'][:5] = self._results['d'][:5]
+
+    def test_equals_per_measure(self):
+        rows, columns = np.triu_indices(3)
+        covariances = PackedCovariances(self._covariance_matrices[:, rows, columns], ['d', 'dperp0', 'dperp1'])
+
+        for max_batch_size in [7, 2 ** 16]:
+            output = DTIMeasures.compute_measures(
+                self._results['d'], self._results['dperp0'], self._results['dperp1'],
+                theta=self._results['theta'], phi=self._results['phi'], psi=self._results['psi'],
+                stds=[self._results[name + '.std'] for name in ['d', 'dperp0', 'dperp1']],
+                covariances=covariances, sort_eigensystem=True, dtype=np.float64, max_batch_size=max_batch_size)
+
+            expected = _old_measures(self._results, self._covariance_matrices)
+            for name in ['FA', 'MD', 'AD', 'RD', 'FA.std', 'MD.std', 'AD.std', 'RD.std', 'vec0', 'vec1', 'vec2']:
+                assert_allclose(output[name], expected[name], rtol=1e-7, atol=1e-20, err_msg=name)
+
+            sorted_eigenvalues, sorted_eigenvectors, ranking = _old_sort_eigensystem(self._results)
+            assert_array_equal(output['ranking'], ranking)
+            assert_allclose(output['sorted_eigenvalues'], sorted_eigenvalues)
+            assert_allclose(output['sorted_eigenvectors'], sorted_eigenvectors, atol=1e-12)
+
+            theta, phi, psi = tensor_cartesian_to_spherical(sorted_eigenvectors[0], sorted_eigenvectors[1])
+            assert_allclose(output['sorted_theta'], theta, atol=1e-10)
+            assert_allclose(output['sorted_phi'], phi, atol=1e-10)
+            assert_allclose(output['sorted_psi'], psi, atol=1e-10)
+
+    def test_extra_optimization_maps(self):
+        output = DTIMeasures.extra_optimization_maps(self._results)
+        expected = _old_measures(self._results, np.eye(3) * self._covariance_matrices)
+
+        for name in ['FA', 'MD', 'AD', 'RD', 'FA.std', 'MD.std', 'AD.std', 'RD.std', 'vec0', 'vec1', 'vec2']:
+            self.assertEqual(output[name].dtype, np.float32)
+            assert_allclose(output[name], expected[name], rtol=1e-5, atol=1e-15, err_msg=name)
+
+    def test_fractional_anisotropy_std(self):
+        diagonal_matrices = np.eye(3) * self._covariance_matrices
+        assert_allclose(DTIMeasures.fractional_anisotropy_std(
+            self._results['d'], self._results['dperp0'], self._results['dperp1'],
+            self._results['d.std'], self._results['dperp0.std'], self._results['dperp1.std']),
+            _old_measures(self._results, diagonal_matrices)['FA.std'], rtol=1e-7)
+
+
+
+class DKIMeasuresTest(unittest.TestCase):
+
+    def test_closed_form_equals_quadrature(self):
+        rng = np.random.RandomState(0)
+        eigenvalues = np.sort(rng.uniform(0.2e-9, 3e-9, (200, 3)), axis=1)[:, ::-1]
+
+        # near-equal and equal eigenvalues, covering the limits of the Tabesh functions
+        base = rng.uniform(0.2e-9, 3e-9, (10, 1))
+        for relative_difference in [0, 1e-7, 1e-5, 1e-3]:
+            for pattern in [[1, 1, 0.5], [1, 0.5, 0.5], [1, 1, 1]]:
+                values = base * np.array(pattern)
+                values[:, 1] *= 1 - relative_difference
+                eigenvalues = np.concatenate([eigenvalues, values])
+
+        parameters = _get_kurtosis_parameters(rng, eigenvalues)
+        closed_form = DKIMeasures.compute_measures(parameters, method='closed_form')
+        quadrature = DKIMeasures.compute_measures(parameters, method='quadrature', quadrature_order=32)
+
+        assert_allclose(closed_form['MK'], quadrature['MK'], rtol=1e-4, atol=1e-5)
+
+        # with a repeated largest eigenvalue, the first eigenvector and hence AK and RK are not uniquely defined
+        sorted_eigenvalues = np.sort(eigenvalues, axis=1)
+        unique_first = sorted_eigenvalues[:, 2] - sorted_eigenvalues[:, 1] > 1e-6 * sorted_eigenvalues[:, 2]
+        for name in ['AK', 'RK']:
+            assert_allclose(closed_form[name][unique_first], quadrature[name][unique_first],
+                            rtol=1e-4, atol=1e-5, err_msg=name)
+
+    def test_tabesh_limits(self):
+        a = np.array([1., 1., 2., 0.5])
+        b = np.array([1., 0.4, 0.7, 1.3])
+
+        for relative_difference in [2e-5, 1e-4]:
+            close = b * (1 + relative_difference)
+            assert_allclose(_tabesh_f1(a, b, close), _tabesh_f1(a, b, b), rtol=1e-3)
+            assert_allclose(_tabesh_f1(a, a * (1 + relative_difference), b), _tabesh_f1(a, a, b), rtol=1e-3)
+            assert_allclose(_tabesh_f2(a, b, close), _tabesh_f2(a, b, b), rtol=1e-3)
+            assert_allclose(_tabesh_g1(a, b, close), _tabesh_g1(a, b, b), rtol=1e-3)
+            assert_allclose(_tabesh_g2(a, b, close), _tabesh_g2(a, b, b), rtol=1e-3)
+
+        assert_allclose(_tabesh_f1(a, a, a), 1 / 5.)
+        assert_allclose(_tabesh_f2(a, a, a), 6 / 15.)
+
+
+def _old_measures(results, covariance_matrices):
+    """The Tensor measures as computed one measure at the time, before the measures were computed in one pass.
+
+    This uses the full gradient of the FA and the full covariance matrices for the error propagation. The MD.std and
+    RD.std use the same error propagation as the FA.std.
+    """
+    d, dperp0, dperp1 = (results[name].astype(np.float64) for name in ['d', 'dperp0', 'dperp1'])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        denominator = (2 * (d ** 2 + dperp0 ** 2 + dperp1 ** 2) ** (3 / 2.)
+                       * np.sqrt(d ** 2 - d * (dperp0 + dperp1) + dperp0 ** 2 - dperp0 * dperp1 + dperp1 ** 2))
+        fa_gradient = np.stack([
+            (d ** 2 * (dperp0 + dperp1) + 2 * d * dperp0 * dperp1 - dperp0 ** 3
+             - dperp0 ** 2 * dperp1 - dperp0 * dperp1 ** 2 - dperp1 ** 3) / denominator,
+            (-d ** 3 - d ** 2 * dperp1 + d * (dperp0 ** 2 + 2 * dperp0 * dperp1 - dperp1 ** 2)
+             + dperp1 * (dperp0 ** 2 - dperp1 ** 2)) / denominator,
+            (-d ** 3 - d ** 2 * dperp0 + d * (-dperp0 ** 2 + 2 * dperp0 * dperp1 + dperp1 ** 2)
+             - dperp0 ** 3 + dperp0 * dperp1 ** 2) / denominator], axis=-1)
+
+    def propagate(gradient):
+        gradient = np.broadcast_to(gradient, (d.shape[0], 3))
+        return np.sqrt(np.einsum('ni,nij,nj->n', gradient, covariance_matrices, gradient))
+
+    eigenvectors = tensor_spherical_to_cartesian(results['theta'], results['phi'], results['psi'])
+    return {
+        'FA': DTIMeasures.fractional_anisotropy(d, dperp0, dperp1),
+        'MD': (d + dperp0 + dperp1) / 3.,
+        'AD': d,
+        'RD': (dperp0 + dperp1) / 2.,
+        'FA.std': np.nan_to_num(propagate(fa_gradient)),
+        'MD.std': propagate([1 / 3., 1 / 3., 1 / 3.]),
+        'AD.std': results['d.std'],
+        'RD.std': propagate([0, 1 / 2., 1 / 2.]),
+        'vec0': eigenvectors[0], 'vec1': eigenvectors[1], 'vec2': eigenvectors[2]
+    }
+
+
+def _old_sort_eigensystem(results):
+    """The eigensystem sorting as it was before it was computed by :meth:`DTIMeasures.compute_measures`."""
+    eigenvectors = np.stack(tensor_spherical_to_cartesian(results['theta'], results['phi'], results['psi']), axis=0)
+    eigenvalues = np.stack([results['d'], results['dperp0'], results['dperp1']], axis=1)
+
+    ranking = np.argsort(eigenvalues, axis=1, kind='mergesort')[:, ::-1]
+    voxels_range = np.arange(ranking.shape[0])
+    sorted_eigenvalues = np.stack([eigenvalues[voxels_range, ranking[:, ind]] for ind in range(3)], axis=1)
+    sorted_eigenvectors = np.stack([eigenvectors[ranking[:, ind], voxels_range, :] for ind in range(3)])
+    return sorted_eigenvalues, sorted_eigenvectors, ranking
+
+
+def _get_kurtosis_parameters(rng, eigenvalues):
+    """Random Kurtosis tensor parameters for the given (n, 3) eigenvalues, given in random order."""
+    nmr_voxels = eigenvalues.shape[0]
+    eigenvalues = eigenvalues[np.arange(nmr_voxels)[:, None], np.argsort(rng.uniform(size=(nmr_voxels, 3)), axis=1)]
+
+    parameters = {'d': eigenvalues[:, 0], 'dperp0': eigenvalues[:, 1], 'dperp1': eigenvalues[:, 2],
+                  'theta': rng.uniform(0, np.pi, nmr_voxels), 'phi': rng.uniform(0, np.pi, nmr_voxels),
+                  'psi': rng.uniform(0, np.pi, nmr_voxels)}
+    for name in DKIMeasures.parameter_names[6:]:
+        if name in ('W_0000', 'W_1111', 'W_2222'):
+            parameters[name] = rng.uniform(0.2, 1, nmr_voxels)
+        else:
+            parameters[name] = rng.uniform(-0.05, 0.05, nmr_voxels)
+    return parameters
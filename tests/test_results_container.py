@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_results_container
+----------------------------------
+
+Tests for writing, reading and masking the results containers.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import nibabel as nib
+import numpy as np
+from numpy.testing import assert_array_equal
+
+import mdt
+from mdt.lib.components import get_model
+from mdt.lib.nifti import get_all_nifti_data, load_nifti
+from mdt.lib.results_container import ResultsContainerWriter, ResultsContainer, RESULTS_CONTAINER_NAME, \
+    find_results_container
+from mdt.utils import model_output_exists, load_covariances, write_covariances_order, create_roi
+
+
+class ResultsContainerTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_results_container_test')
+        self._container_path = os.path.join(self._tmp_dir, RESULTS_CONTAINER_NAME)
+
+        rng = np.random.RandomState(0)
+        self._mask = rng.uniform(size=(6, 5, 4)) > 0.3
+        self._maps = {'a': rng.normal(size=self._mask.shape),
+                      'b': rng.normal(size=self._mask.shape + (3,)).astype(np.float32),
+                      'univariate_normal/a': rng.normal(size=self._mask.shape)}
+        self._header = nib.Nifti2Header()
+        self._header.set_data_shape(self._mask.shape)
+        self._header.set_zooms((2., 2, 3))
+
+        with ResultsContainerWriter(self._container_path, self._mask, nifti_header=self._header,
+                                    chunk_size=7) as writer:
+            writer.add_map('a', self._maps['a'])
+            writer.add_map('b', self._maps['b'][self._mask])
+            writer.add_map('univariate_normal/a', self._maps['univariate_normal/a'])
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_read(self):
+        with ResultsContainer(self._container_path) as container:
+            self.assertEqual(sorted(container.map_names), ['a', 'b', 'univariate_normal/a'])
+            self.assertEqual(container.nmr_voxels, np.count_nonzero(self._mask))
+            assert_array_equal(container.mask, self._mask)
+            self.assertEqual(container.nifti_header.get_zooms(), (2., 2, 3))
+
+            for name, volume in self._maps.items():
+                expected = volume * np.reshape(self._mask, self._mask.shape + (1,) * (volume.ndim - 3))
+                assert_array_equal(container.get_volume(name), expected)
+                self.assertEqual(container.get_volume(name).dtype, volume.dtype)
+                assert_array_equal(container.get_roi(name), volume[self._mask])
+
+                roi_indices = [20, 0, 8, 7, 6]
+                assert_array_equal(container.get_roi(name, roi_indices), volume[self._mask][roi_indices])
+
+            self.assertEqual(sorted(container.get_maps()), ['a', 'b'])
+            self.assertEqual(list(container.get_maps(subdir='univariate_normal')), ['a'])
+
+    def test_masked_loading(self):
+        mask = np.zeros_like(self._mask)
+        mask[1:4, 2:, 1:3] = True
+
+        rois = get_all_nifti_data(self._tmp_dir, mask=mask)
+        self.assertEqual(sorted(rois), ['a', 'b'])
+        for name in ['a', 'b']:
+            assert_array_equal(rois[name], (self._maps[name] * self._mask.reshape(
+                self._mask.shape + (1,) * (self._maps[name].ndim - 3)))[mask])
+
+        rois = mdt.load_volume_maps(os.path.join(self._tmp_dir, 'univariate_normal'), mask=mask)
+        assert_array_equal(rois['a'], (self._maps['univariate_normal/a'] * self._mask)[mask])
+
+        rois = create_roi(self._tmp_dir, self._mask)
+        assert_array_equal(rois['a'], self._maps['a'][self._mask][:, None])
+
+    def test_find_and_export(self):
+        self.assertEqual(find_results_container(self._tmp_dir), (self._container_path, ''))
+        self.assertEqual(find_results_container(os.path.join(self._tmp_dir, 'univariate_normal')),
+                         (self._container_path, 'univariate_normal'))
+        self.assertIsNone(find_results_container(os.path.join(self._tmp_dir, '..')))
+
+        output_dir = os.path.join(self._tmp_dir, 'export')
+        mdt.export_results_container(self._tmp_dir, output_dir, gzip=False)
+        self.assertTrue(os.path.isfile(os.path.join(output_dir, 'univariate_normal', 'a.nii')))
+
+        nifti = load_nifti(os.path.join(output_dir, 'b.nii'))
+        assert_array_equal(nifti.get_data(), self._maps['b'] * self._mask[..., None])
+        self.assertEqual(nifti.header.get_zooms()[:3], (2., 2, 3))
+
+    def test_write_failure(self):
+        path = os.path.join(self._tmp_dir, 'failed', RESULTS_CONTAINER_NAME)
+        with self.assertRaises(RuntimeError):
+            with ResultsContainerWriter(path, self._mask) as writer:
+                writer.add_map('a', self._maps['a'])
+                raise RuntimeError()
+        self.assertEqual(os.listdir(os.path.dirname(path)), [])
+
+    def test_covariances(self):
+        param_names = ['p0', 'p1']
+        packed = np.random.RandomState(1).normal(size=self._mask.shape + (3,))
+
+        output_dir = os.path.join(self._tmp_dir, 'model')
+        with ResultsContainerWriter(os.path.join(output_dir, RESULTS_CONTAINER_NAME), self._mask) as writer:
+            writer.add_map('covariances', packed)
+        write_covariances_order(output_dir, param_names)
+
+        covariances = load_covariances(output_dir, brain_mask=self._mask)
+        self.assertEqual(covariances.param_names, param_names)
+        assert_array_equal(covariances.packed, packed[self._mask])
+        assert_array_equal(covariances['p0_to_p1'], packed[self._mask][:, 1])
+
+    def test_model_output_exists(self):
+        model = get_model('BallStick_r1')()
+        output_dir = os.path.join(self._tmp_dir, 'BallStick_r1')
+        param_names = model.get_free_param_names()
+
+        with ResultsContainerWriter(os.path.join(output_dir, RESULTS_CONTAINER_NAME), self._mask) as writer:
+            for name in param_names[:-1]:
+                writer.add_map(name, self._maps['a'])
+        self.assertFalse(model_output_exists(model, self._tmp_dir))
+
+        with ResultsContainerWriter(os.path.join(output_dir, RESULTS_CONTAINER_NAME), self._mask) as writer:
+            for name in param_names:
+                writer.add_map(name, self._maps['a'])
+        self.assertTrue(model_output_exists(model, self._tmp_dir))
+        self.assertTrue(model_output_exists('BallStick_r1', output_dir, append_model_name_to_path=False))
+
+
+if __name__ == '__main__':
+    unittest.main()
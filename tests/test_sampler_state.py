@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_sampler_state
+----------------------------------
+
+Tests for storing the sampler state and continuing existing chains.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from numpy.testing import assert_array_equal
+
+import mdt
+from mdt.configuration import config_context, YamlStringAction
+from mdt.lib.sampler_state import get_sampler_state, apply_sampler_state, write_sampler_state, load_sampler_state, \
+    has_sampler_state
+from mdt.protocols import Protocol
+
+
+class SamplerStateTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_sampler_state_test')
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_write_and_load(self):
+        rng = np.random.RandomState(0)
+        state = {'current_chain_position': rng.normal(size=(10, 4)),
+                 'rng_state': rng.randint(0, 100, size=(10, 6)).astype(np.uint32),
+                 'sampling_index': np.full(10, 25, dtype=np.uint64)}
+
+        self.assertFalse(has_sampler_state(self._tmp_dir))
+        write_sampler_state(self._tmp_dir, {k: v[:6] for k, v in state.items()}, np.arange(6), 10)
+        write_sampler_state(self._tmp_dir, {k: v[6:] for k, v in state.items()}, np.arange(6, 10), 10)
+        self.assertTrue(has_sampler_state(self._tmp_dir))
+
+        loaded = load_sampler_state(self._tmp_dir)
+        self.assertEqual(sorted(loaded), sorted(state))
+        for name, value in state.items():
+            assert_array_equal(loaded[name], value)
+            self.assertEqual(loaded[name].dtype, value.dtype)
+
+        roi_indices = np.array([7, 2, 3])
+        for name, value in load_sampler_state(self._tmp_dir, roi_indices).items():
+            assert_array_equal(value, state[name][roi_indices])
+
+    def test_get_and_apply(self):
+        sampler = _Sampler(np.arange(12.).reshape(4, 3), sampling_index=30)
+        state = get_sampler_state(sampler)
+        self.assertEqual(sorted(state), ['current_chain_position', 'proposal_stds', 'sampling_index'])
+        assert_array_equal(state['sampling_index'], np.full(4, 30))
+
+        new_sampler = _Sampler(np.zeros((4, 3)), sampling_index=0)
+        new_sampler._acceptance_counter = np.ones((4, 3))
+        apply_sampler_state(new_sampler, state)
+
+        assert_array_equal(new_sampler._current_chain_position, sampler._current_chain_position)
+        assert_array_equal(new_sampler._proposal_stds, sampler._proposal_stds)
+        assert_array_equal(new_sampler._acceptance_counter, np.ones((4, 3)))
+        self.assertEqual(new_sampler._sampling_index, 30)
+
+    def test_continued_chain_equals_single_run(self):
+        input_data = _get_input_data()
+
+        with config_context(YamlStringAction('numpy_backend: {enabled: True}')):
+            np.random.seed(0)
+            mdt.sample_model('BallStick_r1', input_data, os.path.join(self._tmp_dir, 'single'),
+                             nmr_samples=60, burnin=5, method='AMWG')
+
+            np.random.seed(0)
+            continued_dir = os.path.join(self._tmp_dir, 'continued')
+            mdt.sample_model('BallStick_r1', input_data, continued_dir, nmr_samples=40, burnin=5, method='AMWG')
+            mdt.sample_model('BallStick_r1', input_data, continued_dir, nmr_samples=20, method='AMWG',
+                             continue_from=continued_dir)
+
+        single = mdt.load_samples(os.path.join(self._tmp_dir, 'single', 'BallStick_r1', 'samples'))
+        continued = mdt.load_samples(os.path.join(continued_dir, 'BallStick_r1', 'samples'))
+
+        self.assertEqual(sorted(single), sorted(continued))
+        for name in single:
+            self.assertEqual(continued[name].shape, (6, 60))
+            assert_array_equal(continued[name], single[name])
+
+
+class _Sampler:
+
+    def __init__(self, chain_position, sampling_index):
+        """Mimics the attributes of a MOT sampler."""
+        self._nmr_problems = chain_position.shape[0]
+        self._current_chain_position = chain_position
+        self._proposal_stds = chain_position * 2
+        self._sampling_index = sampling_index
+
+
+def _get_input_data():
+    rng = np.random.RandomState(0)
+    b = np.repeat([0, 1e9, 2e9, 3e9], 10)
+    g = rng.normal(size=(40, 3))
+    g /= np.linalg.norm(g, axis=1)[:, None]
+
+    signal4d = 1000 * np.exp(-b * rng.uniform(0.5e-9, 2e-9, (2, 3, 1, 1))) + rng.normal(0, 20, (2, 3, 1, 40))
+    return mdt.load_input_data((signal4d, None), Protocol({'b': b, 'g': g}), np.ones((2, 3, 1), dtype=bool),
+                               noise_std=20)
+
+
+if __name__ == '__main__':
+    unittest.main()
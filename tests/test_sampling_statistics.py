@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_sampling_statistics
+----------------------------------
+
+Tests for the running statistics over MCMC chains, comparing them against the statistics of the full chain.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+
+import mdt
+from mdt.configuration import config_context, YamlStringAction
+from mdt.lib.nifti import yield_nifti_info
+from mdt.lib.sampling_statistics import RunningSampleStatistics
+from mdt.protocols import Protocol
+
+
+class RunningSampleStatisticsTest(unittest.TestCase):
+
+    def test_equals_batch_statistics(self):
+        rng = np.random.RandomState(0)
+        samples, log_likelihoods, log_priors = _get_chain(rng, 5, 3, 230)
+        log_posteriors = log_likelihoods + log_priors
+
+        for batch_size in [1, 7, 100, 230, 1000]:
+            statistics = RunningSampleStatistics(5, 3)
+            for start in range(0, 230, batch_size):
+                batch = slice(start, start + batch_size)
+                statistics.update(samples[..., batch], log_likelihoods[:, batch], log_priors[:, batch])
+
+            self.assertEqual(statistics.nmr_samples, 230)
+            assert_allclose(statistics.mean, np.mean(samples, axis=2))
+            assert_allclose(statistics.std, np.std(samples, axis=2))
+            assert_allclose(statistics.acceptance_rate,
+                            np.count_nonzero(np.diff(samples, axis=2), axis=2) / 230.)
+
+            for (max_samples, max_values, max_indices), values in [(statistics.maximum_likelihood, log_likelihoods),
+                                                                   (statistics.maximum_a_posteriori, log_posteriors)]:
+                indices = np.argmax(values, axis=1)
+                assert_array_equal(max_indices, indices)
+                assert_array_equal(max_values, values[range(5), indices])
+                assert_array_equal(max_samples, samples[range(5), :, indices])
+
+
+class RunningStatisticsSamplingTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_sampling_statistics_test')
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_equals_full_chain_maps(self):
+        """Storing only some of the samples uses the running statistics, which should give the same maps."""
+        input_data = _get_input_data()
+        post_processing = {'model_defined_maps': False, 'maximum_likelihood': True, 'maximum_a_posteriori': True,
+                           'average_acceptance_rate': True, 'univariate_normal': True}
+
+        with config_context(YamlStringAction('numpy_backend: {enabled: True}')):
+            for name, store_samples in [('full_chain', True), ('running', [0, 10, 20])]:
+                np.random.seed(0)
+                mdt.sample_model('BallStick_r1', input_data, os.path.join(self._tmp_dir, name),
+                                 nmr_samples=50, burnin=5, method='AMWG', store_samples=store_samples,
+                                 post_processing=post_processing)
+
+        full_chain_maps = _load_output_maps(os.path.join(self._tmp_dir, 'full_chain', 'BallStick_r1', 'samples'))
+        running_maps = _load_output_maps(os.path.join(self._tmp_dir, 'running', 'BallStick_r1', 'samples'))
+
+        self.assertEqual(sorted(running_maps), sorted(full_chain_maps))
+        for name in ['univariate_normal/S0.s0.std', 'maximum_likelihood/S0.s0', 'maximum_a_posteriori/S0.s0',
+                     'average_acceptance_rate/S0.s0']:
+            self.assertIn(name, running_maps)
+        for name in full_chain_maps:
+            assert_allclose(running_maps[name], full_chain_maps[name], rtol=1e-5, atol=1e-6, err_msg=name)
+
+        running_samples = mdt.load_samples(os.path.join(self._tmp_dir, 'running', 'BallStick_r1', 'samples'))
+        full_chain_samples = mdt.load_samples(os.path.join(self._tmp_dir, 'full_chain', 'BallStick_r1', 'samples'))
+        for name in full_chain_samples:
+            assert_array_equal(running_samples[name], full_chain_samples[name][:, [0, 10, 20]])
+
+
+def _get_chain(rng, nmr_problems, nmr_params, nmr_samples):
+    """A random chain in which about half of the proposals are rejected."""
+    samples = rng.normal(size=(nmr_problems, nmr_params, nmr_samples))
+    rejected = rng.uniform(size=samples.shape) < 0.5
+    for ind in range(1, nmr_samples):
+        samples[..., ind] = np.where(rejected[..., ind], samples[..., ind - 1], samples[..., ind])
+    return samples, rng.normal(size=(nmr_problems, nmr_samples)), rng.normal(size=(nmr_problems, nmr_samples))
+
+
+def _load_output_maps(directory):
+    """Load all the nifti maps in the given directory and its subdirectories, by their relative path."""
+    maps = {}
+    for root, _, _ in os.walk(directory):
+        for path, map_name, _ in yield_nifti_info(root):
+            maps[os.path.relpath(os.path.join(root, map_name), directory)] = mdt.load_nifti(path).get_data()
+    return maps
+
+
+def _get_input_data():
+    rng = np.random.RandomState(0)
+    b = np.repeat([0, 1e9, 2e9, 3e9], 10)
+    g = rng.normal(size=(40, 3))
+    g /= np.linalg.norm(g, axis=1)[:, None]
+
+    signal4d = 1000 * np.exp(-b * rng.uniform(0.5e-9, 2e-9, (2, 3, 1, 1))) + rng.normal(0, 20, (2, 3, 1, 40))
+    return mdt.load_input_data((signal4d, None), Protocol({'b': b, 'g': g}), np.ones((2, 3, 1), dtype=bool),
+                               noise_std=20)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_simulation_study
+----------------------------------
+
+Tests for the Monte Carlo simulation studies.
+"""
+import unittest
+import numpy as np
+from numpy.testing import assert_allclose
+
+import mdt
+from mdt.lib.simulation_study import PolarAngleDistribution, _get_chunk_statistics, _statistics_to_results
+from mdt.protocols import Protocol
+
+
+class OrientationErrorTest(unittest.TestCase):
+
+    def test_orientation_angle(self):
+        param_names = ['S0.s0', 'Stick0.theta', 'Stick0.phi']
+        ground_truth = np.array([[1000, 0.5, 1.0],
+                                 [1000, np.pi / 2, 0.01],
+                                 [1000, 0.3, 2.0],
+                                 [1000, 1.2, 0.5]])
+        estimates = np.array([[1010, np.pi - 0.5, 1.0 + np.pi],  # antipodal
+                              [990, np.pi / 2, np.pi - 0.01],  # mirrored in the y-z plane, 0.02 apart
+                              [1000, 0.4, 2.0],  # 0.1 in theta
+                              [1000, 1.2 + np.pi / 2, 0.5]])  # perpendicular
+
+        results = _statistics_to_results({1: _get_chunk_statistics(param_names, estimates, ground_truth, 2)})[1]
+
+        self.assertEqual(list(results), ['S0.s0', 'Stick0.orientation'])
+        assert_allclose(results['S0.s0']['bias'], 0)
+        assert_allclose(results['S0.s0']['rmse'], np.sqrt(50))
+
+        angles = np.array([0, 0.02, 0.1, np.pi / 2])
+        assert_allclose(results['Stick0.orientation']['bias'], np.mean(angles), atol=1e-7)
+        assert_allclose(results['Stick0.orientation']['rmse'], np.sqrt(np.mean(angles ** 2)), atol=1e-7)
+        assert_allclose(results['Stick0.orientation']['variance'],
+                        np.mean([np.var(angles[:2], ddof=1), np.var(angles[2:], ddof=1)]), atol=1e-7)
+
+
+class SimulationStudyTest(unittest.TestCase):
+
+    def test_noise_free_study(self):
+        model = mdt.get_model('BallStick_r1')()
+        model.update_active_post_processing('optimization', {'uncertainties': False})
+
+        distributions = {'S0.s0': 1000, 'w_stick0.w': (0.3, 0.7),
+                         'Stick0.theta': PolarAngleDistribution(), 'Stick0.phi': (0, np.pi)}
+
+        results = [mdt.run_simulation_study(model, _get_protocol(), distributions, [1e5], nmr_simulations=6,
+                                            nmr_repetitions=2, chunk_size=chunk_size, seed=1,
+                                            method='Nelder-Mead', use_ground_truth_inits=True)
+                   for chunk_size in [4, 4, 100]]
+
+        for result in results:
+            self.assertEqual(list(result[1e5]), ['S0.s0', 'w_stick0.w', 'Stick0.orientation'])
+            for param_results in result[1e5].values():
+                self.assertEqual(param_results['nmr_voxels'], 12)
+
+            assert_allclose(result[1e5]['S0.s0']['mean'], 1000, rtol=1e-3)
+            assert_allclose(result[1e5]['S0.s0']['bias'], 0, atol=1)
+            assert_allclose(result[1e5]['w_stick0.w']['bias'], 0, atol=1e-3)
+            self.assertLess(result[1e5]['Stick0.orientation']['rmse'], 1e-2)
+
+        self.assertEqual(results[0], results[1])
+
+
+def _get_protocol():
+    rng = np.random.RandomState(0)
+    g = rng.normal(size=(30, 3))
+    g /= np.linalg.norm(g, axis=1)[:, None]
+    return Protocol({'b': np.r_[np.zeros(4), np.full(26, 2e9)], 'g': g})
+
+
+if __name__ == '__main__':
+    unittest.main()
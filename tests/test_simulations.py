@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_simulations
+----------------------------------
+
+Tests for the noise generation, its reproducibility and its distribution.
+"""
+import unittest
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+
+from mdt.simulations import add_noise, add_rician_noise
+
+
+class AddNoiseTest(unittest.TestCase):
+
+    def test_reproducible(self):
+        signals = np.random.RandomState(0).uniform(0, 100, (1000, 7))
+        for noise_type in ['gaussian', 'rician', 'noncentral_chi']:
+            with self.subTest(noise_type):
+                expected = add_noise(signals, 10, noise_type=noise_type, nmr_coils=3, seed=1, nmr_threads=1)
+                for nmr_threads, block_size in [(1, 1), (4, 7), (4, 100), (3, 1000), (2, 5000)]:
+                    assert_array_equal(add_noise(signals, 10, noise_type=noise_type, nmr_coils=3, seed=1,
+                                                 nmr_threads=nmr_threads, block_size=block_size), expected)
+
+                self.assertFalse(np.array_equal(
+                    add_noise(signals, 10, noise_type=noise_type, nmr_coils=3, seed=2), expected))
+
+    def test_subset_of_voxels(self):
+        signals = np.random.RandomState(0).uniform(0, 100, (100, 5))
+        noisy = add_noise(signals, 10, seed=1, block_size=30)
+        assert_array_equal(add_noise(signals[:40], 10, seed=1, block_size=7), noisy[:40])
+
+    def test_distributions(self):
+        signals = np.full((50000, 4), 50.)
+        noise_std = 10
+
+        gaussian = add_noise(signals, noise_std, noise_type='gaussian', seed=0)
+        assert_allclose(np.mean(gaussian), 50, atol=0.1)
+        assert_allclose(np.std(gaussian), noise_std, rtol=0.01)
+
+        # the second moment of the non-central chi distribution is the signal squared plus 2 * nmr_coils * std squared
+        for noise_type, nmr_coils in [('rician', 1), ('noncentral_chi', 4)]:
+            noisy = add_noise(signals, noise_std, noise_type=noise_type, nmr_coils=nmr_coils, seed=0)
+            self.assertTrue(np.all(noisy >= 0))
+            assert_allclose(np.mean(noisy ** 2), 50 ** 2 + 2 * nmr_coils * noise_std ** 2, rtol=0.01)
+
+    def test_noise_std_per_voxel(self):
+        signals = np.zeros((2, 3, 4, 5))
+        noise_std = np.reshape(np.arange(24), (2, 3, 4))
+
+        noisy = add_noise(signals, noise_std, noise_type='gaussian', seed=0)
+        self.assertEqual(noisy.shape, signals.shape)
+        assert_array_equal(noisy[noise_std == 0], 0)
+        assert_allclose(noisy, noise_std[..., None] * add_noise(signals, 1, noise_type='gaussian', seed=0))
+
+    def test_rician_noise(self):
+        signals = np.random.RandomState(0).uniform(0, 100, (10, 5)).astype(np.float32)
+        noisy = add_rician_noise(signals, 5, seed=0)
+        self.assertEqual(noisy.dtype, np.float32)
+        assert_array_equal(noisy, add_noise(signals, 5, noise_type='rician', seed=0))
+
+    def test_unknown_noise_type(self):
+        with self.assertRaises(ValueError):
+            add_noise(np.zeros((2, 2)), 1, noise_type='unknown')
+
+
+if __name__ == '__main__':
+    unittest.main()
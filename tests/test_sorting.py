@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_sorting
+----------------------------------
+
+Tests for the voxel-wise sorting of the orientations.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from mdt.lib.nifti import load_nifti, write_nifti
+from mdt.lib.sorting import sort_orientations, sort_orientations_in_directory, create_4d_sort_matrix, \
+    sort_volumes_per_voxel, undo_sort_volumes_per_voxel
+
+_weight_names = ['w0', 'w1', 'w2']
+_extra_sortable_maps = [['theta0', 'theta1', 'theta2'], ['vec0', 'vec1', 'vec2']]
+
+
+class SortOrientationsTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_sorting_test')
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_sort_orientations(self):
+        maps = _get_maps((6, 5, 4))
+        sorted_maps = sort_orientations(dict(maps), _weight_names, _extra_sortable_maps)
+
+        weights = np.stack([maps[name] for name in _weight_names], axis=-1)
+        order = np.argsort(-weights, axis=-1)
+        for names in _extra_sortable_maps + [_weight_names]:
+            stacked = np.stack([maps[name] for name in names], axis=weights.ndim - 1)
+            for rank, name in enumerate(names):
+                index = np.reshape(order[..., rank], order.shape[:-1] + (1,) * (stacked.ndim - order.ndim + 1))
+                expected = np.take_along_axis(stacked, index, axis=weights.ndim - 1)
+                assert_array_equal(sorted_maps[name], np.squeeze(expected, axis=weights.ndim - 1))
+
+    def test_blocks_equal_whole_volume(self):
+        maps = _get_maps((6, 5, 4))
+        expected = sort_orientations(dict(maps), _weight_names, _extra_sortable_maps)
+        blocked = sort_orientations(dict(maps), _weight_names, _extra_sortable_maps, max_block_size=100)
+        for name in expected:
+            assert_array_equal(blocked[name], expected[name])
+
+    def test_undo_sort(self):
+        maps = _get_maps((6, 5, 4))
+        sort_matrix = create_4d_sort_matrix([maps[name] for name in _weight_names], reversed_sort=True)
+        volumes = [maps[name] for name in _extra_sortable_maps[1]]
+        restored = undo_sort_volumes_per_voxel(sort_volumes_per_voxel(volumes, sort_matrix), sort_matrix)
+        for volume, original in zip(restored, volumes):
+            assert_array_equal(volume, original)
+
+    def test_niftis_in_directory(self):
+        maps = _get_maps((6, 5, 4))
+        for name, value in maps.items():
+            write_nifti(value, os.path.join(self._tmp_dir, name + '.nii.gz'))
+
+        expected = sort_orientations(dict(maps), _weight_names, _extra_sortable_maps)
+        sort_orientations_in_directory(self._tmp_dir, _weight_names, _extra_sortable_maps)
+        for name in maps:
+            loaded = load_nifti(os.path.join(self._tmp_dir, name + '.nii.gz')).get_data()
+            assert_array_equal(np.reshape(loaded, expected[name].shape), expected[name])
+
+    def test_samples_in_directory(self):
+        maps = {name: value for name, value in _get_maps((50, 20)).items() if not name.startswith('vec')}
+        for name, value in maps.items():
+            np.save(os.path.join(self._tmp_dir, name + '.samples.npy'), value)
+
+        expected = sort_orientations(dict(maps), _weight_names, _extra_sortable_maps[:1])
+        output_dir = os.path.join(self._tmp_dir, 'sorted')
+        sort_orientations_in_directory(self._tmp_dir, _weight_names, _extra_sortable_maps[:1],
+                                       output_directory=output_dir, max_block_size=1000)
+        sort_orientations_in_directory(self._tmp_dir, _weight_names, _extra_sortable_maps[:1], max_block_size=1000)
+
+        for name in maps:
+            assert_array_equal(np.load(os.path.join(output_dir, name + '.samples.npy')), expected[name])
+            assert_array_equal(np.load(os.path.join(self._tmp_dir, name + '.samples.npy')), expected[name])
+
+    def test_interrupted_in_place(self):
+        maps = _get_maps((6, 5, 4))
+        for name, value in maps.items():
+            write_nifti(value, os.path.join(self._tmp_dir, name + '.nii.gz'))
+        files = {name: _read_bytes(os.path.join(self._tmp_dir, name)) for name in os.listdir(self._tmp_dir)}
+
+        write_nifti_calls = []
+
+        def failing_write_nifti(*args, **kwargs):
+            write_nifti_calls.append(args)
+            if len(write_nifti_calls) > 4:
+                raise KeyboardInterrupt()
+            write_nifti(*args, **kwargs)
+
+        with mock.patch('mdt.lib.sorting.write_nifti', failing_write_nifti):
+            with self.assertRaises(KeyboardInterrupt):
+                sort_orientations_in_directory(self._tmp_dir, _weight_names, _extra_sortable_maps)
+
+        self.assertEqual(sorted(os.listdir(self._tmp_dir)), sorted(files))
+        for name, content in files.items():
+            self.assertEqual(_read_bytes(os.path.join(self._tmp_dir, name)), content)
+
+        samples_dir = os.path.join(self._tmp_dir, 'samples')
+        os.makedirs(samples_dir)
+        for name, value in maps.items():
+            np.save(os.path.join(samples_dir, name + '.samples.npy'), value)
+
+        with mock.patch('mdt.lib.sorting._sort_in_blocks', side_effect=KeyboardInterrupt()):
+            with self.assertRaises(KeyboardInterrupt):
+                sort_orientations_in_directory(samples_dir, _weight_names, _extra_sortable_maps)
+
+        self.assertEqual(sorted(os.listdir(samples_dir)), sorted(name + '.samples.npy' for name in maps))
+        for name, value in maps.items():
+            assert_array_equal(np.load(os.path.join(samples_dir, name + '.samples.npy')), value)
+
+
+def _read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _get_maps(shape):
+    rng = np.random.RandomState(0)
+    maps = {}
+    for ind in range(3):
+        maps['w{}'.format(ind)] = rng.uniform(size=shape).astype(np.float32)
+        maps['theta{}'.format(ind)] = rng.uniform(size=shape)
+        maps['vec{}'.format(ind)] = rng.uniform(size=shape + (3,)).astype(np.float32)
+    return maps
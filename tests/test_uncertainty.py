@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_uncertainty
+----------------------------------
+
+Tests for the error propagation on packed covariances, comparing against the full covariance matrices.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from numpy.testing import assert_allclose
+
+import mdt
+from mdt.lib.nifti import write_nifti
+from mdt.lib.uncertainty import propagate_variance, propagate_uncertainty, covariances_to_correlations
+from mdt.utils import PackedCovariances, write_covariances_order, create_covariance_matrix, load_covariances
+
+_param_names = ['a', 'b', 'c']
+
+
+class PropagateVarianceTest(unittest.TestCase):
+
+    def test_gradient_matrix(self):
+        rng = np.random.RandomState(0)
+        matrices = _get_covariance_matrices(rng, 20)
+        gradient = rng.normal(size=(20, 3))
+
+        expected = np.einsum('ni,nij,nj->n', gradient, matrices, gradient)
+        for max_batch_size in [1, 7, 20, 100]:
+            assert_allclose(propagate_variance(gradient, _pack(matrices), max_batch_size=max_batch_size), expected)
+
+    def test_broadcast_gradients(self):
+        rng = np.random.RandomState(0)
+        matrices = _get_covariance_matrices(rng, 20)
+        column = rng.normal(size=20)
+
+        expected = np.einsum('ni,nij,nj->n', np.tile([1., -2, 3], (20, 1)), matrices, np.tile([1., -2, 3], (20, 1)))
+        assert_allclose(propagate_variance(np.array([1., -2, 3]), _pack(matrices), max_batch_size=7), expected)
+
+        gradient = np.stack([column, np.full(20, -2.), np.zeros(20)], axis=1)
+        expected = np.einsum('ni,nij,nj->n', gradient, matrices, gradient)
+        assert_allclose(propagate_variance([column, -2, 0], _pack(matrices), max_batch_size=7), expected)
+
+    def test_volume(self):
+        rng = np.random.RandomState(0)
+        matrices = _get_covariance_matrices(rng, 24)
+        gradient = rng.normal(size=(24, 3))
+
+        covariances = PackedCovariances(np.reshape(_pack(matrices).packed, (2, 3, 4, -1)), _param_names)
+        variances = propagate_variance(gradient, covariances, max_batch_size=5)
+        self.assertEqual(variances.shape, (2, 3, 4))
+        assert_allclose(variances.ravel(), np.einsum('ni,nij,nj->n', gradient, matrices, gradient))
+
+    def test_propagate_uncertainty(self):
+        rng = np.random.RandomState(0)
+        matrices = _get_covariance_matrices(rng, 20)
+        parameters = {name: rng.uniform(1, 2, 20) for name in _param_names}
+
+        def gradient_func(a, b, c):
+            return {'ratio.std': [1 / b, -a / b ** 2, 0],
+                    'sum.std': np.array([1., 1, 1])}
+
+        stds = propagate_uncertainty(gradient_func, parameters, _pack(matrices), max_batch_size=7)
+
+        ratio_gradient = np.stack([1 / parameters['b'], -parameters['a'] / parameters['b'] ** 2, np.zeros(20)], axis=1)
+        assert_allclose(stds['ratio.std'], np.sqrt(np.einsum('ni,nij,nj->n', ratio_gradient, matrices,
+                                                             ratio_gradient)))
+        assert_allclose(stds['sum.std'], np.sqrt(np.sum(matrices, axis=(1, 2))))
+
+
+class CorrelationTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_uncertainty_test')
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_covariances_to_correlations(self):
+        matrices = _get_covariance_matrices(np.random.RandomState(0), 20)
+        stds = np.sqrt(np.diagonal(matrices, axis1=1, axis2=2))
+        expected = matrices / (stds[:, :, None] * stds[:, None, :])
+        assert_allclose(covariances_to_correlations(_pack(matrices)).get_matrix(), expected)
+
+    def test_covariance_to_correlation(self):
+        matrices = _get_covariance_matrices(np.random.RandomState(0), 24)
+        covariances = PackedCovariances(np.reshape(_pack(matrices).packed, (2, 3, 4, -1)), _param_names)
+
+        write_nifti(covariances.packed, os.path.join(self._tmp_dir, 'covariances.nii.gz'))
+        write_covariances_order(self._tmp_dir, _param_names)
+
+        for correlations in [mdt.covariance_to_correlation({'covariances': covariances}),
+                             mdt.covariance_to_correlation(self._tmp_dir)]:
+            self.assertEqual(sorted(correlations), ['Correlation_a_to_b', 'Correlation_a_to_c', 'Correlation_b_to_c'])
+            for (x, y) in [(0, 1), (0, 2), (1, 2)]:
+                expected = matrices[:, x, y] / np.sqrt(matrices[:, x, x] * matrices[:, y, y])
+                assert_allclose(np.ravel(correlations['Correlation_{}_to_{}'.format(_param_names[x], _param_names[y])]),
+                                expected, rtol=1e-5)
+
+    def test_create_covariance_matrix(self):
+        matrices = _get_covariance_matrices(np.random.RandomState(0), 20)
+        results = {name + '.std': np.sqrt(matrices[:, ind, ind]) for ind, name in enumerate(_param_names)}
+        covariance_maps = {'b_to_a': matrices[:, 0, 1], 'a_to_c': matrices[:, 0, 2], 'b_to_c': matrices[:, 1, 2]}
+
+        assert_allclose(create_covariance_matrix(results, _param_names, covariance_maps), matrices)
+        assert_allclose(create_covariance_matrix(results, _param_names, _pack(matrices)), matrices)
+
+
+class LoadCovariancesTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_uncertainty_test')
+        self._matrices = _get_covariance_matrices(np.random.RandomState(0), 24)
+        self._mask = np.reshape(np.arange(24) % 3 != 0, (2, 3, 4))
+
+        for ind, name in enumerate(_param_names):
+            write_nifti(np.reshape(np.sqrt(self._matrices[:, ind, ind]), (2, 3, 4)),
+                        os.path.join(self._tmp_dir, name + '.std.nii.gz'))
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_packed(self):
+        write_nifti(np.reshape(_pack(self._matrices).packed, (2, 3, 4, -1)),
+                    os.path.join(self._tmp_dir, 'covariances.nii.gz'))
+        write_covariances_order(self._tmp_dir, _param_names)
+        self._assert_loads_matrices()
+
+    def test_per_pair_subdirectory(self):
+        for x, y in [(0, 1), (0, 2), (1, 2)]:
+            write_nifti(np.reshape(self._matrices[:, x, y], (2, 3, 4)), os.path.join(
+                self._tmp_dir, 'covariances', '{}_to_{}.nii.gz'.format(_param_names[x], _param_names[y])))
+        self._assert_loads_matrices()
+
+    def test_per_pair_maps(self):
+        for x, y in [(0, 1), (0, 2), (1, 2)]:
+            write_nifti(np.reshape(self._matrices[:, x, y], (2, 3, 4)), os.path.join(
+                self._tmp_dir, 'Covariance_{}_to_{}.nii.gz'.format(_param_names[x], _param_names[y])))
+        self._assert_loads_matrices()
+
+    def test_missing(self):
+        with self.assertRaises(ValueError):
+            load_covariances(self._tmp_dir)
+
+    def _assert_loads_matrices(self):
+        covariances = load_covariances(self._tmp_dir)
+        self.assertEqual(covariances.param_names, _param_names)
+        assert_allclose(np.reshape(covariances.get_matrix(), (24, 3, 3)), self._matrices, rtol=1e-6)
+
+        covariances = load_covariances(self._tmp_dir, brain_mask=self._mask)
+        assert_allclose(covariances.get_matrix(), self._matrices[self._mask.ravel()], rtol=1e-6)
+
+
+def _get_covariance_matrices(rng, nmr_voxels):
+    """Random symmetric positive definite matrices, one per voxel."""
+    factors = rng.normal(size=(nmr_voxels, 3, 3))
+    return np.einsum('nij,nkj->nik', factors, factors) + 0.1 * np.eye(3)
+
+
+def _pack(matrices):
+    rows, columns = np.triu_indices(matrices.shape[1])
+    return PackedCovariances(matrices[:, rows, columns], _param_names)
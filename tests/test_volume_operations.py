@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_volume_operations
+----------------------------------
+
+Tests for the streamed volume merging and volume extraction, comparing against the results computed in memory.
+"""
+import functools
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import nibabel as nib
+import numpy as np
+from numpy.testing import assert_array_equal, assert_allclose
+
+import mdt
+import mdt.utils
+from mdt.lib.nifti import write_nifti, load_nifti
+from mdt.protocols import Protocol, write_protocol, load_protocol
+
+
+class VolumeMergeTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_volume_operations_test')
+        rng = np.random.RandomState(0)
+
+        self._volumes = [rng.uniform(0, 100, (5, 4, 3, 4)), rng.uniform(0, 100, (5, 4, 3, 2)),
+                         rng.uniform(0, 100, (5, 4, 3, 3))]
+        self._volume_paths = []
+        self._protocol_paths = []
+        for ind, (volume, extension) in enumerate(zip(self._volumes, ['.nii.gz', '.nii', '.nii.gz'])):
+            self._volume_paths.append(os.path.join(self._tmp_dir, 'volume_{}{}'.format(10 - ind, extension)))
+            write_nifti(volume, self._volume_paths[-1])
+
+            nmr_volumes = volume.shape[3]
+            self._protocol_paths.append(os.path.join(self._tmp_dir, 'volume_{}.prtcl'.format(10 - ind)))
+            write_protocol(Protocol({'b': np.full(nmr_volumes, ind * 1e9), 'g': np.tile([1., 0, 0], (nmr_volumes, 1))}),
+                           self._protocol_paths[-1])
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_equals_in_memory(self):
+        volume3d = np.random.RandomState(1).uniform(0, 100, (5, 4, 3))
+        volume_paths = self._volume_paths + [os.path.join(self._tmp_dir, 'volume3d.nii')]
+        write_nifti(volume3d, volume_paths[-1])
+
+        expected = np.concatenate(self._volumes + [volume3d[..., None]], axis=3)
+
+        for extension in ['.nii', '.nii.gz']:
+            for max_block_size in [1, 2 ** 28]:
+                with self.subTest(extension=extension, max_block_size=max_block_size):
+                    output_fname = os.path.join(self._tmp_dir, 'merged' + extension)
+                    with _max_block_size(max_block_size):
+                        mdt.volume_merge(volume_paths, output_fname, nmr_threads=2)
+
+                    merged = load_nifti(output_fname)
+                    self.assertEqual(merged.header.get_data_dtype(), np.float64)
+                    assert_array_equal(merged.get_data(), expected)
+
+    def test_sort_with_protocols(self):
+        volume_paths = list(self._volume_paths)
+        protocol_paths = list(self._protocol_paths)
+        output_fname = os.path.join(self._tmp_dir, 'merged.nii.gz')
+        output_protocol_fname = os.path.join(self._tmp_dir, 'merged.prtcl')
+
+        order = mdt.volume_merge(volume_paths, output_fname, sort=True, protocol_paths=protocol_paths,
+                                 output_protocol_fname=output_protocol_fname)
+
+        self.assertEqual(order, self._volume_paths[::-1])
+        self.assertEqual(volume_paths, self._volume_paths)
+        self.assertEqual(protocol_paths, self._protocol_paths)
+
+        expected = np.concatenate(self._volumes[::-1], axis=3)
+        assert_array_equal(load_nifti(output_fname).get_data(), expected)
+        assert_array_equal(load_protocol(output_protocol_fname).get_column('b').ravel(),
+                           np.r_[np.full(3, 2e9), np.full(2, 1e9), np.zeros(4)])
+
+    def test_protocol_length_mismatch(self):
+        output_fname = os.path.join(self._tmp_dir, 'merged.nii.gz')
+        with self.assertRaises(ValueError):
+            mdt.volume_merge(self._volume_paths, output_fname, protocol_paths=self._protocol_paths[::-1],
+                             output_protocol_fname=os.path.join(self._tmp_dir, 'merged.prtcl'))
+
+    def test_scaled_data(self):
+        image = nib.Nifti1Image(np.arange(5 * 4 * 3 * 2, dtype=np.int16).reshape((5, 4, 3, 2)), np.eye(4))
+        image.header.set_slope_inter(0.5, 10)
+        scaled_fname = os.path.join(self._tmp_dir, 'scaled.nii.gz')
+        nib.save(image, scaled_fname)
+
+        output_fname = os.path.join(self._tmp_dir, 'merged.nii.gz')
+        mdt.volume_merge([scaled_fname, self._volume_paths[0]], output_fname)
+        assert_allclose(load_nifti(output_fname).get_data(),
+                        np.concatenate([load_nifti(scaled_fname).get_data(), self._volumes[0]], axis=3))
+
+
+class ExtractVolumesTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_volume_operations_test')
+        self._volume = np.random.RandomState(0).uniform(0, 100, (5, 4, 3, 8)).astype(np.float32)
+        self._protocol = Protocol({'b': np.arange(8) * 1e8, 'g': np.tile([0, 1., 0], (8, 1))})
+
+        self._volume_fname = os.path.join(self._tmp_dir, 'dwi.nii.gz')
+        write_nifti(self._volume, self._volume_fname)
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_equals_in_memory(self):
+        output_protocol = os.path.join(self._tmp_dir, 'out.prtcl')
+
+        for volume_indices in [[1, 2, 3], [7, 0, 4, 4], [6, 5]]:
+            for max_block_size in [1, 2 ** 28]:
+                with self.subTest(volume_indices=volume_indices, max_block_size=max_block_size):
+                    output_fname = os.path.join(self._tmp_dir, 'out.nii.gz')
+                    with _max_block_size(max_block_size):
+                        mdt.extract_volumes(self._volume_fname, self._protocol, output_fname, output_protocol,
+                                            volume_indices, nmr_threads=2)
+
+                    extracted = load_nifti(output_fname)
+                    self.assertEqual(extracted.header.get_data_dtype(), np.float32)
+                    assert_array_equal(extracted.get_data(), self._volume[..., volume_indices])
+                    assert_array_equal(load_protocol(output_protocol).get_column('b').ravel(),
+                                       self._protocol.get_column('b').ravel()[volume_indices])
+
+    def test_protocol_length_mismatch(self):
+        output_protocol = os.path.join(self._tmp_dir, 'out.prtcl')
+        with self.assertRaises(ValueError):
+            mdt.extract_volumes(self._volume_fname, self._protocol.get_new_protocol_with_indices([0, 1]),
+                                os.path.join(self._tmp_dir, 'out.nii.gz'), output_protocol, [0])
+        self.assertFalse(os.path.exists(output_protocol))
+
+
+def _max_block_size(max_block_size):
+    """Limit the number of bytes copied at once by the volume operations."""
+    return mock.patch('mdt.utils._copy_nifti_volumes',
+                      functools.partial(mdt.utils._copy_nifti_volumes, max_block_size=max_block_size))